@@ -0,0 +1,319 @@
+"""
+Generate the synthetic benchmark corpus in benchmarks/corpus
+
+The corpus is checked in; this script documents how it was made and regenerates it
+byte for byte (the random generator is seeded). Every paper exists in each format:
+
+    jats/<id>.nxml      JATS XML, as from PMC
+    tei/<id>.tei.xml    GROBID fulltext TEI, also served by the mocked GROBID for pdf input
+    xml/<id>.xml        tralics XML, the input of the LaTeX xml -> S2ORC step
+    tex/<id>.tar.gz     LaTeX sources, only benchmarked when tralics and latexpand exist
+
+Papers grow in size so the per-paper latency percentiles mean something.
+"""
+
+import io
+import os
+import gzip
+import random
+import tarfile
+import argparse
+from xml.sax.saxutils import escape
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+SEED = 2024
+PAPER_SIZES = [(3, 3, 8), (4, 4, 12), (5, 5, 20), (6, 6, 25), (8, 6, 30), (10, 8, 40), (12, 8, 50), (15, 10, 60)]
+
+WORDS = (
+    "model data method result analysis network learning system protein cell gene expression "
+    "sample measure effect training error signal image structure function process energy "
+    "distribution parameter estimate observation response control performance approach study "
+    "significant increase reduce compare propose evaluate observe derive improve obtain show "
+    "large small high low novel robust efficient linear nonlinear spatial temporal average"
+).split()
+SURNAMES = "Smith Chen Garcia Müller Kumar Rossi Tanaka Silva Novak Ivanova Dubois Kowalski".split()
+FORENAMES = "Anna Wei Carlos Jonas Priya Marco Yuki Ana Petr Olga Claire Piotr".split()
+
+
+def sentence(rng, n_min=8, n_max=20):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(n_min, n_max))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraph(rng, n_sentences=4):
+    return ' '.join(sentence(rng) for _ in range(n_sentences))
+
+
+def make_paper(rng, index, n_sections, n_paragraphs, n_refs):
+    paper = {
+        "id": f'bench{index:02d}',
+        "title": sentence(rng, 6, 12)[:-1],
+        "authors": [(rng.choice(FORENAMES), rng.choice(SURNAMES)) for _ in range(rng.randint(2, 6))],
+        "abstract": [paragraph(rng, 5)],
+        "sections": [],
+        "figures": [sentence(rng) for _ in range(rng.randint(1, 4))],
+        "tables": [[[str(rng.randint(0, 999)) for _ in range(4)] for _ in range(5)] for _ in range(rng.randint(1, 3))],
+        "equations": [f'x_{i} = \\alpha_{i} + \\beta y_{i}^2' for i in range(rng.randint(1, 5))],
+        "refs": [],
+    }
+    for s in range(n_sections):
+        paras = []
+        for p in range(rng.randint(max(1, n_paragraphs // 2), n_paragraphs)):
+            # a few citations and cross references per paragraph
+            cites = [rng.randrange(n_refs) for _ in range(rng.randint(0, 3))]
+            fig = rng.randrange(len(paper["figures"])) if rng.random() < 0.2 else None
+            tab = rng.randrange(len(paper["tables"])) if rng.random() < 0.1 else None
+            eq = rng.randrange(len(paper["equations"])) if rng.random() < 0.15 else None
+            paras.append({"text": paragraph(rng, rng.randint(2, 6)), "cites": cites, "fig": fig, "tab": tab, "eq": eq})
+        paper["sections"].append({"title": sentence(rng, 2, 4)[:-1], "paragraphs": paras})
+    for r in range(n_refs):
+        paper["refs"].append({
+            "authors": [(rng.choice(FORENAMES), rng.choice(SURNAMES)) for _ in range(rng.randint(1, 4))],
+            "title": sentence(rng, 5, 12)[:-1],
+            "venue": f'Journal of {rng.choice(WORDS).capitalize()} {rng.choice(WORDS).capitalize()}',
+            "year": str(rng.randint(1980, 2023)),
+            "volume": str(rng.randint(1, 80)),
+            "pages": f'{rng.randint(1, 400)}-{rng.randint(401, 900)}',
+        })
+    return paper
+
+
+def ref_string(ref):
+    authors = ', '.join(f'{first[0]}. {last}' for first, last in ref["authors"])
+    return f'{authors}. {ref["title"]}. {ref["venue"]}, {ref["volume"]}:{ref["pages"]}, {ref["year"]}.'
+
+
+# JATS
+
+def jats_paragraph(para):
+    text = escape(para["text"])
+    for c in para["cites"]:
+        text += f' <xref ref-type="bibr" rid="ref{c}">{c + 1}</xref>'
+    if para["fig"] is not None:
+        text += f' See <xref ref-type="fig" rid="fig{para["fig"]}">Figure {para["fig"] + 1}</xref>.'
+    if para["tab"] is not None:
+        text += f' See <xref ref-type="table" rid="tab{para["tab"]}">Table {para["tab"] + 1}</xref>.'
+    return f'<p>{text}</p>'
+
+
+def make_jats(paper):
+    contribs = ''.join(
+        f'<contrib contrib-type="author"><name><surname>{escape(last)}</surname><given-names>{escape(first)}</given-names></name></contrib>'
+        for first, last in paper["authors"]
+    )
+    sections = ''.join(
+        f'<sec id="sec{i}"><title>{escape(sec["title"])}</title>{"".join(jats_paragraph(p) for p in sec["paragraphs"])}</sec>'
+        for i, sec in enumerate(paper["sections"])
+    )
+    figures = ''.join(
+        f'<fig id="fig{i}"><label>Figure {i + 1}</label><caption><p>{escape(caption)}</p></caption></fig>'
+        for i, caption in enumerate(paper["figures"])
+    )
+    tables = ''.join(
+        f'<table-wrap id="tab{i}"><label>Table {i + 1}</label><caption><p>Table {i + 1} values.</p></caption>'
+        f'<table><tbody>{"".join("<tr>" + "".join(f"<td>{c}</td>" for c in row) + "</tr>" for row in table)}</tbody></table></table-wrap>'
+        for i, table in enumerate(paper["tables"])
+    )
+    refs = ''.join(
+        f'<ref id="ref{i}"><label>{i + 1}</label><element-citation publication-type="journal"><person-group person-group-type="author">'
+        + ''.join(f'<name><surname>{escape(last)}</surname><given-names>{first[0]}</given-names></name>' for first, last in ref["authors"])
+        + f'</person-group><article-title>{escape(ref["title"])}</article-title><source>{escape(ref["venue"])}</source>'
+        f'<year>{ref["year"]}</year><volume>{ref["volume"]}</volume><fpage>{ref["pages"].split("-")[0]}</fpage>'
+        f'<lpage>{ref["pages"].split("-")[1]}</lpage></element-citation></ref>'
+        for i, ref in enumerate(paper["refs"])
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<article article-type="research-article"><front>'
+        '<journal-meta><journal-title-group><journal-title>Journal of Benchmarks</journal-title></journal-title-group></journal-meta>'
+        f'<article-meta><article-id pub-id-type="pmc">{paper["id"]}</article-id>'
+        f'<article-id pub-id-type="doi">10.0000/{paper["id"]}</article-id>'
+        f'<title-group><article-title>{escape(paper["title"])}</article-title></title-group>'
+        f'<contrib-group>{contribs}</contrib-group>'
+        '<pub-date pub-type="epub"><year>2020</year></pub-date>'
+        f'<abstract>{"".join(f"<p>{escape(p)}</p>" for p in paper["abstract"])}</abstract>'
+        f'</article-meta></front><body>{sections}{figures}{tables}</body>'
+        f'<back><ref-list>{refs}</ref-list></back></article>\n'
+    )
+
+
+# GROBID TEI
+
+def tei_pers_name(first, last):
+    return f'<persName><forename type="first">{escape(first)}</forename><surname>{escape(last)}</surname></persName>'
+
+
+def tei_bibl_struct(ref, xml_id=None):
+    authors = ''.join(f'<author>{tei_pers_name(first, last)}</author>' for first, last in ref["authors"])
+    first_page, last_page = ref["pages"].split('-')
+    id_attr = f' xml:id="{xml_id}"' if xml_id else ''
+    return (
+        f'<biblStruct{id_attr}><analytic><title level="a" type="main">{escape(ref["title"])}</title>{authors}</analytic>'
+        f'<monogr><title level="j">{escape(ref["venue"])}</title><imprint><biblScope unit="volume">{ref["volume"]}</biblScope>'
+        f'<biblScope unit="page" from="{first_page}" to="{last_page}"/><date type="published" when="{ref["year"]}"/></imprint></monogr>'
+        f'<note type="raw_reference">{escape(ref_string(ref))}</note></biblStruct>'
+    )
+
+
+def tei_paragraph(para):
+    text = escape(para["text"])
+    for c in para["cites"]:
+        text += f' <ref type="bibr" target="#b{c}">[{c + 1}]</ref>'
+    if para["fig"] is not None:
+        text += f' See <ref type="figure" target="#fig_{para["fig"]}">Figure {para["fig"] + 1}</ref>.'
+    if para["tab"] is not None:
+        text += f' See <ref type="table" target="#tab_{para["tab"]}">Table {para["tab"] + 1}</ref>.'
+    return f'<p>{text}</p>'
+
+
+def make_tei(paper):
+    authors = ''.join(f'<author>{tei_pers_name(first, last)}</author>' for first, last in paper["authors"])
+    body = ''.join(
+        f'<div><head n="{i + 1}">{escape(sec["title"])}</head>{"".join(tei_paragraph(p) for p in sec["paragraphs"])}</div>'
+        for i, sec in enumerate(paper["sections"])
+    )
+    figures = ''.join(
+        f'<figure xml:id="fig_{i}"><head>Figure {i + 1}</head><label>{i + 1}</label><figDesc>{escape(caption)}</figDesc></figure>'
+        for i, caption in enumerate(paper["figures"])
+    )
+    tables = ''.join(
+        f'<figure type="table" xml:id="tab_{i}"><head>Table {i + 1}</head><label>{i + 1}</label><figDesc>Table {i + 1} values.</figDesc>'
+        f'<table>{"".join("<row>" + "".join(f"<cell>{c}</cell>" for c in row) + "</row>" for row in table)}</table></figure>'
+        for i, table in enumerate(paper["tables"])
+    )
+    bibl = ''.join(tei_bibl_struct(ref, f'b{i}') for i, ref in enumerate(paper["refs"]))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader><fileDesc>'
+        f'<titleStmt><title level="a" type="main">{escape(paper["title"])}</title></titleStmt>'
+        '<publicationStmt><publisher/><availability status="unknown"><licence/></availability></publicationStmt>'
+        f'<sourceDesc><biblStruct><analytic>{authors}<title level="a" type="main">{escape(paper["title"])}</title></analytic>'
+        '<monogr><imprint><date/></imprint></monogr></biblStruct></sourceDesc></fileDesc>'
+        f'<profileDesc><abstract>{"".join(f"<div><p>{escape(p)}</p></div>" for p in paper["abstract"])}</abstract></profileDesc>'
+        f'</teiHeader><text><body>{body}{figures}{tables}</body>'
+        f'<back><div type="references"><listBibl>{bibl}</listBibl></div></back></text></TEI>\n'
+    )
+
+
+# tralics XML
+
+def tralics_paragraph(para, paper):
+    text = escape(para["text"])
+    for c in para["cites"]:
+        text += f' <cit><ref target="bid{c}"/></cit>'
+    if para["fig"] is not None:
+        text += f' See Figure <ref target="uid{100 + para["fig"]}"/>.'
+    if para["tab"] is not None:
+        text += f' See Table <ref target="uid{200 + para["tab"]}"/>.'
+    if para["eq"] is not None:
+        text += f' Using <ref target="uid{300 + para["eq"]}"/> and <formula type="inline"><math><mi>x</mi></math><texmath>x</texmath></formula>.'
+    return f'<p>{text}</p>'
+
+
+def make_tralics_xml(paper):
+    authors = ', '.join(f'{first} {last}' for first, last in paper["authors"])
+    sections = []
+    for i, sec in enumerate(paper["sections"]):
+        paras = ''.join(tralics_paragraph(p, paper) for p in sec["paragraphs"])
+        if i == 0:
+            paras += ''.join(
+                f'<formula id-text="{j + 1}" id="uid{300 + j}" type="display"><math><mi>x</mi></math>'
+                f'<texmath>{escape(eq)}</texmath></formula>'
+                for j, eq in enumerate(paper["equations"])
+            )
+            paras += f'<p>{escape(sentence(random.Random(i)))}<note id-text="1" id="uid400" place="foot">{escape(sentence(random.Random(i + 1)))}</note></p>'
+        sections.append(f'<div0 id-text="{i + 1}" id="cid{i + 1}"><head>{escape(sec["title"])}</head>{paras}</div0>')
+    figures = ''.join(
+        f'<float name="figure" id-text="{i + 1}" id="uid{100 + i}"><figure file="figures/fig{i}" extension="pdf"/>'
+        f'<caption>{escape(caption)}</caption></float>'
+        for i, caption in enumerate(paper["figures"])
+    )
+    tables = ''.join(
+        f'<float name="table" id-text="{i + 1}" id="uid{200 + i}"><caption>Table {i + 1} values.</caption><table rend="display">'
+        + ''.join('<row>' + ''.join(f'<cell halign="center">{c}</cell>' for c in row) + '</row>' for row in table)
+        + '</table></float>'
+        for i, table in enumerate(paper["tables"])
+    )
+    bib = ''.join(
+        f'<p noindent="true"><bibitem id="bid{i}"/>{escape(ref_string(ref))}</p>'
+        for i, ref in enumerate(paper["refs"])
+    )
+    return (
+        "<?xml version='1.0' encoding='UTF-8'?>\n"
+        '<!DOCTYPE std PUBLIC "-//INRIA//DTD std V1.0//EN" "std.dtd">\n'
+        f'<std><maketitle><title>{escape(paper["title"])}</title><author>{escape(authors)}</author></maketitle>'
+        f'<abstract>{"".join(f"<p>{escape(p)}</p>" for p in paper["abstract"])}</abstract>'
+        f'{"".join(sections)}{figures}{tables}'
+        f'<bibliography>{bib}</bibliography></std>\n'
+    )
+
+
+# LaTeX sources
+
+def make_latex(paper):
+    lines = [
+        '\\documentclass{article}', '\\usepackage{graphicx}', '\\usepackage{amsmath}',
+        f'\\title{{{paper["title"]}}}', f'\\author{{{", ".join(f"{f} {l}" for f, l in paper["authors"])}}}',
+        '\\begin{document}', '\\maketitle', '\\begin{abstract}', *paper["abstract"], '\\end{abstract}',
+    ]
+    for i, sec in enumerate(paper["sections"]):
+        lines.append(f'\\section{{{sec["title"]}}}\\label{{sec:{i}}}')
+        if i == 0:
+            lines += [f'\\begin{{equation}}\\label{{eq:{j}}}\n{eq}\n\\end{{equation}}' for j, eq in enumerate(paper["equations"])]
+        for para in sec["paragraphs"]:
+            text = para["text"]
+            if para["cites"]:
+                text += ' \\cite{' + ','.join(f'ref{c}' for c in para["cites"]) + '}'
+            if para["fig"] is not None:
+                text += f' See Figure~\\ref{{fig:{para["fig"]}}}.'
+            if para["tab"] is not None:
+                text += f' See Table~\\ref{{tab:{para["tab"]}}}.'
+            if para["eq"] is not None:
+                text += f' Using \\eqref{{eq:{para["eq"]}}}.'
+            lines += ['', text]
+    for i, caption in enumerate(paper["figures"]):
+        lines.append(f'\\begin{{figure}}\\includegraphics{{figures/fig{i}.pdf}}\\caption{{{caption}}}\\label{{fig:{i}}}\\end{{figure}}')
+    for i, table in enumerate(paper["tables"]):
+        rows = ' \\\\\n'.join(' & '.join(row) for row in table)
+        lines.append(f'\\begin{{table}}\\caption{{Table {i + 1} values.}}\\label{{tab:{i}}}\\begin{{tabular}}{{cccc}}\n{rows}\n\\end{{tabular}}\\end{{table}}')
+    lines.append('\\begin{thebibliography}{99}')
+    lines += [f'\\bibitem{{ref{i}}} {ref_string(ref)}' for i, ref in enumerate(paper["refs"])]
+    lines += ['\\end{thebibliography}', '\\end{document}', '']
+    return '\n'.join(lines)
+
+
+def make_tex_archive(paper) -> bytes:
+    # fixed mtimes and no gzip timestamp, so the archive is reproducible
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+            source = make_latex(paper).encode()
+            info = tarfile.TarInfo(f'{paper["id"]}.tex')
+            info.size = len(source)
+            tar.addfile(info, io.BytesIO(source))
+    return buffer.getvalue()
+
+
+def write_corpus(output_dir: str = CORPUS_DIR):
+    rng = random.Random(SEED)
+    for fmt in ('jats', 'tei', 'xml', 'tex'):
+        os.makedirs(os.path.join(output_dir, fmt), exist_ok=True)
+    for index, (n_sections, n_paragraphs, n_refs) in enumerate(PAPER_SIZES):
+        paper = make_paper(rng, index, n_sections, n_paragraphs, n_refs)
+        with open(os.path.join(output_dir, 'jats', f'{paper["id"]}.nxml'), 'w', encoding='utf-8') as f:
+            f.write(make_jats(paper))
+        with open(os.path.join(output_dir, 'tei', f'{paper["id"]}.tei.xml'), 'w', encoding='utf-8') as f:
+            f.write(make_tei(paper))
+        with open(os.path.join(output_dir, 'xml', f'{paper["id"]}.xml'), 'w', encoding='utf-8') as f:
+            f.write(make_tralics_xml(paper))
+        with open(os.path.join(output_dir, 'tex', f'{paper["id"]}.tar.gz'), 'wb') as f:
+            f.write(make_tex_archive(paper))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate the benchmark corpus")
+    parser.add_argument("-o", "--output", default=CORPUS_DIR, help="corpus directory")
+    args = parser.parse_args()
+    write_corpus(args.output)
+    print('done.')
@@ -0,0 +1,68 @@
+"""
+In-process stand-in for GROBID, used by the benchmarks
+
+GrobidClient.post is replaced, so the client code (and its `grobid` stage timing) still
+runs without the HTTP round trip of the mock GROBID server, whose responses are reused:
+fulltext requests are answered with the corpus TEI file of the same name, citations and
+author names are turned into TEI with a few rules.
+"""
+
+import time
+import contextlib
+from typing import Optional
+from unittest import mock
+
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient
+from doc2json.grobid2json.grobid.mock_server import SERVICES, citation_tei, citation_list_tei, header_names_tei, \
+    affiliation_tei, fulltext_tei
+
+
+class MockResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.content = text.encode()
+
+
+class MockGrobid:
+    """
+    Canned GROBID responses, optionally after a fixed latency per request
+    """
+    def __init__(self, tei_dir: Optional[str] = None, latency: float = 0.0):
+        self.tei_dir = tei_dir
+        self.latency = latency
+        self.requests = 0
+
+    def post(self, client, url, data=None, files=None, **kwargs):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        service = url.rsplit('/', 1)[-1]
+        data = data or {}
+        if service == 'processCitation':
+            return MockResponse(citation_tei(data['citations'])), 200
+        if service == 'processCitationList':
+            return MockResponse(citation_list_tei(data['citations'])), 200
+        if service == 'processHeaderNames':
+            return MockResponse(header_names_tei(data['names'])), 200
+        if service == 'processAffiliations':
+            return MockResponse(affiliation_tei(data['affiliations'])), 200
+        if service in SERVICES:
+            return MockResponse(fulltext_tei(files['input'][0], self.tei_dir)), 200
+        return MockResponse(''), 404
+
+
+@contextlib.contextmanager
+def mock_grobid(tei_dir: Optional[str] = None, latency: float = 0.0):
+    """
+    Answer all GrobidClient requests from a MockGrobid while in the block
+    :param tei_dir: directory of <name>.tei.xml files for fulltext requests of <name>.pdf
+    :param latency: seconds added to every request
+    :return: the MockGrobid, which counts requests
+    """
+    grobid = MockGrobid(tei_dir, latency)
+
+    def post(client, url, params=None, data=None, files=None, **kwargs):
+        return grobid.post(client, url, data=data, files=files, **kwargs)
+
+    with mock.patch.object(GrobidClient, 'post', post):
+        yield grobid
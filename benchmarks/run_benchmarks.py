@@ -0,0 +1,291 @@
+"""
+Benchmark the converters over the checked-in corpus
+
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py -o new.json --compare results.json
+
+Cases:
+    jats    JATS nxml -> S2ORC json (process_jats_file)
+    tei     GROBID TEI -> S2ORC json
+    pdf     pdf -> S2ORC json through GrobidClient (process_pdf_stream), GROBID mocked
+    xml     tralics XML -> S2ORC json, GROBID mocked for citations and author names
+    tex     LaTeX archive -> S2ORC json (process_tex_file), GROBID mocked; needs tralics and latexpand
+
+Each case runs in a fresh process, so peak RSS is not inherited from another case. A case
+reports papers/s, p50 / p95 per-paper latency and peak RSS, and for every stage and converter
+step its p50 / p95 duration per paper and the largest RSS seen when it ended.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import warnings
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from typing import Dict, List
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BENCHMARK_DIR))
+
+from doc2json.utils.instrument_util import Sink, add_sink, close_sinks, instrument_paper, stage
+from doc2json.utils.memory_util import get_rss, get_peak_rss
+
+
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, 'corpus')
+CASES = ('jats', 'tei', 'pdf', 'xml', 'tex')
+
+
+def current_rss_mb() -> float:
+    return (get_rss() or 0) / (1 << 20)
+
+
+def peak_rss_mb() -> float:
+    return get_peak_rss() / (1 << 20)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Linearly interpolated percentile
+    :param values:
+    :param q: between 0 and 100
+    :return:
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class CollectingSink(Sink):
+    """
+    Keeps the spans of every paper, and the RSS when each stage ended
+    """
+    def __init__(self):
+        self.papers = []
+        self.rss_mb = {}
+
+    def span(self, name, seconds, paper_id):
+        self.rss_mb[name] = max(self.rss_mb.get(name, 0.0), current_rss_mb())
+
+    def paper_done(self, paper_id, spans, counts):
+        self.papers.append(dict(spans))
+
+
+def get_inputs(case: str, corpus_dir: str) -> List[str]:
+    pattern = {
+        'jats': 'jats/*.nxml', 'tei': 'tei/*.tei.xml', 'pdf': 'tei/*.tei.xml', 'xml': 'xml/*.xml', 'tex': 'tex/*.tar.gz'
+    }[case]
+    return sorted(glob(os.path.join(corpus_dir, pattern)))
+
+
+def get_converter(case: str, corpus_dir: str, work_dir: str):
+    """
+    Function converting one input file of a case
+    """
+    output_dir = os.path.join(work_dir, 'output')
+    log_dir = os.path.join(work_dir, 'log')
+    os.makedirs(log_dir, exist_ok=True)
+
+    def fresh_output(process_file):
+        # the CLI functions warn when they overwrite an earlier output
+        def convert(input_file, *args):
+            shutil.rmtree(output_dir, ignore_errors=True)
+            return process_file(input_file, *args)
+        return convert
+
+    if case == 'jats':
+        from doc2json.jats2json.process_jats import process_jats_file
+        return lambda input_file: fresh_output(process_jats_file)(input_file, output_dir, log_dir)
+
+    if case == 'tei':
+        from doc2json.grobid2json.tei_to_json import convert_tei_xml_file_to_s2orc_json
+
+        def convert(input_file):
+            paper_id = os.path.basename(input_file).split('.')[0]
+            with instrument_paper(paper_id):
+                with stage('soup_conversion'):
+                    paper = convert_tei_xml_file_to_s2orc_json(input_file)
+                with stage('serialise'):
+                    return json.dumps(paper.release_json())
+        return convert
+
+    if case == 'pdf':
+        from doc2json.grobid2json.process_pdf import process_pdf_stream
+
+        def convert(input_file):
+            pdf_file = os.path.basename(input_file).split('.')[0] + '.pdf'
+            return process_pdf_stream(pdf_file, '0' * 40, b'%PDF-1.4 benchmark')
+        return convert
+
+    if case == 'xml':
+        from doc2json.tex2json.xml_to_json import convert_latex_xml_to_s2orc_json
+
+        def convert(input_file):
+            paper_id = os.path.basename(input_file).split('.')[0]
+            with instrument_paper(paper_id):
+                with stage('soup_conversion'):
+                    paper = convert_latex_xml_to_s2orc_json(input_file, log_dir)
+                with stage('serialise'):
+                    return json.dumps(paper.release_json("latex"))
+        return convert
+
+    if case == 'tex':
+        from doc2json.tex2json.process_tex import process_tex_file
+        return lambda input_file: fresh_output(process_tex_file)(
+            input_file, os.path.join(work_dir, 'temp'), output_dir, log_dir
+        )
+
+    raise ValueError(f'Unknown case {case}')
+
+
+def run_case(case: str, corpus_dir: str = CORPUS_DIR, repeat: int = 3, warmup: int = 1, grobid_latency: float = 0.0) -> Dict:
+    """
+    Run one case over the corpus, in the current process
+    :param case:
+    :param corpus_dir:
+    :param repeat: timed passes over the corpus
+    :param warmup: untimed passes first (imports, caches)
+    :param grobid_latency: seconds added to every mocked GROBID request
+    :return: results of the case
+    """
+    sys.path.append(BENCHMARK_DIR)
+    from mock_grobid import mock_grobid
+
+    if case == 'tex' and not (shutil.which('tralics') and shutil.which('latexpand')):
+        return {"skipped": "tralics or latexpand not found"}
+    inputs = get_inputs(case, corpus_dir)
+    if not inputs:
+        return {"skipped": f"no inputs in {corpus_dir}"}
+
+    # bs4 warns about parsing XML with the lxml HTML parser, once per file
+    warnings.simplefilter('ignore')
+    work_dir = tempfile.mkdtemp(prefix=f'bench-{case}-')
+    sink = CollectingSink()
+    latencies = []
+    try:
+        with mock_grobid(os.path.join(corpus_dir, 'tei'), grobid_latency) as grobid:
+            convert = get_converter(case, corpus_dir, work_dir)
+            for _ in range(warmup):
+                for input_file in inputs:
+                    convert(input_file)
+            add_sink(sink)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for input_file in inputs:
+                    paper_start = time.perf_counter()
+                    convert(input_file)
+                    latencies.append(time.perf_counter() - paper_start)
+            total = time.perf_counter() - start
+    finally:
+        close_sinks()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    stage_names = sorted({name for spans in sink.papers for name in spans})
+    stages = {}
+    for name in stage_names:
+        durations = [spans.get(name, 0.0) for spans in sink.papers]
+        stages[name] = {
+            "p50": percentile(durations, 50),
+            "p95": percentile(durations, 95),
+            "total": sum(durations),
+            "rss_mb": round(sink.rss_mb.get(name, 0.0), 1)
+        }
+    return {
+        "papers": len(latencies),
+        "seconds": total,
+        "papers_per_s": len(latencies) / total if total else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "grobid_requests": grobid.requests,
+        "stages": stages,
+    }
+
+
+def get_metadata(args) -> Dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "warmup": args.warmup,
+        "grobid_latency": args.grobid_latency,
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def format_results(results: Dict, baseline: Dict = None) -> str:
+    """
+    Human readable table, with the change against a baseline run if given
+    """
+    def change(case, key, value):
+        old = ((baseline or {}).get("cases", {}).get(case) or {}).get(key)
+        if not old:
+            return ''
+        return f' ({(value - old) / old * 100:+.1f}%)'
+
+    lines = []
+    for case, result in results["cases"].items():
+        if "skipped" in result:
+            lines.append(f'{case}: skipped, {result["skipped"]}')
+            continue
+        lines.append(
+            f'{case}: {result["papers_per_s"]:.2f} papers/s{change(case, "papers_per_s", result["papers_per_s"])}, '
+            f'p50 {result["latency_p50"] * 1000:.1f} ms{change(case, "latency_p50", result["latency_p50"])}, '
+            f'p95 {result["latency_p95"] * 1000:.1f} ms{change(case, "latency_p95", result["latency_p95"])}, '
+            f'peak RSS {result["peak_rss_mb"]:.1f} MB{change(case, "peak_rss_mb", result["peak_rss_mb"])}'
+        )
+        for name, timing in sorted(result["stages"].items(), key=lambda item: -item[1]["total"]):
+            lines.append(
+                f'    {name:<16} p50 {timing["p50"] * 1000:8.2f} ms  p95 {timing["p95"] * 1000:8.2f} ms  '
+                f'RSS {timing["rss_mb"]:.1f} MB'
+            )
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the TEX, TEI and JATS converters")
+    parser.add_argument("--cases", nargs='+', default=list(CASES), choices=CASES, help="cases to run")
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="corpus directory")
+    parser.add_argument("--repeat", default=3, type=int, help="timed passes over the corpus")
+    parser.add_argument("--warmup", default=1, type=int, help="untimed passes over the corpus first")
+    parser.add_argument("--grobid_latency", default=0.0, type=float, help="seconds added to each mocked GROBID request")
+    parser.add_argument("-o", "--output", default=None, help="write results to this json file")
+    parser.add_argument("--compare", default=None, help="json results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    results = {"meta": get_metadata(args), "cases": {}}
+    # a fresh process per case, so peak RSS and warm caches don't carry over
+    context = multiprocessing.get_context('spawn')
+    for case in args.cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results["cases"][case] = executor.submit(
+                run_case, case, args.corpus, args.repeat, args.warmup, args.grobid_latency
+            ).result()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
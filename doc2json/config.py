@@ -1,2 +1,4 @@
 S2ORC_NAME_STRING = 'S2ORC'
-S2ORC_VERSION_STRING = '1.0.0'
\ No newline at end of file
+S2ORC_VERSION_STRING = '1.0.0'
+# bump when a change to the pipelines changes their output (invalidates cached results)
+PIPELINE_VERSION = '1'
@@ -1,55 +1,155 @@
 """
 Flask app for S2ORC pdf2json utility
 """
-import hashlib
-import requests
-from flask import Flask, request, jsonify, flash, url_for, redirect, render_template, send_file
-from doc2json.grobid2json.process_pdf import process_pdf_stream
-from doc2json.tex2json.process_tex import process_tex_stream
-from doc2json.jats2json.process_jats import process_jats_stream
+import os
+import time
+import shutil
+import functools
+from flask import Flask, Response, g, request, jsonify, flash, url_for, redirect, render_template, send_file
+from doc2json.flask.jobs import JobQueue, QueueFullError, get_job_kind, JOBS_DIR, JOB_WORKERS, JOB_TIMEOUT, \
+    MAX_QUEUED_JOBS, JOB_MAX_MEMORY, JOB_RETENTION
+from doc2json.flask.cache import ResultCache, get_cache_key, CACHE_DIR, CACHE_MAX_BYTES
+from doc2json.flask.uploads import UploadTooLargeError, request_dir, new_request_dir, save_stream, download_url, \
+    process_upload, UPLOAD_DIR, MAX_UPLOAD_BYTES, DOWNLOAD_TIMEOUT
+from doc2json.flask.batch import BatchError, extract_archive, find_server_files, process_batch, \
+    BATCH_WORKERS, MAX_BATCH_BYTES, MAX_BATCH_FILES, BATCH_TIMEOUT, BATCH_MAX_MEMORY, BATCH_MAX_TASKS_PER_CHILD, \
+    BATCH_MAX_MEMORY_PER_CHILD, BATCH_LEDGER
+from doc2json.utils.instrument_util import REGISTRY, RegistrySink, add_sink
 
 app = Flask(__name__)
+app.config.update(
+    JOBS_DIR=JOBS_DIR,
+    JOB_WORKERS=JOB_WORKERS,
+    JOB_TIMEOUT=JOB_TIMEOUT,
+    # RSS budgets in bytes of a job process and of a batch worker, None for no limit
+    JOB_MAX_MEMORY=JOB_MAX_MEMORY,
+    MAX_QUEUED_JOBS=MAX_QUEUED_JOBS,
+    # seconds finished jobs are kept, None to keep them forever
+    JOB_RETENTION=JOB_RETENTION,
+    CACHE_DIR=CACHE_DIR,
+    CACHE_MAX_BYTES=CACHE_MAX_BYTES,
+    UPLOAD_DIR=UPLOAD_DIR,
+    MAX_UPLOAD_BYTES=MAX_UPLOAD_BYTES,
+    DOWNLOAD_TIMEOUT=DOWNLOAD_TIMEOUT,
+    BATCH_WORKERS=BATCH_WORKERS,
+    MAX_BATCH_BYTES=MAX_BATCH_BYTES,
+    MAX_BATCH_FILES=MAX_BATCH_FILES,
+    BATCH_TIMEOUT=BATCH_TIMEOUT,
+    BATCH_MAX_MEMORY=BATCH_MAX_MEMORY,
+    BATCH_MAX_TASKS_PER_CHILD=BATCH_MAX_TASKS_PER_CHILD,
+    BATCH_MAX_MEMORY_PER_CHILD=BATCH_MAX_MEMORY_PER_CHILD,
+    # outcome of every paper run by a batch, None to keep no record
+    BATCH_LEDGER=BATCH_LEDGER,
+    # directory server-side batch paths must be in, None to only accept archives
+    BATCH_ROOT=None,
+    # also time every converter step into /metrics (jobs and batches run elsewhere, only their stages are reported)
+    INSTRUMENT_SPANS=False,
+    # werkzeug rejects larger requests before parsing them; leave room for the multipart framing
+    MAX_CONTENT_LENGTH=max(MAX_UPLOAD_BYTES, MAX_BATCH_BYTES) + (1 << 20)
+)
 
 ALLOWED_EXTENSIONS = {'pdf', 'gz', 'nxml'}
 
+job_queue = None
+result_cache = None
+span_sink = None
+
+REQUESTS = REGISTRY.counter('doc2json_requests_total', 'HTTP requests by endpoint, file type and status')
+REQUEST_SECONDS = REGISTRY.histogram('doc2json_request_seconds', 'HTTP request latency by endpoint and file type')
+QUEUE_DEPTH = REGISTRY.gauge('doc2json_job_queue_depth', 'Jobs waiting to be processed')
+CACHE_ENTRIES = REGISTRY.gauge('doc2json_cache_entries', 'Results in the result cache')
+CACHE_BYTES = REGISTRY.gauge('doc2json_cache_bytes', 'Size of the result cache')
+
+
+def get_job_queue() -> JobQueue:
+    """
+    The job queue of this service process, its workers are started on first use
+    :return:
+    """
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(
+            app.config['JOBS_DIR'], app.config['JOB_WORKERS'], app.config['JOB_TIMEOUT'], app.config['MAX_QUEUED_JOBS'],
+            app.config['MAX_UPLOAD_BYTES'], app.config['JOB_MAX_MEMORY'], app.config['JOB_RETENTION']
+        )
+        job_queue.start()
+    return job_queue
+
+
+def get_result_cache() -> ResultCache:
+    """
+    The result cache, shared on disk with the other service processes
+    :return:
+    """
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache(app.config['CACHE_DIR'], app.config['CACHE_MAX_BYTES'])
+    return result_cache
+
+
+@app.before_request
+def start_timer():
+    global span_sink
+    if app.config['INSTRUMENT_SPANS'] and span_sink is None:
+        span_sink = add_sink(RegistrySink())
+    g.start_time = time.perf_counter()
+    g.kind = ''
+
+@app.after_request
+def record_request(response):
+    # for streamed responses (/batch) this is the time to the first byte
+    labels = {"endpoint": request.endpoint or 'unknown', "kind": g.get('kind', '')}
+    REQUESTS.inc(status=str(response.status_code), **labels)
+    if 'start_time' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.start_time, **labels)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    if job_queue is not None:
+        QUEUE_DEPTH.set(job_queue.queue_depth())
+    cache_stats = get_result_cache().stats()
+    CACHE_ENTRIES.set(cache_stats["entries"])
+    CACHE_BYTES.set(cache_stats["bytes"])
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def home():
     return render_template("home.html")
 
+def too_large_response(max_bytes=None):
+    return jsonify({"Error": f"File is larger than {max_bytes or app.config['MAX_UPLOAD_BYTES']} bytes!"}), 413
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return too_large_response(app.config['MAX_CONTENT_LENGTH'])
+
+
 @app.route('/', methods=['POST'])
 def upload_file():
     uploaded_file = request.files['file']
     if uploaded_file.filename != '':
-        filename = uploaded_file.filename
-        # read pdf file
-        if filename.endswith('pdf'):
-            pdf_stream = uploaded_file.stream
-            pdf_content = pdf_stream.read()
-            # compute hash
-            pdf_sha = hashlib.sha1(pdf_content).hexdigest()
-            # get results
-            results = process_pdf_stream(filename, pdf_sha, pdf_content)
-            return jsonify(results)
-        # read latex file
-        elif filename.endswith('gz'):
-            zip_stream = uploaded_file.stream
-            zip_content = zip_stream.read()
-            # get results
-            results = process_tex_stream(filename, zip_content)
-            return jsonify(results)
-        # read nxml file (jats)
-        elif filename.endswith('nxml'):
-            xml_stream = uploaded_file.stream
-            xml_content = xml_stream.read()
-            # get results
-            results = process_jats_stream(filename, xml_content)
-            return jsonify(results)
-        # unknown
-        else:
+        filename = os.path.basename(uploaded_file.filename)
+        kind = g.kind = get_job_kind(filename) or ''
+        if not kind:
             return {
                 "Error": "Unknown file type!"
             }
+        # every request works in its own directory, removed when it is done
+        with request_dir(app.config['UPLOAD_DIR']) as work_dir:
+            input_file = os.path.join(work_dir, 'input', filename)
+            # hash while copying to disk, re-uploads are answered from the cache
+            try:
+                sha = save_stream(uploaded_file.stream, input_file, app.config['MAX_UPLOAD_BYTES'])
+            except UploadTooLargeError:
+                return too_large_response()
+            cache_key = get_cache_key(sha, filename)
+            cached = get_result_cache().get(cache_key)
+            if cached is not None:
+                return Response(cached, mimetype='application/json')
+            results = process_upload(kind, filename, input_file, work_dir, sha)
+        return Response(get_result_cache().put(cache_key, results), mimetype='application/json')
 
     return redirect(url_for('index'))
 
@@ -57,12 +157,83 @@ def upload_file():
 def upload_url():
     url = request.args.get('url')
     filename = "unknown"
-    pdf_content = requests.get(url).content
-    # compute hash
-    pdf_sha = hashlib.sha1(pdf_content).hexdigest()
-    # get results
-    results = process_pdf_stream(filename, pdf_sha, pdf_content)
-    return jsonify(results)
+    g.kind = 'pdf'
+    with request_dir(app.config['UPLOAD_DIR']) as work_dir:
+        input_file = os.path.join(work_dir, 'input', filename)
+        try:
+            pdf_sha = download_url(url, input_file, app.config['MAX_UPLOAD_BYTES'], app.config['DOWNLOAD_TIMEOUT'])
+        except UploadTooLargeError:
+            return too_large_response()
+        cache_key = get_cache_key(pdf_sha, filename)
+        cached = get_result_cache().get(cache_key)
+        if cached is not None:
+            return Response(cached, mimetype='application/json')
+        # get results
+        results = process_upload('pdf', filename, input_file, work_dir, pdf_sha)
+    return Response(get_result_cache().put(cache_key, results), mimetype='application/json')
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Process a tar / zip archive uploaded as `file`, or the server-side files of a json body
+    {"paths": [...]}, streaming back one line of json per paper as soon as it is done
+    """
+    uploaded_file = request.files.get('file')
+    work_dir = new_request_dir(app.config['UPLOAD_DIR'])
+    try:
+        if uploaded_file is not None and uploaded_file.filename != '':
+            archive_file = os.path.join(work_dir, 'archive')
+            save_stream(uploaded_file.stream, archive_file, app.config['MAX_BATCH_BYTES'])
+            base_dir = os.path.join(work_dir, 'input')
+            input_files = extract_archive(archive_file, base_dir, app.config['MAX_BATCH_BYTES'])
+            os.remove(archive_file)
+        else:
+            paths = (request.get_json(silent=True) or {}).get('paths')
+            if not paths or not isinstance(paths, list):
+                raise BatchError('Upload an archive as file, or post a json list of paths')
+            base_dir = app.config['BATCH_ROOT']
+            input_files = find_server_files(paths, app.config['BATCH_ROOT'])
+        if len(input_files) > app.config['MAX_BATCH_FILES']:
+            raise BatchError(f"More than {app.config['MAX_BATCH_FILES']} files in batch")
+    except UploadTooLargeError:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return too_large_response(app.config['MAX_BATCH_BYTES'])
+    except BatchError as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return jsonify({"Error": str(e)}), 400
+
+    lines = process_batch(
+        input_files, os.path.join(work_dir, 'work'), get_result_cache(), app.config['BATCH_WORKERS'], base_dir,
+        app.config['BATCH_TIMEOUT'], app.config['BATCH_MAX_MEMORY'], app.config['BATCH_MAX_TASKS_PER_CHILD'],
+        app.config['BATCH_MAX_MEMORY_PER_CHILD'], app.config['BATCH_LEDGER']
+    )
+    response = Response(lines, mimetype='application/x-ndjson')
+    # runs once the response is sent, or the client went away
+    response.call_on_close(functools.partial(shutil.rmtree, work_dir, ignore_errors=True))
+    return response
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    uploaded_file = request.files.get('file')
+    if uploaded_file is None or uploaded_file.filename == '':
+        return jsonify({"Error": "No file uploaded!"}), 400
+    try:
+        g.kind = get_job_kind(uploaded_file.filename) or ''
+        job_id = get_job_queue().submit(uploaded_file.filename, uploaded_file.stream)
+    except ValueError:
+        return jsonify({"Error": "Unknown file type!"}), 400
+    except UploadTooLargeError:
+        return too_large_response()
+    except QueueFullError as e:
+        return jsonify({"Error": str(e)}), 429, {"Retry-After": "30"}
+    return jsonify({"id": job_id, "status": "queued"}), 202, {"Location": url_for('get_job', job_id=job_id)}
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"Error": "Unknown job!"}), 404
+    return jsonify(job)
 
 if __name__ == '__main__':
     app.run(port=8080, host='0.0.0.0')
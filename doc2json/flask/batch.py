@@ -0,0 +1,196 @@
+"""
+Batch processing for the Flask service
+
+A batch is an archive (tar, tar.gz or zip) of pdf / gz / nxml files, or a list of files on
+the server. Papers are answered from the result cache when possible, the others are run
+concurrently in a pool of processes, and results are yielded in the order papers finish
+so the service can stream them back as JSON lines. A paper going over the memory budget or
+the timeout only fails itself: its worker is replaced. The outcome of every paper that was run
+is also appended to a ledger on the server, so failures are recorded whether or not the client
+reads the whole response.
+"""
+
+import os
+import json
+import shutil
+import tarfile
+import zipfile
+from typing import Iterator, List, Optional, Tuple
+
+from doc2json.flask.cache import ResultCache, get_cache_key
+from doc2json.flask.jobs import MP_CONTEXT, get_job_kind
+from doc2json.flask.uploads import UploadTooLargeError, hash_file, process_upload, warm_pipelines
+from doc2json.utils.batch_util import Ledger, WorkerPool
+from doc2json.utils.instrument_util import record_stages, observe_stages
+
+
+BATCH_WORKERS = 4
+MAX_BATCH_BYTES = 2 << 30
+MAX_BATCH_FILES = 1000
+BATCH_TIMEOUT = 600
+# RSS budget of a batch worker in bytes, None for no limit
+BATCH_MAX_MEMORY = None
+# workers are replaced after this many papers, or when their RSS stays above the limit after a paper
+BATCH_MAX_TASKS_PER_CHILD = 100
+BATCH_MAX_MEMORY_PER_CHILD = None
+# JSON lines record of the papers run by batches, None to keep no record
+BATCH_LEDGER = os.path.join('temp', 'batch_ledger.jsonl')
+
+
+class BatchError(Exception):
+    pass
+
+
+def _is_within_directory(directory: str, target: str) -> bool:
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([directory, os.path.realpath(target)]) == directory
+
+
+def extract_archive(archive_file: str, output_dir: str, max_bytes: int = MAX_BATCH_BYTES) -> List[str]:
+    """
+    Extract the regular files of a tar or zip archive, refusing members outside output_dir
+    :param archive_file:
+    :param output_dir:
+    :param max_bytes: limit on the total extracted size
+    :return: paths of the extracted files
+    """
+    if tarfile.is_tarfile(archive_file):
+        with tarfile.open(archive_file) as tar:
+            members = [m for m in tar.getmembers() if m.isfile()]
+            _check_members(output_dir, [(m.name, m.size) for m in members], max_bytes)
+            for member in members:
+                tar.extract(member, output_dir, set_attrs=False)
+            names = [m.name for m in members]
+    elif zipfile.is_zipfile(archive_file):
+        with zipfile.ZipFile(archive_file) as zip_ref:
+            members = [m for m in zip_ref.infolist() if not m.is_dir()]
+            _check_members(output_dir, [(m.filename, m.file_size) for m in members], max_bytes)
+            for member in members:
+                zip_ref.extract(member, output_dir)
+            names = [m.filename for m in members]
+    else:
+        raise BatchError('Batch upload is not a tar or zip archive')
+    return [os.path.join(output_dir, name) for name in names]
+
+
+def _check_members(output_dir: str, members: List[Tuple[str, int]], max_bytes: int):
+    total = 0
+    for name, size in members:
+        if not _is_within_directory(output_dir, os.path.join(output_dir, name)):
+            raise BatchError(f'Archive member {name} is outside the archive')
+        total += size
+    if total > max_bytes:
+        raise UploadTooLargeError(f'Archive expands to more than {max_bytes} bytes')
+
+
+def find_server_files(paths: List[str], root: Optional[str]) -> List[str]:
+    """
+    Files for a list of server-side paths, directories are searched recursively
+    :param paths:
+    :param root: only paths under this directory are allowed, None disables server-side paths
+    :return:
+    """
+    if not root:
+        raise BatchError('Server-side paths are not enabled')
+    files = []
+    for path in paths:
+        path = os.path.join(root, path)
+        if not _is_within_directory(root, path):
+            raise BatchError(f'{path} is outside {root}')
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise BatchError(f"{path} doesn't exist")
+    return files
+
+
+def _process_file(kind: str, filename: str, input_file: str, work_dir: str, sha: str):
+    # runs in a pool process; partial files of a paper are removed as soon as it is done
+    with record_stages() as stages:
+        try:
+            result = process_upload(kind, filename, input_file, work_dir, sha)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return result, stages
+
+
+def process_batch(
+        input_files: List[str],
+        work_dir: str,
+        cache: ResultCache,
+        workers: int = BATCH_WORKERS,
+        base_dir: Optional[str] = None,
+        timeout: Optional[float] = BATCH_TIMEOUT,
+        max_memory: Optional[int] = BATCH_MAX_MEMORY,
+        max_tasks_per_child: Optional[int] = BATCH_MAX_TASKS_PER_CHILD,
+        max_memory_per_child: Optional[int] = BATCH_MAX_MEMORY_PER_CHILD,
+        ledger_file: Optional[str] = BATCH_LEDGER
+) -> Iterator[bytes]:
+    """
+    Process many files, yielding one line of json per file as soon as it is done
+    :param input_files: files to process
+    :param work_dir: directory for partial and output files, one sub-directory per file
+    :param cache: results are looked up and stored there
+    :param workers: number of papers processed at the same time
+    :param base_dir: reported file names are relative to this directory
+    :param timeout: seconds a paper may take
+    :param max_memory: RSS budget of a worker in bytes
+    :param max_tasks_per_child: papers after which a worker is replaced
+    :param max_memory_per_child: RSS in bytes above which a worker is replaced once its paper is done
+    :param ledger_file: the record of every paper that is run (without its result) is appended to it,
+        keyed by its reported file name; None to keep no record
+    :return: lines {"filename": ..., "result": ...} or {"filename": ..., "error": ...}
+    """
+    def line(name: str, key: str, value) -> bytes:
+        value = value if isinstance(value, bytes) else json.dumps(value).encode()
+        return b'{"filename": ' + json.dumps(name).encode() + b', "' + key.encode() + b'": ' + value + b'}\n'
+
+    tasks = []
+    papers = {}
+    for i, input_file in enumerate(input_files):
+        name = os.path.relpath(input_file, base_dir) if base_dir else input_file
+        filename = os.path.basename(input_file)
+        kind = get_job_kind(filename)
+        if kind is None:
+            yield line(name, 'error', 'Unknown file type!')
+            continue
+        sha = hash_file(input_file)
+        cache_key = get_cache_key(sha, filename)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            yield line(name, 'result', cached)
+            continue
+        tasks.append((str(i), (kind, filename, input_file, os.path.join(work_dir, str(i)), sha)))
+        papers[str(i)] = (name, cache_key)
+    if not tasks:
+        return
+
+    # closing the pool is also reached when the client goes away: papers in progress are dropped
+    # new workers import the pipelines of the batch before they get papers
+    kinds = sorted({args[0] for _, args in tasks})
+    ledger = Ledger(ledger_file) if ledger_file else None
+    try:
+        with WorkerPool(
+                _process_file, min(workers, len(tasks)), max_memory, timeout,
+                max_tasks_per_child=max_tasks_per_child, max_memory_per_child=max_memory_per_child,
+                initializer=warm_pipelines, initargs=(kinds,), mp_context=MP_CONTEXT
+        ) as pool:
+            for record in pool.run(tasks):
+                name, cache_key = papers[record["key"]]
+                if ledger is not None:
+                    # written before the line is yielded, the client may be gone
+                    ledger.record(dict(
+                        {key: value for key, value in record.items() if key != 'result'}, key=name
+                    ))
+                if record["status"] != 'done':
+                    yield line(name, 'error', record["error"])
+                    continue
+                result, stages = record["result"]
+                observe_stages(stages)
+                yield line(name, 'result', cache.put(cache_key, result))
+    finally:
+        if ledger is not None:
+            ledger.close()
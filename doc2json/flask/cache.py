@@ -0,0 +1,147 @@
+"""
+On-disk cache of processing results for the Flask service
+
+Results are keyed by the hash of the uploaded file, its name (paper ids are derived from it)
+and the pipeline version, so a re-upload of the same paper is answered without running
+GROBID / tralics again. Entries are stored as json files next to a SQLite index of their
+size and last access time; the least recently used entries are evicted once the cache grows
+beyond its size limit. The index is the only shared state, so all service processes can use
+the same cache directory.
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import contextlib
+from typing import Dict, Optional
+
+from doc2json.config import S2ORC_VERSION_STRING, PIPELINE_VERSION
+from doc2json.utils.instrument_util import REGISTRY
+
+
+CACHE_DIR = os.path.join('temp', 'cache')
+CACHE_MAX_BYTES = 1 << 30
+
+CACHE_LOOKUPS = REGISTRY.counter('doc2json_cache_lookups_total', 'Result cache lookups by result (hit or miss)')
+
+
+def get_cache_key(content_sha: str, filename: str) -> str:
+    """
+    Cache key of an upload: content hash, file name and pipeline version
+    :param content_sha: sha1 hex digest of the uploaded bytes
+    :param filename: name of the uploaded file
+    :return:
+    """
+    return hashlib.sha1(
+        f'{S2ORC_VERSION_STRING}:{PIPELINE_VERSION}:{filename}:{content_sha}'.encode()
+    ).hexdigest()
+
+
+class ResultCache:
+    """
+    Result cache with LRU eviction, shared by all processes using the same directory
+    """
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_file = os.path.join(cache_dir, 'cache.sqlite3')
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Serialised json of a cached result, None on a miss
+        :param key:
+        :return:
+        """
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result='miss')
+            return None
+        with self._connect() as db:
+            db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        CACHE_LOOKUPS.inc(result='hit')
+        return data
+
+    def put(self, key: str, result: Dict) -> bytes:
+        """
+        Store a result, evicting least recently used entries if the cache is too large
+        :param key:
+        :param result: S2ORC json
+        :return: the serialised json
+        """
+        data = json.dumps(result).encode()
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, path)
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO entries (key, size, last_access) VALUES (?, ?, ?)",
+                (key, len(data), time.time())
+            )
+        self.evict()
+        return data
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        :return:
+        """
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                evicted = []
+                if total > self.max_bytes:
+                    for key, size in db.execute("SELECT key, size FROM entries ORDER BY last_access"):
+                        if total <= self.max_bytes:
+                            break
+                        evicted.append(key)
+                        total -= size
+                    db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in evicted])
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        for key in evicted:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._get_path(key))
+
+    def stats(self) -> Dict:
+        """
+        Number and size of the entries, and hits / misses of this process
+        :return:
+        """
+        with self._connect() as db:
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": entries, "bytes": size, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,359 @@
+"""
+Asynchronous processing jobs for the Flask service
+
+Uploads are stored on disk and queued in a SQLite database; a pool of dispatcher threads
+claims queued jobs and runs each one in its own process, so a job that exceeds its timeout
+or memory budget can be killed. The database is the only shared state, so several service processes can
+use the same jobs directory. The upload of a job is deleted once the job has run, and finished jobs
+(their directory and row) expire after a retention period.
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import threading
+import contextlib
+import multiprocessing
+from typing import Dict, Optional
+
+from doc2json.flask.uploads import MAX_UPLOAD_BYTES, UploadTooLargeError, save_stream, process_upload
+from doc2json.utils.instrument_util import record_stages, observe_stages
+from doc2json.utils.memory_util import get_rss, format_size
+
+
+JOBS_DIR = os.path.join('temp', 'jobs')
+JOB_WORKERS = 2
+JOB_TIMEOUT = 600
+MAX_QUEUED_JOBS = 100
+# RSS budget of a job process in bytes, None for no limit
+JOB_MAX_MEMORY = None
+# seconds finished jobs and their results are kept, None to keep them forever
+JOB_RETENTION = 24 * 3600
+POLL_INTERVAL = 1.0
+WATCHDOG_INTERVAL = 0.5
+# seconds between looking for expired jobs
+EXPIRE_INTERVAL = 60
+
+JOB_KINDS = {'pdf', 'gz', 'nxml'}
+
+# jobs are started from worker threads; forking a threaded process is unsafe
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def get_job_kind(filename: str) -> Optional[str]:
+    """
+    Kind of job for an uploaded file, None if the file type is not supported
+    :param filename:
+    :return:
+    """
+    for kind in JOB_KINDS:
+        if filename.endswith(kind):
+            return kind
+    return None
+
+
+def _run_job(kind: str, filename: str, input_file: str, job_dir: str):
+    # runs in a child process: the result (or the error) and the stage timings are written next to the input
+    result_file = os.path.join(job_dir, 'result.json')
+    work_dir = os.path.join(job_dir, 'work')
+    with record_stages() as stages:
+        try:
+            output = {"result": process_upload(kind, filename, input_file, work_dir)}
+        except Exception as e:
+            output = {"error": f'{type(e).__name__}: {e}'}
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    output["stages"] = stages
+    tmp_file = f'{result_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(output, f)
+    os.replace(tmp_file, result_file)
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    On-disk job queue with a local pool of workers
+
+    Jobs go through the states queued -> running -> done / failed / timeout, and are deleted
+    retention seconds after they finished.
+    """
+    def __init__(
+            self,
+            jobs_dir: str = JOBS_DIR,
+            workers: int = JOB_WORKERS,
+            timeout: float = JOB_TIMEOUT,
+            max_queued: int = MAX_QUEUED_JOBS,
+            max_upload_bytes: int = MAX_UPLOAD_BYTES,
+            max_memory: Optional[int] = JOB_MAX_MEMORY,
+            retention: Optional[float] = JOB_RETENTION
+    ):
+        self.jobs_dir = jobs_dir
+        self.workers = workers
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.max_upload_bytes = max_upload_bytes
+        self.max_memory = max_memory
+        self.retention = retention
+        self.db_file = os.path.join(jobs_dir, 'jobs.sqlite3')
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_expired = 0.0
+        os.makedirs(jobs_dir, exist_ok=True)
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    worker_pid INTEGER,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self._requeue_orphans()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # autocommit connection, closed on exit; explicit transactions use BEGIN IMMEDIATE
+        db = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def _requeue_orphans(self):
+        # jobs left running by a service process that no longer exists
+        with self._connect() as db:
+            rows = db.execute("SELECT id, worker_pid FROM jobs WHERE status = 'running'").fetchall()
+            for row in rows:
+                if not _pid_alive(row["worker_pid"]):
+                    db.execute(
+                        "UPDATE jobs SET status = 'queued', worker_pid = NULL, started = NULL "
+                        "WHERE id = ? AND status = 'running'", (row["id"],)
+                    )
+
+    def get_job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    def queue_depth(self) -> int:
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def submit(self, filename: str, stream, kind: Optional[str] = None) -> str:
+        """
+        Store an upload and queue it for processing
+        :param filename: name of the uploaded file
+        :param stream: file-like object with the upload
+        :param kind: pdf, gz or nxml, derived from the filename by default
+        :return: job id
+        :raises UploadTooLargeError: if the upload is larger than max_upload_bytes
+        """
+        kind = kind or get_job_kind(filename)
+        if kind not in JOB_KINDS:
+            raise ValueError(f'Unknown file type: {filename}')
+        # don't read the upload when the queue is full; checked again when the job is inserted
+        if self.queue_depth() >= self.max_queued:
+            raise QueueFullError(f'{self.max_queued} jobs already queued')
+
+        job_id = uuid.uuid4().hex
+        input_file = os.path.join(self.get_job_dir(job_id), 'input', os.path.basename(filename))
+        try:
+            save_stream(stream, input_file, self.max_upload_bytes)
+        except UploadTooLargeError:
+            shutil.rmtree(self.get_job_dir(job_id), ignore_errors=True)
+            raise
+
+        # count and insert in one transaction, so concurrent submits can't go over max_queued
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                queued = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+                if queued < self.max_queued:
+                    db.execute(
+                        "INSERT INTO jobs (id, kind, filename, status, created) VALUES (?, ?, ?, 'queued', ?)",
+                        (job_id, kind, os.path.basename(filename), time.time())
+                    )
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        if queued >= self.max_queued:
+            shutil.rmtree(self.get_job_dir(job_id), ignore_errors=True)
+            raise QueueFullError(f'{self.max_queued} jobs already queued')
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: str, with_result: bool = True) -> Optional[Dict]:
+        """
+        Status of a job, with its result once it is done
+        :param job_id:
+        :param with_result: include the S2ORC json of finished jobs
+        :return: None if there is no such job
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {key: row[key] for key in ('id', 'kind', 'filename', 'status', 'error', 'created', 'started', 'finished')}
+        if with_result and row["status"] == 'done':
+            try:
+                with open(os.path.join(self.get_job_dir(job_id), 'result.json'), 'r') as f:
+                    job["result"] = json.load(f)["result"]
+            except FileNotFoundError:
+                # expired since the row was read
+                return None
+        return job
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        # atomically move the oldest queued job to running
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE jobs SET status = 'running', worker_pid = ?, started = ? WHERE id = ?",
+                        (os.getpid(), time.time(), row["id"])
+                    )
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        return row
+
+    def _finish(self, job_id: str, status: str, error: Optional[str] = None):
+        # the upload is no longer needed, whether the job succeeded, failed or was killed
+        shutil.rmtree(os.path.join(self.get_job_dir(job_id), 'input'), ignore_errors=True)
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                (status, error, time.time(), job_id)
+            )
+
+    def expire(self) -> int:
+        """
+        Delete the jobs that finished more than retention seconds ago, with their results
+        :return: number of jobs deleted
+        """
+        if self.retention is None:
+            return 0
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                job_ids = [row["id"] for row in db.execute(
+                    "SELECT id FROM jobs WHERE status IN ('done', 'failed', 'timeout') AND finished < ?",
+                    (time.time() - self.retention,)
+                )]
+                db.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        # rows first, so a job is never found without its directory
+        for job_id in job_ids:
+            shutil.rmtree(self.get_job_dir(job_id), ignore_errors=True)
+        return len(job_ids)
+
+    def run_next(self) -> bool:
+        """
+        Run the oldest queued job in a child process, killing it after the timeout or when it goes
+        over the memory budget
+        :return: False if there was nothing to run
+        """
+        row = self._claim()
+        if row is None:
+            return False
+        job_dir = self.get_job_dir(row["id"])
+        input_file = os.path.join(job_dir, 'input', row["filename"])
+        process = MP_CONTEXT.Process(
+            target=_run_job, args=(row["kind"], row["filename"], input_file, job_dir), daemon=True
+        )
+        process.start()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            process.join(min(WATCHDOG_INTERVAL, max(0.0, deadline - time.monotonic())))
+            if not process.is_alive():
+                break
+            rss = get_rss(process.pid) or 0
+            if self.max_memory and rss > self.max_memory:
+                process.kill()
+                process.join()
+                self._finish(
+                    row["id"], 'failed', f'Job exceeded its memory budget of {format_size(self.max_memory)}'
+                )
+                return True
+            if time.monotonic() >= deadline:
+                process.kill()
+                process.join()
+                self._finish(row["id"], 'timeout', f'Job exceeded {self.timeout} seconds')
+                return True
+
+        result_file = os.path.join(job_dir, 'result.json')
+        if not os.path.exists(result_file):
+            self._finish(row["id"], 'failed', f'Worker exited with code {process.exitcode}')
+            return True
+        with open(result_file, 'r') as f:
+            output = json.load(f)
+        observe_stages(output.get("stages", []))
+        self._finish(row["id"], 'failed' if output.get("error") else 'done', output.get("error"))
+        return True
+
+    def _work(self):
+        while not self._stop.is_set():
+            if time.monotonic() - self._last_expired >= EXPIRE_INTERVAL:
+                self._last_expired = time.monotonic()
+                self.expire()
+            if not self.run_next():
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+
+    def start(self):
+        """
+        Start the worker threads
+        :return:
+        """
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the worker threads once their current jobs are done
+        :return:
+        """
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stop.clear()
@@ -0,0 +1,188 @@
+"""
+Upload handling for the Flask service
+
+Every request works in its own temp directory, removed when the request is done, so
+concurrent uploads of files with the same name can't overwrite each other's input, partial
+or output files. Uploads and downloaded urls are copied to disk in chunks and hashed on the
+way; the size limit is enforced while copying, before any pipeline runs.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import importlib
+import contextlib
+from typing import Dict, Iterable, Optional
+
+import requests
+
+
+UPLOAD_DIR = os.path.join('temp', 'uploads')
+MAX_UPLOAD_BYTES = 200 << 20
+UPLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_TIMEOUT = 60
+# pipeline module of each kind of upload, imported by process_upload
+PIPELINE_MODULES = {
+    'pdf': 'doc2json.grobid2json.process_pdf',
+    'gz': 'doc2json.tex2json.process_tex',
+    'nxml': 'doc2json.jats2json.process_jats',
+}
+
+
+class UploadTooLargeError(Exception):
+    pass
+
+
+def new_request_dir(base_dir: str = UPLOAD_DIR) -> str:
+    """
+    Create a unique working directory for one request, the caller removes it
+    :param base_dir:
+    :return:
+    """
+    os.makedirs(base_dir, exist_ok=True)
+    return tempfile.mkdtemp(dir=base_dir)
+
+
+@contextlib.contextmanager
+def request_dir(base_dir: str = UPLOAD_DIR):
+    """
+    Unique working directory for one request, removed on exit whatever happens
+    :param base_dir:
+    :return:
+    """
+    work_dir = new_request_dir(base_dir)
+    try:
+        yield work_dir
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def save_chunks(chunks: Iterable[bytes], path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> str:
+    """
+    Write chunks to a file, giving up as soon as they exceed max_bytes
+    :param chunks:
+    :param path: file to write, its directory is created if needed
+    :param max_bytes:
+    :return: sha1 hex digest of the content
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sha = hashlib.sha1()
+    size = 0
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLargeError(f'Upload is larger than {max_bytes} bytes')
+            sha.update(chunk)
+            f.write(chunk)
+    return sha.hexdigest()
+
+
+def save_stream(stream, path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> str:
+    """
+    Copy a file-like object to disk in chunks
+    :param stream:
+    :param path:
+    :param max_bytes:
+    :return: sha1 hex digest of the content
+    """
+    return save_chunks(iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''), path, max_bytes)
+
+
+def hash_file(path: str) -> str:
+    """
+    sha1 hex digest of a file, read in chunks
+    :param path:
+    :return:
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def download_url(url: str, path: str, max_bytes: int = MAX_UPLOAD_BYTES, timeout: float = DOWNLOAD_TIMEOUT) -> str:
+    """
+    Download a url to disk in chunks, rejecting it up front if it announces a size over the limit
+    :param url:
+    :param path:
+    :param max_bytes:
+    :param timeout: connect / read timeout in seconds
+    :return: sha1 hex digest of the content
+    """
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) > max_bytes:
+            raise UploadTooLargeError(f'Upload is larger than {max_bytes} bytes')
+        return save_chunks(response.iter_content(UPLOAD_CHUNK_SIZE), path, max_bytes)
+
+
+def process_upload(
+        kind: str,
+        filename: str,
+        input_file: str,
+        work_dir: str,
+        sha: Optional[str] = None,
+        grobid_config: Optional[Dict] = None
+) -> Dict:
+    """
+    Run the pipeline matching the kind of upload, keeping all its files inside work_dir
+    :param kind: pdf, gz or nxml
+    :param filename: name of the uploaded file
+    :param input_file: path of the uploaded file
+    :param work_dir: directory for partial and output files of this upload
+    :param sha: sha1 hex digest of the upload, computed if not given
+    :param grobid_config: GROBID client config, the default one if not given
+    :return: S2ORC json
+    """
+    temp_dir = os.path.join(work_dir, 'temp')
+    output_dir = os.path.join(work_dir, 'output')
+    log_dir = os.path.join(work_dir, 'log')
+    # imported here so the service process doesn't load the pipelines until they're needed
+    if kind == 'pdf':
+        from doc2json.grobid2json.process_pdf import process_pdf_stream
+        with open(input_file, 'rb') as f:
+            content = f.read()
+        return process_pdf_stream(
+            filename, sha or hashlib.sha1(content).hexdigest(), content, temp_dir=temp_dir, grobid_config=grobid_config
+        )
+    elif kind == 'gz':
+        from doc2json.tex2json.process_tex import process_tex_file
+        output_file = process_tex_file(
+            input_file, temp_dir=temp_dir, output_dir=output_dir, log_dir=log_dir, grobid_config=grobid_config
+        )
+    elif kind == 'nxml':
+        from doc2json.jats2json.process_jats import process_jats_file
+        output_file = process_jats_file(input_file, output_dir=output_dir, log_dir=log_dir)
+    else:
+        raise ValueError(f'Unknown upload kind {kind}')
+
+    if not output_file or not os.path.exists(output_file):
+        return []
+    with open(output_file, 'r') as f:
+        return json.load(f)
+
+
+def warm_pipelines(kinds: Iterable[str] = tuple(PIPELINE_MODULES)):
+    """
+    Pay the start-up costs of the pipelines before the first paper: imports (and their
+    module level regexes), the XML parsers of BeautifulSoup and the GROBID connection
+    session. Run by batch workers when they start.
+    :param kinds: kinds of upload to get ready for
+    :return:
+    """
+    from bs4 import BeautifulSoup
+    from doc2json.grobid2json.grobid.client import get_session
+
+    for kind in kinds:
+        importlib.import_module(PIPELINE_MODULES[kind])
+    if set(kinds) & {'gz', 'nxml'}:
+        # imported by the pipelines on their first formula
+        importlib.import_module('latex2mathml.converter')
+    for features in ('xml', 'lxml'):
+        BeautifulSoup('<article><p>warm</p></article>', features)
+    get_session()
@@ -1,7 +1,7 @@
 """ Generic API Client """
 from copy import deepcopy
 import json
-import requests
+import threading
 
 try:
     from urlparse import urljoin
@@ -9,6 +9,23 @@ except ImportError:
     from urllib.parse import urljoin
 
 
+_local = threading.local()
+
+
+def get_session():
+    """ Session of the current thread, keeping connections to the service alive.
+
+    Returns:
+        requests.Session
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        # requests is slow to import, runs without GROBID calls don't need it
+        import requests
+        session = _local.session = requests.Session()
+    return session
+
+
 class ApiClient(object):
     """ Client to interact with a generic Rest API.
 
@@ -123,7 +140,7 @@ class ApiClient(object):
         files = files or {}
         #if self.username is not None and self.api_key is not None:
         #    params.update(self.get_credentials())
-        r = requests.request(
+        r = get_session().request(
             method,
             url,
             headers=headers,
@@ -5,8 +5,12 @@ import argparse
 import time
 import glob
 from doc2json.grobid2json.grobid.client import ApiClient
+from doc2json.grobid2json.grobid.recording import GrobidRecording, GrobidRecordingMiss, RecordedResponse, \
+    get_request_key, RECORDING_MODES
+from doc2json.utils.instrument_util import stage, instrument_paper, close_sinks
+from doc2json.utils.profile_util import add_profile_args, setup_profile
 import ntpath
-from typing import List
+from typing import Dict, List
 
 '''
 This version uses the standard ProcessPoolExecutor for parallelizing the concurrent calls to the GROBID services.
@@ -28,8 +32,22 @@ DEFAULT_GROBID_CONFIG = {
     "include_raw_citations": True,
     "include_raw_affiliations": False,
     "max_workers": 2,
+    # record GROBID responses to this file, or replay them from it
+    "recording_file": None,
+    # one of record, replay (a request that wasn't recorded fails), replay_or_record (it goes to GROBID)
+    "recording_mode": None,
 }
 
+# recordings opened by this process, by path
+_recordings = {}
+
+
+def get_recording(path: str) -> GrobidRecording:
+    if path not in _recordings:
+        _recordings[path] = GrobidRecording(path)
+    return _recordings[path]
+
+
 class GrobidClient(ApiClient):
 
     def __init__(self, config=None):
@@ -43,6 +61,30 @@ class GrobidClient(ApiClient):
         self.grobid_server = self.config["grobid_server"]
         self.grobid_port = self.config["grobid_port"]
         self.sleep_time = self.config["sleep_time"]
+        self.recording_mode = self.config.get("recording_mode")
+        self.recording = None
+        if self.recording_mode:
+            if self.recording_mode not in RECORDING_MODES:
+                raise ValueError(f'Unknown recording mode {self.recording_mode}, expected one of {RECORDING_MODES}')
+            if not self.config.get("recording_file"):
+                raise ValueError('recording_mode needs a recording_file')
+            self.recording = get_recording(self.config["recording_file"])
+
+    def post(self, url, params=None, data=None, files=None, **kwargs):
+        if self.recording is None:
+            return super().post(url, params=params, data=data, files=files, **kwargs)
+        service = url.rsplit('/', 1)[-1]
+        key = get_request_key(service, data, files)
+        if self.recording_mode != 'record':
+            text = self.recording.get(key)
+            if text is not None:
+                return RecordedResponse(text), 200
+            if self.recording_mode == 'replay':
+                raise GrobidRecordingMiss(f'{service} request {key} is not in {self.recording.path}')
+        res, status = super().post(url, params=params, data=data, files=files, **kwargs)
+        if status == 200:
+            self.recording.put(key, service, res.text)
+        return res, status
 
     def process(self, input: str, output: str, service: str):
         batch_size_pdf = self.config['batch_size']
@@ -62,7 +104,8 @@ class GrobidClient(ApiClient):
     def process_batch(self, pdf_files: List[str], output: str, service: str) -> None:
         print(len(pdf_files), "PDF files to process")
         for pdf_file in pdf_files:
-            self.process_pdf(pdf_file, output, service)
+            with instrument_paper(os.path.splitext(ntpath.basename(pdf_file))[0]):
+                self.process_pdf(pdf_file, output, service)
 
     def process_pdf_stream(self, pdf_file: str, pdf_strm: bytes, output: str, service: str) -> str:
         # process the stream
@@ -106,16 +149,17 @@ class GrobidClient(ApiClient):
         else:
             the_data['includeRawCitations'] = '0'
 
-        res, status = self.post(
-            url=the_url,
-            files=files,
-            data=the_data,
-            headers={'Accept': 'text/plain'}
-        )
+        with stage('grobid'):
+            res, status = self.post(
+                url=the_url,
+                files=files,
+                data=the_data,
+                headers={'Accept': 'text/plain'}
+            )
 
         if status == 503:
             time.sleep(self.sleep_time)
-            return self.process_pdf_stream(pdf_file, pdf_strm, service)
+            return self.process_pdf_stream(pdf_file, pdf_strm, output, service)
         elif status != 200:
             with open(os.path.join(output, "failed.log"), "a+") as failed:
                 failed.write(pdf_file.strip(".pdf") + "\n")
@@ -169,6 +213,8 @@ class GrobidClient(ApiClient):
                     break
                 else:
                     return res.text
+            except GrobidRecordingMiss:
+                raise
             except Exception:
                 continue
 
@@ -225,17 +271,51 @@ class GrobidClient(ApiClient):
             return res.text
 
 
+def add_grobid_args(parser):
+    """
+    Command line options for the GROBID server and recording
+    :param parser: argparse parser
+    :return:
+    """
+    parser.add_argument("--grobid_config", default=None, help="path to a GROBID client config json")
+    parser.add_argument("--grobid_recording", default=None, help="file to record GROBID responses to / replay them from")
+    parser.add_argument(
+        "--grobid_mode", default='replay_or_record', choices=RECORDING_MODES, help="how --grobid_recording is used"
+    )
+
+
+def get_grobid_config(args) -> Dict:
+    """
+    GROBID client config from the options added by add_grobid_args
+    :param args: parsed arguments
+    :return:
+    """
+    config = dict(DEFAULT_GROBID_CONFIG)
+    if args.grobid_config:
+        with open(args.grobid_config, 'r') as f:
+            config.update(json.load(f))
+    if args.grobid_recording:
+        config.update(recording_file=args.grobid_recording, recording_mode=args.grobid_mode)
+    return config
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Client for GROBID services")
     parser.add_argument("service", help="one of [processFulltextDocument, processHeaderDocument, processReferences]")
     parser.add_argument("--input", default=None, help="path to the directory containing PDF to process")
     parser.add_argument("--output", default=None, help="path to the directory where to put the results")
     parser.add_argument("--config", default=None, help="path to the config file, default is ./config.json")
+    parser.add_argument("--recording", default=None, help="file to record GROBID responses to / replay them from")
+    parser.add_argument("--mode", default='replay_or_record', choices=RECORDING_MODES, help="how --recording is used")
+    add_profile_args(parser)
 
     args = parser.parse_args()
+    setup_profile(args)
 
     input_path = args.input
     config = json.load(open(args.config)) if args.config else DEFAULT_GROBID_CONFIG
+    if args.recording:
+        config = dict(config, recording_file=args.recording, recording_mode=args.mode)
     output_path = args.output
     service = args.service
 
@@ -247,3 +327,4 @@ if __name__ == "__main__":
 
     runtime = round(time.time() - start_time, 3)
     print("runtime: %s seconds " % (runtime))
+    close_sinks()
@@ -0,0 +1,244 @@
+"""
+Lightweight stand-in for the GROBID service, for offline runs and load tests
+
+Implements the endpoints used by GrobidClient (processCitation, processCitationList,
+processHeaderNames, processAffiliations and processFulltextDocument) without the JVM.
+Fulltext requests are answered with the recorded TEI of the same name from a directory,
+or a minimal TEI document; citations, names and affiliations are turned into TEI with a
+few rules. Latency, injected 503s and a limit on the requests served at the same time
+(GROBID answers 503 when its pool is busy) can be set to exercise the client's
+concurrency and retry behaviour.
+
+    python doc2json/grobid2json/grobid/mock_server.py --tei_dir tei/ --latency 0.5 --error_rate 0.1
+"""
+
+import os
+import re
+import time
+import random
+import argparse
+import threading
+import contextlib
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+from flask import Flask, Response, request
+
+from doc2json.grobid2json.grobid.grobid_client import DEFAULT_GROBID_CONFIG
+
+
+TEI_NS = 'http://www.tei-c.org/ns/1.0'
+NAME_PATTERN = r'(?:[A-Z]\. )*[^.,]+'
+REF_PATTERN = re.compile(
+    rf'^(?P<authors>{NAME_PATTERN}(?:, {NAME_PATTERN})*)\. (?P<title>[^.]+)\. (?P<venue>[^,]+), '
+    r'(?P<volume>\d+):(?P<pages>[\d-]+), (?P<year>\d{4})\.$'
+)
+YEAR_PATTERN = re.compile(r'\b(1[89]\d\d|20\d\d)\b')
+SERVICES = {'processCitation', 'processCitationList', 'processHeaderNames', 'processAffiliations', 'processFulltextDocument'}
+
+
+def pers_name_tei(name: str) -> str:
+    """
+    persName of a name, the last token being the surname
+    :param name:
+    :return:
+    """
+    parts = name.strip().split()
+    if not parts:
+        return ''
+    forenames = ''.join(
+        f'<forename type="{"first" if i == 0 else "middle"}">{escape(part)}</forename>' for i, part in enumerate(parts[:-1])
+    )
+    return f'<persName>{forenames}<surname>{escape(parts[-1])}</surname></persName>'
+
+
+def citation_tei(citation: str) -> str:
+    """
+    biblStruct of a raw reference string; references like "A. Smith, B. Chen. Title. Venue, 12:3-4, 2019."
+    are split into their fields, others only keep their title and year
+    :param citation:
+    :return:
+    """
+    raw = f'<note type="raw_reference">{escape(citation)}</note>'
+    match = REF_PATTERN.match(citation.strip())
+    if not match:
+        year = YEAR_PATTERN.search(citation)
+        date = f'<date type="published" when="{year.group(0)}"/>' if year else ''
+        return (
+            f'<biblStruct><monogr><title level="m">{escape(citation.strip())}</title><imprint>{date}</imprint></monogr>'
+            f'{raw}</biblStruct>'
+        )
+    authors = ''.join(f'<author>{pers_name_tei(name)}</author>' for name in match.group('authors').split(', '))
+    first_page, _, last_page = match.group('pages').partition('-')
+    pages = f'<biblScope unit="page" from="{first_page}" to="{last_page}"/>' if last_page else \
+        f'<biblScope unit="page">{first_page}</biblScope>'
+    return (
+        f'<biblStruct><analytic><title level="a" type="main">{escape(match.group("title"))}</title>{authors}</analytic>'
+        f'<monogr><title level="j">{escape(match.group("venue"))}</title><imprint>'
+        f'<biblScope unit="volume">{match.group("volume")}</biblScope>{pages}'
+        f'<date type="published" when="{match.group("year")}"/></imprint></monogr>{raw}</biblStruct>'
+    )
+
+
+def citation_list_tei(citations: List[str]) -> str:
+    bibl = ''.join(citation_tei(citation) for citation in citations)
+    return f'<TEI xmlns="{TEI_NS}"><text><back><div><listBibl>{bibl}</listBibl></div></back></text></TEI>'
+
+
+def header_names_tei(names: str) -> str:
+    """
+    persNames of a comma or "and" separated list of names
+    :param names:
+    :return:
+    """
+    persons = ''.join(pers_name_tei(name) for name in re.split(r',|\band\b', names) if name.strip())
+    return f'<TEI xmlns="{TEI_NS}">{persons}</TEI>'
+
+
+def affiliation_tei(affiliation: str) -> str:
+    parts = [part.strip() for part in affiliation.split(',') if part.strip()]
+    org = f'<orgName type="institution">{escape(parts[0])}</orgName>' if parts else ''
+    address = f'<address><country>{escape(parts[-1])}</country></address>' if len(parts) > 1 else ''
+    return f'<affiliation>{org}{address}</affiliation>'
+
+
+def fulltext_tei(pdf_file: str, tei_dir: Optional[str] = None) -> str:
+    """
+    Recorded TEI <tei_dir>/<name>.tei.xml for <name>.pdf, or a document with only a title
+    :param pdf_file:
+    :param tei_dir:
+    :return:
+    """
+    stem = os.path.splitext(os.path.basename(pdf_file or 'document.pdf'))[0]
+    if tei_dir:
+        tei_file = os.path.join(tei_dir, f'{stem}.tei.xml')
+        if os.path.exists(tei_file):
+            with open(tei_file, 'r', encoding='utf-8') as f:
+                return f.read()
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<TEI xmlns="{TEI_NS}"><teiHeader><fileDesc><titleStmt><title level="a" type="main">{escape(stem)}</title>'
+        '</titleStmt><sourceDesc><biblStruct><analytic/><monogr><imprint/></monogr></biblStruct></sourceDesc></fileDesc>'
+        '<profileDesc><abstract/></profileDesc></teiHeader><text><body/><back/></text></TEI>'
+    )
+
+
+def create_app(
+        tei_dir: Optional[str] = None,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        max_concurrency: Optional[int] = None,
+        seed: Optional[int] = None
+) -> Flask:
+    """
+    Flask app serving the mocked GROBID API under /api
+    :param tei_dir: recorded TEI files for fulltext requests
+    :param latency: seconds spent on each request
+    :param jitter: up to this many seconds are added to the latency at random
+    :param error_rate: fraction of requests answered with 503
+    :param max_concurrency: requests served at the same time, others get 503; None for no limit
+    :param seed: seed of the latency jitter and the injected errors
+    :return:
+    """
+    app = Flask(__name__)
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+    stats = app.config['MOCK_GROBID_STATS'] = {"requests": 0, "rejected": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0}
+    stats_lock = threading.Lock()
+
+    def handle(service: str) -> str:
+        if service == 'processCitation':
+            return citation_tei(request.form.get('citations', ''))
+        if service == 'processCitationList':
+            return citation_list_tei(request.form.getlist('citations'))
+        if service == 'processHeaderNames':
+            return header_names_tei(request.form.get('names', ''))
+        if service == 'processAffiliations':
+            return affiliation_tei(request.form.get('affiliations', ''))
+        upload = request.files.get('input')
+        return fulltext_tei(upload.filename if upload else None, tei_dir)
+
+    @app.route('/api/isalive', methods=['GET'])
+    def isalive():
+        return Response('true', mimetype='text/plain')
+
+    @app.route('/api/<service>', methods=['POST'])
+    def api(service):
+        if service not in SERVICES:
+            return Response(f'Unknown service {service}', status=404, mimetype='text/plain')
+        with stats_lock:
+            stats["requests"] += 1
+        if slots is not None and not slots.acquire(blocking=False):
+            with stats_lock:
+                stats["rejected"] += 1
+            return Response('', status=503)
+        try:
+            with rng_lock:
+                delay = latency + (rng.uniform(0, jitter) if jitter else 0.0)
+                fail = error_rate and rng.random() < error_rate
+            with stats_lock:
+                stats["in_flight"] += 1
+                stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+            try:
+                if delay:
+                    time.sleep(delay)
+                if fail:
+                    with stats_lock:
+                        stats["errors"] += 1
+                    return Response('', status=503)
+                return Response(handle(service), mimetype='application/xml')
+            finally:
+                with stats_lock:
+                    stats["in_flight"] -= 1
+        finally:
+            if slots is not None:
+                slots.release()
+
+    return app
+
+
+@contextlib.contextmanager
+def run_mock_server(host: str = 'localhost', port: int = 0, **kwargs) -> Tuple[Dict, Dict]:
+    """
+    Serve a mock GROBID in a background thread while in the block
+    :param host:
+    :param port: 0 for any free port
+    :param kwargs: passed to create_app
+    :return: GrobidClient config pointing at the server, and its request counts
+    """
+    from werkzeug.serving import make_server
+
+    app = create_app(**kwargs)
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield dict(
+            DEFAULT_GROBID_CONFIG,
+            grobid_server=host,
+            grobid_port=str(server.server_port),
+            sleep_time=0
+        ), app.config['MOCK_GROBID_STATS']
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mock GROBID server")
+    parser.add_argument("--host", default="localhost", help="host to listen on")
+    parser.add_argument("--port", default=int(DEFAULT_GROBID_CONFIG["grobid_port"]), type=int, help="port to listen on")
+    parser.add_argument("--tei_dir", default=None, help="directory of recorded <name>.tei.xml for fulltext requests")
+    parser.add_argument("--latency", default=0.0, type=float, help="seconds spent on each request")
+    parser.add_argument("--jitter", default=0.0, type=float, help="random extra latency, up to this many seconds")
+    parser.add_argument("--error_rate", default=0.0, type=float, help="fraction of requests answered with 503")
+    parser.add_argument("--max_concurrency", default=None, type=int, help="requests served at once, others get 503")
+    parser.add_argument("--seed", default=None, type=int, help="random seed of the jitter and injected errors")
+
+    args = parser.parse_args()
+
+    create_app(
+        args.tei_dir, args.latency, args.jitter, args.error_rate, args.max_concurrency, args.seed
+    ).run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,126 @@
+"""
+Recorded GROBID traffic, to replay regression runs without GROBID
+
+Responses are stored in a single SQLite file, compressed, keyed by the service and a
+normalized form of the request: form fields with collapsed whitespace, uploaded files by
+their content hash. The server address is not part of the key, so a recording can be
+replayed against any configuration with the same GROBID parameters. Only successful
+responses are recorded.
+"""
+
+import os
+import re
+import zlib
+import json
+import hashlib
+import sqlite3
+import contextlib
+from typing import Dict, Optional
+
+
+RECORDING_MODES = ('record', 'replay', 'replay_or_record')
+
+WHITESPACE = re.compile(r'\s+')
+
+
+class GrobidRecordingMiss(Exception):
+    pass
+
+
+class RecordedResponse:
+    """
+    Stands in for the requests response of a recorded request
+    """
+    status_code = 200
+
+    def __init__(self, text: str):
+        self.text = text
+
+    @property
+    def content(self) -> bytes:
+        return self.text.encode('utf-8')
+
+
+def _normalize(value):
+    if isinstance(value, bytes):
+        return 'sha1:' + hashlib.sha1(value).hexdigest()
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return WHITESPACE.sub(' ', str(value)).strip()
+
+
+def get_request_key(service: str, data: Optional[Dict] = None, files: Optional[Dict] = None) -> str:
+    """
+    Key of a GROBID request: service, form fields and uploaded file contents
+    :param service: e.g. processCitation
+    :param data: form fields
+    :param files: uploads as passed to requests, {name: (filename, content, ...)}
+    :return: sha1 hex digest
+    """
+    request = {
+        "service": service,
+        "data": {key: _normalize(value) for key, value in (data or {}).items()},
+        # the file name doesn't change GROBID's output, only the content does
+        "files": {
+            key: _normalize(value[1] if isinstance(value, tuple) else value) for key, value in (files or {}).items()
+        }
+    }
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+class GrobidRecording:
+    """
+    On-disk store of GROBID responses, safe to share between processes
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    service TEXT NOT NULL,
+                    response BLOB NOT NULL
+                )
+            """)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Recorded response text, None if the request wasn't recorded
+        :param key:
+        :return:
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, key: str, service: str, text: str):
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, service, response) VALUES (?, ?, ?)",
+                (key, service, zlib.compress(text.encode('utf-8'), 6))
+            )
+
+    def stats(self) -> Dict:
+        """
+        Recorded responses per service, and hits / misses of this process
+        :return:
+        """
+        with self._connect() as db:
+            services = dict(db.execute("SELECT service, COUNT(*) FROM responses GROUP BY service").fetchall())
+        return {"services": services, "hits": self.hits, "misses": self.misses}
@@ -5,33 +5,46 @@ import time
 from bs4 import BeautifulSoup
 from typing import Optional, Dict
 
-from doc2json.grobid2json.grobid.grobid_client import GrobidClient
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient, add_grobid_args, get_grobid_config
 from doc2json.grobid2json.tei_to_json import convert_tei_xml_file_to_s2orc_json, convert_tei_xml_soup_to_s2orc_json
+from doc2json.utils.instrument_util import stage, instrument_paper, format_stage_timings, add_instrument_args, \
+    setup_sinks, close_sinks
+from doc2json.utils.profile_util import add_profile_args, setup_profile
 
 BASE_TEMP_DIR = 'temp'
 BASE_OUTPUT_DIR = 'output'
 BASE_LOG_DIR = 'log'
 
 
-def process_pdf_stream(input_file: str, sha: str, input_stream: bytes, grobid_config: Optional[Dict] = None) -> Dict:
+def process_pdf_stream(
+        input_file: str,
+        sha: str,
+        input_stream: bytes,
+        temp_dir: str = BASE_TEMP_DIR,
+        grobid_config: Optional[Dict] = None
+) -> Dict:
     """
     Process PDF stream
     :param input_file:
     :param sha:
     :param input_stream:
+    :param temp_dir: directory for failed.log when GROBID fails
     :return:
     """
-    # process PDF through Grobid -> TEI.XML
-    client = GrobidClient(grobid_config)
-    tei_text = client.process_pdf_stream(input_file, input_stream, 'temp', "processFulltextDocument")
+    os.makedirs(temp_dir, exist_ok=True)
 
-    # make soup
-    soup = BeautifulSoup(tei_text, "xml")
+    with instrument_paper(input_file):
+        # process PDF through Grobid -> TEI.XML
+        client = GrobidClient(grobid_config)
+        tei_text = client.process_pdf_stream(input_file, input_stream, temp_dir, "processFulltextDocument")
 
-    # get paper
-    paper = convert_tei_xml_soup_to_s2orc_json(soup, input_file, sha)
+        # make soup and get paper
+        with stage('soup_conversion'):
+            soup = BeautifulSoup(tei_text, "xml")
+            paper = convert_tei_xml_soup_to_s2orc_json(soup, input_file, sha)
 
-    return paper.release_json('pdf')
+        with stage('serialise'):
+            return paper.release_json('pdf')
 
 
 def process_pdf_file(
@@ -61,21 +74,23 @@ def process_pdf_file(
     if os.path.exists(output_file):
         print(f'{output_file} already exists!')
 
-    # process PDF through Grobid -> TEI.XML
-    client = GrobidClient(grobid_config)
-    # TODO: compute PDF hash
-    # TODO: add grobid version number to output
-    client.process_pdf(input_file, temp_dir, "processFulltextDocument")
+    with instrument_paper(paper_id):
+        # process PDF through Grobid -> TEI.XML
+        client = GrobidClient(grobid_config)
+        # TODO: compute PDF hash
+        # TODO: add grobid version number to output
+        client.process_pdf(input_file, temp_dir, "processFulltextDocument")
 
-    # process TEI.XML -> JSON
-    assert os.path.exists(tei_file)
-    paper = convert_tei_xml_file_to_s2orc_json(tei_file)
+        # process TEI.XML -> JSON
+        assert os.path.exists(tei_file)
+        with stage('soup_conversion'):
+            paper = convert_tei_xml_file_to_s2orc_json(tei_file)
 
-    # write to file
-    with open(output_file, 'w') as outf:
-        json.dump(paper.release_json(), outf, indent=4, sort_keys=False)
+        # write to file
+        with stage('serialise'), open(output_file, 'w') as outf:
+            json.dump(paper.release_json(), outf, indent=4, sort_keys=False)
 
-    return output_file
+        return output_file
 
 
 if __name__ == '__main__':
@@ -85,7 +100,13 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--output", default=BASE_OUTPUT_DIR, help="path to the output dir for putting json files")
     parser.add_argument("-k", "--keep", action='store_true')
 
+    add_grobid_args(parser)
+    add_instrument_args(parser)
+    add_profile_args(parser)
+
     args = parser.parse_args()
+    setup_sinks(args)
+    setup_profile(args)
 
     input_path = args.input
     temp_path = args.temp
@@ -97,8 +118,10 @@ if __name__ == '__main__':
     os.makedirs(temp_path, exist_ok=True)
     os.makedirs(output_path, exist_ok=True)
 
-    process_pdf_file(input_path, temp_path, output_path)
+    process_pdf_file(input_path, temp_path, output_path, get_grobid_config(args))
 
     runtime = round(time.time() - start_time, 3)
     print("runtime: %s seconds " % (runtime))
+    print("stages: %s" % format_stage_timings())
+    close_sinks()
     print('done.')
\ No newline at end of file
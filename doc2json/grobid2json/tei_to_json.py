@@ -8,6 +8,7 @@ from bs4 import BeautifulSoup, NavigableString
 from typing import List, Dict, Tuple
 
 from doc2json.s2orc import Paper
+from doc2json.utils.instrument_util import span, count
 
 from doc2json.utils.grobid_util import parse_bib_entry, extract_paper_metadata_from_grobid_xml
 from doc2json.utils.citation_util import SINGLE_BRACKET_REGEX, BRACKET_REGEX, BRACKET_STYLE_THRESHOLD
@@ -697,21 +698,26 @@ def convert_tei_xml_soup_to_s2orc_json(soup: BeautifulSoup, paper_id: str, pdf_h
     :return:
     """
     # extract metadata
-    metadata = extract_paper_metadata_from_grobid_xml(soup.fileDesc)
-    # clean metadata authors (remove dupes etc)
-    metadata['authors'] = _clean_empty_and_duplicate_authors_from_grobid_parse(metadata['authors'])
+    with span('metadata'):
+        metadata = extract_paper_metadata_from_grobid_xml(soup.fileDesc)
+        # clean metadata authors (remove dupes etc)
+        metadata['authors'] = _clean_empty_and_duplicate_authors_from_grobid_parse(metadata['authors'])
 
     # parse bibliography entries (removes empty bib entries)
-    biblio_entries = parse_bibliography(soup)
-    bibkey_map = {
-        normalize_grobid_id(bib['ref_id']): bib for bib in biblio_entries
-    }
+    with span('bibliography'):
+        biblio_entries = parse_bibliography(soup)
+        bibkey_map = {
+            normalize_grobid_id(bib['ref_id']): bib for bib in biblio_entries
+        }
+    count('bib_entries', len(bibkey_map))
 
     # # process formulas and replace with text
     # extract_formulas_from_tei_xml(soup)
 
     # extract figure and table captions
-    refkey_map = extract_figures_and_tables_from_tei_xml(soup)
+    with span('figure_table_map'):
+        refkey_map = extract_figures_and_tables_from_tei_xml(soup)
+    count('ref_entries', len(refkey_map))
 
     # get bracket style
     is_bracket_style = check_if_citations_are_bracket_style(soup)
@@ -720,13 +726,17 @@ def convert_tei_xml_soup_to_s2orc_json(soup: BeautifulSoup, paper_id: str, pdf_h
     soup = sub_all_note_tags(soup)
 
     # process abstract if possible
-    abstract_entries = extract_abstract_from_tei_xml(soup, bibkey_map, refkey_map, is_bracket_style)
+    with span('abstract'):
+        abstract_entries = extract_abstract_from_tei_xml(soup, bibkey_map, refkey_map, is_bracket_style)
 
     # process body text
-    body_entries = extract_body_text_from_tei_xml(soup, bibkey_map, refkey_map, is_bracket_style)
+    with span('body_text'):
+        body_entries = extract_body_text_from_tei_xml(soup, bibkey_map, refkey_map, is_bracket_style)
+    count('paragraphs', len(body_entries))
 
     # parse back matter (acks, author statements, competing interests, abbrevs etc)
-    back_matter = extract_back_matter_from_tei_xml(soup, bibkey_map, refkey_map, is_bracket_style)
+    with span('back_matter'):
+        back_matter = extract_back_matter_from_tei_xml(soup, bibkey_map, refkey_map, is_bracket_style)
 
     # form final paper entry
     return Paper(
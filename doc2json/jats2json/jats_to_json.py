@@ -1,32 +1,69 @@
 """
 Mostly copied from cite2vec paper_parsing.parse_nxml
+
+The JATS XML is parsed with lxml.etree, leniently: a broken article is converted as far as
+the parser can recover it.
 """
 
-from typing import List, Set, Dict, Callable
+from typing import List, Set, Dict, Callable, Union
 
 import os
 import json
 import re
-import multiprocessing
-from bs4 import BeautifulSoup
-from tqdm import tqdm
-from glob import glob
-from pprint import pprint
+import html
+from lxml import etree
 
-from doc2json.utils.soup_utils import destroy_unimportant_tags_inplace
+from doc2json.utils.instrument_util import span, count
 from doc2json.jats2json.pmc_utils.front_tag_utils import parse_journal_id_tag, parse_journal_name_tag, \
     parse_title_tag, parse_category_tag, parse_date_tag, parse_doi_tag, parse_pmc_id_tag, parse_pubmed_id_tag, \
     parse_authors, parse_affiliations, parse_abstract_tag, parse_funding_groups, NoAuthorNamesError
 from doc2json.jats2json.pmc_utils.extract_utils import extract_fig_blobs, extract_table_blobs, extract_suppl_blobs
-from doc2json.jats2json.pmc_utils.all_tag_utils import replace_xref_with_string_placeholders, \
-    replace_sup_sub_tags_with_string_placeholders, recurse_parse_section
+from doc2json.jats2json.pmc_utils.all_tag_utils import replace_tags_with_string_placeholders, recurse_parse_section, \
+    replace_with_text, get_text, extract
 from doc2json.jats2json.pmc_utils.all_tag_utils import parse_all_paragraphs_in_section
 from doc2json.jats2json.pmc_utils.back_tag_utils import parse_bib_entries
 
 from doc2json.s2orc import Paper
 
 
-def process_front_tag(front_tag, soup) -> Dict:
+# the DTD isn't loaded, entities it would define are left in the tree and resolved as HTML entities
+PARSER_OPTIONS = dict(recover=True, resolve_entities=False, no_network=True, huge_tree=True)
+JATS_PARSER = etree.XMLParser(**PARSER_OPTIONS)
+# for XML that was decoded already, whatever its declaration says
+UTF8_JATS_PARSER = etree.XMLParser(encoding='utf-8', **PARSER_OPTIONS)
+UNIMPORTANT_TAGS = ('bold', 'italic', 'graphic')
+BLANK_TEXT = etree.XPath('//text()[normalize-space()=""]')
+
+
+def parse_jats_xml(jats_xml: Union[str, bytes]):
+    """
+    Parse JATS XML, with formatting tags like <bold> replaced by their contents
+    Text between tags that is only whitespace becomes a single newline (or space), which
+    keeps the text of pretty printed XML as it was with the BeautifulSoup parser.
+    :param jats_xml: contents of a JATS XML file, bytes are decoded as the XML declaration says
+    :return: root element
+    """
+    if isinstance(jats_xml, str):
+        root = etree.fromstring(jats_xml.encode('utf-8'), UTF8_JATS_PARSER)
+    else:
+        root = etree.fromstring(jats_xml, JATS_PARSER)
+    if root is None:
+        raise ValueError('No XML could be parsed')
+    for entity in list(root.iter(etree.Entity)):
+        replace_with_text(entity, html.unescape(entity.text))
+    for text in BLANK_TEXT(root):
+        blank = '\n' if '\n' in text else ' '
+        if text.is_tail:
+            text.getparent().tail = blank
+        else:
+            text.getparent().text = blank
+    # comments separate text nodes until here
+    etree.strip_elements(root, etree.Comment, etree.ProcessingInstruction, with_tail=False)
+    etree.strip_tags(root, *UNIMPORTANT_TAGS)
+    return root
+
+
+def process_front_tag(front_tag) -> Dict:
     # process <journal-meta> tags
     journal_id: str = parse_journal_id_tag(front_tag=front_tag)
     journal_name: str = parse_journal_name_tag(front_tag=front_tag)
@@ -46,7 +83,7 @@ def process_front_tag(front_tag, soup) -> Dict:
     pmc_id: str = parse_pmc_id_tag(front_tag=front_tag)
     doi: str = parse_doi_tag(front_tag=front_tag)
 
-    abstract: List[Dict] = parse_abstract_tag(front_tag=front_tag, soup=soup)
+    abstract: List[Dict] = parse_abstract_tag(front_tag=front_tag)
 
     # categories: str = parse_category_tag(front_tag=front_tag)
 
@@ -67,22 +104,18 @@ def process_front_tag(front_tag, soup) -> Dict:
     }
 
 
-def process_body_tag(body_tag, soup) -> Dict:
-    # replace all xref tags with string placeholders
-    replace_xref_with_string_placeholders(soup_tag=body_tag, soup=soup)
-
-    # replace all sup/sub tags with string placeholders
-    replace_sup_sub_tags_with_string_placeholders(soup_tag=body_tag, soup=soup)
+def process_body_tag(body_tag) -> Dict:
+    # replace all xref and sup/sub tags with string placeholders
+    replace_tags_with_string_placeholders(body_tag)
 
     # some articles (like PMC2844102) have no sections
-    sec_tags = body_tag.find_all('sec', recursive=False)
+    sec_tags = body_tag.findall('sec')
 
     # try looking in article tag
     if not sec_tags:
-        try:
-            sec_tags = body_tag.article.find_all('sec', recursive=False)
-        except:
-            pass
+        article_tag = body_tag.find('.//article')
+        if article_tag is not None:
+            sec_tags = article_tag.findall('sec')
 
     if sec_tags:
         all_par_blobs = []
@@ -116,14 +149,14 @@ def process_back_tag(back_tag) -> Dict:
     # TODO: PMC2778891 has back tag that looks like:  <back><sec><title>Acknowledgements</title><p>Supported by the Austrian Science Fund (P-20670 and W11).</p></sec></back>
     #       that is, it doesn't have 'ack' section.
     acknowledgements: List[Dict] = []
-    for ack_tag in back_tag.find_all('ack'):
-        title_tag = ack_tag.find('title')
-        for par_tag in ack_tag.find_all('p'):
+    for ack_tag in back_tag.iter('ack'):
+        title_tag = ack_tag.find('.//title')
+        for par_tag in ack_tag.iterfind('.//p'):
             acknowledgements.append({
-                'section': title_tag.text if title_tag is not None else None,
-                'text': par_tag.text,
-                'funding_sources': [fund_tag.text for fund_tag in par_tag.find_all('funding-source')],
-                'urls': [url_tag.text for url_tag in par_tag.find_all('ext-link')]
+                'section': get_text(title_tag) if title_tag is not None else None,
+                'text': get_text(par_tag),
+                'funding_sources': [get_text(fund_tag) for fund_tag in par_tag.iter('funding-source')],
+                'urls': [get_text(url_tag) for url_tag in par_tag.iter('ext-link')]
             })
 
     bib_entries = parse_bib_entries(back_tag)
@@ -223,18 +256,32 @@ def convert_jats_xml_to_s2orc_json(jats_file: str, log_dir: str):
     file_id = jats_file.split('/')[-1].split('.')[0]
 
     # read JATS XML
-    with open(jats_file, 'r') as f_in:
-        soup = BeautifulSoup(f_in, 'lxml')
-        destroy_unimportant_tags_inplace(soup, tags_to_remove=['bold', 'italic', 'graphic'])
+    with open(jats_file, 'rb') as f_in:
+        return convert_jats_xml_string_to_s2orc_json(f_in.read(), file_id)
+
+
+def convert_jats_xml_string_to_s2orc_json(jats_xml: Union[str, bytes], file_id: str):
+    """
+    Convert the contents of a JATS XML file to S2ORC JSON, e.g. for articles read from an archive
+    :param jats_xml: bytes are decoded as the XML declaration says
+    :param file_id: paper id, usually the PMC id
+    :return:
+    """
+    with span('parse_xml'):
+        root = parse_jats_xml(jats_xml)
 
     # all the XML files have their own wonky reference IDs.  we want to standardize them, but need to remember the old->new mapping
     old_key_to_new_key = {}
 
     # REFERENCES
-    table_blobs = extract_table_blobs(soup)
-    figure_blobs = extract_fig_blobs(soup)
+    with span('table_map'):
+        table_blobs = extract_table_blobs(root)
+    with span('figure_map'):
+        figure_blobs = extract_fig_blobs(root)
     # TODO: not current represented in S2ORC, keep for later
-    suppl_blobs = extract_suppl_blobs(soup)
+    suppl_blobs = extract_suppl_blobs(root)
+    count('tables', len(table_blobs))
+    count('figures', len(figure_blobs))
     # TODO: for S2ORC, need to process them into a single ref dict.  need to construct new IDs to match ID conventions.  and update all cite spans.
     #       also, S2ORC table captions are free text without detected reference/citation mentions
     # TODO: may want to keep table representations around
@@ -265,17 +312,21 @@ def convert_jats_xml_to_s2orc_json(jats_file: str, log_dir: str):
         ref_entries[new_figure_key] = {'text': figure_text, 'type': 'figure'}
 
     # FRONT TAGS
-    front_tag = soup.find('front').extract()
-    front_dict = process_front_tag(front_tag=front_tag, soup=soup)
-    front_dict = postprocess_front_tags_for_s2orc(front_dict)
-    front_dict['abstract'] = convert_paragraphs_to_s2orc(front_dict['abstract'], old_key_to_new_key)
+    with span('metadata'):
+        front_tag = extract(root.find('.//front'))
+        front_dict = process_front_tag(front_tag=front_tag)
+        front_dict = postprocess_front_tags_for_s2orc(front_dict)
+    with span('abstract'):
+        front_dict['abstract'] = convert_paragraphs_to_s2orc(front_dict['abstract'], old_key_to_new_key)
 
     # BACK TAGS
-    back_tag = soup.find('back')
+    back_tag = root.find('.//back')
     back_dict = {}
     # PMC1139917 doesnt have 'back' tag
     if back_tag is not None:
-        back_dict = process_back_tag(back_tag=back_tag)
+        with span('bibliography'):
+            back_dict = process_back_tag(back_tag=back_tag)
+        count('bib_entries', len(back_dict['bib_entries']))
         # TODO: format bib entries to S2ORC format.  we're already very close, but need a couple changes:
         #       - author blobs include a 'suffix' which defaults to empty string
         #       - issn defaults to empty string
@@ -293,16 +344,18 @@ def convert_jats_xml_to_s2orc_json(jats_file: str, log_dir: str):
         back_dict['acknowledgements'] = convert_acks_to_s2orc(back_dict['acknowledgements'])
 
     # BODY TAGS
-    body_tag = soup.find('body')
+    body_tag = root.find('.//body')
     # PMC1240684 doesnt have 'body' tag
-    if body_tag is not None:
-        body_dict = process_body_tag(body_tag=body_tag, soup=soup)
-        body_text = body_dict['body_text']
-    else:
-        # Has no body: /disk2/gorpus/20200101/pmc/Br_Foreign_Med_Chir_Rev/PMC5163425.nxml
-        body_text = []
-
-    body_text = convert_paragraphs_to_s2orc(body_text, old_key_to_new_key)
+    with span('body_text'):
+        if body_tag is not None:
+            body_dict = process_body_tag(body_tag=body_tag)
+            body_text = body_dict['body_text']
+        else:
+            # Has no body: /disk2/gorpus/20200101/pmc/Br_Foreign_Med_Chir_Rev/PMC5163425.nxml
+            body_text = []
+
+        body_text = convert_paragraphs_to_s2orc(body_text, old_key_to_new_key)
+    count('paragraphs', len(body_text))
 
     metadata = {
         "title": front_dict['title'],
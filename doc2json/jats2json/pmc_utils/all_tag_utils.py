@@ -1,34 +1,91 @@
-from typing import Dict, List, Callable
+"""
+Helpers shared by the parsers of the front, body and back of JATS XML trees
+
+Tags are lxml.etree elements; `get_text` is the text of a tag with all its descendants, and
+tags that become text (xrefs, sup/sub, formulas) are replaced by strings joined to the text
+around them.
+"""
+
+from typing import Dict, List, Callable, Optional
 
 import re
 import itertools
 
-from bs4 import BeautifulSoup
+from lxml import etree
 
 START_TOKENS = {"#!start#", "@!start@", "&!start&"}
 SEP_TOKENS = {"#!sep#"}
 END_TOKENS = {"#!end#", "@!end@", "&!end&"}
 ALL_TOKENS = START_TOKENS | SEP_TOKENS | END_TOKENS
 
+MML_NAMESPACE = 'http://www.w3.org/1998/Math/MathML'
+XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
+# MathML without a declared namespace keeps its prefix in the tag name
+MATH_TAGS = (f'{{{MML_NAMESPACE}}}math', 'mml:math')
+XLINK_HREF_ATTRIBUTES = (f'{{{XLINK_NAMESPACE}}}href', 'xlink:href')
+NAMESPACE_DECLARATION = re.compile(r'\s+xmlns(?::[\w.-]+)?="[^"]*"')
 
-def replace_xref_with_string_placeholders(soup_tag, soup):
-    # replace all xref tags with string placeholders
-    for xref_tag in soup_tag.find_all("xref"):
-        rid = xref_tag['rid'] if 'rid' in xref_tag.attrs else None
-        ref_type = xref_tag['ref-type'] if 'ref-type' in xref_tag.attrs else None
-        xref_tag.replace_with(
-            soup.new_string(
-                f"#!start#{xref_tag.text}#!sep#{rid}#!sep#{ref_type}#!end#"
-            )
-        )
 
+def get_text(tag) -> str:
+    """Text of a tag and its descendants, without the tail of the tag"""
+    return ''.join(tag.itertext())
+
+
+def to_string(tag) -> str:
+    """XML of a tag, without the namespace declarations lxml copies from its ancestors"""
+    xml = etree.tostring(tag, encoding='unicode', with_tail=False)
+    end = xml.index('>')
+    return NAMESPACE_DECLARATION.sub('', xml[:end]) + xml[end:]
+
+
+def get_xlink_href(tag) -> Optional[str]:
+    for attribute in XLINK_HREF_ATTRIBUTES:
+        if tag.get(attribute):
+            return tag.get(attribute)
+    return None
 
-def replace_sup_sub_tags_with_string_placeholders(soup_tag, soup):
-    # replace all sup/sub tags with string placeholders
-    for sup_tag in soup_tag.find_all("sup"):
-        sup_tag.replace_with(soup.new_string(f"@!start@{sup_tag.text}@!end@"))
-    for sub_tag in soup_tag.find_all("sub"):
-        sub_tag.replace_with(soup.new_string(f"&!start&{sub_tag.text}&!end&"))
+
+def replace_with_text(tag, text: str):
+    """Replace a tag and its descendants with a string, merged into the text around it"""
+    parent = tag.getparent()
+    if parent is None:
+        return
+    text += tag.tail or ''
+    tag.tail = None
+    previous = tag.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or '') + text
+    else:
+        parent.text = (parent.text or '') + text
+    parent.remove(tag)
+
+
+def extract(tag):
+    """Remove a tag from its tree, leaving the text after it in place"""
+    replace_with_text(tag, '')
+    return tag
+
+
+def replace_tags_with_string_placeholders(tag):
+    """
+    Replace all xref, sup and sub tags with string placeholders
+    The tags are collected in one walk; xrefs are replaced first, so the placeholders of
+    sup/sub tags containing xrefs contain the xref placeholders, and sup before sub.
+    :param tag:
+    :return:
+    """
+    placeholder_tags = list(tag.iterdescendants('xref', 'sup', 'sub'))
+    for xref_tag in placeholder_tags:
+        if xref_tag.tag == 'xref':
+            rid = xref_tag.get('rid')
+            ref_type = xref_tag.get('ref-type')
+            replace_with_text(xref_tag, f"#!start#{get_text(xref_tag)}#!sep#{rid}#!sep#{ref_type}#!end#")
+    for sup_tag in placeholder_tags:
+        if sup_tag.tag == 'sup':
+            replace_with_text(sup_tag, f"@!start@{get_text(sup_tag)}@!end@")
+    for sub_tag in placeholder_tags:
+        if sub_tag.tag == 'sub':
+            replace_with_text(sub_tag, f"&!start&{get_text(sub_tag)}&!end&")
 
 
 def recurse_parse_section(
@@ -42,13 +99,14 @@ def recurse_parse_section(
             'section': SUBSUBSECTION_NAME :: SUBSECTION_NAME :: SECTION_NAME
         }
     """
-    subsections = sec_tag.find_all("sec", recursive=False)
+    subsections = sec_tag.findall("sec")
     if not subsections:
         return parse_all_paragraphs_in_section(
             sec_tag=sec_tag
         )  # , suppl_blobs=suppl_blobs)
     else:
         outputs = []
+        title = get_text(sec_tag.find(".//title"))
         for child in subsections:
             child_blobs = recurse_parse_section(
                 sec_tag=child
@@ -57,7 +115,7 @@ def recurse_parse_section(
                 # PMC373254 - process blob['section'] to remove any span markers left in there
                 for t in ALL_TOKENS:
                     blob['section'] = blob['section'].replace(t, '')
-                blob["section"] = blob["section"] + " :: " + sec_tag.find("title").text
+                blob["section"] = blob["section"] + " :: " + title
             outputs.extend(child_blobs)
         return outputs
 
@@ -123,178 +181,198 @@ def _add_spans(
 def get_latex_from_formula(
     formula_tag
 ):
-    if formula_tag.find('tex-math'):
-        latex_text = formula_tag.find('tex-math').text
+    tex_math_tag = formula_tag.find('.//tex-math')
+    if tex_math_tag is not None:
+        latex_text = get_text(tex_math_tag)
         match = re.search(r'\\begin\{document\}(.+)\\end\{document\}', latex_text)
         if match:
             return match.group(1).strip('$')
     return None
 
 
+def get_math_tag(formula_tag):
+    return next(formula_tag.iterdescendants(*MATH_TAGS), None)
+
+
 def get_mathml_from_formula(
     formula_tag
 ):
-    if formula_tag.find('mml:math'):
-        return str(formula_tag.find('mml:math'))
+    math_tag = get_math_tag(formula_tag)
+    if math_tag is not None:
+        return to_string(math_tag)
     return None
 
 
 def parse_formulas(
     para_el,
-    sp,
     replace
 ):
     # sub and get corresponding spans of inline formulas
     formula_dict = dict()
     eq_ind = 0
-    for ftag in para_el.find_all('inline-formula'):
+    for ftag in list(para_el.iterdescendants('inline-formula')):
         try:
             formula_key = f'INLINEFORM{eq_ind}'
             eq_ind += 1
-            try:
-                formula_text = ftag.find('mml:math').text
-            except:
-                if 'begin{document}' not in ftag.text:
-                    formula_text = ftag.text
-                else:
-                    formula_text = "FORMULA"
+            math_tag = get_math_tag(ftag)
+            if math_tag is not None:
+                formula_text = get_text(math_tag)
+            elif 'begin{document}' not in get_text(ftag):
+                formula_text = get_text(ftag)
+            else:
+                formula_text = "FORMULA"
             formula_latex = get_latex_from_formula(ftag)
             formula_mathml = get_mathml_from_formula(ftag)
             if not formula_mathml and formula_latex:
+                import latex2mathml.converter
                 formula_mathml = latex2mathml.converter.convert(formula_latex)
             formula_dict[formula_key] = (formula_text, formula_latex, formula_mathml, ftag.get('id'))
             if replace:
-                ftag.replace_with(sp.new_string(f" {formula_key} "))
+                replace_with_text(ftag, f" {formula_key} ")
             else:
                 # replace with mathml text if available
                 if formula_text != 'FORMULA':
-                    ftag.replace_with(sp.new_string(f" {formula_text} "))
+                    replace_with_text(ftag, f" {formula_text} ")
         except AttributeError:
             continue
 
     return formula_dict
 
 
+def parse_paragraph_text(
+    par_text: str,
+    section: str,
+    formula_dict: Dict
+) -> Dict:
+    """Paragraph blob of the text of a paragraph with string placeholders; the placeholders become spans"""
+    cite_spans = []
+    fig_spans = []
+    table_spans = []
+    # suppl_spans = []
+    sup_spans = []
+    sub_spans = []
+
+    par_text = re.sub(
+        r"[^\S\n\t]", " ", par_text
+    )  # replaces whitespace but not newline or tab
+    par_text = re.sub(
+        r"  ", " ", par_text
+    )  # replaces two spaces w/ one
+
+    # Tokenize the text into normal text and special placeholder tokens.
+    pattern = r"(#!start#)|(#!sep#)|(#!end#)|(@!start@)|(@!end@)|(&!start&)|(&!end&)"
+    tokens = [tok for tok in re.split(pattern, par_text) if tok]
+
+    # To handle nested structures, use a shift-reduce algorithm to consume the text. Placeholder tags are merged away, and related spans are registered.
+    stack = []
+    full_text = []
+    pos = 0
+    disable_count = False
+    for token in tokens:
+        if token in START_TOKENS:
+            stack.append(token)
+            stack.append(pos)
+            stack.append(token.replace('start', 'sep'))
+        elif token in SEP_TOKENS:
+            assert stack
+            stack.append(token)
+            disable_count = True
+        elif token in END_TOKENS:
+            assert stack
+            disable_count = False
+            args = _reduce_args(stack, token)
+            start_pos = args[0][0]
+            text = "".join(args[1])
+            assert len(args) == 2 or len(args) == 4
+            if len(args) == 2:
+                ref_id, ref_type = None, None
+            elif len(args) == 4:
+                ref_id = args[2] and args[2][0]
+                ref_type = args[3] and args[3][0]
+            stack.append(text)
+            _add_spans(
+                token,
+                start_pos,
+                text,
+                ref_id,
+                ref_type,
+                cite_spans,
+                fig_spans,
+                table_spans,
+                sup_spans,
+                sub_spans,
+            )
+        else:  # just normal text
+            stack.append(token)
+            if not disable_count:  # metadata appearing after a separator
+                full_text.append(token)
+                pos += len(token)
+
+    full_text = "".join(full_text)
+    assert pos == len(full_text)
+
+    # get all equation spans
+    eq_spans = []
+    for span in itertools.chain(
+            re.finditer(r'(INLINEFORM\d+)', full_text),
+            re.finditer(r'(DISPLAYFORM\d+)', full_text)
+    ):
+        try:
+            matching_formula = formula_dict[span.group()]
+            eq_spans.append({
+                "start": span.start(),
+                "end": span.start() + len(span.group()),
+                "text": matching_formula[0],
+                "latex": matching_formula[1],
+                "mathml": matching_formula[2],
+                "ref_id": span.group()
+            })
+        except KeyError:
+            continue
+
+    return {
+        "text": full_text,
+        'cite_spans': cite_spans,
+        'fig_spans': fig_spans,
+        'table_spans': table_spans,
+        # 'suppl_spans': suppl_spans,
+        'sup_spans': sup_spans,
+        'sub_spans': sub_spans,
+        'eq_spans': eq_spans,
+        "section": section,
+    }
+
+
+def parse_paragraph(
+    par_tag,
+    section: str,
+    par_to_text: Callable = None,
+    replace_formula=True
+) -> Dict:
+    """Paragraph blob of a `p` tag, see `parse_all_paragraphs_in_section`"""
+    if par_tag.find('.//display-formula') is not None:
+        raise NotImplementedError('Display formula!')
+
+    if par_tag.find('.//formula') is not None:
+        raise NotImplementedError('Formula!')
+
+    formula_dict = parse_formulas(par_tag, replace_formula)
+
+    par_text = par_to_text(par_tag) if par_to_text else get_text(par_tag)
+    return parse_paragraph_text(par_text, section, formula_dict)
+
+
 def parse_all_paragraphs_in_section(
     sec_tag,
     par_to_text: Callable = None,
     replace_formula=True
 ) -> List[Dict]:
     """Internal function. Assumes section has no nested tags
-    `par_to_text` is an optional function that converts the `par` tag into a string.  by default, calls `par_tag.text`.
+    `par_to_text` is an optional function that converts the `par` tag into a string.  by default, calls `get_text`.
     """
-    outputs = []
-    sp = BeautifulSoup('', 'lxml')
-    for par_tag in sec_tag.find_all("p", recursive=True):
-        cite_spans = []
-        fig_spans = []
-        table_spans = []
-        # suppl_spans = []
-        sup_spans = []
-        sub_spans = []
-        eq_spans = []
-
-        if par_tag.find('display-formula'):
-            raise NotImplementedError('Display formula!')
-
-        if par_tag.find('formula'):
-            raise NotImplementedError('Formula!')
-
-        formula_dict = parse_formulas(par_tag, sp, replace_formula)
-
-        par_text = par_to_text(par_tag) if par_to_text else par_tag.text
-        par_text = re.sub(
-            r"[^\S\n\t]", " ", par_text
-        )  # replaces whitespace but not newline or tab
-        par_text = re.sub(
-            r"  ", " ", par_text
-        )  # replaces two spaces w/ one
-
-        # Tokenize the text into normal text and special placeholder tokens.
-        pattern = r"(#!start#)|(#!sep#)|(#!end#)|(@!start@)|(@!end@)|(&!start&)|(&!end&)"
-        tokens = [tok for tok in re.split(pattern, par_text) if tok]
-
-        # To handle nested structures, use a shift-reduce algorithm to consume the text. Placeholder tags are merged away, and related spans are registered.
-        stack = []
-        full_text = []
-        pos = 0
-        disable_count = False
-        for token in tokens:
-            if token in START_TOKENS:
-                stack.append(token)
-                stack.append(pos)
-                stack.append(token.replace('start', 'sep'))
-            elif token in SEP_TOKENS:
-                assert stack
-                stack.append(token)
-                disable_count = True
-            elif token in END_TOKENS:
-                assert stack
-                disable_count = False
-                args = _reduce_args(stack, token)
-                start_pos = args[0][0]
-                text = "".join(args[1])
-                assert len(args) == 2 or len(args) == 4
-                if len(args) == 2:
-                    ref_id, ref_type = None, None
-                elif len(args) == 4:
-                    ref_id = args[2] and args[2][0]
-                    ref_type = args[3] and args[3][0]
-                stack.append(text)
-                _add_spans(
-                    token,
-                    start_pos,
-                    text,
-                    ref_id,
-                    ref_type,
-                    cite_spans,
-                    fig_spans,
-                    table_spans,
-                    sup_spans,
-                    sub_spans,
-                )
-            else:  # just normal text
-                stack.append(token)
-                if not disable_count:  # metadata appearing after a separator
-                    full_text.append(token)
-                    pos += len(token)
-
-        full_text = "".join(full_text)
-        assert pos == len(full_text)
-
-        title = sec_tag.find("title")
-        title = title.text if title else ""
-
-        # get all equation spans
-        eq_spans = []
-        for span in itertools.chain(
-                re.finditer(r'(INLINEFORM\d+)', full_text),
-                re.finditer(r'(DISPLAYFORM\d+)', full_text)
-        ):
-            try:
-                matching_formula = formula_dict[span.group()]
-                eq_spans.append({
-                    "start": span.start(),
-                    "end": span.start() + len(span.group()),
-                    "text": matching_formula[0],
-                    "latex": matching_formula[1],
-                    "mathml": matching_formula[2],
-                    "ref_id": span.group()
-                })
-            except KeyError:
-                continue
-
-        outputs.append(
-            {
-                "text": full_text,
-                'cite_spans': cite_spans,
-                'fig_spans': fig_spans,
-                'table_spans': table_spans,
-                # 'suppl_spans': suppl_spans,
-                'sup_spans': sup_spans,
-                'sub_spans': sub_spans,
-                'eq_spans': eq_spans,
-                "section": title,
-            }
-        )
-    return outputs
+    title = sec_tag.find(".//title")
+    title = get_text(title) if title is not None else ""
+    return [
+        parse_paragraph(par_tag, title, par_to_text, replace_formula)
+        for par_tag in sec_tag.findall(".//p")
+    ]
@@ -1,56 +1,58 @@
 from typing import Dict, List
 
+from doc2json.jats2json.pmc_utils.all_tag_utils import get_text
+
 
 def _wrap_text(tag):
-    return tag.text if tag else ''
+    return get_text(tag) if tag is not None else ''
 
 
 def parse_authors(authors_tag) -> List:
     """The PMC XML has a slightly different format than authors listed in front tag."""
-    if not authors_tag:
+    if authors_tag is None:
         return []
 
     authors = []
-    for name_tag in authors_tag.find_all('name', recursive=False):
-        surname = name_tag.find('surname')
-        given_names = name_tag.find('given-names')
-        given_names = given_names.text.split(' ') if given_names else None
-        suffix = name_tag.find('suffix')
+    for name_tag in authors_tag.findall('name'):
+        surname = name_tag.find('.//surname')
+        given_names = name_tag.find('.//given-names')
+        given_names = get_text(given_names).split(' ') if given_names is not None else None
+        suffix = name_tag.find('.//suffix')
         authors.append({
             'first': given_names[0] if given_names else '',
             'middle': given_names[1:] if given_names else [],
-            'last': surname.text if surname else '',
-            'suffix': suffix.text if suffix else ''
+            'last': _wrap_text(surname),
+            'suffix': _wrap_text(suffix)
         })
     return authors
 
 
 def parse_bib_entries(back_tag) -> Dict:
     bib_entries = {}
-    # TODO: PMC2778891 does not have 'ref-list' in its back_tag.  do we even need this, or can directly .find_all('ref')?
-    ref_list_tag = back_tag.find('ref-list')
-    if ref_list_tag:
-        for ref_tag in ref_list_tag.find_all('ref'):
+    # TODO: PMC2778891 does not have 'ref-list' in its back_tag.  do we even need this, or can directly .iter('ref')?
+    ref_list_tag = back_tag.find('.//ref-list')
+    if ref_list_tag is not None:
+        for ref_tag in ref_list_tag.iter('ref'):
             # The ref ID and label are semantically swapped between CORD-19 and PMC, lol
-            ref_label = ref_tag['id']
-            ref_id = ref_tag.find('label')
-            authors_tag = ref_tag.find('person-group', {'person-group-type': 'author'})
-            year = ref_tag.find('year')
-            fpage = ref_tag.find('fpage')
-            lpage = ref_tag.find('lpage')
-            pages = f'{fpage.text}-{lpage.text}' if fpage and lpage else None
-            dois = [tag.text for tag in ref_tag.find_all('pub-id', {'pub-id-type': 'doi'})]
+            ref_label = ref_tag.attrib['id']
+            ref_id = ref_tag.find('.//label')
+            authors_tag = ref_tag.find('.//person-group[@person-group-type="author"]')
+            year = ref_tag.find('.//year')
+            fpage = ref_tag.find('.//fpage')
+            lpage = ref_tag.find('.//lpage')
+            pages = f'{get_text(fpage)}-{get_text(lpage)}' if fpage is not None and lpage is not None else None
+            dois = [get_text(tag) for tag in ref_tag.iterfind('.//pub-id[@pub-id-type="doi"]')]
             bib_entries[ref_label] = {
                 'ref_id': _wrap_text(ref_id),
-                'title': _wrap_text(ref_tag.find('article-title')),
+                'title': _wrap_text(ref_tag.find('.//article-title')),
                 'authors': parse_authors(authors_tag),
-                'year': int(year.text) if year and year.text.isdigit() else None,
-                'venue': _wrap_text(ref_tag.find('source')),
-                'volume': _wrap_text(ref_tag.find('volume')),
-                'issn': _wrap_text(ref_tag.find('issue')),
+                'year': int(get_text(year)) if year is not None and get_text(year).isdigit() else None,
+                'venue': _wrap_text(ref_tag.find('.//source')),
+                'volume': _wrap_text(ref_tag.find('.//volume')),
+                'issn': _wrap_text(ref_tag.find('.//issue')),
                 'pages': pages,
                 'other_ids': {
                     'DOI': dois,
                 }
             }
-    return bib_entries
\ No newline at end of file
+    return bib_entries
\ No newline at end of file
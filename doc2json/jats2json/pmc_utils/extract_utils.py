@@ -1,21 +1,22 @@
-
 from typing import Dict
 
-import bs4
-from bs4 import BeautifulSoup
+from doc2json.jats2json.pmc_utils.all_tag_utils import parse_all_paragraphs_in_section, parse_paragraph, \
+    parse_paragraph_text, get_text, to_string, extract
+
 
-from doc2json.jats2json.pmc_utils.all_tag_utils import parse_all_paragraphs_in_section
+def _get_label(tag):
+    label = tag.find('.//label')
+    return get_text(label) if label is not None else None
 
 
 def extract_fig_blobs(body_tag) -> Dict:
     fig_blobs = {}
-    for fig_tag in body_tag.find_all('fig'):
-        fig = fig_tag.extract()
-        label = fig.find('label')
-        if fig.has_attr('id'):
-            fig_blobs[fig['id']] = {
-                'label': label and label.text,
-                'caption': fig.find('caption'),
+    for fig in list(body_tag.iter('fig')):
+        extract(fig)
+        if fig.get('id') is not None:
+            fig_blobs[fig.get('id')] = {
+                'label': _get_label(fig),
+                'caption': fig.find('.//caption'),
             }
     _update_fig_blobs(fig_blobs)
     return fig_blobs
@@ -27,29 +28,33 @@ def _update_fig_blobs(fig_blobs: Dict):
             continue
         # replace non-p tags w/ p tags in figure caption (mostly dealing with title tags, which weren't being extracted before)
         for tag in fig_blob['caption']:
-            if type(tag) == bs4.element.Tag and tag.name != 'p':
-                tag.name = 'p'
+            if tag.tag != 'p':
+                tag.tag = 'p'
         par_blobs = parse_all_paragraphs_in_section(sec_tag=fig_blob['caption'], replace_formula=False)
         for par_blob in par_blobs:
             del par_blob['section']
         fig_blob['caption'] = par_blobs
 
 
+def _table_to_text(table_tag) -> str:
+    # the table XML in a fake <p> paragraph tag
+    return '<p>' + to_string(table_tag) + '</p>'
+
+
 def extract_table_blobs(body_tag) -> Dict:
     # note 1: footnotes dont always exist for each table; hence the if statement
     # note 2: we want to preserve the XML tags for tables, but also need to run it through the regex cleaner for xrefs and other spans
-    #         hence, wrapping all of the table XML text into a fake <p> paragraph tag
+    #         hence, converting the table to XML text wrapped into a fake <p> paragraph tag
     table_blobs = {}
-    for table_tag in body_tag.find_all('table-wrap'):
-        table = table_tag.extract()
-        label = table.find('label')
+    for table in list(body_tag.iter('table-wrap')):
+        extract(table)
         # TODO: currently restricting to tables with identifiers.  might want to include unreferenced tables once we care more.
         if table.get('id'):
-            table_blobs[table['id']] = {
-                'label': label and label.text,
-                'caption': table.find('caption'),
-                'footnote': table.find('table-wrap-foot') if table.find('table-wrap-foot') else BeautifulSoup('<p></p>', 'xml'),
-                'xml': BeautifulSoup('<p>' + str(table.find('table')) + '</p>', 'xml')
+            table_blobs[table.get('id')] = {
+                'label': _get_label(table),
+                'caption': table.find('.//caption'),
+                'footnote': table.find('.//table-wrap-foot'),
+                'xml': table.find('.//table')
             }
     _update_table_blobs(table_blobs)
     return table_blobs
@@ -60,38 +65,42 @@ def _update_table_blobs(table_blobs: Dict):
         if table_blob['caption'] is not None:
             # replace non-p tags w/ p tags in table caption (mostly dealing with title tags, which weren't being extracted before)
             for tag in table_blob['caption']:
-                if type(tag) == bs4.element.Tag and tag.name != 'p':
-                    tag.name = 'p'
+                if tag.tag != 'p':
+                    tag.tag = 'p'
             par_blobs = parse_all_paragraphs_in_section(sec_tag=table_blob['caption'], replace_formula=False)
             for par_blob in par_blobs:
                 del par_blob['section']
             table_blob['caption'] = par_blobs
         if table_blob['footnote'] is not None:
             par_blobs = parse_all_paragraphs_in_section(sec_tag=table_blob['footnote'], replace_formula=False)
-            for par_blob in par_blobs:
-                del par_blob['section']
-            table_blob['footnote'] = par_blobs
-        # note: if we dont include `par_to_text` function, the parser will convert all <p> tags to text via `par_tag.text`
+        else:
+            # tables without footnotes get an empty one
+            par_blobs = [parse_paragraph_text('', '', {})]
+        for par_blob in par_blobs:
+            del par_blob['section']
+        table_blob['footnote'] = par_blobs
+        # note: if we dont include `par_to_text` function, the parser will convert the table to text via `get_text`
         #       which actually removes all XML tags we wanted to preserve in table.
-        #       by passing in str(), we ensure to keep all of those tags
+        #       by passing in `_table_to_text`, we ensure to keep all of those tags
         if table_blob['xml'] is not None:
-            par_blobs = parse_all_paragraphs_in_section(sec_tag=table_blob['xml'], par_to_text=str, replace_formula=False)
-            for par_blob in par_blobs:
-                del par_blob['section']
-            table_blob['xml'] = par_blobs
+            par_blob = parse_paragraph(table_blob['xml'], '', par_to_text=_table_to_text, replace_formula=False)
+        else:
+            # tables given as images only
+            par_blob = parse_paragraph_text('<p>None</p>', '', {})
+        del par_blob['section']
+        table_blob['xml'] = [par_blob]
 
 
 def extract_suppl_blobs(body_tag) -> Dict:
     suppl_blobs = {}
-    for suppl_tag in body_tag.find_all('supplementary-material'):
-        suppl = suppl_tag.extract()
+    for suppl in list(body_tag.iter('supplementary-material')):
+        extract(suppl)
         # We only care about supplementary material that can be referenced (like figures/tables)
         # for example, we dont care about PMC1139917 which has supplementary material but without an ID
-        if 'id' in suppl:
-            label = suppl.find('label')
-            suppl_blobs[suppl['id']] = {
-                'label': label and label.text,
-                'caption': suppl.find('caption')
+        if suppl.get('id') is not None:
+            suppl_blobs[suppl.get('id')] = {
+                'label': _get_label(suppl),
+                'caption': suppl.find('.//caption')
             }
     _update_suppl_blobs(suppl_blobs)
     return suppl_blobs
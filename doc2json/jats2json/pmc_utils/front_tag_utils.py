@@ -1,6 +1,6 @@
 """
 
-Functions for parsing specific `front_tag` soup tags
+Functions for parsing specific `front_tag` tags
 
 """
 
@@ -12,7 +12,7 @@ import re
 
 
 from doc2json.jats2json.pmc_utils.all_tag_utils import recurse_parse_section, parse_all_paragraphs_in_section, \
-    replace_sup_sub_tags_with_string_placeholders, replace_xref_with_string_placeholders
+    replace_tags_with_string_placeholders, get_text, get_xlink_href, extract
 
 
 class NoAuthorNamesError(Exception):
@@ -24,7 +24,7 @@ class NoAuthorNamesError(Exception):
 
 def parse_journal_id_tag(front_tag) -> str:
     """
-    front_tag.find_all('journal-id') returns:
+    front_tag.findall('.//journal-id') returns:
         [
             <journal-id journal-id-type="nlm-ta">Neurosci J</journal-id>,
             <journal-id journal-id-type="iso-abbrev">Neurosci J</journal-id>,
@@ -36,9 +36,9 @@ def parse_journal_id_tag(front_tag) -> str:
         ]
     """
     c = Counter()
-    for tag in front_tag.find_all('journal-id'):
-        c[tag.text] += 1
-        tag.decompose()
+    for tag in front_tag.findall('.//journal-id'):
+        c[get_text(tag)] += 1
+        extract(tag)
 
     # if the counter is empty, the 'journal-id' tag could not be found.
     if not c:
@@ -70,31 +70,31 @@ def parse_journal_name_tag(front_tag) -> str:
             </journal-title>
         ...
     """
-    if len(front_tag.find_all('journal-title')) > 1:
+    journal_title_tags = front_tag.findall('.//journal-title')
+    if len(journal_title_tags) > 1:
         raise Exception('Multiple journal titles?!')
-    journal_title_tag = front_tag.find('journal-title')
-    return journal_title_tag.extract().text if journal_title_tag else ""
+    return get_text(extract(journal_title_tags[0])) if journal_title_tags else ""
 
 
 def parse_pubmed_id_tag(front_tag) -> Optional[str]:
     """Not every PMC paper has a PMID """
-    pmid_tag = front_tag.find('article-id', {'pub-id-type': 'pmid'})
+    pmid_tag = front_tag.find('.//article-id[@pub-id-type="pmid"]')
     if pmid_tag is None:
         return None
     else:
-        return pmid_tag.extract().text
+        return get_text(extract(pmid_tag))
 
 
 def parse_pmc_id_tag(front_tag) -> str:
-    pmc_tag = front_tag.find('article-id', {'pub-id-type': 'pmc'})
-    return f"PMC{pmc_tag.extract().text}" if pmc_tag else ""
+    pmc_tag = front_tag.find('.//article-id[@pub-id-type="pmc"]')
+    return f"PMC{get_text(extract(pmc_tag))}" if pmc_tag is not None else ""
 
 
 def parse_doi_tag(front_tag) -> Optional[str]:
     """Not all papers have a DOI"""
-    doi_tag = front_tag.find('article-id', {'pub-id-type': 'doi'})
+    doi_tag = front_tag.find('.//article-id[@pub-id-type="doi"]')
     if doi_tag is not None:
-        return doi_tag.extract().text
+        return get_text(extract(doi_tag))
     else:
         return None
 
@@ -113,13 +113,13 @@ def parse_title_tag(front_tag) -> str:
 
     Want to restrict to `title-group` because sometimes title shows up in <notes> under self-citation
     """
-    search = front_tag.find('title-group')
-    if not search:
+    search = front_tag.find('.//title-group')
+    if search is None:
         return ""
-    title_group = search.extract()
-    if len(title_group.find_all('article-title')) > 1:
+    title_group = extract(search)
+    if len(title_group.findall('.//article-title')) > 1:
         raise Exception('Multiple article titles?!')
-    return title_group.find('article-title').text
+    return get_text(title_group.find('.//article-title'))
 
 
 def parse_category_tag(front_tag) -> List[str]:
@@ -138,10 +138,10 @@ def parse_category_tag(front_tag) -> List[str]:
             </subj-group>
         </article-categories>
     """
-    if len(front_tag.find_all('subj-group')) > 1 or len(front_tag.find_all('subject')) > 1:
+    if len(front_tag.findall('.//subj-group')) > 1 or len(front_tag.findall('.//subject')) > 1:
         raise Exception('Multiple categories?!')
-    article_categories = front_tag.find('article-categories').extract()
-    return article_categories.find('subject').text
+    article_categories = extract(front_tag.find('.//article-categories'))
+    return get_text(article_categories.find('.//subject'))
 
 
 def parse_date_tag(front_tag) -> Dict:
@@ -177,27 +177,27 @@ def parse_date_tag(front_tag) -> Dict:
     PMC2557072 has `date` tag with no `day`, only `year` and `month`
     """
     out = {}
-    for pub_date in front_tag.find_all('pub-date'):
-        year = pub_date.find('year')
-        month = pub_date.find('month')
-        day = pub_date.find('day')
-        out[pub_date.get('pub-type', 'MISSING_PUB_TYPE')] = '-'.join([tag.text for tag in [year, month, day] if tag is not None])
-        pub_date.decompose()
-    for date in front_tag.find_all('date'):
-        year = date.find('year')
-        month = date.find('month')
-        day = date.find('day')
-        out[date.get('date-type', 'MISSING_DATE_TYPE')] = '-'.join([tag.text for tag in [year, month, day] if tag is not None])
-        date.decompose()
+    for pub_date in front_tag.findall('.//pub-date'):
+        year = pub_date.find('.//year')
+        month = pub_date.find('.//month')
+        day = pub_date.find('.//day')
+        out[pub_date.get('pub-type', 'MISSING_PUB_TYPE')] = '-'.join([get_text(tag) for tag in [year, month, day] if tag is not None])
+        extract(pub_date)
+    for date in front_tag.findall('.//date'):
+        year = date.find('.//year')
+        month = date.find('.//month')
+        day = date.find('.//day')
+        out[date.get('date-type', 'MISSING_DATE_TYPE')] = '-'.join([get_text(tag) for tag in [year, month, day] if tag is not None])
+        extract(date)
     return out
 
 
 def parse_funding_groups(front_tag) -> List[str]:
     outs = []
-    for tag in front_tag.find_all():
+    for tag in list(front_tag.iterdescendants('funding-source', 'funding-statement')):
 
         # AND statement skips cases where the two tag types nest within each other; we only process the inner one
-        if (tag.name == 'funding-source' or tag.name == 'funding-statement') and tag.find('funding-source') is None and tag.find('funding-statement') is None:
+        if tag.find('.//funding-source') is None and tag.find('.//funding-statement') is None:
 
             out = {
                 'name': None,
@@ -207,25 +207,25 @@ def parse_funding_groups(front_tag) -> List[str]:
             }
 
             # handle institution
-            institution_id_tag = tag.find('institution-id')
-            if institution_id_tag:
-                out['doi'] = institution_id_tag.extract().text.replace('http://dx.doi.org/', '')
-            institution_tag = tag.find('institution')
-            if institution_tag:
-                out['name'] = tag.find('institution').extract().text
+            institution_id_tag = tag.find('.//institution-id')
+            if institution_id_tag is not None:
+                out['doi'] = get_text(extract(institution_id_tag)).replace('http://dx.doi.org/', '')
+            institution_tag = tag.find('.//institution')
+            if institution_tag is not None:
+                out['name'] = get_text(extract(institution_tag))
 
             # handle named content
-            funder_name_tag = tag.find('named-content', {'content-type': 'funder-name'})
-            if funder_name_tag:
-                out['name'] = funder_name_tag.extract().text
+            funder_name_tag = tag.find('.//named-content[@content-type="funder-name"]')
+            if funder_name_tag is not None:
+                out['name'] = get_text(extract(funder_name_tag))
 
-            funder_id_tag = tag.find('named-content', {'content-type': 'funder-identifier'})
-            if funder_id_tag:
-                out['doi'] = funder_id_tag.extract().text.replace('http://dx.doi.org/', '')
+            funder_id_tag = tag.find('.//named-content[@content-type="funder-identifier"]')
+            if funder_id_tag is not None:
+                out['doi'] = get_text(extract(funder_id_tag)).replace('http://dx.doi.org/', '')
 
             # handle urls
-            if tag.get('xlink:href'):
-                out['doi'] = tag['xlink:href']
+            if get_xlink_href(tag):
+                out['doi'] = get_xlink_href(tag)
 
             # fix DOIs with URLs in them
             if out['doi']:
@@ -234,8 +234,8 @@ def parse_funding_groups(front_tag) -> List[str]:
                     out['doi'] = match.group(2)
 
             # remainder text is either a name or a full statement
-            text = tag.text
-            if tag.name == 'funding-statement' or ('fund' in text or 'support' in text or 'provide' in text):
+            text = get_text(tag)
+            if tag.tag == 'funding-statement' or ('fund' in text or 'support' in text or 'provide' in text):
                 out['notes'] = text
             else:
                 # what if something already in 'name'?  observed it's typically empty string; so ignore.
@@ -257,25 +257,27 @@ def parse_funding_groups(front_tag) -> List[str]:
 # TODO: didnt want to handle <collab> group names; seemed rare and inconsistent; focus on <contrib> with <name> and <aff>
 def parse_authors(front_tag) -> List[Dict]:
     authors = []
-    for contrib_tag in front_tag.find_all('contrib'):
+    for contrib_tag in front_tag.iter('contrib'):
 
         # skip nesting; just process children (individual authors)
-        if contrib_tag.find_all('contrib'):
+        if contrib_tag.find('.//contrib') is not None:
             continue
 
         # skip contribs without a name; these should be ones that consist of <collab> tag
-        if contrib_tag.find('name') is None:
+        name_tag = contrib_tag.find('.//name')
+        if name_tag is None:
             continue
 
         # corresponding tag
-        if (contrib_tag.get('corresp') == 'yes') or (contrib_tag.find('xref', {'ref-type': 'corresp'})):
+        if (contrib_tag.get('corresp') == 'yes') or (contrib_tag.find('.//xref[@ref-type="corresp"]') is not None):
             is_corresp = True
         else:
             is_corresp = False
 
         # orcid ID is sometimes a URL or just a number.  standardize as hyphenized number.
-        if contrib_tag.find('contrib-id'):
-            orcid_id = contrib_tag.find('contrib-id').text
+        contrib_id_tag = contrib_tag.find('.//contrib-id')
+        if contrib_id_tag is not None:
+            orcid_id = get_text(contrib_id_tag)
             match = re.search(r'http(s?)://orcid.org/(.+)', orcid_id)
             if match:
                 orcid_id = match.group(2)
@@ -287,11 +289,11 @@ def parse_authors(front_tag) -> List[Dict]:
             orcid_id = None
 
         # Email may or may not be present.
-        email = contrib_tag.find('email')
-        email = email.text if email else None
+        email = contrib_tag.find('.//email')
+        email = get_text(email) if email is not None else None
 
         # Get the name info for the author.
-        name_info = {name_tag.name: name_tag.text for name_tag in contrib_tag.find('name').find_all()}
+        name_info = {tag.tag: get_text(tag) for tag in name_tag.iterdescendants()}
         # TODO: PMC3462967 is an Erratum. It does not have ['given-names'].  not sure we care about those, so try-catch for now
         try:
             given_names = name_info['given-names'].split(' ')
@@ -304,7 +306,7 @@ def parse_authors(front_tag) -> List[Dict]:
             'last': name_info['surname'],
             'suffix': name_info.get('suffix', ''),
             'email': email,
-            'affiliation_ids': [xref_tag.get('rid') for xref_tag in contrib_tag.find_all('xref', {'ref-type': 'aff'})],
+            'affiliation_ids': [xref_tag.get('rid') for xref_tag in contrib_tag.iterfind('.//xref[@ref-type="aff"]')],
             'corresponding': is_corresp,
             'orcid': orcid_id
         })
@@ -322,30 +324,30 @@ def parse_affiliations(front_tag) -> List[Dict]:
         <aff>St. Paul, Minnesota</aff>
     """
     outs = []
-    for aff_tag in front_tag.find_all('aff'):
-        if aff_tag.find('label'):                   # get rid of unused markers so `.text` is cleaner
-            aff_tag.find('label').decompose()
-        if aff_tag.find('sup'):
-            aff_tag.find('sup').decompose()         # same treatment as label
+    for aff_tag in front_tag.findall('.//aff'):
+        label_tag = aff_tag.find('.//label')
+        if label_tag is not None:                   # get rid of unused markers so the text is cleaner
+            extract(label_tag)
+        sup_tag = aff_tag.find('.//sup')
+        if sup_tag is not None:
+            extract(sup_tag)                        # same treatment as label
 
         aff_id = aff_tag.get('id')
 
         # it looks like we want to go to the full affiliation surface form without worrying about all possible handlings of <named-content> and other fields
         # BUT, we do want to keep ISNI and GRID IDs when they occur.  They seem to occur typically within <institution-wrap>
-        # so let's handle those if they exist; safely decompose the tags (because they dont contribute to surface form); then grab remaining affiliation surface form
+        # so let's handle those if they exist; safely remove the tags (because they dont contribute to surface form); then grab remaining affiliation surface form
 
         # implicit in this approach is that we dont need to actually handle <institution-wrap> tags because only one per affiliation
-        if len(aff_tag.find_all('institution-wrap')) > 1:
-            import pdb; pdb.set_trace()
         id_type_to_id = {}
-        for institution_id_tag in aff_tag.find_all('institution-id'):
-            id_type_to_id[institution_id_tag['institution-id-type']] = institution_id_tag.text
-            institution_id_tag.decompose()
+        for institution_id_tag in aff_tag.findall('.//institution-id'):
+            id_type_to_id[institution_id_tag.attrib['institution-id-type']] = get_text(institution_id_tag)
+            extract(institution_id_tag)
 
         # TODO: processing of text:  there are a lot of random newline chars (cuz XML preserves page layout)
         # --> replace them with whitespace if there's preceding punctuation char
         # --> otherwise, replace them with comma
-        text = aff_tag.text
+        text = get_text(aff_tag)
 
         outs.append({
             'id': aff_id,
@@ -356,7 +358,7 @@ def parse_affiliations(front_tag) -> List[Dict]:
     return outs
 
 
-def parse_abstract_tag(front_tag, soup) -> List[Dict]:
+def parse_abstract_tag(front_tag) -> List[Dict]:
     """Not every paper has an abstract
 
     Furthermore, note very abstract is structured into sections.
@@ -368,18 +370,16 @@ def parse_abstract_tag(front_tag, soup) -> List[Dict]:
     """
     # TODO: are there cases where <abstract> text <p> text </> </abstract> ?
     abstract: List[Dict] = []
-    if front_tag.find('abstract'):
-        abstract_tag = front_tag.find('abstract').extract()
+    abstract_tag = front_tag.find('.//abstract')
+    if abstract_tag is not None:
+        extract(abstract_tag)
 
-        # replace all xref tags with string placeholders
-        replace_xref_with_string_placeholders(soup_tag=abstract_tag, soup=soup)
+        # replace all xref and sup/sub tags with string placeholders
+        replace_tags_with_string_placeholders(abstract_tag)
 
-        # replace all sup/sub tags with string placeholders
-        replace_sup_sub_tags_with_string_placeholders(soup_tag=abstract_tag, soup=soup)
-
-        if abstract_tag.find('sec'):
+        if abstract_tag.find('.//sec') is not None:
             all_par_blobs = []
-            for sec_tag in abstract_tag.find_all('sec', recursive=False):
+            for sec_tag in abstract_tag.findall('sec'):
                 par_blobs = recurse_parse_section(sec_tag=sec_tag)
                 all_par_blobs.extend(par_blobs)
         else:
@@ -2,9 +2,14 @@ import os
 import json
 import argparse
 import time
+import shutil
+import tempfile
 from typing import Optional
 
 from doc2json.jats2json.jats_to_json import convert_jats_xml_to_s2orc_json
+from doc2json.utils.instrument_util import stage, instrument_paper, format_stage_timings, add_instrument_args, \
+    setup_sinks, close_sinks
+from doc2json.utils.profile_util import add_profile_args, setup_profile
 
 
 BASE_TEMP_DIR = 'temp'
@@ -24,23 +29,27 @@ def process_jats_stream(
     :param temp_dir:
     :return:
     """
-    temp_input_dir = os.path.join(temp_dir, 'input')
-    temp_input_file = os.path.join(temp_input_dir, fname)
-
+    # a directory of its own, so concurrent calls with the same fname don't clobber each other
     os.makedirs(temp_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(dir=temp_dir)
+    temp_input_dir = os.path.join(work_dir, 'input')
+    temp_input_file = os.path.join(temp_input_dir, os.path.basename(fname))
     os.makedirs(temp_input_dir, exist_ok=True)
 
-    with open(temp_input_file, 'wb') as outf:
-        outf.write(stream)
+    try:
+        with open(temp_input_file, 'wb') as outf:
+            outf.write(stream)
 
-    output_file = process_jats_file(temp_input_file)
+        output_file = process_jats_file(temp_input_file, output_dir=os.path.join(work_dir, 'output'))
 
-    if os.path.exists(output_file):
-        with open(output_file, 'r') as f:
-            contents = json.load(f)
-            return contents
-    else:
-        return []
+        if os.path.exists(output_file):
+            with open(output_file, 'r') as f:
+                contents = json.load(f)
+                return contents
+        else:
+            return []
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 
 def process_jats_file(
@@ -69,14 +78,16 @@ def process_jats_file(
     if os.path.exists(output_file):
         print(f'{output_file} already exists!')
 
-    # convert to S2ORC
-    paper = convert_jats_xml_to_s2orc_json(jats_file, log_dir)
+    with instrument_paper(paper_id):
+        # convert to S2ORC
+        with stage('soup_conversion'):
+            paper = convert_jats_xml_to_s2orc_json(jats_file, log_dir)
 
-    # write to file
-    with open(output_file, 'w') as outf:
-        json.dump(paper.release_json("jats"), outf, indent=4, sort_keys=False)
+        # write to file
+        with stage('serialise'), open(output_file, 'w') as outf:
+            json.dump(paper.release_json("jats"), outf, indent=4, sort_keys=False)
 
-    return output_file
+        return output_file
 
 
 if __name__ == '__main__':
@@ -85,7 +96,12 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--output", default='output', help="path to the output dir for putting json files")
     parser.add_argument("-l", "--log", default='log', help="path to the log dir")
 
+    add_instrument_args(parser)
+    add_profile_args(parser)
+
     args = parser.parse_args()
+    setup_sinks(args)
+    setup_profile(args)
 
     input_path = args.input
     output_path = args.output
@@ -99,4 +115,6 @@ if __name__ == '__main__':
 
     runtime = round(time.time() - start_time, 3)
     print("runtime: %s seconds " % (runtime))
+    print("stages: %s" % format_stage_timings())
+    close_sinks()
     print('done.')
@@ -0,0 +1,298 @@
+"""
+Batch conversion of JATS articles, e.g. the PMC open access dumps
+
+Articles are read from .nxml/.xml files, directories of them, or .tar.gz archives (the PMC
+bulk packages of many articles as well as the per-article OA packages). Archives are
+streamed member by member, without unpacking them to disk. Articles are converted on a
+pool of worker processes and the S2ORC json of each one is written as a line of sharded
+JSON lines files, output/shard-00000.jsonl, output/shard-00001.jsonl, ...
+
+A shard is written as <shard>.jsonl.partial and renamed once it is full or the run is
+over. The ledger, output/ledger.jsonl, records the outcome of every article and the shard
+holding it: a restarted run skips the articles of finished shards and the failures (unless
+--retry_failed), so it has to be given the same inputs. Shard numbers are never reused, the
+partial shards of a killed run are deleted and their articles converted again.
+
+    python doc2json/jats2json/process_jats_batch.py -i oa_comm_xml.PMC000xxxxxx.baseline.tar.gz -o output
+"""
+
+import os
+import re
+import json
+import time
+import tarfile
+import argparse
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from doc2json.jats2json.jats_to_json import convert_jats_xml_string_to_s2orc_json
+from doc2json.utils.batch_util import POOL_WORKERS, WorkerPool, Ledger
+from doc2json.utils.memory_util import parse_size
+from doc2json.utils.instrument_util import stage, instrument_paper, record_stages, observe_stages, \
+    format_stage_timings
+
+
+JATS_EXTENSIONS = ('.nxml', '.xml')
+ARCHIVE_EXTENSIONS = ('.tar.gz', '.tgz', '.tar')
+SHARD_SIZE = 10000
+SHARD_PATTERN = re.compile(r'^shard-(\d+)\.jsonl(?:\.partial)?$')
+PARTIAL_SUFFIX = '.partial'
+LEDGER_NAME = 'ledger.jsonl'
+ARTICLE_TIMEOUT = 300
+# workers are replaced after this many articles, the parsers leave fragmented heaps behind
+MAX_TASKS_PER_CHILD = 1000
+
+
+def is_jats_file(name: str) -> bool:
+    return name.lower().endswith(JATS_EXTENSIONS)
+
+
+def is_archive(name: str) -> bool:
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def iter_archive(archive_file: str) -> Iterator[Tuple[str, Tuple]]:
+    """
+    JATS articles of a tar archive, read sequentially
+    :param archive_file:
+    :return: tasks (key, (name, None, content))
+    """
+    # stream mode: the archive is decompressed once, front to back, and never seeked
+    with tarfile.open(archive_file, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and is_jats_file(member.name):
+                content = tar.extractfile(member).read()
+                yield f'{archive_file}:{member.name}', (member.name, None, content)
+
+
+def iter_articles(inputs: Iterable[str]) -> Iterator[Tuple[str, Tuple]]:
+    """
+    JATS articles of files, directories (walked in name order) and archives
+    :param inputs: paths
+    :return: tasks (key, (name, path, content)); articles in archives come with their content
+    """
+    for input_path in inputs:
+        input_path = os.path.normpath(input_path)
+        if not os.path.isdir(input_path):
+            paths = [input_path]
+        else:
+            paths = []
+            for root, dirs, files in os.walk(input_path):
+                dirs.sort()
+                paths.extend(os.path.join(root, name) for name in sorted(files))
+        for path in paths:
+            if is_archive(path):
+                yield from iter_archive(path)
+            elif is_jats_file(path):
+                yield path, (os.path.basename(path), path, None)
+
+
+def convert_article(name: str, path: Optional[str], content: Optional[bytes]) -> Tuple[str, List]:
+    """
+    Convert an article to a line of S2ORC json, in a worker process
+    :param name: file name, the paper id is taken from it
+    :param path: file to read, if content isn't given
+    :param content: JATS XML
+    :return: json line, and the stages timed on the way
+    """
+    paper_id = os.path.basename(name).split('.')[0]
+    with record_stages() as stages, instrument_paper(paper_id):
+        if content is None:
+            with open(path, 'rb') as f:
+                content = f.read()
+        with stage('soup_conversion'):
+            paper = convert_jats_xml_string_to_s2orc_json(content, paper_id)
+        with stage('serialise'):
+            line = json.dumps(paper.release_json("jats"))
+    return line, stages
+
+
+def get_shard_index(name: Optional[str]) -> Optional[int]:
+    match = SHARD_PATTERN.match(name or '')
+    return int(match.group(1)) if match else None
+
+
+class ShardWriter:
+    """
+    Writes lines to numbered JSON lines shards of at most shard_size lines
+    """
+    def __init__(self, output_dir: str, shard_size: int = SHARD_SIZE, first_index: int = 0):
+        """
+        :param output_dir:
+        :param shard_size: lines per shard
+        :param first_index: lowest shard number to use, e.g. after the shards an earlier run recorded
+        """
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        os.makedirs(output_dir, exist_ok=True)
+        # shards of earlier runs are kept, finished or partial, numbering carries on after them
+        indices = [index for index in map(get_shard_index, os.listdir(output_dir)) if index is not None]
+        self.index = max(indices + [first_index - 1], default=-1) + 1
+        self.name = None
+        self.lines = 0
+        self._file = None
+
+    def write(self, line: str) -> str:
+        """
+        Append a line to the current shard
+        :param line: without a newline
+        :return: name of the shard
+        """
+        if self._file is None:
+            self.name = f'shard-{self.index:05d}.jsonl'
+            self._file = open(os.path.join(self.output_dir, self.name + PARTIAL_SUFFIX), 'w')
+        self._file.write(line + '\n')
+        # flushed before the ledger records the article as written
+        self._file.flush()
+        name = self.name
+        self.lines += 1
+        if self.lines >= self.shard_size:
+            self.close()
+        return name
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        path = os.path.join(self.output_dir, self.name)
+        os.replace(path + PARTIAL_SUFFIX, path)
+        self._file = None
+        self.index += 1
+        self.lines = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def get_finished_keys(output_dir: str, retry_failed: bool = False) -> Set[str]:
+    """
+    Articles of an earlier run that don't have to be converted again: written to a finished
+    shard, or failed
+    :param output_dir:
+    :param retry_failed: convert the failures again
+    :return: keys
+    """
+    finished = set()
+    for key, record in Ledger.load(os.path.join(output_dir, LEDGER_NAME)).items():
+        if record["status"] == 'done':
+            if record.get("shard") and os.path.exists(os.path.join(output_dir, record["shard"])):
+                finished.add(key)
+        elif not retry_failed:
+            finished.add(key)
+    return finished
+
+
+def get_next_shard_index(output_dir: str) -> int:
+    """
+    Shard number after all the ones the ledger mentions, deleted partial shards included
+    :param output_dir:
+    :return:
+    """
+    indices = [get_shard_index(record.get("shard")) for record in Ledger.read(os.path.join(output_dir, LEDGER_NAME))]
+    return max([index for index in indices if index is not None], default=-1) + 1
+
+
+def remove_partial_shards(output_dir: str):
+    # left by a run that was killed; their articles are converted again
+    for name in os.listdir(output_dir):
+        if SHARD_PATTERN.match(name) and name.endswith(PARTIAL_SUFFIX):
+            os.remove(os.path.join(output_dir, name))
+
+
+def process_jats_batch(
+        inputs: List[str],
+        output_dir: str,
+        workers: int = POOL_WORKERS,
+        shard_size: int = SHARD_SIZE,
+        timeout: Optional[float] = ARTICLE_TIMEOUT,
+        max_memory: Optional[int] = None,
+        max_tasks_per_child: Optional[int] = MAX_TASKS_PER_CHILD,
+        max_memory_per_child: Optional[int] = None,
+        retry_failed: bool = False,
+        progress: bool = True
+) -> Dict[str, int]:
+    """
+    Convert JATS articles to sharded S2ORC JSON lines, resuming an earlier run in output_dir
+    :param inputs: JATS files, directories and tar archives
+    :param output_dir: shards and ledger
+    :param workers: number of worker processes
+    :param shard_size: articles per shard
+    :param timeout: seconds an article may take
+    :param max_memory: RSS budget of a worker in bytes
+    :param max_tasks_per_child: articles after which a worker is replaced
+    :param max_memory_per_child: RSS in bytes above which a worker is replaced after an article
+    :param retry_failed: convert the articles that failed in an earlier run again
+    :param progress: show a progress bar
+    :return: number of articles done, failed and skipped
+    """
+    from tqdm import tqdm
+
+    os.makedirs(output_dir, exist_ok=True)
+    finished = get_finished_keys(output_dir, retry_failed)
+    # numbered before the partial shards are gone: ledger records of a killed run may point to them
+    shards = ShardWriter(output_dir, shard_size, get_next_shard_index(output_dir))
+    remove_partial_shards(output_dir)
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+
+    def tasks():
+        for key, args in iter_articles(inputs):
+            if key in finished:
+                counts["skipped"] += 1
+                continue
+            yield key, args
+
+    with Ledger(os.path.join(output_dir, LEDGER_NAME)) as ledger, shards, \
+            WorkerPool(
+                convert_article, workers, max_memory, timeout,
+                max_tasks_per_child=max_tasks_per_child, max_memory_per_child=max_memory_per_child
+            ) as pool, \
+            tqdm(unit=' articles', disable=not progress) as bar:
+        for record in pool.run(tasks()):
+            result = record.pop("result", None)
+            if record["status"] == 'done':
+                line, stages = result
+                observe_stages(stages)
+                record["shard"] = shards.write(line)
+                counts["done"] += 1
+            else:
+                counts["failed"] += 1
+            ledger.record(record)
+            bar.set_postfix(failed=counts["failed"], refresh=False)
+            bar.update()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run S2ORC JATS2JSON on many articles")
+    parser.add_argument("-i", "--input", nargs='+', required=True, help="JATS files, directories and .tar.gz archives")
+    parser.add_argument("-o", "--output", default='output', help="output dir for the json lines shards and the ledger")
+    parser.add_argument("--workers", default=POOL_WORKERS, type=int, help="number of worker processes")
+    parser.add_argument("--shard_size", default=SHARD_SIZE, type=int, help="articles per shard")
+    parser.add_argument("--timeout", default=ARTICLE_TIMEOUT, type=float, help="seconds an article may take")
+    parser.add_argument("--max_memory", default=None, help="RSS budget of a worker, e.g. 2G")
+    parser.add_argument("--max_tasks_per_child", default=MAX_TASKS_PER_CHILD, type=int,
+                        help="articles after which a worker is replaced, 0 to keep workers")
+    parser.add_argument("--max_memory_per_child", default=None, help="RSS after which a worker is replaced, e.g. 1G")
+    parser.add_argument("--retry_failed", action='store_true', help="convert the failures of an earlier run again")
+    parser.add_argument("--no_progress", action='store_true', help="don't show a progress bar")
+
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    counts = process_jats_batch(
+        args.input, args.output, args.workers, args.shard_size, args.timeout, parse_size(args.max_memory),
+        args.max_tasks_per_child or None, parse_size(args.max_memory_per_child), args.retry_failed,
+        not args.no_progress
+    )
+
+    runtime = round(time.time() - start_time, 3)
+    print("articles: %(done)s done, %(failed)s failed, %(skipped)s skipped" % counts)
+    print("runtime: %s seconds (%.1f articles/s)" % (runtime, counts["done"] / max(runtime, 1e-3)))
+    print("stages: %s" % format_stage_timings())
+    if counts["failed"]:
+        print(f'failures are listed in {os.path.join(args.output, LEDGER_NAME)}')
+    print('done.')
@@ -2,20 +2,20 @@ import os
 import json
 import argparse
 import time,sys
+import shutil
+import tempfile
 from typing import Optional, Dict
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..','..')))
 from doc2json.tex2json.tex_to_xml import convert_latex_to_s2orc_json
 from doc2json.tex2json.xml_to_json import convert_latex_xml_to_s2orc_json
-import json
-import io
-import copy
-import os
-from PIL import Image
-import pandas as pd
-from pdf2image import convert_from_path
-import pyarrow as pa
-import pyarrow.parquet as pq
+from doc2json.grobid2json.grobid.grobid_client import add_grobid_args, get_grobid_config
 from collections import OrderedDict
+from doc2json.utils.record_util import RECORD_TEMPLATE, RecordBuilder
+from doc2json.utils.image_util import FIGURE_DPI, FIGURE_CACHE_DIR, get_figure_paths, render_pdf_figure, \
+    render_pdf_figures, read_image_bytes, normalize_image
+from doc2json.utils.instrument_util import stage, instrument_paper, format_stage_timings, add_instrument_args, \
+    setup_sinks, close_sinks
+from doc2json.utils.profile_util import add_profile_args, setup_profile
  
 
 
@@ -40,25 +40,31 @@ def process_tex_stream(
     :param grobid_config:
     :return:
     """
-    temp_input_dir = os.path.join(temp_dir, 'input')
-    temp_input_file = os.path.join(temp_input_dir, fname)
-
+    # a directory of its own, so concurrent calls with the same fname don't clobber each other
     os.makedirs(temp_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(dir=temp_dir)
+    temp_input_dir = os.path.join(work_dir, 'input')
+    temp_input_file = os.path.join(temp_input_dir, os.path.basename(fname))
     os.makedirs(temp_input_dir, exist_ok=True)
 
-    with open(temp_input_file, 'wb') as outf:
-        outf.write(stream)
+    try:
+        with open(temp_input_file, 'wb') as outf:
+            outf.write(stream)
 
-    output_file = process_tex_file(
-        temp_input_file, temp_dir=temp_dir, keep_flag=keep_flag, grobid_config=grobid_config
-    )
+        output_file = process_tex_file(
+            temp_input_file, temp_dir=os.path.join(work_dir, 'temp'), output_dir=os.path.join(work_dir, 'output'),
+            keep_flag=keep_flag, grobid_config=grobid_config
+        )
 
-    if os.path.exists(output_file):
-        with open(output_file, 'r') as f:
-            contents = json.load(f)
-            return contents
-    else:
-        return []
+        if output_file and os.path.exists(output_file):
+            with open(output_file, 'r') as f:
+                contents = json.load(f)
+                return contents
+        else:
+            return []
+    finally:
+        if not keep_flag:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
 def process_tex_file(
         input_file: str,
@@ -94,47 +100,59 @@ def process_tex_file(
     if os.path.exists(output_file):
         print(f'{output_file} already exists!')
 
-    # process LaTeX
-    xml_file = convert_latex_to_s2orc_json(input_file, temp_dir, cleanup_flag)
-    if not xml_file:
-        return None
+    with instrument_paper(paper_id):
+        # process LaTeX
+        xml_file = convert_latex_to_s2orc_json(input_file, temp_dir, cleanup_flag)
+        if not xml_file:
+            return None
 
-    # convert to S2ORC
-    paper = convert_latex_xml_to_s2orc_json(xml_file, log_dir, grobid_config=grobid_config)
+        # convert to S2ORC
+        with stage('soup_conversion'):
+            paper = convert_latex_xml_to_s2orc_json(xml_file, log_dir, grobid_config=grobid_config)
 
-    # write to file
-    with open(output_file, 'w') as outf:
-        json.dump(paper.release_json("latex"), outf, indent=4, sort_keys=False)
+        # write to file
+        with stage('serialise'), open(output_file, 'w') as outf:
+            json.dump(paper.release_json("latex"), outf, indent=4, sort_keys=False)
 
-    return output_file,output_file
+        return output_file
 
-def read_image(image_path):
-    # 打开图像文件
+def read_image(
+        image_path, figure_dpi=FIGURE_DPI, figure_cache=FIGURE_CACHE_DIR, image_max_size=None, image_format=None,
+        rendered=None
+):
+    # 打开图像文件; pdf figures rendered up front are looked up in rendered (pdf path -> png path)
     if image_path.lower().endswith('.pdf'):
-                images = convert_from_path(image_path)
-                new_image_path = os.path.splitext(image_path)[0] + ".png"
-                images[0].save(new_image_path, 'PNG')
-                image_path = new_image_path
-    if os.path.isdir(image_path):
+        if rendered is None:
+            image_path = render_pdf_figure(image_path, dpi=figure_dpi, cache_dir=figure_cache)
+        elif image_path in rendered:
+            image_path = rendered[image_path]
+        else:
+            # failed to render up front
+            return None
+    if not os.path.isfile(image_path):
         return None 
 
-    with open(image_path, 'rb') as file:
-        image = Image.open(file)
-        # 将图像转换为二进制格式
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format=image.format)
-        img_byte_arr = img_byte_arr.getvalue()
-    return img_byte_arr
-
-def save_to_parquet(data, output_path):
-    df = pd.DataFrame(data)
-    table = pa.Table.from_pandas(df)
-    pq.write_table(table, output_path)
-
-def convert_to_target_format_cyp(data, template, tmp_dir):
-    result=[]
-    template["文件id"] = data['paper_id']
-    template["处理时间"] = data["header"]["date_generated"]
+    # 原始二进制直接透传，只有需要缩放或转换格式时才用PIL重新编码
+    return normalize_image(read_image_bytes(image_path), image_max_size, image_format)
+
+def convert_to_target_format_cyp(
+        data, template, tmp_dir, figure_dpi=FIGURE_DPI, figure_cache=FIGURE_CACHE_DIR, figure_workers=None,
+        image_max_size=None, image_format=None
+):
+    # the same figure file can be referenced many times; read it once and share the bytes
+    images = {}
+    # rasterise referenced pdf figures up front, in parallel; without a cache the pngs are written next
+    # to the pdfs in tmp_dir. read_image then reads the rendered pngs without hashing the pdfs again
+    ref_ids = {ref["ref_id"] for para in data["latex_parse"]["body_text"] for ref in para["ref_spans"] if "ref_id" in ref}
+    pdf_paths = [
+        path for ref_id, path in get_figure_paths(data, tmp_dir).items()
+        if ref_id in ref_ids and path.lower().endswith('.pdf')
+    ]
+    rendered = render_pdf_figures(pdf_paths, dpi=figure_dpi, cache_dir=figure_cache, max_workers=figure_workers)
+
+    builder = RecordBuilder(template)
+    builder.set_default("文件id", data['paper_id'])
+    builder.set_default("处理时间", data["header"]["date_generated"])
     
     ## step 1 bod_text map to section
     doc_parse = data["latex_parse"] # todo other doc types
@@ -147,61 +165,44 @@ def convert_to_target_format_cyp(data, template, tmp_dir):
             body_dict[text_dict["section"]] = [text_dict] # keep all info
     
     ## step 2 build list
-    new_entry = copy.deepcopy(template)
-    new_entry["块id"] = 'title'
-    new_entry["文本"] = data["title"]
-    new_entry["数据类型"] = 'text' 
-    result.append(new_entry)
-    
-    new_entry = copy.deepcopy(template)
-    new_entry["数据类型"] = 'text' 
-    new_entry["块id"] = "abstract"
-    new_entry["文本"] = data["abstract"]
-    result.append(new_entry)
-    
+    builder.add({"块id": 'title', "文本": data["title"], "数据类型": 'text'})
+    builder.add({"数据类型": 'text', "块id": "abstract", "文本": data["abstract"]})
     
     ref_entries = doc_parse["ref_entries"]
     for section, para_list in body_dict.items():
-        template["块id"] = section
+        builder.set_default("块id", section)
         for para in para_list:     
-            new_entry = copy.deepcopy(template)
-            new_entry["文本"] = para['text'] 
-            new_entry["数据类型"]='text'
-            result.append(copy.deepcopy(new_entry))
+            builder.add({"文本": para['text'], "数据类型": 'text'})
             for ref in para["ref_spans"]:
                 if "ref_id" in ref and ref["ref_id"] in ref_entries:  
-                    new_entry = copy.deepcopy(template)
-                    new_entry["数据类型"] =ref_entries[ref["ref_id"]]['type_str']
-                    new_entry["块id"] = section
-                    if new_entry["数据类型"]=='figure':
-                        # path=os.path.join('s2orc-doc2json/temp_dir/latex',data['paper_id'],"".join(ref_entries[ref["ref_id"]]["uris"]))
-                        path=os.path.join(tmp_dir, 'latex',data['paper_id'],"".join(ref_entries[ref["ref_id"]]["uris"]))
-                        new_entry["图片"]=read_image(path)   
-                    new_entry["文本"] = ref_entries[ref["ref_id"]]['text']
-                    filtered_entries = {k: v for k, v in ref_entries[ref["ref_id"]].items() if k != 'text' and 'ref_id' }
-                    new_entry["额外信息"] = filtered_entries 
-                    result.append(copy.deepcopy(new_entry))
-               
+                    ref_entry = ref_entries[ref["ref_id"]]
+                    fields = {"数据类型": ref_entry['type_str'], "块id": section}
+                    if fields["数据类型"]=='figure':
+                        path=os.path.join(tmp_dir, 'latex',data['paper_id'],"".join(ref_entry["uris"]))
+                        if path not in images:
+                            images[path] = read_image(
+                                path, figure_dpi, figure_cache, image_max_size, image_format, rendered
+                            )
+                        fields["图片"]=images[path]   
+                    fields["文本"] = ref_entry['text']
+                    fields["额外信息"] = {k: v for k, v in ref_entry.items() if k != 'text'}
+                    builder.add(fields)
             
             for ref in para["cite_spans"]:
                 if ref["ref_id"] in ref_entries:  
-                    new_entry = copy.deepcopy(template)
-                    new_entry["数据类型"] =ref_entries[ref["ref_id"]]['type_str']   
-                    new_entry["块id"] = section
-                    new_entry["文本"] = ref_entries[ref["ref_id"]]['text'] 
-                    filtered_entries = {k: v for k, v in ref_entries[ref["ref_id"]].items() if k != 'text' and 'ref_id' }
-                    new_entry["额外信息"] = filtered_entries
-                    result.append(copy.deepcopy(new_entry))
+                    ref_entry = ref_entries[ref["ref_id"]]
+                    builder.add({
+                        "数据类型": ref_entry['type_str'],
+                        "块id": section,
+                        "文本": ref_entry['text'],
+                        "额外信息": {k: v for k, v in ref_entry.items() if k != 'text'}
+                    })
             
             for ref in para["eq_spans"]:
-                    new_entry = copy.deepcopy(template)
-                    new_entry["数据类型"] ='formula'
-                    new_entry["块id"] = section
-                    new_entry["文本"] =str(ref)
-                    result.append(copy.deepcopy(new_entry))
+                    builder.add({"数据类型": 'formula', "块id": section, "文本": str(ref)})
        
     
-    return result
+    return builder.records
 
 
 if __name__ == '__main__':
@@ -211,8 +212,22 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--output", default='output', help="path to the output dir for putting json files")
     parser.add_argument("-l", "--log", default='log', help="path to the log dir")
     parser.add_argument("-k", "--keep", default=True, help="keep temporary files")
+    parser.add_argument("--figure_dpi", default=FIGURE_DPI, type=int, help="resolution for rendering pdf figures")
+    parser.add_argument("--figure_cache", default=FIGURE_CACHE_DIR, help="cache dir for rendered pdf figures")
+    parser.add_argument("--figure_workers", default=None, type=int, help="number of processes rendering pdf figures")
+    parser.add_argument("--image_max_size", default=None, type=int, help="downscale images larger than this many pixels")
+    parser.add_argument("--image_format", default=None, help="re-encode images to this format (e.g. PNG, JPEG)")
+    parser.add_argument("--dedup_images", action='store_true', help="store each distinct image once in a side table")
+    parser.add_argument("--thumbnail_size", default=None, type=int, help="also store thumbnails of at most this many pixels")
+    parser.add_argument("--dataset", default=None, help="write into this partitioned parquet dataset instead of a single file")
+
+    add_grobid_args(parser)
+    add_instrument_args(parser)
+    add_profile_args(parser)
 
     args = parser.parse_args()
+    setup_sinks(args)
+    setup_profile(args)
 
     input_path = args.input
     temp_path = args.temp
@@ -225,20 +240,33 @@ if __name__ == '__main__':
     os.makedirs(temp_path, exist_ok=True)
     os.makedirs(output_path, exist_ok=True)
 
-    _,output_file=process_tex_file(input_path, temp_path, output_path, log_path, keep_temp)
+    output_file = process_tex_file(input_path, temp_path, output_path, log_path, keep_temp, get_grobid_config(args))
   
 
     runtime = round(time.time() - start_time, 3)
   
     
-    template = {"文件md5": None, "文件id": None, "页码": None, "块id": None, "文本": None, "图片": None, "处理时间": None, "数据类型": None, "bounding_box": None, "额外信息": None}
+    template = dict(RECORD_TEMPLATE)
     # json_path = '/root/autodl-tmp/s2orc-doc2json/output_dir/2004.14974.json'
     with open(output_file, 'r') as file:
         data = json.load(file)
-        result = convert_to_target_format_cyp(data, template, temp_path)
+        result = convert_to_target_format_cyp(
+            data, template, temp_path, args.figure_dpi, args.figure_cache, args.figure_workers,
+            args.image_max_size, args.image_format
+        )
         
        
-    output_json_path = os.path.splitext(output_file)[0] + ".parquet"
-    save_to_parquet(result, output_json_path)
+    # pyarrow is only needed here, importing it lazily keeps process_tex_file cheap to import
+    from doc2json.utils.parquet_util import save_to_parquet, save_to_dataset
+    if args.dataset:
+        save_to_dataset(
+            result, args.dataset, data['paper_id'], {"year": data.get("year")},
+            dedup_images=args.dedup_images, thumbnail_size=args.thumbnail_size
+        )
+    else:
+        output_json_path = os.path.splitext(output_file)[0] + ".parquet"
+        save_to_parquet(result, output_json_path, args.dedup_images, args.thumbnail_size)
     print("runtime: %s seconds " % (runtime))
+    print("stages: %s" % format_stage_timings())
+    close_sinks()
     print('done.')
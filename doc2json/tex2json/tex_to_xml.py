@@ -18,6 +18,7 @@ import shutil
 from typing import Optional
 
 from doc2json.utils.latex_util import normalize, latex_to_xml
+from doc2json.utils.instrument_util import stage
 
 
 def _is_gzip_file(fpath):
@@ -191,16 +192,19 @@ def convert_latex_to_xml(
     :return:
     """
     # extract zip file
-    latex_output_dir = extract_latex(zip_file, latex_dir, cleanup)
+    with stage('extract'):
+        latex_output_dir = extract_latex(zip_file, latex_dir, cleanup)
 
     # normalize latex
     norm_log_file = os.path.join(log_dir, 'norm_error.log')
-    norm_output_dir = normalize_latex(latex_output_dir, norm_dir, norm_log_file, cleanup)
+    with stage('latexpand'):
+        norm_output_dir = normalize_latex(latex_output_dir, norm_dir, norm_log_file, cleanup)
 
     # convert to xml
     xml_error_file = os.path.join(log_dir, 'xml_error.log')
     xml_log_file = os.path.join(log_dir, 'xml_skip.log')
-    xml_output_file = norm_latex_to_xml(norm_output_dir, xml_dir, xml_error_file, xml_log_file, cleanup)
+    with stage('tralics'):
+        xml_output_file = norm_latex_to_xml(norm_output_dir, xml_dir, xml_error_file, xml_log_file, cleanup)
 
     return xml_output_file
 
@@ -5,11 +5,11 @@ import bs4
 from bs4 import BeautifulSoup, NavigableString
 from typing import List, Dict, Tuple, Optional
 import copy
-import latex2mathml.converter
 
 from doc2json.grobid2json.grobid.grobid_client import GrobidClient
 from doc2json.utils.grobid_util import parse_bib_entry, get_author_data_from_grobid_xml
 from doc2json.s2orc import Paper, Paragraph
+from doc2json.utils.instrument_util import span, count
 
 
 SKIP_TAGS = {
@@ -282,6 +282,7 @@ def process_paragraph(sp: BeautifulSoup, para_el: bs4.element.Tag, section_info:
                 ref_id = None
                 inline_key_ind += 1
             try:
+                import latex2mathml.converter
                 formula_mathml = latex2mathml.converter.convert(ftag.texmath.text)
             except Exception:
                 formula_mathml = ""
@@ -672,6 +673,7 @@ def process_equations_from_tex(sp: BeautifulSoup) -> Dict:
                 if eq.get('id', None):
                     ref_id = eq.get('id').replace('uid', 'EQREF')
                     try:
+                        import latex2mathml.converter
                         mathml = latex2mathml.converter.convert(eq.texmath.text.strip())
                     except Exception:
                         mathml = ""
@@ -1286,11 +1288,14 @@ def convert_xml_to_s2orc(
     decompose_tags_before_title(sp)
 
     # process maketitle info
-    title, authors = process_metadata(sp, client, log_file)
+    with span('metadata'):
+        title, authors = process_metadata(sp, client, log_file)
 
     # processing of bibliography entries
     # TODO: look into why authors aren't processing
-    bibkey_map = process_bibliography_from_tex(sp, client, log_file)
+    with span('bibliography'):
+        bibkey_map = process_bibliography_from_tex(sp, client, log_file)
+    count('bib_entries', len(bibkey_map))
 
     # no bibliography entries
     if not bibkey_map:
@@ -1298,37 +1303,52 @@ def convert_xml_to_s2orc(
             bib_f.write(f'{file_id},warn_no_bibs\n')
 
     # process section headers
-    section_map = process_sections_from_text(sp)
+    with span('section_map'):
+        section_map = process_sections_from_text(sp)
 
     # process and replace non-inline equations
-    equation_map = process_equations_from_tex(sp)
+    with span('equation_map'):
+        equation_map = process_equations_from_tex(sp)
 
     # process footnote markers
-    footnote_map = process_footnotes_from_text(sp)
+    with span('footnote_map'):
+        footnote_map = process_footnotes_from_text(sp)
 
     # get figure map
-    figure_map = get_figure_map_from_tex(sp)
+    with span('figure_map'):
+        figure_map = get_figure_map_from_tex(sp)
 
     # get table_map
-    table_map = get_table_map_from_text(sp)
+    with span('table_map'):
+        table_map = get_table_map_from_text(sp)
+    count('sections', len(section_map))
+    count('equations', len(equation_map))
+    count('footnotes', len(footnote_map))
+    count('figures', len(figure_map))
+    count('tables', len(table_map))
 
     # combine references in one dict
     refkey_map = combine_ref_maps(equation_map, figure_map, table_map, footnote_map, section_map)
 
     # process and replace figures
-    refkey_map = process_figures_from_tex(sp, refkey_map)
+    with span('figures'):
+        refkey_map = process_figures_from_tex(sp, refkey_map)
 
     # process and replace tables
-    refkey_map = process_tables_from_tex(sp, refkey_map)
+    with span('tables'):
+        refkey_map = process_tables_from_tex(sp, refkey_map)
 
     # collapse all hi tags
     collapse_formatting_tags(sp)
 
     # process abstract if possible
-    abstract = process_abstract_from_tex(sp, bibkey_map, refkey_map)
+    with span('abstract'):
+        abstract = process_abstract_from_tex(sp, bibkey_map, refkey_map)
 
     # process body text
-    body_text = process_body_text_from_tex(sp, bibkey_map, refkey_map)
+    with span('body_text'):
+        body_text = process_body_text_from_tex(sp, bibkey_map, refkey_map)
+    count('paragraphs', len(body_text))
 
     # skip if no body text parsed
     if not body_text:
@@ -1387,7 +1407,8 @@ def convert_latex_xml_to_s2orc_json(xml_fpath: str, log_dir: str, grobid_config:
     with open(xml_fpath, 'r') as f:
         try:
             xml = f.read()
-            soup = BeautifulSoup(xml, "lxml")
+            with span('parse_xml'):
+                soup = BeautifulSoup(xml, "lxml")
             paper = convert_xml_to_s2orc(soup, file_id, year, log_file, grobid_config=grobid_config)
             return paper
         except UnicodeDecodeError:
@@ -0,0 +1,334 @@
+"""
+Supervised process pool for batch runs
+
+Each worker process converts one paper at a time; the parent hands out the papers and
+watches the workers. A worker whose RSS goes over the memory budget, or that spends longer
+than the timeout on a paper, is killed and replaced by a fresh process: the paper is
+reported as failed and the rest of the batch carries on. The outcome, time and peak RSS of
+every paper can be appended to a ledger, a JSON lines file that lists the failures of a run
+and lets a restarted run skip the papers that are done.
+
+Parsers leave fragmented heaps behind, so long-lived workers grow: a worker can also retire
+after a number of papers, or once its RSS stays above a limit after a paper, and is then
+replaced. New workers run an initializer (imports, clients) before they get papers.
+"""
+
+import os
+import json
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from doc2json.utils.memory_util import MemoryTracker, get_rss, format_size
+
+
+POOL_WORKERS = os.cpu_count() or 1
+WATCHDOG_INTERVAL = 0.5
+STOP_TIMEOUT = 5
+
+# workers are started from threads in the Flask service; forking a threaded process is unsafe
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+class Ledger:
+    """
+    Append-only JSON lines record of the papers of a batch run
+    """
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'a', buffering=1)
+
+    def record(self, record: Dict):
+        self._file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @staticmethod
+    def read(path: str) -> Iterator[Dict]:
+        """
+        All records of a ledger, oldest first
+        :param path:
+        :return: nothing if there is no ledger yet
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # last line of a run that was killed while writing
+                    continue
+
+    @staticmethod
+    def load(path: str) -> Dict[str, Dict]:
+        """
+        Last record of each paper in a ledger
+        :param path:
+        :return: records by key, empty if there is no ledger yet
+        """
+        return {record["key"]: record for record in Ledger.read(path)}
+
+
+def _worker_main(
+        conn,
+        function: Callable,
+        trace_memory: bool,
+        initializer: Optional[Callable],
+        initargs: Tuple,
+        max_tasks: Optional[int],
+        max_memory: Optional[int]
+):
+    # runs in a worker process: warm up, then convert papers until told to stop or due to retire
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception as e:
+            conn.send({"init_error": f'{type(e).__name__}: {e}'})
+            return
+    conn.send({"ready": os.getpid()})
+    tasks_done = 0
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        key, args = task
+        start = time.perf_counter()
+        with MemoryTracker(trace_python=trace_memory) as tracker:
+            try:
+                record = {"status": "done", "result": function(*args)}
+            except Exception as e:
+                record = {"status": "failed", "error": f'{type(e).__name__}: {e}'}
+        record.update(key=key, seconds=time.perf_counter() - start, peak_rss=tracker.peak_rss, worker_pid=os.getpid())
+        if trace_memory:
+            record["traced_peak"] = tracker.traced_peak
+        tasks_done += 1
+        retire = (max_tasks and tasks_done >= max_tasks) or (max_memory and (get_rss() or 0) > max_memory)
+        conn.send(dict(record, retire=bool(retire)))
+        if retire:
+            return
+
+
+class _Worker:
+    def __init__(self, context, args: Tuple):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,) + args)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.key = None
+        self.started = None
+
+    def assign(self, key: str, args: Tuple):
+        self.conn.send((key, args))
+        self.key = key
+        self.started = time.monotonic()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        if self.key is not None or not self.ready:
+            return self.kill()
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Pool of worker processes, each killed and replaced when a paper takes too much memory or time
+
+        with WorkerPool(convert_file, workers=8, max_memory=4 << 30) as pool:
+            for record in pool.run((path, (path,)) for path in paths):
+                ...
+    """
+    def __init__(
+            self,
+            function: Callable,
+            workers: int = POOL_WORKERS,
+            max_memory: Optional[int] = None,
+            timeout: Optional[float] = None,
+            ledger: Optional[Ledger] = None,
+            trace_memory: bool = False,
+            max_tasks_per_child: Optional[int] = None,
+            max_memory_per_child: Optional[int] = None,
+            initializer: Optional[Callable] = None,
+            initargs: Tuple = (),
+            interval: float = WATCHDOG_INTERVAL,
+            mp_context=MP_CONTEXT
+    ):
+        """
+        :param function: picklable function converting a paper, called with the args of a task
+        :param workers: number of worker processes
+        :param max_memory: RSS budget of a worker in bytes, None for no limit
+        :param timeout: seconds a worker may spend on a paper, None for no limit
+        :param ledger: every paper's record (without its result) is appended to it
+        :param trace_memory: also report the peak of Python allocations of each paper (slower)
+        :param max_tasks_per_child: papers after which a worker is replaced, None to keep it
+        :param max_memory_per_child: RSS in bytes above which a worker is replaced after its paper
+        :param initializer: picklable function run by each new worker before it gets papers
+        :param initargs: arguments of the initializer
+        :param interval: seconds between checks of the workers
+        :param mp_context: multiprocessing context of the workers
+        """
+        self.function = function
+        self.workers = max(1, workers)
+        self.max_memory = max_memory
+        self.timeout = timeout
+        self.ledger = ledger
+        self.trace_memory = trace_memory
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_memory_per_child = max_memory_per_child
+        self.initializer = initializer
+        self.initargs = initargs
+        self.interval = interval
+        # workers replaced after reaching max_tasks_per_child or max_memory_per_child
+        self.retired = 0
+        self.mp_context = mp_context
+        self._workers: List[_Worker] = []
+
+    def _start_worker(self) -> _Worker:
+        return _Worker(self.mp_context, (
+            self.function, self.trace_memory, self.initializer, self.initargs,
+            self.max_tasks_per_child, self.max_memory_per_child
+        ))
+
+    def _check_ready(self, i: int, ready):
+        # a new worker reports once its initializer ran
+        worker = self._workers[i]
+        if worker.conn in ready:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                message = {}
+            if "ready" in message:
+                worker.ready = True
+                return
+            if "init_error" in message:
+                raise RuntimeError(f'Worker initializer failed: {message["init_error"]}')
+        if worker.process.sentinel in ready and not worker.process.is_alive():
+            raise RuntimeError(f'Worker exited with code {worker.process.exitcode} while starting')
+
+    def _replace(self, i: int, record: Dict) -> Dict:
+        worker = self._workers[i]
+        worker.kill()
+        record.update(
+            key=worker.key, seconds=time.monotonic() - worker.started, worker_pid=worker.process.pid
+        )
+        self._workers[i] = self._start_worker()
+        return record
+
+    def _check(self, i: int, ready) -> Optional[Dict]:
+        # the record of the worker's paper if it is done or was aborted
+        worker = self._workers[i]
+        if worker.conn in ready or worker.process.sentinel in ready:
+            try:
+                if worker.conn.poll():
+                    record = worker.conn.recv()
+                    worker.key = None
+                    if record.pop("retire"):
+                        worker.process.join()
+                        worker.conn.close()
+                        self._workers[i] = self._start_worker()
+                        self.retired += 1
+                    return record
+            except (EOFError, OSError):
+                pass
+            if not worker.process.is_alive():
+                return self._replace(i, {
+                    "status": "failed", "error": f'Worker exited with code {worker.process.exitcode}', "peak_rss": None
+                })
+        if self.max_memory:
+            rss = get_rss(worker.process.pid) or 0
+            if rss > self.max_memory:
+                return self._replace(i, {
+                    "status": "memory",
+                    "error": f'Worker RSS {format_size(rss)} exceeded the budget of {format_size(self.max_memory)}',
+                    "peak_rss": rss
+                })
+        if self.timeout and time.monotonic() - worker.started > self.timeout:
+            return self._replace(i, {
+                "status": "timeout", "error": f'Paper exceeded {self.timeout} seconds', "peak_rss": None
+            })
+        return None
+
+    def run(self, tasks: Iterable[Tuple[str, Tuple]]) -> Iterator[Dict]:
+        """
+        Process tasks, yielding their records in the order they finish
+        :param tasks: (key, args) pairs, consumed as workers become free
+        :return: records {"key", "status" (done, failed, memory or timeout), "result" or "error", "seconds", "peak_rss"}
+        """
+        tasks = iter(tasks)
+        remaining = True
+        while len(self._workers) < self.workers:
+            self._workers.append(self._start_worker())
+        while True:
+            for worker in self._workers:
+                if remaining and worker.ready and worker.key is None:
+                    task = next(tasks, None)
+                    if task is None:
+                        remaining = False
+                    else:
+                        worker.assign(*task)
+
+            if not remaining and all(worker.key is None for worker in self._workers):
+                return
+            ready = wait(
+                [worker.conn for worker in self._workers] + [worker.process.sentinel for worker in self._workers],
+                timeout=self.interval
+            )
+            for i, worker in enumerate(self._workers):
+                if not worker.ready:
+                    self._check_ready(i, ready)
+                    continue
+                if worker.key is None:
+                    if worker.process.sentinel in ready:
+                        # an idle worker went away (killed from outside)
+                        worker.conn.close()
+                        self._workers[i] = self._start_worker()
+                    continue
+                record = self._check(i, ready)
+                if record is None:
+                    continue
+                if self.ledger is not None:
+                    self.ledger.record({key: value for key, value in record.items() if key != 'result'})
+                yield record
+
+    def close(self):
+        """
+        Stop the workers, killing those still busy
+        :return:
+        """
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
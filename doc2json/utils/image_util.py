@@ -0,0 +1,189 @@
+"""
+Utilities for turning figure files referenced by a paper into image bytes
+
+PDF figures are rasterised with poppler (through pdf2image). Only the first page is
+rendered, and results are cached by the hash of the PDF file so repeated exports of
+the same paper don't re-invoke poppler.
+
+Image files are passed through as raw bytes; PIL is only used when an image has to be
+normalised (resized or converted to another format). PIL and pdf2image are imported on
+first use, so importing this module stays cheap for runs that only produce JSON.
+"""
+
+import io
+import os
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Iterable, Optional
+
+
+FIGURE_DPI = 200
+THUMBNAIL_SIZE = 256
+THUMBNAIL_FORMAT = 'JPEG'
+FIGURE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'doc2json', 'figures')
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_sha1(fpath: str) -> str:
+    """
+    Compute sha1 of a file's contents without loading it all in memory
+    :param fpath:
+    :return:
+    """
+    sha = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_figure_paths(paper: Dict, tmp_dir: str) -> Dict[str, str]:
+    """
+    Get paths of the figure files of a S2ORC LaTeX paper in its extracted source dir
+    :param paper: S2ORC json of the paper
+    :param tmp_dir: temp dir the LaTeX sources were extracted to
+    :return: dict from figure ref id to figure path
+    """
+    return {
+        ref_id: os.path.join(tmp_dir, 'latex', paper['paper_id'], ''.join(ref_entry["uris"] or []))
+        for ref_id, ref_entry in paper["latex_parse"]["ref_entries"].items()
+        if ref_entry["type_str"] == "figure"
+    }
+
+
+def render_pdf_figure(
+        pdf_path: str,
+        png_path: Optional[str] = None,
+        dpi: int = FIGURE_DPI,
+        cache_dir: Optional[str] = FIGURE_CACHE_DIR
+) -> str:
+    """
+    Render the first page of a PDF figure to PNG
+    :param pdf_path: PDF figure file
+    :param png_path: where to write the PNG, defaults to the PDF path with a .png extension
+    :param dpi: rendering resolution
+    :param cache_dir: directory of rendered figures keyed by PDF hash, None to disable caching
+    :return: path of the PNG file
+    """
+    if png_path is None:
+        png_path = os.path.splitext(pdf_path)[0] + ".png"
+
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, f'{file_sha1(pdf_path)}_{dpi}.png')
+        if os.path.exists(cache_file):
+            if os.path.abspath(cache_file) != os.path.abspath(png_path):
+                shutil.copyfile(cache_file, png_path)
+            return png_path
+
+    from pdf2image import convert_from_path
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=1, last_page=1)
+    _atomic_save_png(images[0], png_path)
+
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        shutil.copyfile(png_path, tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    return png_path
+
+
+def render_pdf_figures(
+        pdf_paths: Iterable[str],
+        dpi: int = FIGURE_DPI,
+        cache_dir: Optional[str] = FIGURE_CACHE_DIR,
+        max_workers: Optional[int] = None
+) -> Dict[str, str]:
+    """
+    Render many PDF figures on a process pool
+    :param pdf_paths:
+    :param dpi:
+    :param cache_dir:
+    :param max_workers: pool size, defaults to the number of CPUs; 1 renders serially
+    :return: dict from PDF path to PNG path, PDFs that failed to render are left out
+    """
+    pdf_paths = sorted(set(p for p in pdf_paths if os.path.isfile(p)))
+    if not pdf_paths:
+        return {}
+
+    render = partial(_safe_render_pdf_figure, dpi=dpi, cache_dir=cache_dir)
+    if max_workers == 1 or len(pdf_paths) == 1:
+        png_paths = [render(pdf_path) for pdf_path in pdf_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            png_paths = list(executor.map(render, pdf_paths))
+
+    return {
+        pdf_path: png_path for pdf_path, png_path in zip(pdf_paths, png_paths) if png_path
+    }
+
+
+def read_image_bytes(image_path: str) -> bytes:
+    """
+    Read the raw bytes of an image file
+    :param image_path:
+    :return:
+    """
+    with open(image_path, 'rb') as f:
+        return f.read()
+
+
+def normalize_image(
+        image_bytes: bytes,
+        max_size: Optional[int] = None,
+        image_format: Optional[str] = None
+) -> bytes:
+    """
+    Resize and/or re-encode an image; returns the input untouched if nothing is asked
+    :param image_bytes:
+    :param max_size: max width and height in pixels, aspect ratio is kept
+    :param image_format: PIL format name to convert to (e.g. PNG, JPEG)
+    :return:
+    """
+    if not max_size and not image_format:
+        return image_bytes
+
+    from PIL import Image
+    image = Image.open(io.BytesIO(image_bytes))
+    out_format = (image_format or image.format or 'PNG').upper()
+    needs_resize = bool(max_size) and max(image.size) > max_size
+    if not needs_resize and out_format == image.format:
+        return image_bytes
+
+    if needs_resize:
+        image.thumbnail((max_size, max_size))
+    if out_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    out = io.BytesIO()
+    image.save(out, format=out_format)
+    return out.getvalue()
+
+
+def make_thumbnail(image_bytes: bytes, size: int = THUMBNAIL_SIZE) -> Optional[bytes]:
+    """
+    Make a downscaled preview of an image
+    :param image_bytes:
+    :param size: max width and height of the thumbnail
+    :return: thumbnail bytes, None if the image can't be decoded
+    """
+    try:
+        return normalize_image(image_bytes, max_size=size, image_format=THUMBNAIL_FORMAT)
+    except Exception:
+        return None
+
+
+def _safe_render_pdf_figure(pdf_path: str, dpi: int, cache_dir: Optional[str]) -> Optional[str]:
+    try:
+        return render_pdf_figure(pdf_path, dpi=dpi, cache_dir=cache_dir)
+    except Exception as e:
+        print(f'Failed to render {pdf_path}: {e}')
+        return None
+
+
+def _atomic_save_png(image, png_path: str):
+    tmp_file = f'{png_path}.{os.getpid()}.tmp'
+    image.save(tmp_file, 'PNG')
+    os.replace(tmp_file, png_path)
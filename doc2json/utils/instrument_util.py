@@ -0,0 +1,408 @@
+"""
+Timings and counters for the pipelines, exposed in the Prometheus text format
+
+Pipeline stages are timed with `stage`, which both the CLI scripts and the Flask service
+go through; the service adds its own request metrics. Metrics live in a per-process
+registry. Work done in a child process (jobs, batches) is timed there with
+`record_stages` and the timings are handed back to the service with `observe_stages`.
+
+The converters are also instrumented step by step with `span` and `count`. These only do
+work while a sink is installed with `add_sink`: a log line per paper, a json file per
+paper, or Prometheus metrics (in the registry, optionally written to a textfile for the
+node exporter). Without sinks they return immediately.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in items
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    A named family of values, one per combination of label values
+    """
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels: LabelValues, value) -> List[str]:
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_value(self, labels: LabelValues, value) -> List[str]:
+        counts, total = value
+        lines = [
+            f'{self.name}_bucket{_format_labels(labels, ("le", _format_value(bound)))} {count}'
+            for bound, count in zip(self.buckets, counts)
+        ]
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {counts[-1]}')
+        return lines
+
+    def summary(self) -> Dict[LabelValues, Tuple[int, float]]:
+        """
+        Number of observations and their total, per label values
+        :return:
+        """
+        with self._lock:
+            return {labels: (counts[-1], total) for labels, (counts, total) in self._values.items()}
+
+
+class Registry:
+    """
+    The metrics of a process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name: str, documentation: str, **kwargs) -> Metric:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, documentation, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._get(Counter, name, documentation)
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._get(Gauge, name, documentation)
+
+    def histogram(self, name: str, documentation: str, buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, documentation, buckets=buckets)
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format
+        :return:
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(line + '\n' for metric in metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram('doc2json_stage_seconds', 'Duration of pipeline stages')
+
+_recording = threading.local()
+_sinks = []
+_current = threading.local()
+_NO_SPAN = contextlib.nullcontext()
+
+
+class Sink:
+    """
+    Receives the spans and counts of the converters; subclasses override what they need
+    """
+    def span(self, name: str, seconds: float, paper_id: Optional[str]):
+        pass
+
+    def count(self, name: str, value: float, paper_id: Optional[str]):
+        pass
+
+    def paper_start(self, paper_id: str):
+        pass
+
+    def paper_done(self, paper_id: str, spans: Dict[str, float], counts: Dict[str, float]):
+        pass
+
+    def close(self):
+        pass
+
+
+class LogSink(Sink):
+    """
+    One line per paper with the time spent in each span and the counts
+    """
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def paper_done(self, paper_id: str, spans: Dict[str, float], counts: Dict[str, float]):
+        timings = ', '.join(f'{name} {round(seconds, 3)}s' for name, seconds in spans.items())
+        counted = ', '.join(f'{name}={_format_value(value)}' for name, value in counts.items())
+        print(f'{paper_id}: {timings}' + (f'; {counted}' if counted else ''), file=self.stream)
+
+
+class JsonSink(Sink):
+    """
+    A <paper_id>.timings.json file per paper with its spans and counts
+    """
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+
+    def paper_done(self, paper_id: str, spans: Dict[str, float], counts: Dict[str, float]):
+        with open(os.path.join(self.output_dir, f'{paper_id}.timings.json'), 'w') as f:
+            json.dump({"paper_id": paper_id, "spans": spans, "counts": counts}, f, indent=4)
+
+
+class RegistrySink(Sink):
+    """
+    Spans and counts as Prometheus metrics of this process
+    """
+    def __init__(self, registry: Registry = REGISTRY):
+        self.registry = registry
+        self.span_seconds = registry.histogram('doc2json_span_seconds', 'Duration of converter steps')
+        self.counts = registry.counter('doc2json_span_items_total', 'Items produced by converter steps')
+
+    def span(self, name: str, seconds: float, paper_id: Optional[str]):
+        self.span_seconds.observe(seconds, span=name)
+
+    def count(self, name: str, value: float, paper_id: Optional[str]):
+        self.counts.inc(value, item=name)
+
+
+class PrometheusTextfileSink(RegistrySink):
+    """
+    Registry metrics written to a textfile for the node exporter, at most every interval
+    seconds and when the sink is closed
+    """
+    def __init__(self, path: str, interval: float = 10, registry: Registry = REGISTRY):
+        super().__init__(registry)
+        self.path = path
+        self.interval = interval
+        self._last_write = 0.0
+
+    def paper_done(self, paper_id: str, spans: Dict[str, float], counts: Dict[str, float]):
+        if time.monotonic() - self._last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        tmp_file = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(self.registry.render())
+        os.replace(tmp_file, self.path)
+        self._last_write = time.monotonic()
+
+    def close(self):
+        self.write()
+
+
+def add_sink(sink: Sink) -> Sink:
+    _sinks.append(sink)
+    return sink
+
+
+def close_sinks():
+    """
+    Close and remove all sinks
+    :return:
+    """
+    while _sinks:
+        _sinks.pop().close()
+
+
+def _emit_span(name: str, seconds: float):
+    paper = getattr(_current, 'paper', None)
+    if paper is not None:
+        paper["spans"][name] = paper["spans"].get(name, 0) + seconds
+    for sink in _sinks:
+        sink.span(name, seconds, paper and paper["id"])
+
+
+@contextlib.contextmanager
+def _timed_span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _emit_span(name, time.perf_counter() - start)
+
+
+def span(name: str):
+    """
+    Time a step of a converter, a no-op unless a sink is installed
+    :param name:
+    :return: context manager
+    """
+    if not _sinks:
+        return _NO_SPAN
+    return _timed_span(name)
+
+
+def count(name: str, value: float = 1):
+    """
+    Count items produced by a converter step, a no-op unless a sink is installed
+    :param name:
+    :param value:
+    :return:
+    """
+    if not _sinks:
+        return
+    paper = getattr(_current, 'paper', None)
+    if paper is not None:
+        paper["counts"][name] = paper["counts"].get(name, 0) + value
+    for sink in _sinks:
+        sink.count(name, value, paper and paper["id"])
+
+
+@contextlib.contextmanager
+def instrument_paper(paper_id: str):
+    """
+    Attribute the spans and counts inside to a paper, reported to the sinks at the end
+    :param paper_id:
+    :return:
+    """
+    if not _sinks:
+        yield
+        return
+    previous = getattr(_current, 'paper', None)
+    paper = _current.paper = {"id": paper_id, "spans": {}, "counts": {}}
+    for sink in _sinks:
+        sink.paper_start(paper_id)
+    try:
+        yield
+    finally:
+        _current.paper = previous
+        for sink in _sinks:
+            sink.paper_done(paper_id, paper["spans"], paper["counts"])
+
+
+def add_instrument_args(parser):
+    """
+    Command line options of the CLI scripts for installing sinks
+    :param parser: argparse parser
+    :return:
+    """
+    parser.add_argument("--timings_log", action='store_true', help="print the time spent in each step per paper")
+    parser.add_argument("--timings_json", default=None, help="write a json file of step timings per paper to this dir")
+    parser.add_argument("--timings_textfile", default=None, help="write step metrics to this Prometheus textfile")
+
+
+def setup_sinks(args):
+    """
+    Install the sinks asked for on the command line
+    :param args: parsed arguments of a parser set up with add_instrument_args
+    :return:
+    """
+    if args.timings_log:
+        add_sink(LogSink())
+    if args.timings_json:
+        add_sink(JsonSink(args.timings_json))
+    if args.timings_textfile:
+        add_sink(PrometheusTextfileSink(args.timings_textfile))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Time a pipeline stage (extract, latexpand, tralics, grobid, soup_conversion, serialise)
+    :param name:
+    :return:
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=name)
+        recorded = getattr(_recording, 'stages', None)
+        if recorded is not None:
+            recorded.append((name, seconds))
+        if _sinks:
+            _emit_span(name, seconds)
+
+
+@contextlib.contextmanager
+def record_stages():
+    """
+    Collect the stages timed in this thread, to hand them to another process
+    :return: list of (stage, seconds), filled as stages finish
+    """
+    previous = getattr(_recording, 'stages', None)
+    _recording.stages = []
+    try:
+        yield _recording.stages
+    finally:
+        _recording.stages = previous
+
+
+def observe_stages(stages: Iterable[Tuple[str, float]]):
+    """
+    Add stage timings recorded in another process to this process' metrics
+    :param stages: list of (stage, seconds)
+    :return:
+    """
+    for name, seconds in stages:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def format_stage_timings() -> str:
+    """
+    One line summary of the time spent per stage, for the CLI scripts
+    :return:
+    """
+    totals = sorted(
+        ((dict(labels)['stage'], total) for labels, (count, total) in STAGE_SECONDS.summary().items()),
+        key=lambda item: -item[1]
+    )
+    return ', '.join(f'{name} {round(total, 3)}s' for name, total in totals)
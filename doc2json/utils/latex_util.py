@@ -5,8 +5,6 @@ the unarXive project: https://github.com/IllDepence/unarXive
 Modifications have been made to better identify the primary latex file and expand all other latex
 files into the main file. Latexpand and tralics options have also been changed.
 """
-import chardet
-import magic
 import os
 import re
 import glob
@@ -51,6 +49,9 @@ def read_file(path):
         with open(path) as f:
             cntnt = f.read()
     except UnicodeDecodeError:
+        # encoding detection is rarely needed, its libraries are imported on demand
+        import magic
+        import chardet
         blob = open(path, 'rb').read()
         m = magic.Magic(mime_encoding=True)
         encoding = m.from_buffer(blob)
@@ -0,0 +1,115 @@
+"""
+Memory accounting for the pipelines
+
+The resident set size (RSS) of a process is read from /proc, which also works for other
+processes, so a parent can watch its workers. MemoryTracker samples the RSS of the current
+process while a paper is converted to find its high-water mark, and can also trace the
+peak of Python allocations with tracemalloc (slower, but independent of what the
+allocator keeps around from earlier papers).
+"""
+
+import os
+import re
+import sys
+import resource
+import threading
+import tracemalloc
+from typing import Optional
+
+
+MEMORY_SAMPLE_INTERVAL = 0.05
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def get_rss(pid: Optional[int] = None) -> Optional[int]:
+    """
+    Resident set size of a process in bytes
+    :param pid: the current process by default
+    :return: None if the process doesn't exist or /proc isn't available
+    """
+    try:
+        with open(f'/proc/{pid or "self"}/statm', 'r') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        if pid is None or pid == os.getpid():
+            return get_peak_rss()
+        return None
+
+
+def get_peak_rss() -> int:
+    """
+    Largest resident set size of the current process so far, in bytes
+    :return:
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def parse_size(size) -> Optional[int]:
+    """
+    Number of bytes of a size like 512M or 2G (binary units), None and 0 stay None
+    :param size: str or int
+    :return:
+    """
+    if size is None or isinstance(size, int):
+        return size or None
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', size.upper())
+    if not match:
+        raise ValueError(f'Invalid size {size}, expected e.g. 512M or 2G')
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)]) or None
+
+
+def format_size(size: Optional[int]) -> str:
+    if size is None:
+        return '-'
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}T'
+
+
+class MemoryTracker:
+    """
+    High-water mark of the RSS of this process while in the block, sampled from a thread
+
+        with MemoryTracker() as tracker:
+            convert(paper)
+        tracker.peak_rss
+    """
+    def __init__(self, interval: float = MEMORY_SAMPLE_INTERVAL, trace_python: bool = False):
+        self.interval = interval
+        self.trace_python = trace_python
+        self.start_rss = None
+        self.peak_rss = None
+        self.traced_peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, get_rss() or 0)
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = get_rss() or 0
+        if self.trace_python:
+            tracemalloc.start()
+        self._thread = threading.Thread(target=self._sample, name='memory-tracker', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, get_rss() or 0)
+        if self.trace_python:
+            self.traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return False
@@ -0,0 +1,338 @@
+"""
+Helpers for writing export records to Parquet
+
+Images can be deduplicated into a side table keyed by content hash: block rows then
+keep only the hash in IMAGE_HASH_KEY, and the image bytes (plus an optional thumbnail)
+are stored once in `<name>.images.parquet`.
+
+Records can also be written into a Hive-partitioned dataset (`year=.../数据类型=.../`)
+shared by many papers. The dataset root holds a manifest with the row count and the
+per-column min/max statistics of every file, so readers can prune files without
+opening them. Papers are often exported by concurrent processes: the manifest and the
+files of the dataset are changed under an exclusive lock on `_manifest.lock`.
+"""
+
+import os
+import re
+import json
+import fcntl
+import hashlib
+import contextlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from doc2json.utils.image_util import make_thumbnail
+
+
+IMAGE_KEY = "图片"
+IMAGE_HASH_KEY = "图片hash"
+THUMBNAIL_KEY = "缩略图"
+IMAGE_TABLE_SUFFIX = '.images.parquet'
+PARTITION_COLUMNS = ('year', '数据类型')
+MANIFEST_NAME = '_manifest.json'
+MANIFEST_LOCK_NAME = '_manifest.lock'
+IMAGE_DATASET_DIR = '_images'
+
+# columns with a fixed arrow type; all other column types are inferred
+COLUMN_TYPES = {
+    IMAGE_KEY: pa.large_binary(),
+    IMAGE_HASH_KEY: pa.string(),
+    THUMBNAIL_KEY: pa.large_binary()
+}
+
+
+def records_to_table(records: List[Dict], names: Optional[List[str]] = None) -> pa.Table:
+    """
+    Convert export records to an arrow table, one column array per record key
+    :param records:
+    :param names: columns to write, defaults to all record keys in order of appearance
+    :return:
+    """
+    if names is None:
+        names = list(dict.fromkeys(key for record in records for key in record))
+
+    arrays = [
+        pa.array([record.get(name) for record in records], type=COLUMN_TYPES.get(name))
+        for name in names
+    ]
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def split_images(records: List[Dict], thumbnail_size: Optional[int] = None) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Move images out of export records into a table with one row per distinct image
+    :param records:
+    :param thumbnail_size: also make thumbnails no larger than this, None to skip them
+    :return: block records referencing images by hash, image records
+    """
+    block_records = []
+    image_records = {}
+    # hash each distinct bytes object once; rows of the same figure share it
+    hashes_by_id = {}
+    for record in records:
+        block_record = record.copy()
+        block_records.append(block_record)
+        image = record.get(IMAGE_KEY)
+        if image is None:
+            block_record[IMAGE_HASH_KEY] = None
+            continue
+        image_hash = hashes_by_id.get(id(image))
+        if image_hash is None:
+            image_hash = hashlib.sha1(image).hexdigest()
+            hashes_by_id[id(image)] = image_hash
+        if image_hash not in image_records:
+            image_record = {IMAGE_HASH_KEY: image_hash, IMAGE_KEY: image}
+            if thumbnail_size:
+                image_record[THUMBNAIL_KEY] = make_thumbnail(image, thumbnail_size)
+            image_records[image_hash] = image_record
+        block_record[IMAGE_KEY] = None
+        block_record[IMAGE_HASH_KEY] = image_hash
+    return block_records, list(image_records.values())
+
+
+def add_thumbnails(records: List[Dict], thumbnail_size: int) -> List[Dict]:
+    """
+    Add a thumbnail column next to the images of export records
+    :param records:
+    :param thumbnail_size:
+    :return:
+    """
+    thumbnails = {}
+    new_records = []
+    for record in records:
+        new_record = record.copy()
+        image = record.get(IMAGE_KEY)
+        if image is not None and id(image) not in thumbnails:
+            thumbnails[id(image)] = make_thumbnail(image, thumbnail_size)
+        new_record[THUMBNAIL_KEY] = thumbnails.get(id(image)) if image is not None else None
+        new_records.append(new_record)
+    return new_records
+
+
+def get_image_table_path(output_path: str) -> str:
+    """
+    Path of the image side table belonging to a parquet file
+    :param output_path:
+    :return:
+    """
+    return os.path.splitext(output_path)[0] + IMAGE_TABLE_SUFFIX
+
+
+def save_to_parquet(
+        records: List[Dict],
+        output_path: str,
+        dedup_images: bool = False,
+        thumbnail_size: Optional[int] = None
+):
+    """
+    Write export records to a parquet file
+    :param records:
+    :param output_path:
+    :param dedup_images: store each distinct image once in a side table next to output_path
+    :param thumbnail_size: also store thumbnails no larger than this, None to skip them
+    :return:
+    """
+    if dedup_images:
+        records, image_records = split_images(records, thumbnail_size)
+        image_columns = [IMAGE_HASH_KEY, IMAGE_KEY] + ([THUMBNAIL_KEY] if thumbnail_size else [])
+        pq.write_table(records_to_table(image_records, image_columns), get_image_table_path(output_path))
+    elif thumbnail_size:
+        records = add_thumbnails(records, thumbnail_size)
+    pq.write_table(records_to_table(records), output_path)
+
+
+def save_to_dataset(
+        records: List[Dict],
+        root_dir: str,
+        basename: str,
+        partition_values: Optional[Dict] = None,
+        partition_cols: Iterable[str] = PARTITION_COLUMNS,
+        dedup_images: bool = False,
+        thumbnail_size: Optional[int] = None
+) -> List[str]:
+    """
+    Write export records into a Hive-partitioned parquet dataset and update its manifest
+    :param records:
+    :param root_dir: dataset root
+    :param basename: prefix of the written files, usually the paper id; rewriting a paper replaces its files
+    :param partition_values: values set on every record, e.g. the paper year
+    :param partition_cols: columns to partition by
+    :param dedup_images: store each distinct image once under root_dir/_images
+    :param thumbnail_size: also store thumbnails no larger than this, None to skip them
+    :return: paths of the written data files
+    """
+    if partition_values:
+        records = [dict(record, **partition_values) for record in records]
+    image_file = os.path.join(root_dir, IMAGE_DATASET_DIR, f'{basename}.parquet')
+    if dedup_images:
+        records, image_records = split_images(records, thumbnail_size)
+        image_columns = [IMAGE_HASH_KEY, IMAGE_KEY] + ([THUMBNAIL_KEY] if thumbnail_size else [])
+        os.makedirs(os.path.dirname(image_file), exist_ok=True)
+        pq.write_table(records_to_table(image_records, image_columns), image_file)
+    else:
+        if os.path.exists(image_file):
+            os.remove(image_file)
+        if thumbnail_size:
+            records = add_thumbnails(records, thumbnail_size)
+
+    table = records_to_table(records)
+    file_pattern = re.compile(rf'{re.escape(basename)}-\d+\.parquet')
+    with manifest_lock(root_dir):
+        # drop the files of a previous export of the same paper, its partitions may have changed
+        removed = [
+            rel_path for rel_path in load_manifest(root_dir)["files"]
+            if file_pattern.fullmatch(os.path.basename(rel_path))
+        ]
+        for rel_path in removed:
+            if os.path.exists(os.path.join(root_dir, rel_path)):
+                os.remove(os.path.join(root_dir, rel_path))
+
+        written = []
+        pq.write_to_dataset(
+            table,
+            root_dir,
+            partition_cols=list(partition_cols),
+            basename_template=f'{basename}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore',
+            file_visitor=lambda written_file: written.append(written_file.path)
+        )
+        _remove_empty_partitions(root_dir, removed)
+        _update_manifest(root_dir, written, removed)
+    return written
+
+
+@contextlib.contextmanager
+def manifest_lock(root_dir: str):
+    """
+    Hold the exclusive lock on the manifest and files of a dataset, blocking until it is free
+    :param root_dir:
+    :return:
+    """
+    os.makedirs(root_dir, exist_ok=True)
+    with open(os.path.join(root_dir, MANIFEST_LOCK_NAME), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _remove_empty_partitions(root_dir: str, rel_paths: Iterable[str]):
+    # partition directories of removed files that no file is left in
+    root_dir = os.path.abspath(root_dir)
+    for rel_path in rel_paths:
+        directory = os.path.dirname(os.path.join(root_dir, rel_path))
+        while directory != root_dir and directory.startswith(root_dir + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # not empty, or gone already
+                break
+            directory = os.path.dirname(directory)
+
+
+def get_file_stats(path: str, root_dir: str) -> Dict:
+    """
+    Manifest entry of one data file: partition values, row count and column min/max
+    :param path:
+    :param root_dir:
+    :return:
+    """
+    metadata = pq.read_metadata(path)
+    rel_path = os.path.relpath(path, root_dir)
+    partition = dict(
+        part.split('=', 1) for part in os.path.dirname(rel_path).split(os.sep) if '=' in part
+    )
+
+    columns = {}
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            name = column.path_in_schema
+            if name in COLUMN_TYPES and name != IMAGE_HASH_KEY:
+                continue
+            stats = column.statistics
+            entry = columns.setdefault(name, {"min": None, "max": None, "null_count": 0})
+            if stats is None:
+                continue
+            entry["null_count"] += stats.null_count
+            if not stats.has_min_max or isinstance(stats.min, bytes):
+                continue
+            if entry["min"] is None or stats.min < entry["min"]:
+                entry["min"] = stats.min
+            if entry["max"] is None or stats.max > entry["max"]:
+                entry["max"] = stats.max
+
+    return {
+        "partition": partition,
+        "num_rows": metadata.num_rows,
+        "columns": columns
+    }
+
+
+def build_manifest(root_dir: str) -> Dict:
+    """
+    Rebuild the manifest of a dataset from the footers of all of its data files
+    :param root_dir:
+    :return:
+    """
+    with manifest_lock(root_dir):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root_dir):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith(('_', '.')))
+            paths.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.endswith('.parquet'))
+        return _write_manifest(root_dir, {
+            os.path.relpath(path, root_dir): get_file_stats(path, root_dir) for path in paths
+        })
+
+
+def update_manifest(root_dir: str, paths: Iterable[str], removed: Iterable[str] = ()) -> Dict:
+    """
+    Add or refresh the manifest entries of the given data files
+    :param root_dir:
+    :param paths:
+    :param removed: paths relative to root_dir of files no longer in the dataset
+    :return:
+    """
+    with manifest_lock(root_dir):
+        return _update_manifest(root_dir, paths, removed)
+
+
+def _update_manifest(root_dir: str, paths: Iterable[str], removed: Iterable[str] = ()) -> Dict:
+    # with the manifest lock held
+    files = load_manifest(root_dir)["files"]
+    for rel_path in removed:
+        files.pop(rel_path, None)
+    for path in paths:
+        files[os.path.relpath(path, root_dir)] = get_file_stats(path, root_dir)
+    return _write_manifest(root_dir, files)
+
+
+def load_manifest(root_dir: str) -> Dict:
+    """
+    Read the manifest of a dataset, empty if there is none yet
+    :param root_dir:
+    :return:
+    """
+    manifest_file = os.path.join(root_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {"files": {}}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def _write_manifest(root_dir: str, files: Dict) -> Dict:
+    manifest = {
+        "num_files": len(files),
+        "num_rows": sum(entry["num_rows"] for entry in files.values()),
+        "files": dict(sorted(files.items()))
+    }
+    manifest_file = os.path.join(root_dir, MANIFEST_NAME)
+    tmp_file = f'{manifest_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, default=str)
+    os.replace(tmp_file, manifest_file)
+    return manifest
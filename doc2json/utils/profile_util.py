@@ -0,0 +1,154 @@
+"""
+Profiling of the CLI scripts
+
+`--profile DIR` profiles a run with cProfile (deterministic) or pyinstrument (sampling,
+if installed), either as a whole or per paper. Profiling is done by a sink of
+instrument_util: per paper profiles start and stop with `instrument_paper`, a profile of
+the whole run stops when the sinks are closed. cProfile profiles are written as .prof
+files (pstats, snakeviz), pyinstrument ones as speedscope json; both come with a text
+summary of the hottest functions. Only the thread processing the paper is profiled.
+"""
+
+import io
+import os
+import re
+import sys
+import pstats
+import cProfile
+from typing import Optional
+
+from doc2json.utils.instrument_util import Sink, add_sink
+
+
+PROFILERS = ('cprofile', 'pyinstrument')
+PROFILE_TOP = 30
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r'[^\w.-]+', '_', name) or 'paper'
+
+
+class ProfileSink(Sink):
+    """
+    Profiles the whole run, or each paper, and writes the profiles to a directory
+    """
+    def __init__(
+            self,
+            output_dir: str,
+            profiler: str = 'cprofile',
+            per_paper: bool = False,
+            top: int = PROFILE_TOP,
+            stream=None
+    ):
+        if profiler not in PROFILERS:
+            raise ValueError(f'Unknown profiler {profiler}, expected one of {PROFILERS}')
+        if profiler == 'pyinstrument':
+            try:
+                import pyinstrument
+            except ImportError:
+                raise ImportError('pyinstrument is not installed, use the cprofile profiler or pip install pyinstrument')
+        self.output_dir = output_dir
+        self.profiler = profiler
+        self.per_paper = per_paper
+        self.top = top
+        self.stream = stream or sys.stderr
+        self._active = None
+        # instrument_paper blocks can be nested, only the outermost one is profiled
+        self._depth = 0
+        os.makedirs(output_dir, exist_ok=True)
+        if not per_paper:
+            self._active = self._start()
+
+    def _start(self):
+        if self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def _stop(self):
+        profiler, self._active = self._active, None
+        if self.profiler == 'pyinstrument':
+            profiler.stop()
+        else:
+            profiler.disable()
+        return profiler
+
+    def summary(self, profiler) -> str:
+        """
+        The top functions of a profile by time spent in the function itself
+        :param profiler:
+        :return:
+        """
+        if self.profiler == 'pyinstrument':
+            # rows are "<seconds> <function> <file>:<line>", after a header
+            lines = profiler.output_text(flat=True, short_mode=True).splitlines()
+            return '\n'.join([line for line in lines if re.match(r'\s*\d', line)][:self.top]) + '\n'
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).strip_dirs().sort_stats('tottime').print_stats(self.top)
+        return out.getvalue()
+
+    def write(self, profiler, name: str) -> str:
+        """
+        Write a profile and its summary
+        :param profiler:
+        :param name: file name without extension
+        :return: the summary
+        """
+        path = os.path.join(self.output_dir, _safe_name(name))
+        if self.profiler == 'pyinstrument':
+            from pyinstrument.renderers import SpeedscopeRenderer
+            with open(f'{path}.speedscope.json', 'w') as f:
+                f.write(profiler.output(SpeedscopeRenderer()))
+        else:
+            profiler.dump_stats(f'{path}.prof')
+        summary = self.summary(profiler)
+        with open(f'{path}.txt', 'w') as f:
+            f.write(summary)
+        return summary
+
+    def paper_start(self, paper_id: str):
+        if not self.per_paper:
+            return
+        self._depth += 1
+        if self._depth == 1:
+            self._active = self._start()
+
+    def paper_done(self, paper_id: str, spans, counts):
+        if not self.per_paper:
+            return
+        self._depth -= 1
+        if self._depth == 0 and self._active is not None:
+            self.write(self._stop(), paper_id)
+
+    def close(self):
+        if self._active is None:
+            return
+        summary = self.write(self._stop(), 'profile')
+        print(f'profile written to {self.output_dir}, hottest functions:\n{summary}', file=self.stream)
+
+
+def add_profile_args(parser):
+    """
+    Command line options of the CLI scripts for profiling
+    :param parser: argparse parser
+    :return:
+    """
+    parser.add_argument("--profile", default=None, help="profile the run and write the profiles to this dir")
+    parser.add_argument("--profiler", default='cprofile', choices=PROFILERS, help="cprofile or pyinstrument (sampling)")
+    parser.add_argument("--profile_per_paper", action='store_true', help="write a profile per paper instead of one")
+    parser.add_argument("--profile_top", default=PROFILE_TOP, type=int, help="functions in the profile summaries")
+
+
+def setup_profile(args) -> Optional[ProfileSink]:
+    """
+    Start profiling if asked for on the command line; profiles are written by close_sinks
+    :param args: parsed arguments of a parser set up with add_profile_args
+    :return:
+    """
+    if not args.profile:
+        return None
+    return add_sink(ProfileSink(args.profile, args.profiler, args.profile_per_paper, args.profile_top))
@@ -0,0 +1,65 @@
+"""
+Helpers for building the flat block records exported to JSON / Parquet
+"""
+
+import base64
+from typing import Dict, List, Optional
+
+
+RECORD_TEMPLATE = {
+    "文件md5": None,
+    "文件id": None,
+    "页码": None,
+    "块id": None,
+    "文本": None,
+    "图片": None,
+    "处理时间": None,
+    "数据类型": None,
+    "bounding_box": None,
+    "额外信息": None
+}
+
+
+class RecordBuilder:
+    """
+    Builds export records directly from a template
+
+    Every record is a shallow copy of the template with the given fields set, so the
+    (possibly large) values passed in, such as image bytes or ref entry dicts, are
+    referenced rather than copied. Key order follows the template, with unknown keys
+    appended at the end.
+    """
+    def __init__(self, template: Optional[Dict] = None):
+        self.template = dict(RECORD_TEMPLATE if template is None else template)
+        self.records: List[Dict] = []
+
+    def set_default(self, key: str, value):
+        """
+        Set a value used by all records added from now on
+        :param key:
+        :param value:
+        :return:
+        """
+        self.template[key] = value
+
+    def add(self, fields: Dict) -> Dict:
+        """
+        Append a new record made of the template and the given fields
+        :param fields:
+        :return:
+        """
+        record = self.template.copy()
+        record.update(fields)
+        self.records.append(record)
+        return record
+
+
+def record_json_default(obj):
+    """
+    json.dump default hook for export records; binary values (images) become base64 strings
+    :param obj:
+    :return:
+    """
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode('ascii')
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
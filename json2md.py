@@ -1,68 +1,153 @@
 import json
-import io
-import copy
 import os
 import argparse
-from PIL import Image
-from pdf2image import convert_from_path
-from mdutils.mdutils import MdUtils
-from mdutils import Html
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from doc2json.utils.image_util import FIGURE_DPI, FIGURE_CACHE_DIR, get_figure_paths, render_pdf_figures
 
-import pdb 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='parameters')
     parser.add_argument('--data_path', dest='data_path',
-                        default='', type=str) 
+                        default='', type=str, help='json file, or a directory of json files')
     parser.add_argument('--output_path', dest='output_path',
-                        default='', type=str) 
+                        default='', type=str)
     parser.add_argument('--tmp_path', dest='tmp_path',
-                        default='', type=str) 
+                        default='', type=str)
+    parser.add_argument('--figure_dpi', dest='figure_dpi',
+                        default=FIGURE_DPI, type=int)
+    parser.add_argument('--figure_cache', dest='figure_cache',
+                        default=FIGURE_CACHE_DIR, type=str)
+    parser.add_argument('--figure_workers', dest='figure_workers',
+                        default=None, type=int)
+    parser.add_argument('--workers', dest='workers',
+                        default=None, type=int, help='number of json files converted in parallel')
     args = parser.parse_args()
     return args
 
-def convert_to_target_format(data, md_filepath, tmp_path):
-
-    mdFile = MdUtils(file_name=md_filepath)
-    for i in data:
-        if i == 'title':
-            mdFile.new_header(level=1, title=data["title"])  # style is set 'atx' format by default.
-        
-        if "_parse" in i:
-            for entry in data.get(i, {}).get("abstract", []):
-                text = entry.get("text", "")
-                mdFile.new_paragraph(text) 
-            
-            for entry in data.get(i, {}).get("body_text", []):
-                text = entry.get("text", "")
-                mdFile.new_paragraph(text) 
-
-    for i in data["latex_parse"]["ref_entries"]:
-        if data["latex_parse"]["ref_entries"][i]["type_str"] == "figure":
-            temdir_path = tmp_path + '/latex' 
-            paper_repath = data["latex_parse"]["ref_entries"][i]["uris"]
-            image_path = os.path.join(temdir_path, data['paper_id'], ''.join(paper_repath))
-            if image_path.lower().endswith('.pdf'):
-                images = convert_from_path(image_path)
-                image_path = os.path.splitext(image_path)[0] + ".png"
-                images[0].save(image_path, 'PNG')
-
-            if not os.path.isdir(image_path):
-                image_text = ""
-                mdFile.insert_code("mdFile.new_line(mdFile.new_inline_image(text='{}', path='{}'))".format(image_text, image_path))
-                mdFile.new_line(mdFile.new_inline_image(text=image_text, path=image_path))
-
-    mdFile.create_md_file()
 
+def get_md_name(json_path):
+    # arXiv-2408.05159v1.tar.json -> arXiv-2408.05159v1.md
+    name = os.path.basename(json_path)
+    for ext in ('.json', '.tar'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name + '.md'
 
-if __name__ == '__main__':
-    args = parse_args() 
-    data_name = args.data_path.split('/')[-1] 
 
-    convert_md_filepath = os.path.join(args.output_path, data_name)  
+def get_figures(data, tmp_path, figure_dpi=FIGURE_DPI, figure_cache=FIGURE_CACHE_DIR, figure_workers=None):
+    """
+    Get the image file of every figure that exists, rasterising pdf figures up front in parallel
+    :return: dict from figure ref id to image path
+    """
+    figure_paths = get_figure_paths(data, tmp_path)
+    png_paths = render_pdf_figures(
+        [p for p in figure_paths.values() if p.lower().endswith('.pdf')],
+        dpi=figure_dpi, cache_dir=figure_cache, max_workers=figure_workers
+    )
+    figures = {}
+    for ref_id, image_path in figure_paths.items():
+        if image_path.lower().endswith('.pdf'):
+            image_path = png_paths.get(image_path, os.path.splitext(image_path)[0] + ".png")
+        if os.path.isfile(image_path):
+            figures[ref_id] = image_path
+    return figures
+
+
+def write_figure(out, ref_entry, image_path):
+    out.write(f"![]({image_path})\n\n")
+    if ref_entry.get("text"):
+        out.write(ref_entry["text"] + "\n\n")
+
+
+def convert_to_target_format(data, md_filepath, tmp_path, figure_dpi=FIGURE_DPI, figure_cache=FIGURE_CACHE_DIR, figure_workers=None):
+    """
+    Write a S2ORC json paper as markdown. The document is streamed to the file as body_text is
+    iterated: a header whenever the section changes, and every figure right after the first
+    paragraph that references it (figures that are never referenced go at the end)
+    :param data: S2ORC json of the paper
+    :param md_filepath: markdown file to write, replaced atomically when done
+    :param tmp_path: temp dir the LaTeX sources were extracted to
+    :return: md_filepath
+    """
+    figures = get_figures(data, tmp_path, figure_dpi, figure_cache, figure_workers)
+    figure_entries = data["latex_parse"]["ref_entries"]
+    written_figures = set()
+
+    tmp_filepath = f'{md_filepath}.{os.getpid()}.tmp'
+    with open(tmp_filepath, 'w') as out:
+        if data.get("title"):
+            out.write(f"# {data['title']}\n\n")
+
+        for key in data:
+            if "_parse" not in key:
+                continue
+            doc_parse = data[key] or {}
+
+            for entry in doc_parse.get("abstract", []):
+                out.write(entry.get("text", "") + "\n\n")
+
+            section = None
+            for entry in doc_parse.get("body_text", []):
+                if entry.get("section") and entry["section"] != section:
+                    section = entry["section"]
+                    sec_num = entry.get("sec_num")
+                    out.write(f"## {sec_num} {section}\n\n" if sec_num else f"## {section}\n\n")
+                out.write(entry.get("text", "") + "\n\n")
+
+                for ref in entry.get("ref_spans", []):
+                    ref_id = ref.get("ref_id")
+                    if ref_id in figures and ref_id not in written_figures:
+                        write_figure(out, figure_entries[ref_id], figures[ref_id])
+                        written_figures.add(ref_id)
 
-    json_path = args.data_path 
+        for ref_id, image_path in figures.items():
+            if ref_id not in written_figures:
+                write_figure(out, figure_entries[ref_id], image_path)
+
+    os.replace(tmp_filepath, md_filepath)
+    return md_filepath
+
+
+def convert_json_file(json_path, output_path, tmp_path, figure_dpi=FIGURE_DPI, figure_cache=FIGURE_CACHE_DIR, figure_workers=None):
     with open(json_path, 'r') as file:
         data = json.load(file)
-        convert_to_target_format(data, data_name[:-9], args.tmp_path)
- 
+    md_filepath = os.path.join(output_path, get_md_name(json_path))
+    return convert_to_target_format(data, md_filepath, tmp_path, figure_dpi, figure_cache, figure_workers)
+
+
+def convert_json_files(json_paths, output_path, tmp_path, figure_dpi=FIGURE_DPI, figure_cache=FIGURE_CACHE_DIR, workers=None):
+    """
+    Convert many json files in parallel, one process per file
+    :return: dict from json path to markdown path, None for files that failed
+    """
+    results = {}
+    # each worker renders its own figures serially, the pool is the parallelism
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(convert_json_file, json_path, output_path, tmp_path, figure_dpi, figure_cache, 1): json_path
+            for json_path in json_paths
+        }
+        for future in as_completed(futures):
+            json_path = futures[future]
+            try:
+                results[json_path] = future.result()
+            except Exception as e:
+                print(f'Failed to convert {json_path}: {e}')
+                results[json_path] = None
+    return results
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.output_path:
+        os.makedirs(args.output_path, exist_ok=True)
+
+    if os.path.isdir(args.data_path):
+        json_paths = sorted(
+            os.path.join(args.data_path, f) for f in os.listdir(args.data_path) if f.endswith('.json')
+        )
+        convert_json_files(json_paths, args.output_path, args.tmp_path, args.figure_dpi, args.figure_cache, args.workers)
+    else:
+        convert_json_file(
+            args.data_path, args.output_path, args.tmp_path, args.figure_dpi, args.figure_cache, args.figure_workers
+        )
@@ -1,10 +1,15 @@
 import json
 import io
-import copy
 import os
+import base64
 import argparse
 from PIL import Image
-from pdf2image import convert_from_path
+from doc2json.utils.image_util import FIGURE_DPI, FIGURE_CACHE_DIR, get_figure_paths, render_pdf_figures, \
+    read_image_bytes, normalize_image
+from doc2json.utils.record_util import RECORD_TEMPLATE, RecordBuilder, record_json_default
+from doc2json.utils.parquet_util import save_to_parquet, save_to_dataset
+from doc2json.utils.instrument_util import instrument_paper, close_sinks
+from doc2json.utils.profile_util import add_profile_args, setup_profile
 
 def parse_args():
     parser = argparse.ArgumentParser(description='parameters')
@@ -14,89 +19,99 @@ def parse_args():
                         default='', type=str) 
     parser.add_argument('--tmp_path', dest='tmp_path',
                         default='', type=str) 
+    parser.add_argument('--figure_dpi', dest='figure_dpi',
+                        default=FIGURE_DPI, type=int) 
+    parser.add_argument('--figure_cache', dest='figure_cache',
+                        default=FIGURE_CACHE_DIR, type=str) 
+    parser.add_argument('--figure_workers', dest='figure_workers',
+                        default=None, type=int) 
+    parser.add_argument('--image_max_size', dest='image_max_size',
+                        default=None, type=int) 
+    parser.add_argument('--image_format', dest='image_format',
+                        default=None, type=str) 
+    parser.add_argument('--output_format', dest='output_format',
+                        default='json', choices=['json', 'parquet', 'dataset'], type=str) 
+    parser.add_argument('--dedup_images', dest='dedup_images',
+                        action='store_true') 
+    parser.add_argument('--thumbnail_size', dest='thumbnail_size',
+                        default=None, type=int) 
+    add_profile_args(parser)
     args = parser.parse_args()
     return args
 
 
-def image_to_decimal_array(image_path):
-    # 读取图片文件
-    with open(image_path, 'rb') as file:
-        image_data = file.read()
-    # 将二进制数据转换为十进制数组
-    decimal_array = list(image_data)
-    return decimal_array
-
 def decimal_array_to_image(decimal_array, output_path):
-    # 将十进制数组转换为字节数据
-    byte_data = bytes(decimal_array)
+    # 将十进制数组（旧格式）、base64字符串或二进制转换为字节数据
+    if isinstance(decimal_array, str):
+        byte_data = base64.b64decode(decimal_array)
+    else:
+        byte_data = bytes(decimal_array)
     image = Image.open(io.BytesIO(byte_data))
     image.save(output_path)
 
-def convert_to_target_format(data, template, tmp_path):
-    result = []
-    template["文件id"] = data['paper_id']
-    template["处理时间"] = data["header"]["date_generated"]
+def convert_to_target_format(data, template, tmp_path, figure_dpi=FIGURE_DPI, figure_cache=FIGURE_CACHE_DIR, figure_workers=None,
+                             image_max_size=None, image_format=None):
+    builder = RecordBuilder(template)
+    builder.set_default("文件id", data['paper_id'])
+    builder.set_default("处理时间", data["header"]["date_generated"])
     
     for i in data:
         if i == 'title':
-            new_entry = copy.deepcopy(template)
-            new_entry["块id"] = '0'
-            new_entry["文本"] = data["title"]
-            new_entry["数据类型"] = 'text' 
-            result.append(copy.deepcopy(new_entry))
+            builder.add({"块id": '0', "文本": data["title"], "数据类型": 'text'})
         
         if "_parse" in i:
             for entry in data.get(i, {}).get("abstract", []):
-                new_entry = copy.deepcopy(template)
-                new_entry["数据类型"] = 'text' 
-                new_entry["块id"] = '0'
-                text = entry.get("text", "")
-                new_entry["文本"] = text
-                result.append(copy.deepcopy(new_entry))
+                builder.add({"数据类型": 'text', "块id": '0', "文本": entry.get("text", "")})
             
             for entry in data.get(i, {}).get("body_text", []):
-                new_entry = copy.deepcopy(template)
-                new_entry["数据类型"] = 'text' 
-                id = entry.get("sec_num", "")
-                new_entry["块id"] = id
-                text = entry.get("text", "")
-                new_entry["文本"] = text
-                result.append(copy.deepcopy(new_entry))
+                builder.add({"数据类型": 'text', "块id": entry.get("sec_num", ""), "文本": entry.get("text", "")})
     
+    figure_paths = get_figure_paths(data, tmp_path)
+    png_paths = render_pdf_figures(
+        [p for p in figure_paths.values() if p.lower().endswith('.pdf')],
+        dpi=figure_dpi, cache_dir=figure_cache, max_workers=figure_workers
+    )
     for i in data["latex_parse"]["ref_entries"]:
-        new_entry = copy.deepcopy(template)
         if data["latex_parse"]["ref_entries"][i]["type_str"] == "figure":
-            #temdir_path = '/root/autodl-tmp/s2orc-doc2json/temp_dir/latex'
-            #temdir_path = './temp_dir/latex'
-            temdir_path = tmp_path + '/latex' 
-            paper_repath = data["latex_parse"]["ref_entries"][i]["uris"]
-            image_path = os.path.join(temdir_path, data['paper_id'], ''.join(paper_repath))
+            image_path = figure_paths[i]
             if image_path.lower().endswith('.pdf'):
-                images = convert_from_path(image_path)
-                image_path = os.path.splitext(image_path)[0] + ".png"
-                images[0].save(image_path, 'PNG')
+                image_path = png_paths.get(image_path, os.path.splitext(image_path)[0] + ".png")
 
-            if not os.path.isdir(image_path):
-                decimal_array = image_to_decimal_array(image_path)
-                new_entry["图片"] = decimal_array       
-                new_entry["数据类型"] = 'image'
-                result.append(new_entry)
+            # figures that don't exist or failed to render are left out, like in json2md
+            if os.path.isfile(image_path):
+                image_bytes = normalize_image(read_image_bytes(image_path), image_max_size, image_format)
+                builder.add({"图片": image_bytes, "数据类型": 'image'})
     
-    return result
+    return builder.records
 
 if __name__ == '__main__':
     args = parse_args() 
+    setup_profile(args)
 
-    template = {"文件md5": None, "文件id": None, "页码": None, "块id": None, "文本": None, "图片": None, "处理时间": None, "数据类型": None, "bounding_box": None, "额外信息": None}
+    template = dict(RECORD_TEMPLATE)
     #json_path = '/root/autodl-tmp/s2orc-doc2json/output_dir/2004.14974.json'
     #json_path = './output_dir/arXiv-2408.05159v1.tar.json'
     json_path = args.data_path 
     with open(json_path, 'r') as file:
         data = json.load(file)
-        result = convert_to_target_format(data, template, args.tmp_path)
+        with instrument_paper(data['paper_id']):
+            result = convert_to_target_format(
+                data, template, args.tmp_path, args.figure_dpi, args.figure_cache, args.figure_workers,
+                args.image_max_size, args.image_format
+            )
         
     #output_json_path = '/root/autodl-tmp/s2orc-doc2json/output_dir/converted_result2.json'
     #output_json_path = './output_dir/arXiv-2408.05159v1_converted.json'
-    output_json_path = args.data_path[:-5] + '_convered.json' 
-    with open(output_json_path, 'w') as outfile:
-            json.dump(result, outfile, ensure_ascii=False, indent=1)
+    if args.output_format == 'dataset':
+        # output_path is the root of a partitioned dataset shared by all papers
+        save_to_dataset(
+            result, args.output_path, data['paper_id'], {"year": data.get("year")},
+            dedup_images=args.dedup_images, thumbnail_size=args.thumbnail_size
+        )
+    elif args.output_format == 'parquet':
+        save_to_parquet(result, args.data_path[:-5] + '_convered.parquet', args.dedup_images, args.thumbnail_size)
+    else:
+        output_json_path = args.data_path[:-5] + '_convered.json' 
+        with open(output_json_path, 'w') as outfile:
+                json.dump(result, outfile, ensure_ascii=False, indent=1, default=record_json_default)
+    close_sinks()
@@ -0,0 +1,920 @@
+# Tokenizer-based LaTeX to MyST Markdown converter, an alternative backend for latextomarkdown.
+#
+# Instead of running successive substitutions over the whole document, the source is:
+# 1: split into tokens (commands, braces, brackets, math shifts, comments, text) in a single regex scan;
+# 2: parsed into a tree of groups, environments and commands with their arguments, using an explicit stack;
+# 3: rendered to Markdown in a single post-order pass, again with an explicit stack.
+# Every token and every node is visited once, and none of the steps recurse, so the work does not grow with the
+# number of rules and deeply nested input cannot overflow the Python stack. Text runs are joined once, conditionals
+# are resolved without moving nodes, and renderings are released once they have been used, so the memory stays
+# linear in the size of the input, and so does the time up to copying the text of nested markup into its parents
+# (see TestTokenizerBackend.test_linear_time).
+#
+# Supported: chapters and sections (with labels), conditionals (\ifAfourpaper etc., as in latextomarkdown),
+# inline and display math, equation / align / eqnarray / gather / multline environments, the physics-style
+# macros (\dv, \pdv, \inprod, \twovec, \threevec, \spinor, \diff, \commutator, \unitvec, \dd, ...),
+# figures, tables, theorems and proofs, enumerate / itemize, problem sets (\section*{Problems} followed by
+# an enumerate), worked examples (delimited by %Worked example comments), footnotes, index entries, hyperlinks,
+# references and citations, accents, quotes and the usual text formatting commands.
+# The output follows the regex backend; the differences that remain are listed in TestBackendParity in
+# tests/test_latextomarkdown.py.
+# Not supported: \input of problem files and figure source code (use the regex backend for those).
+
+import re
+
+# A single scan over the source, one alternative per token kind.
+# Order matters: environments before generic commands, commands before comments (for \%).
+TOKEN_PATTERN = re.compile(r"""
+    (?P<verbatim>\\begin\{(?P<verbatimname>verbatim|lstlisting)\}(?P<verbatimbody>.*?)\\end\{(?P=verbatimname)\})
+  | \\begin\s*\{(?P<begin>[^{}]*)\}
+  | \\end\s*\{(?P<end>[^{}]*)\}
+  | \\(?P<command>[A-Za-z@]+|.)(?P<star>(?<=[A-Za-z@])\*)?
+  | (?P<comment>%[^\n]*\n?)
+  | (?P<open>\{)
+  | (?P<close>\})
+  | (?P<openbracket>\[)
+  | (?P<closebracket>\])
+  | (?P<math>\$\$?)
+  | (?P<alignment>&)
+  | (?P<tilde>~)
+  | (?P<quote>`+)
+  | (?P<text>[^\\{}\[\]$&~%`]+)
+""", re.VERBOSE | re.DOTALL)
+
+# Commands with arguments: name -> (takes an optional [] argument, minimum and maximum number of {} arguments).
+COMMAND_ARGUMENTS = {
+    "chapter": (True, 1, 1), "section": (True, 1, 1), "subsection": (True, 1, 1), "subsubsection": (True, 1, 1),
+    "paragraph": (True, 1, 1),
+    "label": (False, 1, 1), "ref": (False, 1, 1), "eqref": (False, 1, 1), "bookref": (False, 1, 1),
+    "cite": (True, 1, 1), "citep": (True, 1, 1), "citet": (True, 1, 1),
+    "emph": (False, 1, 1), "textit": (False, 1, 1), "textbf": (False, 1, 1), "underline": (False, 1, 1),
+    "texttt": (False, 1, 1), "textsc": (False, 1, 1), "textrm": (False, 1, 1), "textsf": (False, 1, 1),
+    "textup": (False, 1, 1), "mbox": (False, 1, 1), "text": (False, 1, 1),
+    "footnote": (True, 1, 1), "index": (False, 1, 1), "url": (False, 1, 1), "href": (False, 2, 2),
+    "bookhref": (False, 2, 2),
+    "includegraphics": (True, 1, 1), "caption": (True, 1, 1),
+    "vspace": (False, 1, 1), "hspace": (False, 1, 1), "setcounter": (False, 2, 2), "newcounter": (False, 1, 1),
+    "parbox": (True, 2, 2), "item": (True, 0, 0),
+    # Accents.
+    "\"": (False, 1, 1), "'": (False, 1, 1), "`": (False, 1, 1), "^": (False, 1, 1), "~": (False, 1, 1),
+    "r": (False, 1, 1),
+    # Math macros.
+    "dv": (True, 1, 2), "pdv": (True, 1, 3), "inprod": (False, 2, 2), "twovec": (False, 2, 2),
+    "threevec": (False, 3, 3), "spinor": (False, 2, 2), "diff": (False, 2, 2), "commutator": (False, 2, 2),
+    "unitvec": (False, 1, 1),
+}
+
+# Accent commands that also take a single letter without braces, as in \"a.
+ACCENT_SUFFIXES = {"\"": "uml", "'": "acute", "`": "grave", "^": "circ", "~": "tilde"}
+
+# Commands that are simply renamed (in text and math mode).
+RENAMED_COMMANDS = {
+    "bvec": "\\bm", "Tr": "\\mathrm{Tr}", "Order": "\\mathcal{O}", "Lg": "\\mathcal{L}", "dd": "\\mathrm{d}",
+    "ev": "\\braket",
+}
+
+# Text mode commands that are dropped (with their arguments).
+DROPPED_COMMANDS = {
+    "vspace", "hspace", "noindent", "small", "normalsize", "centering", "setcounter", "newcounter", "-", "protect",
+}
+
+# Commands that take one whitespace character after them along (see PREP_RULES and TEXT_RULES in latextomarkdown).
+SPACE_EATING_COMMANDS = {"noindent", "small", "normalsize", "dd"}
+
+# Text mode commands for escaped characters and symbols.
+ESCAPED_CHARACTERS = {
+    "%": "\\%", "&": "&", "$": "\\$", "#": "#", "_": "_", "{": "{", "}": "}", " ": " ", "textquotesingle": "'",
+    # Astronomical symbols.
+    "mercury": "&#x263F;", "venus": "&#x2640;", "earth": "&#x2641;", "mars": "&#x2642;", "jupiter": "&#x2643;",
+    "saturn": "&#x2644;", "uranus": "&#x26E2;", "neptune": "&#x2646;", "pluto": "&#x2647;", "sun": "&#x2609;",
+    "leftmoon": "&#x263E;",
+}
+
+# Section levels.
+HEADINGS = {"chapter": 1, "section": 2, "subsection": 3, "subsubsection": 4}
+
+# Environments of which the contents are math.
+MATH_ENVIRONMENTS = {
+    "equation", "equation*", "align", "align*", "alignat", "alignat*", "eqnarray", "eqnarray*", "gather",
+    "gather*", "multline", "multline*", "displaymath", "math", "split", "aligned", "pmatrix", "bmatrix",
+    "matrix", "cases", "array", "subequations",
+}
+
+# Environments rendered as an align math block.
+ALIGN_ENVIRONMENTS = {
+    "align", "align*", "alignat", "alignat*", "eqnarray", "eqnarray*", "gather", "gather*", "multline", "multline*",
+}
+
+# Environments that are just their content.
+TRANSPARENT_ENVIRONMENTS = {"document", "center", "flushleft", "flushright", "minipage", "appendices", "subappendices"}
+
+# sphinx-proof environments.
+PROOF_ENVIRONMENTS = {"theorem", "proposition", "lemma", "corollary", "axiom", "definition", "proof", "example"}
+
+# Conditionals (see ConvertFileContentToMarkdown in latextomarkdown): these take the first part, the others the last.
+CONDITIONALS_FIRST = {"ifAfourpaper", "ifchoicecolor", "ifonline", "ifcontainsLagrangianmechanics", "ifcontainsCM"}
+CONDITIONALS_LAST = {"ifincludesolutions", "ifproblemset"}
+
+# Label prefixes and their MyST roles.
+REF_ROLES = {
+    "fig": "numref", "table": "numref", "tab": "numref", "ch": "numref", "sec": "numref", "app": "numref",
+    "pb": "numref", "thm": "prf:ref", "prop": "prf:ref", "lemma": "prf:ref", "cor": "prf:ref",
+    "axiom": "prf:ref", "def": "prf:ref", "ex": "prf:ref",
+}
+
+FIGURE_WIDTH_PATTERN = re.compile(r"%\s*Figurewidth:\s*(\d+)")
+PROBLEM_TITLE_PATTERN = re.compile(r"%\s?Problemtitle\s?(?:{([^}]+)}|:?\s?(.*))")
+# Worked examples are delimited by comments, and start with a (sub)section titled "Worked example: <title>".
+WORKED_EXAMPLE_HEADINGS = ("section", "subsection")
+WORKED_EXAMPLE_TITLE_PREFIX = "Worked example: "
+SOLUTION_HEADINGS = ("subsubsection", "subsubsubsection")
+TCOLORBOX_TITLE_PATTERN = re.compile(r"title=([^,\]]+)")
+FENCE_PATTERN = re.compile(r"`{3,}")
+# Words before references that are dropped (see REFERENCE_RULES in latextomarkdown).
+REFERENCE_WORD_PATTERN = re.compile(
+    r"(?:fig(?:\.|ure)?|table|ch(?:\.|apter)?|(?:sub)?sec(?:\.|tion)?|app(?:\.|endix|ices)?|theorem|prop(?:\.|osition)?"
+    r"|lemma|corollary|axiom|def(?:\.|inition)?|example)s?(?:&nbsp;|-|\s)$", re.IGNORECASE)
+PROBLEM_REFERENCE_PATTERN = re.compile(r"(?:problem|exercise)(?:&nbsp;| )\{\w+\}`[^`]+`\.$", re.IGNORECASE)
+DISPLAY_EQUATION_PATTERN = re.compile(r"\n\$\$\n(.*?)\n\$\$(?: \(([^)]+)\))?\n", re.DOTALL)
+EQNARRAY_ARGUMENT_PATTERN = re.compile(r"&\s*(=|<|>|\\leq|\\geq|\\!=)\s*&")
+BLANK_LINES_PATTERN = re.compile(r"\n[ \t]*\n(?:[ \t]*\n)+")
+ROW_END_PATTERN = re.compile(r"\s*\\\\\s*$")
+
+# Index entries are marked where they occur and moved in front of their line at the end (as in latextomarkdown).
+INDEX_MARKER_PATTERN = re.compile("\ue000([^\ue000\ue001]*)\ue001")
+
+# Folders stripped from figure paths (see ENVIRONMENT_RULES in latextomarkdown).
+FIGURE_PATH_REPLACEMENTS = [
+    ("/figures/PNG", ""), ("/figures/PDF", ""), ("/problemfigures/PDF", ""), ("/problemfigures/PNG", ""),
+    ("mechanics/figures/", "mechanics/"), ("mechanics/problems/", "mechanics/"), ("/figures/", "/"),
+]
+
+class Node:
+    # Node of the parse tree. Kinds: root, text, comment, command, group, optional, math, environment, conditional, item,
+    # example, solution, verbatim.
+    __slots__ = ("kind", "name", "star", "text", "optional", "args", "children", "start", "end",
+                 "minargs", "maxargs", "hasoptional", "problems", "parent", "rendered")
+
+    def __init__(self, kind, name="", text="", start=0):
+        self.kind = kind
+        self.name = name
+        self.star = False
+        self.text = text
+        self.optional = None
+        self.args = []
+        self.children = []
+        self.start = start
+        self.end = start
+        self.minargs = 0
+        self.maxargs = 0
+        self.hasoptional = False
+        self.problems = False
+        self.parent = None
+        self.rendered = None
+
+    def Source(self, source):
+        # Raw LaTeX between the delimiters of a group / optional argument.
+        return source[self.start:self.end]
+
+    def PlainText(self):
+        # Concatenated text of the direct text children.
+        return "".join(child.text for child in self.children if child.kind == "text")
+
+def Tokenize(latexsource):
+    # Split LaTeX source into (kind, value, start, end) tuples in a single scan.
+    tokens = []
+    position = 0
+    for match in TOKEN_PATTERN.finditer(latexsource):
+        if (match.start() > position):
+            # Characters no alternative matched (e.g. a lone backslash at the end): text.
+            tokens.append(("text", latexsource[position:match.start()], position, match.start()))
+        kind = match.lastgroup
+        if (kind == "verbatimname" or kind == "verbatimbody"): kind = "verbatim"
+        if (kind == "command" or kind == "star"):
+            value = match.group("command")
+            kind = "commandstar" if match.group("star") else "command"
+        elif (kind == "verbatim"):
+            value = match.group("verbatimbody")
+        else:
+            value = match.group(kind)
+        tokens.append((kind, value, match.start(), match.end()))
+        position = match.end()
+    if (position < len(latexsource)):
+        tokens.append(("text", latexsource[position:], position, len(latexsource)))
+    return tokens
+
+def AppendNode(container, node):
+    node.parent = container
+    container.children.append(node)
+
+def Parse(latexsource):
+    # Build the parse tree from the token stream, keeping a stack of open containers.
+    # Arguments are attached to the command that precedes them; unbalanced delimiters are kept as text.
+    root = Node("root")
+    stack = [root]
+    # Command waiting for arguments in the current container, if any.
+    awaiting = [None]
+    # Open conditionals as [stack depth at the \if, whether the current part is kept], innermost last. The kept part is
+    # parsed straight into the enclosing container, the other part into a conditional node that is dropped.
+    conditionals = []
+    # Open environments by name, innermost last, so \end finds its environment without searching the stack.
+    environments = {}
+    # (text node, pieces) of the text an open container ends with; the pieces are joined once the text node is complete,
+    # so a long run of text tokens is not copied over and over.
+    pending = [None]
+
+    def Flush():
+        if (pending[-1] is not None):
+            (textnode, pieces) = pending[-1]
+            textnode.text = "".join(pieces)
+            pending[-1] = None
+
+    def Append(child):
+        # Add a node to the innermost open container, merging adjacent text.
+        if (child.kind == "text" and pending[-1] is not None):
+            pending[-1][1].append(child.text)
+            return
+        Flush()
+        AppendNode(stack[-1], child)
+        if (child.kind == "text"): pending[-1] = (child, [child.text])
+
+    def CloseTop(end):
+        Flush()
+        node = stack.pop()
+        awaiting.pop()
+        pending.pop()
+        Flush()
+        if (node.kind == "environment"): environments[node.name].pop()
+        node.end = end
+        container = stack[-1]
+        if (node.kind == "conditional"):
+            # The part of a conditional that is left out.
+            awaiting[-1] = None
+            return
+        command = awaiting[-1]
+        if (node.kind == "optional" and command is not None):
+            command.optional = node
+            node.parent = command
+            return
+        if (node.kind == "group" and command is not None and len(command.args) < command.maxargs):
+            command.args.append(node)
+            node.parent = command
+            if (len(command.args) >= command.maxargs): awaiting[-1] = None
+            return
+        if (node.kind == "optional"):
+            # A bracket pair that is not an argument: keep as text.
+            Append(Node("text", text="[", start=node.start))
+            for child in node.children: Append(child)
+            Append(Node("text", text="]", start=end))
+            awaiting[-1] = None
+            return
+        if (node.kind == "environment"):
+            MarkProblems(container, node)
+            if (node.name in ("enumerate", "itemize")): GroupItems(node)
+            GroupWorkedExamples(node, latexsource)
+        Append(node)
+        awaiting[-1] = None
+
+    def Open(node):
+        stack.append(node)
+        awaiting.append(None)
+        pending.append(None)
+        if (node.kind == "environment"): environments.setdefault(node.name, []).append(node)
+
+    def AddText(text, start):
+        command = awaiting[-1]
+        if (command is not None):
+            if (command.name in ACCENT_SUFFIXES and len(command.args) == 0 and text[:1].isalpha()):
+                # Accent on a single letter without braces.
+                letter = Node("group", start=start)
+                letter.end = start + 1
+                letter.parent = command
+                AppendNode(letter, Node("text", text=text[0], start=start))
+                command.args.append(letter)
+                awaiting[-1] = None
+                text = text[1:]
+                start += 1
+                if (text == ""): return
+            elif (text.strip() == "" and len(command.args) < command.minargs):
+                # Whitespace between required arguments.
+                return
+            else:
+                awaiting[-1] = None
+        Append(Node("text", text=text, start=start))
+
+    tokens = Tokenize(latexsource)
+    for (kind, value, start, end) in tokens:
+        top = stack[-1]
+        if (kind == "open"):
+            Open(Node("group", start=end))
+        elif (kind == "close"):
+            if (top.kind == "group"): CloseTop(start)
+            else: AddText(value, start)
+        elif (kind == "openbracket"):
+            command = awaiting[-1]
+            if (command is not None and command.hasoptional and command.optional is None and not command.args):
+                Open(Node("optional", start=end))
+            else: AddText(value, start)
+        elif (kind == "closebracket"):
+            if (top.kind == "optional"): CloseTop(start)
+            else: AddText(value, start)
+        elif (kind == "math"):
+            if (top.kind == "math" and top.name == value): CloseTop(start)
+            else:
+                awaiting[-1] = None
+                Open(Node("math", name=value, start=end))
+        elif (kind == "begin"):
+            awaiting[-1] = None
+            node = Node("environment", name=value, start=end)
+            if (value in ("tabular", "alignat", "alignat*", "minipage", "array")):
+                # Column layout / width argument.
+                node.minargs = node.maxargs = 1
+            node.hasoptional = True
+            Open(node)
+            awaiting[-1] = node
+        elif (kind == "end"):
+            environment = environments[value][-1] if environments.get(value) else None
+            if (environment is None): AddText(latexsource[start:end], start)
+            else:
+                while (stack[-1] is not environment): CloseTop(start)
+                CloseTop(start)
+        elif (kind == "verbatim"):
+            awaiting[-1] = None
+            Append(Node("verbatim", text=value, start=start))
+        elif (kind in ("command", "commandstar")):
+            name = value
+            if (name in ("(", "[")):
+                awaiting[-1] = None
+                Open(Node("math", name="\\" + name, start=end))
+                continue
+            if (name in (")", "]") and top.kind == "math" and top.name == "\\" + {")": "(", "]": "["}[name]):
+                CloseTop(start)
+                continue
+            if (name in CONDITIONALS_FIRST or name in CONDITIONALS_LAST or name.startswith("ifcontains")):
+                awaiting[-1] = None
+                keepfirst = (name in CONDITIONALS_FIRST)
+                conditionals.append([len(stack), keepfirst])
+                if (not keepfirst): Open(Node("conditional", name=name, start=end))
+                continue
+            if (name in ("else", "fi") and conditionals):
+                (depth, keepfirst) = conditionals[-1]
+                # Close what the part opened, dropping it if it is left out.
+                while (len(stack) > depth): CloseTop(start)
+                awaiting[-1] = None
+                if (name == "fi"): conditionals.pop()
+                else:
+                    if (keepfirst): Open(Node("conditional", name=name, start=end))
+                    conditionals[-1] = [depth, not keepfirst]
+                continue
+            node = Node("command", name=name, start=start)
+            node.star = (kind == "commandstar")
+            Append(node)
+            (node.hasoptional, node.minargs, node.maxargs) = COMMAND_ARGUMENTS.get(name, (False, 0, 0))
+            awaiting[-1] = node if (node.hasoptional or node.maxargs > 0) else None
+        elif (kind == "comment"):
+            Append(Node("comment", text=value, start=start))
+        else:
+            # text, alignment, tilde, quote: keep the kind for rendering.
+            if (kind == "text"): AddText(value, start)
+            else:
+                awaiting[-1] = None
+                Append(Node(kind, text=value, start=start))
+    while (len(stack) > 1): CloseTop(len(latexsource))
+    Flush()
+    GroupWorkedExamples(root, latexsource)
+    return root
+
+def MarkProblems(container, environment):
+    # An enumerate directly after a \section*{Problems} heading is a problem set.
+    if (environment.name != "enumerate"): return
+    for node in reversed(container.children):
+        if (node.kind in ("text", "comment") and node.text.strip() == "") or node.kind == "comment": continue
+        if (node.kind == "command" and node.name == "label"): continue
+        if (node.kind == "command" and node.name in HEADINGS and node.args and node.args[0].PlainText().strip() == "Problems"):
+            environment.problems = True
+        return
+
+def GroupItems(environment):
+    # Regroup the children of a list environment by \item.
+    items = []
+    current = None
+    for node in environment.children:
+        if (node.kind == "command" and node.name == "item"):
+            current = Node("item", start=node.start)
+            current.optional = node.optional
+            current.problems = environment.problems
+            current.parent = environment
+            items.append(current)
+        elif (current is not None):
+            AppendNode(current, node)
+    environment.children = items
+
+def IsComment(node, text):
+    return node.kind == "comment" and node.text.strip() == text
+
+def NextNode(nodes, i):
+    # Index of the first node from i on that is not whitespace.
+    while (i < len(nodes) and nodes[i].kind == "text" and nodes[i].text.strip() == ""): i += 1
+    return i
+
+def GroupWorkedExamples(container, latexsource):
+    # Move every worked example (%Worked example start, heading, optional label, problem, optionally
+    # %Worked example solution with a Solution heading, and the solution, up to %Worked example end) into an example node.
+    # The node's text is the title, its optional the label command; a solution node holds the solution.
+    children = container.children
+    if (not any(IsComment(child, "%Worked example start") for child in children)): return
+    ends = [j for (j, child) in enumerate(children) if IsComment(child, "%Worked example end")]
+    nextend = 0
+    result = []
+    i = 0
+    while (i < len(children)):
+        child = children[i]
+        heading = NextNode(children, i + 1)
+        while (nextend < len(ends) and ends[nextend] < heading): nextend += 1
+        end = ends[nextend] if (nextend < len(ends) and IsComment(child, "%Worked example start")) else None
+        if (end is None or heading >= end or not IsWorkedExampleHeading(children[heading], latexsource)):
+            result.append(child)
+            i += 1
+            continue
+        example = Node("example", start=child.start)
+        example.parent = container
+        example.text = children[heading].args[0].Source(latexsource).strip()[len(WORKED_EXAMPLE_TITLE_PREFIX):]
+        body = NextNode(children, heading + 1)
+        if (body < end and children[body].kind == "command" and children[body].name == "label" and children[body].args):
+            example.optional = children[body]
+            example.optional.parent = example
+            body += 1
+        target = example
+        j = body
+        while (j < end):
+            if (IsComment(children[j], "%Worked example solution")):
+                solutionheading = NextNode(children, j + 1)
+                if (solutionheading < end and children[solutionheading].kind == "command" and children[solutionheading].name in SOLUTION_HEADINGS):
+                    target = Node("solution", start=children[j].start)
+                    AppendNode(example, target)
+                    j = solutionheading + 1
+                    continue
+            AppendNode(target, children[j])
+            j += 1
+        result.append(example)
+        i = end + 1
+    container.children = result
+
+def IsWorkedExampleHeading(node, latexsource):
+    return (node.kind == "command" and node.name in WORKED_EXAMPLE_HEADINGS and node.args
+            and node.args[0].Source(latexsource).strip().startswith(WORKED_EXAMPLE_TITLE_PREFIX))
+
+def Fence(body):
+    # Directive fence one longer than any fence in the body, so nested directives work.
+    longest = max((len(fence) for fence in FENCE_PATTERN.findall(body)), default=2)
+    return "`" * (longest + 1)
+
+def Directive(name, argument, options, body):
+    fence = Fence(body)
+    result = fence + "{" + name + "}"
+    if (argument): result += " " + argument
+    result += "\n"
+    for (option, value) in options:
+        if (value): result += ":" + option + ": " + value + "\n"
+    return result + body.strip("\n") + "\n" + fence + "\n"
+
+def MathBlocks(markdown):
+    # Display equations in footnotes and problems become math blocks (as in latextomarkdown).
+    return DISPLAY_EQUATION_PATTERN.sub(
+        lambda matchobject: "\n" + Directive("math", "", [("label", matchobject.group(2))], matchobject.group(1)), markdown
+    )
+
+def Indent(text, indent):
+    # Indent every line but the first.
+    return text.replace("\n", "\n" + indent)
+
+def RefRole(label):
+    return REF_ROLES.get(label.split(":")[0], "eq")
+
+class Renderer:
+    # Renders a parse tree in one post-order pass over an explicit stack.
+    # Every node's rendering is stored in node.rendered, so parents can pick apart their children. Tables, figures
+    # and problems also read their grandchildren, so a rendering is released once the grandparent is rendered:
+    # only the renderings still waiting for their grandparent are kept.
+
+    def __init__(self, source):
+        self.source = source
+        self.footnotes = []
+        self.subequationlabels = {}
+
+    def Render(self, root):
+        self.subequationlabels = self.CollectSubequationLabels(root)
+        stack = [(root, False, False, self.SubNodes(root), 0)]
+        while stack:
+            (node, math, appendix, subnodes, position) = stack[-1]
+            if (position < len(subnodes)):
+                stack[-1] = (node, math, appendix, subnodes, position + 1)
+                child = subnodes[position]
+                childmath = self.ChildMath(node, child, math)
+                childappendix = appendix or (node.kind == "environment" and node.name in ("appendices", "subappendices"))
+                stack.append((child, childmath, childappendix, self.SubNodes(child), 0))
+            else:
+                stack.pop()
+                node.rendered = self.RenderNode(node, math, appendix)
+                for child in subnodes:
+                    for grandchild in self.SubNodes(child): grandchild.rendered = None
+        result = root.rendered
+        if (self.footnotes):
+            result += "\n\n"
+            for (footnoteid, text) in enumerate(self.footnotes, start=1):
+                result += "[^" + str(footnoteid) + "]: " + Indent(text.strip(), "\t") + "\n\n"
+        return BLANK_LINES_PATTERN.sub("\n\n", MoveIndexEntries(result)).strip("\n") + "\n"
+
+    def CollectSubequationLabels(self, root):
+        # References to the labels in a subequations group after the first become the first label and a letter
+        # (label -> (group label, letter)), as in latextomarkdown. Walks the tree in document order.
+        subequationlabels = {}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if (node.kind == "environment" and node.name == "subequations"):
+                labels = []
+                groupstack = [node]
+                while groupstack:
+                    child = groupstack.pop()
+                    if (child.kind == "command" and child.name == "label" and child.args): labels.append(self.RawArg(child, 0))
+                    groupstack.extend(reversed(self.SubNodes(child)))
+                for (labelid, label) in enumerate(labels[1:], start=1):
+                    subequationlabels[label] = (labels[0], chr(96 + labelid))
+            stack.extend(reversed(self.SubNodes(node)))
+        return subequationlabels
+
+    def SubNodes(self, node):
+        subnodes = []
+        if (node.optional is not None): subnodes.append(node.optional)
+        return subnodes + node.args + node.children
+
+    def ChildMath(self, node, child, math):
+        # Math mode of a child.
+        if (node.kind == "math"): return True
+        if (node.kind == "environment" and node.name in MATH_ENVIRONMENTS and child in node.children): return True
+        if (node.kind == "environment" and self.IsBoxedMath(node) and child in node.children): return True
+        if (node.kind == "command" and node.name in ("text", "mbox", "textrm", "textbf", "textit", "emph")): return False
+        return math
+
+    def Sequence(self, nodes, skip=()):
+        # Join rendered nodes without the given commands; attach a label following a heading to it.
+        # As in latextomarkdown, a left out or space eating command takes one whitespace character after it along,
+        # \vspace also a \\ after it, and parentheses around a reference are dropped.
+        parts = []
+        headinglabel = None
+        eat = None
+        for (i, node) in enumerate(nodes):
+            if (node is headinglabel): continue
+            iscommand = (node.kind == "command")
+            if (iscommand and node.name in skip):
+                eat = "space" if (node.name == "label") else None
+                continue
+            rendered = node.rendered
+            if (eat == "vspace" and ((node.kind == "text" and node.text.strip(" ") == "") or (iscommand and node.name == "\\"))):
+                if (iscommand): eat = None
+                continue
+            if (eat == "space" and node.kind == "text" and rendered[:1].isspace()): rendered = rendered[1:]
+            if (eat == "paren" and node.kind == "text"): rendered = rendered[1:]
+            eat = None
+            if (iscommand and node.name in HEADINGS):
+                label = self.FollowingLabel(nodes, i)
+                if (label is not None):
+                    parts.append("\n(" + label.args[0].Source(self.source).strip() + ")=")
+                    headinglabel = label
+            if (iscommand and node.name in ("ref", "bookref")): self.DropReferenceWord(parts, node)
+            if (iscommand and node.name in ("ref", "eqref", "bookref") and parts and parts[-1].endswith("(")
+                    and i + 1 < len(nodes) and nodes[i + 1].kind == "text" and nodes[i + 1].text.startswith(")")):
+                parts[-1] = parts[-1][:-1]
+                eat = "paren"
+            elif (iscommand and node.name == "vspace"): eat = "vspace"
+            elif (iscommand and node.name in SPACE_EATING_COMMANDS): eat = "space"
+            parts.append(rendered)
+        return "".join(parts)
+
+    def DropReferenceWord(self, parts, node):
+        # {numref} and {prf:ref} name what they refer to, so drop the word before the reference (as in latextomarkdown);
+        # problem~\ref{ch:X}.\ref{pb:Y} becomes just the reference to the problem.
+        tail = "".join(parts[-4:])
+        wordmatch = REFERENCE_WORD_PATTERN.search(tail)
+        if (self.RawArg(node, 0).startswith("pb:")):
+            wordmatch = PROBLEM_REFERENCE_PATTERN.search(tail) or wordmatch
+        if (wordmatch is None): return
+        cut = len(wordmatch.group(0))
+        while (cut > 0 and parts):
+            if (len(parts[-1]) <= cut):
+                cut -= len(parts.pop())
+            else:
+                parts[-1] = parts[-1][:-cut]
+                cut = 0
+
+    def FollowingLabel(self, nodes, i):
+        for node in nodes[i + 1:]:
+            if (node.kind in ("text",) and node.text.strip() == "") or node.kind == "comment": continue
+            if (node.kind == "command" and node.name == "label" and node.args): return node
+            return None
+        return None
+
+    def Arg(self, node, i):
+        return node.args[i].rendered if (i < len(node.args)) else ""
+
+    def RawArg(self, node, i):
+        return node.args[i].Source(self.source).strip() if (i < len(node.args)) else ""
+
+    def RawCommand(self, node):
+        # Re-emit a command as LaTeX, with its (rendered) arguments.
+        result = "\\" + node.name + ("*" if node.star else "")
+        if (node.optional is not None): result += "[" + node.optional.rendered + "]"
+        for arg in node.args: result += "{" + arg.rendered + "}"
+        return result
+
+    def RenderNode(self, node, math, appendix):
+        kind = node.kind
+        if (kind == "text"): return node.text
+        if (kind == "comment"): return ""
+        if (kind == "verbatim"): return "\n```\n" + node.text.strip("\n") + "\n```\n"
+        if (kind == "alignment"): return "&"
+        if (kind == "tilde"): return "~" if math else "&nbsp;"
+        if (kind == "quote"):
+            if (math or len(node.text) > 2): return node.text
+            return "'" * len(node.text)
+        if (kind in ("root", "optional")): return self.Sequence(node.children)
+        if (kind == "group"): return self.RenderGroup(node, math)
+        if (kind == "math"): return self.RenderMath(node)
+        if (kind == "item"): return self.RenderItem(node)
+        if (kind == "example"): return self.RenderExample(node)
+        if (kind == "solution"): return "\n---\n**Solution**\n" + self.Sequence(node.children)
+        if (kind == "environment"): return self.RenderEnvironment(node, math)
+        if (kind == "command"): return self.RenderCommand(node, math, appendix)
+        return node.text
+
+    def RenderGroup(self, node, math):
+        content = self.Sequence(node.children)
+        if (node.parent is not None and node.parent.kind == "command"):
+            # Argument, braces are added by the command.
+            return content
+        if (not math and node.children and node.children[0].kind == "command" and not node.children[0].args):
+            # {\bf XYZ}, {\it XYZ}, {\em XYZ}
+            switch = node.children[0].name
+            rest = self.Sequence(node.children[1:]).strip()
+            if (switch == "bf"): return "**" + rest + "**"
+            if (switch in ("it", "em")): return "*" + rest + "*"
+        return "{" + content + "}"
+
+    def RenderMath(self, node):
+        content = self.Sequence(node.children)
+        if (node.name == "$"): return "$" + content + "$"
+        if (node.name == "\\("): return "$" + content + "$"
+        if (node.name == "$$"): return "\n$$\n" + content.strip() + "\n$$\n"
+        return "\n```{math}\n" + content.strip() + "\n```\n"
+
+    def RenderCommand(self, node, math, appendix):
+        name = node.name
+        if (name in RENAMED_COMMANDS): return RENAMED_COMMANDS[name]
+        if (name in ("dv", "pdv", "inprod", "twovec", "threevec", "spinor", "diff", "commutator", "unitvec")):
+            return self.RenderMathMacro(node)
+        if (math):
+            if (name == "mbox"): return "\\text{" + self.Arg(node, 0) + "}"
+            return self.RawCommand(node)
+        if (name in HEADINGS):
+            title = node.optional.rendered if (node.optional is not None) else self.Arg(node, 0)
+            if (appendix and name == "section"): title = "Appendix: " + title
+            return "\n" + "#" * HEADINGS[name] + " " + title.strip() + "\n"
+        if (name == "paragraph"): return "\n**" + self.Arg(node, 0).strip() + "** "
+        if (name in ("emph", "textit", "underline")): return "*" + self.Arg(node, 0) + "*"
+        if (name == "textbf"): return "**" + self.Arg(node, 0) + "**"
+        if (name == "texttt"): return "`" + self.RawArg(node, 0) + "`"
+        if (name in ("textsc", "textrm", "textsf", "textup", "mbox", "text")): return self.Arg(node, 0)
+        if (name in ("ref", "bookref", "eqref")):
+            label = self.RawArg(node, 0)
+            if (label in self.subequationlabels):
+                (grouplabel, letter) = self.subequationlabels[label]
+                return "{eq}`" + grouplabel + "`" + letter
+            role = "eq" if (name == "eqref") else RefRole(label)
+            return "{" + role + "}`" + label + "`"
+        if (name in ("cite", "citep", "citet")): return "{cite}`" + self.RawArg(node, 0) + "`"
+        if (name == "url"): return "<" + self.RawArg(node, 0) + ">"
+        if (name in ("href", "bookhref")): return "[" + self.Arg(node, 1) + "](" + self.RawArg(node, 0) + ")"
+        if (name == "footnote"):
+            self.footnotes.append(MathBlocks(self.Arg(node, 0)))
+            return "<sup>[^" + str(len(self.footnotes)) + "]</sup>"
+        if (name == "index"):
+            return "\ue000" + self.RawArg(node, 0).split("|")[0].replace("!", " ; ") + "\ue001"
+        if (name == "parbox"): return self.Arg(node, 1)
+        if (name in ACCENT_SUFFIXES):
+            letter = self.Arg(node, 0)
+            if (len(letter) == 1 and letter.isalpha()): return "&" + letter + ACCENT_SUFFIXES[name] + ";"
+            return self.RawCommand(node)
+        if (name == "r" and self.Arg(node, 0) == "A"): return "Å"
+        if (name in ("clearpage", "cleardoublepage", "newpage")): return "\n\n"
+        if (name in ("newline", "\\")): return "\n"
+        if (name in ESCAPED_CHARACTERS): return ESCAPED_CHARACTERS[name]
+        if (name in DROPPED_COMMANDS): return ""
+        if (name == "includegraphics"): return "\n```{figure} " + self.FigurePath(node) + "\n```\n"
+        return self.RawCommand(node)
+
+    def RenderMathMacro(self, node):
+        name = node.name
+        args = [arg.rendered for arg in node.args]
+        power = node.optional.rendered if (node.optional is not None) else None
+        if (name == "dv"):
+            result = "\\frac{\\mathrm{d}" + ("^" + power + " " if power else "")
+            if (len(args) > 1): result += args[0] + "}{\\mathrm{d}" + args[1]
+            else: result += "}{\\mathrm{d}" + args[0]
+            return result + ("^" + power if power else "") + "}"
+        if (name == "pdv"):
+            if (power): result = "\\frac{\\partial^" + power + " "
+            elif (len(args) > 2): result = "\\frac{\\partial^2 "
+            else: result = "\\frac{\\partial "
+            if (len(args) > 1):
+                result += args[0] + "}{\\partial " + args[1]
+                if (len(args) > 2): result += " \\partial " + args[2]
+            else: result += "}{\\partial " + args[0]
+            if (power and len(args) < 3): result += "^" + power
+            return result + "}"
+        if (len(args) < COMMAND_ARGUMENTS[name][1]): return self.RawCommand(node)
+        if (name == "inprod"): return "\\langle " + args[0] + " \\,, " + args[1] + " \\rangle"
+        if (name in ("twovec", "threevec", "spinor")): return "\\begin{pmatrix} " + " \\\\ ".join(args) + " \\end{pmatrix}"
+        if (name == "diff"): return "\\frac{\\partial " + args[0] + "}{\\partial " + args[1] + "}"
+        if (name == "commutator"): return "\\left[" + args[0] + ", " + args[1] + "\\right]"
+        return "\\bm{\\hat{" + args[0] + "}}"
+
+    def FigurePath(self, node):
+        # Strip the figure folders, add images folder & replace any .pdf with .svg (as in latextomarkdown).
+        path = self.RawArg(node, 0)
+        for (folder, replacement) in FIGURE_PATH_REPLACEMENTS: path = path.replace(folder, replacement)
+        return "images/" + path.replace(".pdf", ".svg")
+
+    def Find(self, node, name):
+        # First direct command child with the given name.
+        return next((child for child in node.children if child.kind == "command" and child.name == name), None)
+
+    def Body(self, node, skip=()):
+        # Rendered children, without the given commands.
+        return self.Sequence(node.children, skip)
+
+    def Label(self, node, last=False):
+        # First (or last) direct \label of a node.
+        labels = [child for child in node.children if child.kind == "command" and child.name == "label"]
+        if (not labels): return ""
+        return self.RawArg(labels[-1] if last else labels[0], 0)
+
+    def RenderEnvironment(self, node, math):
+        name = node.name
+        if (name in TRANSPARENT_ENVIRONMENTS): return self.Sequence(node.children)
+        if (name in ("equation", "equation*", "displaymath")):
+            result = "\n$$\n" + self.Body(node, ("label",)).strip() + "\n$$"
+            label = self.Label(node)
+            return result + (" (" + label + ")\n" if label else "\n")
+        if (name in ALIGN_ENVIRONMENTS):
+            body = self.Body(node, ("label", "nonumber", "notag")).strip()
+            if (name.startswith("eqnarray")):
+                name = "align" + name[len("eqnarray"):]
+                body = EQNARRAY_ARGUMENT_PATTERN.sub(lambda matchobject: "&" + matchobject.group(1), body)
+            basename = name.rstrip("*") + "*"
+            begin = "\\begin{" + basename + "}" + ("{" + self.RawArg(node, 0) + "}" if node.args else "")
+            end = "\\end{" + basename + "}"
+            if (self.InSubequations(node)):
+                # The whole group gets the label of the subequations environment, the labels inside are referred to by letter.
+                return "\n" + Directive("math", "", [("label", self.Label(node.parent))], begin + "\n" + body + "\n" + end)
+            blocks = self.SplitAtLabels(node)
+            if (blocks is not None):
+                return "".join("\n" + Directive("math", "", [("label", label)], begin + "\n" + equations + "\n" + end) for (label, equations) in blocks)
+            # Like latextomarkdown, take the label at the end.
+            return "\n" + Directive("math", "", [("label", self.Label(node, last=True))], begin + "\n" + body + "\n" + end)
+        if (name == "subequations"): return self.Body(node, ("label",))
+        if (math): return "\\begin{" + name + "}" + "".join("{" + arg.Source(self.source) + "}" for arg in node.args) + self.Sequence(node.children) + "\\end{" + name + "}"
+        if (name in ("figure", "figure*")): return self.RenderFigure(node)
+        if (name in ("table", "table*")): return self.RenderTable(node)
+        if (name == "tabular"): return self.RenderTabular(node, "", "")
+        if (name in PROOF_ENVIRONMENTS):
+            title = node.optional.rendered if (node.optional is not None) else ""
+            return "\n" + Directive("prf:" + name, title, [("label", self.Label(node))], self.Body(node, ("label",)).strip()) + "\n"
+        if (name in ("enumerate", "itemize")):
+            return "\n" + "".join(child.rendered for child in node.children) + "\n"
+        if (name == "framed"): return "\n" + Directive("note", "", [], self.Sequence(node.children).strip()) + "\n"
+        if (name == "tcolorbox" and self.IsBoxedMath(node)):
+            # Boxed equation.
+            body = "\\boxed{" + self.Body(node, ("label",)).strip() + "}"
+            return "\n" + Directive("math", "", [("label", self.Label(node))], body) + "\n"
+        if (name == "tcolorbox"):
+            options = node.optional.Source(self.source) if (node.optional is not None) else ""
+            title = TCOLORBOX_TITLE_PATTERN.search(options)
+            if (title is not None): return "\n" + Directive("admonition", title.group(1), [], self.Sequence(node.children).strip()) + "\n"
+            return "\n" + Directive("note", "", [], self.Sequence(node.children).strip()) + "\n"
+        return "\\begin{" + name + "}" + self.Sequence(node.children) + "\\end{" + name + "}"
+
+    def IsBoxedMath(self, node):
+        # A tcolorbox without a title and with the 'ams align' option holds an equation.
+        if (node.name != "tcolorbox" or node.optional is None): return False
+        options = node.optional.Source(self.source)
+        return "ams align" in options and TCOLORBOX_TITLE_PATTERN.search(options) is None
+
+    def InSubequations(self, node):
+        parent = node.parent
+        return parent is not None and parent.kind == "environment" and parent.name == "subequations"
+
+    def SplitAtLabels(self, node):
+        # An align starting with a label and holding more is split into a math block per label, as in latextomarkdown:
+        # (label, equations) for every block, None to keep the align whole.
+        children = [child for child in node.children if not (child.kind == "command" and child.name in ("nonumber", "notag"))]
+        first = next((child for child in children if not (child.kind in ("text", "comment") and child.text.strip() == "")), None)
+        labels = [i for (i, child) in enumerate(children) if child.kind == "command" and child.name == "label"]
+        if (first is None or first.name != "label" or len(labels) < 2): return None
+        blocks = []
+        for (labelid, start) in enumerate(labels):
+            end = labels[labelid + 1] if (labelid + 1 < len(labels)) else len(children)
+            equations = self.Sequence(children[start + 1:end])
+            if (node.name.startswith("eqnarray")):
+                equations = EQNARRAY_ARGUMENT_PATTERN.sub(lambda matchobject: "&" + matchobject.group(1), equations)
+            blocks.append((self.RawArg(children[start], 0), ROW_END_PATTERN.sub("", equations).strip()))
+        return blocks
+
+    def RenderFigure(self, node):
+        graphics = self.Find(node, "includegraphics")
+        if (graphics is None): return self.Sequence(node.children)
+        caption = self.Find(node, "caption")
+        width = next((FIGURE_WIDTH_PATTERN.match(child.text) for child in node.children if child.kind == "comment" and FIGURE_WIDTH_PATTERN.match(child.text)), None)
+        options = [("name", self.Label(node)), ("width", width.group(1) if width else "")]
+        body = self.Arg(caption, 0).strip() if caption is not None else ""
+        return "\n" + Directive("figure", self.FigurePath(graphics), options, body) + "\n"
+
+    def RenderTable(self, node):
+        tabular = next((child for child in node.children if child.kind == "environment" and child.name == "tabular"), None)
+        if (tabular is None): return self.Sequence(node.children)
+        caption = self.Find(node, "caption")
+        title = ""
+        footer = ""
+        if (caption is not None):
+            if (caption.optional is not None):
+                title = caption.optional.rendered.strip()
+                footer = self.Arg(caption, 0).strip()
+            else: title = self.Arg(caption, 0).strip()
+        return self.RenderTabular(tabular, title, self.Label(node)) + (footer + "\n" if footer else "")
+
+    def RenderTabular(self, node, title, label):
+        # Split the rows at \\ and the cells at &, skipping \hline.
+        rows = [[[]]]
+        for child in node.children:
+            if (child.kind == "command" and child.name == "\\"): rows.append([[]])
+            elif (child.kind == "alignment"): rows[-1].append([])
+            elif (child.kind == "command" and child.name in ("hline", "toprule", "midrule", "bottomrule")): continue
+            else: rows[-1][-1].append(child)
+        table = [[self.Sequence(cell).strip() for cell in row] for row in rows]
+        table = [row for row in table if any(row)]
+        layout = node.args[0].Source(self.source) if node.args else ""
+        makeup = {"l": " :--- |", "c": " :--: |", "r": " ---: |"}
+        makeuprow = "|" + "".join(makeup.get(letter, " ---- |") for letter in layout if letter.isalpha())
+        lines = ["| " + " | ".join(row) + " |" for row in table]
+        if (lines): lines.insert(1, makeuprow)
+        return "\n" + Directive("table", title, [("name", label)], "\n".join(lines)) + "\n"
+
+    def RenderItem(self, node):
+        if (node.problems): return self.RenderProblem(node)
+        listenvironment = node.parent.name
+        marker = "1. " if listenvironment == "enumerate" else "- "
+        body = self.Body(node, ("label",)).strip()
+        if (node.optional is not None):
+            body = "**" + node.optional.rendered + "** " + body
+        return marker + Indent(body, " " * len(marker)) + "\n"
+
+    def RenderExample(self, node):
+        # As in latextomarkdown, the display equations of a worked example become math blocks.
+        label = self.RawArg(node.optional, 0) if (node.optional is not None) else ""
+        body = MathBlocks(self.Sequence(node.children))
+        return "\n" + Directive("prf:example", node.text, [("label", label), ("class", "example")], body) + "\n"
+
+    def RenderProblem(self, node):
+        # A problem: title from a %Problemtitle comment or a leading \textbf, label from \label.
+        title = ""
+        skip = None
+        for child in node.children:
+            if (child.kind == "comment"):
+                titlematch = PROBLEM_TITLE_PATTERN.match(child.text.strip())
+                if (titlematch is not None):
+                    title = (titlematch.group(1) or titlematch.group(2) or "").strip()
+                    break
+            elif (child.kind == "text" and child.text.strip() == ""): continue
+            elif (child.kind == "command" and child.name == "label"): continue
+            elif (child.kind == "command" and child.name == "textbf"):
+                title = child.args[0].rendered.strip() if child.args else ""
+                skip = child
+                break
+            else: break
+        body = self.Sequence([child for child in node.children if child is not skip and not (child.kind == "command" and child.name == "label")])
+        return Directive("exercise", title, [("label", self.Label(node)), ("class", "dropdown")], MathBlocks(body).strip()) + "\n"
+
+def ConvertLatexToMarkdown(latexsource):
+    # Main function of the tokenizer backend: LaTeX source in, MyST Markdown out.
+    return Renderer(latexsource).Render(Parse(latexsource))
+
+def MoveIndexEntries(markdown):
+    # Put the index entries of every line in an index directive in front of that line.
+    lines = []
+    for line in markdown.split("\n"):
+        entries = INDEX_MARKER_PATTERN.findall(line)
+        if (entries):
+            lines.append("\n```{index} " + ", ".join(entries) + "\n```")
+            line = INDEX_MARKER_PATTERN.sub("", line)
+        lines.append(line)
+    return "\n".join(lines)
@@ -20,9 +20,40 @@
 
 
 #import enum
-#import re
+import re
 import regex
 import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Directory that figure source files and \input problem files are looked up in.
+# Set by ReadAndConvertLatexContent / ReadAndConvertLatexFile.
+basepath = "./"
+
+# Files read during a conversion (problem files, figure sources), recorded for the incremental cache if not None.
+dependencies = None
+
+def TrackDependency(filename):
+    # Record that the conversion depends on the given file (whether it exists or not).
+    if (dependencies is not None):
+        dependencies.append(filename)
+
+def Rule(pattern, replacement, flags=0, count=0, engine=re):
+    # Precompile a substitution rule. Returns a function that takes a string and returns it with the substitution applied.
+    # Use engine=regex for patterns that need the regex package (recursion).
+    return functools.partial(engine.compile(pattern, flags).sub, replacement, count=count)
+
+def ApplyRules(rules, latexstring):
+    # Apply a table of rules (see Rule; any function from string to string will do) in order.
+    result = latexstring
+    for rule in rules:
+        result = rule(result)
+    return result
 
 def FindSubstringInBraces(fullstring, startpos):
     # Find arguments contained between {}.
@@ -84,39 +115,22 @@ def CommentRemove(matchobject):
 def EqRefReplace(matchobject):
     return "(\\ref{" + matchobject.group(1) + "})"
 
-def AccentsReplace(latexstring):
-    # Replace accented letters with their HTML counterparts. Just a long list of substitutions.
-    result = latexstring
-
-    result = re.sub(r"\\\"\{a\}", "&auml;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\"\{e\}", "&euml;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\"\{i\}", "&iuml;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\"\{o\}", "&ouml;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\"\{u\}", "&uuml;", result, 0, re.MULTILINE)
-
+# Accented letters and their HTML counterparts. Just a long list.
+# None of the replacements contains a backslash, so they can all be done in a single scan.
+ACCENTS = {
+    r'\"{a}': "&auml;", r'\"{e}': "&euml;", r'\"{i}': "&iuml;", r'\"{o}': "&ouml;", r'\"{u}': "&uuml;",
     # Also without the parentheses...
-    result = re.sub(r"\\\"a", "&auml;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\"e", "&euml;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\"i", "&iuml;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\"o", "&ouml;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\"u", "&uuml;", result, 0, re.MULTILINE)
-
-    result = re.sub(r"\\\`\{a\}", "&agrave;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\`\{e\}", "&egrave;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\`\{i\}", "&igrave;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\`\{o\}", "&ograve;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\`\{u\}", "&ugrave;", result, 0, re.MULTILINE)
-
-    result = re.sub(r"\\\'\{a\}", "&aacute;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\'\{e\}", "&eacute;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\'\{i\}", "&iacute;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\'\{o\}", "&oacute;", result, 0, re.MULTILINE)
-    result = re.sub(r"\\\'\{u\}", "&uacute;", result, 0, re.MULTILINE)
-
+    r'\"a': "&auml;", r'\"e': "&euml;", r'\"i': "&iuml;", r'\"o': "&ouml;", r'\"u': "&uuml;",
+    r"\`{a}": "&agrave;", r"\`{e}": "&egrave;", r"\`{i}": "&igrave;", r"\`{o}": "&ograve;", r"\`{u}": "&ugrave;",
+    r"\'{a}": "&aacute;", r"\'{e}": "&eacute;", r"\'{i}": "&iacute;", r"\'{o}": "&oacute;", r"\'{u}": "&uacute;",
     #The Å in Ångström. Note that $Acirc; actually gives an A with a circumflex.
-    result = re.sub(r"\\r{A}", "Å", result, 0, re.MULTILINE)
+    r"\r{A}": "Å",
+}
+ACCENTS_PATTERN = re.compile("|".join(re.escape(accent) for accent in ACCENTS))
 
-    return result
+def AccentsReplace(latexstring):
+    # Replace accented letters with their HTML counterparts (see ACCENTS).
+    return ACCENTS_PATTERN.sub(lambda matchobject: ACCENTS[matchobject.group(0)], latexstring)
 
 def QuotesReplace(matchobject):
     if len(matchobject.group(0)) == 1: return "'"
@@ -147,6 +161,8 @@ def ChapterTitleReplace(matchobject):
     returnstring += "# " + matchobject.group(2) + "\n"
     return returnstring
 
+APPENDIX_SECTION_PATTERN = re.compile(r"\\section{([^}]+)}", re.MULTILINE)
+
 def AppendicesReplace(matchobject):
     # If a \begin{appendices} - \end{appendices} pair is found,
     # add "Appendix " to the title of every section inside the pair,
@@ -154,8 +170,7 @@ def AppendicesReplace(matchobject):
     def AddAppendixToSectionName(localmatchobject):
         return "\\section{Appendix: " + localmatchobject.group(1) + "}"
     returnstring = matchobject.group(1)
-    regexpression = r"\\section{([^}]+)}"
-    returnstring = re.sub(regexpression, AddAppendixToSectionName, returnstring, 0, re.MULTILINE)
+    returnstring = APPENDIX_SECTION_PATTERN.sub(AddAppendixToSectionName, returnstring)
     return returnstring
 
 def SectionTitleReplace(matchobject):
@@ -239,12 +254,18 @@ def InlineEquationReplace(matchobject):
 def EqnArrayArgumentReplace(matchobject):
     return r"&" + matchobject.group(1)
 
+EQNARRAY_PATTERN = re.compile(r"eqnarray", re.MULTILINE)
+EQNARRAY_ARGUMENT_PATTERN = re.compile(r"&\s*(=|<|>|\\leq|\\geq|\!=)\s*&", re.MULTILINE)
+
 def EqnArrayToAlign(matchobject):
     # Turn \begin{eqnarray} .. \end{eqnarray} in to \begin{align} .. \end{align} 
-    returnstring = re.sub(r"eqnarray", r"align", matchobject.group(0), 0, re.MULTILINE)
-    returnstring = re.sub(r"&\s*(=|<|>|\\leq|\\geq|\!=)\s*&", EqnArrayArgumentReplace, returnstring, 0, re.MULTILINE)
+    returnstring = EQNARRAY_PATTERN.sub(r"align", matchobject.group(0))
+    returnstring = EQNARRAY_ARGUMENT_PATTERN.sub(EqnArrayArgumentReplace, returnstring)
     return returnstring
 
+LABEL_PATTERN = re.compile(r"\\label{([^}]+)}\s?", re.MULTILINE)
+LABEL_NONUMBER_PATTERN = re.compile(r"\\label{[^}]+}\s?|\\nonumber", re.MULTILINE)
+
 def AlignReplace(matchobject):
     # If an align environment is found (in between \begin{align} and \end{align}), replace with align in markdown.
     # Check for presence of \begin{subequations} .. \end{subequations} around align.
@@ -264,7 +285,7 @@ def AlignReplace(matchobject):
         # No subequations, but there's at least one label. Add it.
         returnstring += ":label: " + matchobject.group(8) + "\n"
         # Check for multiple labels. If present, split the object.
-        labels = re.finditer(r"\\label{([^}]+)}\s?", matchobject.group(9), re.MULTILINE)
+        labels = LABEL_PATTERN.finditer(matchobject.group(9))
         labellist = []
         for labelid, label in enumerate(labels, start=1):
             # Extract relevant data of labels.
@@ -299,7 +320,7 @@ def AlignReplace(matchobject):
 
     # Strip labels and \nonumber comments from string
     # (not strictly needed but cleaner).
-    strippedequations = re.sub(r"\\label{[^}]+}\s?|\\nonumber", "", matchobject.group(9), 0, re.MULTILINE)
+    strippedequations = LABEL_NONUMBER_PATTERN.sub("", matchobject.group(9))
 
     # Single-label case; complete the returnstring, stripping internal label info.
     if (matchobject.group(5) != None):
@@ -366,9 +387,11 @@ def AlignReplaceOld(matchobject):
     else: returnstring += "\\begin{align*}\n" + strippedequations.strip() + r"\n\\end{align*}" + "\n```\n"
     return returnstring
 
+PDF_EXTENSION_PATTERN = re.compile(r"\.pdf")
+
 def NewFigurePath(oldpath):
     # Add images folder & replace any .pdf with .svg.
-    newpath = "images/" + re.sub(r"\.pdf", ".svg", oldpath)
+    newpath = "images/" + PDF_EXTENSION_PATTERN.sub(".svg", oldpath)
     return newpath
 
 def FigureReplace(matchobject):
@@ -473,6 +496,11 @@ def ProblemRefReplace(matchobject):
 def ExampleRefReplace(matchobject):
     return "{prf:ref}`" + matchobject.group(7) + "`"
 
+def ExampleRefsReplace(latexstring, label):
+    # Replace references to the worked example with the given label with {prf:ref}.
+    regexpression = r"((sub)?(sec)(\.|tion)?|example)?(s)?(~|&nbsp;|-|\s)\\ref{(" + label + r")}"
+    return re.sub(regexpression, ExampleRefReplace, latexstring, 0, re.MULTILINE | re.IGNORECASE)
+
 def RefReplace(matchobject):
     # Did not include (table). Needs number update for including.
     #print(matchobject.group(2))
@@ -530,13 +558,15 @@ def TheoremReplace(matchobject):
 def CitationReplace(matchobject):
     return matchobject.group(1) + "{cite}`" + matchobject.group(2) + "`"
 
+ENUMERATE_ITEM_PATTERN = re.compile(r" *\\item (\\label{[^}]+})?")
+
 def EnumerateReplace(matchobject):
     # Replace a \begin{enumerate}..\end{enumerate} with enumerated list.
     # Check (group 1) if \begin{enumerate} is followed by [(a)], if so, itemize with abcd... instead of 1, 2, 3 etc. Group 2 is the contents of the thing between brackets.
     # Other options might have to be added later.
     returnstring = matchobject.group(3)
     # Update: also strip any \label{..} as those don't work (yet) for itemized lists in JB.
-    returnstring = re.sub(r" *\\item (\\label{[^}]+})?", "1. ", returnstring)
+    returnstring = ENUMERATE_ITEM_PATTERN.sub("1. ", returnstring)
     return returnstring
 
 def ItemizeItemReplace(matchobject):
@@ -545,13 +575,15 @@ def ItemizeItemReplace(matchobject):
         return "- **" + matchobject.group(3) + "**"
     else: return "-"
 
+ITEMIZE_ITEM_PATTERN = re.compile(r"( |\t)*\\item(\[([^\]]+)\])?")
+
 def ItemizeReplace(matchobject):
     # Replace a \begin{itemize}..\end{itemize} with unnumbered list.
     # Choices: +, *, -, we will try -.
     # For now, no nesting.
     #returnstring = str.replace(matchobject.group(1), "\item", "-")
     #returnstring = re.sub(r" *\\item", "-", matchobject.group(2))
-    returnstring = re.sub(r"( |\t)*\\item(\[([^\]]+)\])?", ItemizeItemReplace, matchobject.group(2))
+    returnstring = ITEMIZE_ITEM_PATTERN.sub(ItemizeItemReplace, matchobject.group(2))
     return returnstring
 
 def HyperlinkReplace(matchobject):
@@ -562,31 +594,32 @@ def FramedReplace(matchobject):
     # Replace \begin{framed}...\end{framed} with a 'note' box.
     return "```{note}\n" + matchobject.group(1) + "```\n"
 
+TCOLORBOX_TITLE_PATTERN = re.compile(r",title=([^,]+)")
+TCOLORBOX_AMSALIGN_PATTERN = re.compile(r"ams align")
+TCOLORBOX_LABEL_PATTERN = re.compile(r"\\label\{([^\}]+)\}")
+
 def TcolorboxReplace(matchobject):
     # Replace \begin{tcolorbox}[..]..\end{tcolorbox} with a 'note' or titled box.
     #opening = "```{note}\n"
     returnstring = "```{note}\n"
     # First, check if the first argument contains a title.
     if (matchobject.group(1) != None):
-        localregexpression = r",title=([^,]+)"
-        titlematch = re.search(localregexpression, matchobject.group(1))
+        titlematch = TCOLORBOX_TITLE_PATTERN.search(matchobject.group(1))
         if (titlematch != None):
             #opening = "```{admonition} " + titlematch.group(1) + "\n"
             returnstring = "```{admonition} " + titlematch.group(1) + "\n" + matchobject.group(2).strip() + "\n```\n"
         else:
             # No title, but there could be 'ams align', implying internal math.
-            localregexpression = r"ams align"
-            amsalignmatch = re.search(localregexpression, matchobject.group(1))
+            amsalignmatch = TCOLORBOX_AMSALIGN_PATTERN.search(matchobject.group(1))
             if (amsalignmatch != None):
                 # Math. Could make a note, but rather box the math.
-                labelregexpression = r"\\label\{([^\}]+)\}"
-                labelmatch = re.search(labelregexpression, matchobject.group(2))
+                labelmatch = TCOLORBOX_LABEL_PATTERN.search(matchobject.group(2))
                 #NB: don't add 4 `s here, as that'll lead to an error when checking for nesting.
                 #returnstring = "```{note}\n```{math}\n"
                 returnstring = "```{math}\n"
                 if (labelmatch != None):
                     returnstring + ":label: " + labelmatch.group(1) + "\n"
-                    returnstring += "\\boxed{" + re.sub(labelregexpression, "", matchobject.group(2)).strip() + "}"
+                    returnstring += "\\boxed{" + TCOLORBOX_LABEL_PATTERN.sub("", matchobject.group(2)).strip() + "}"
                 else: returnstring += "\\boxed{" + matchobject.group(2).strip() + "}"
                 #returnstring += "\n```\n```\n"
                 returnstring += "\n```\n"
@@ -656,7 +689,7 @@ def InfoboxReplace(matchobject):
 
 def IndexEntryReplace(matchobject):
     arguments = str.split(matchobject.group(2), "|")
-    indexentry = re.sub(r"!", " ; ", arguments[0])
+    indexentry = arguments[0].replace("!", " ; ")
     return "\n\n```{index} " + indexentry + "\n```\n" + matchobject.group(1)
 
 def CombineIndexEntries(matchobject):
@@ -697,11 +730,12 @@ def TwovecReplace(latexstring):
 
     return result
 
+SOURCE_REF_PATTERN = re.compile(r"\[\\ref{([^}]+)}\]", re.MULTILINE)
+
 def SourceRefReplace(latexstring, sourcesstring):
     # Replace all occurrences of source citations, of the form [\ref{source}], with a footnote containing the reference as found on a single line in the sourcesstring.
     result = latexstring
-    regexpression = r"\[\\ref{([^}]+)}\]"
-    matches = re.finditer(regexpression, result, re.MULTILINE)
+    matches = SOURCE_REF_PATTERN.finditer(result)
     matchlist = []
     for matchid, match in enumerate(matches, start=1):
         matchlist.append((matchid, match.start(), match.group(1)))
@@ -870,11 +904,12 @@ def EquationToAdmonition(matchobject):
     result += matchobject.group(1) + "\n```\n"
     return result
 
+FOOTNOTE_EQUATION_PATTERN = re.compile(r"\$\$\n\s*(.*)\n\s*\$\$( \(([^\)]+)\))?", re.MULTILINE)
+
 def FormatFootnoteText(footnotetext):
     # Format the text in a footnote, such that, after the first line, every line indents, and admonitions are properly started on their own line.
     # First, make sure any stand-alone equations are in admonition form.
-    regexpression = r"\$\$\n\s*(.*)\n\s*\$\$( \(([^\)]+)\))?"
-    result = re.sub(regexpression, EquationToAdmonition, footnotetext, 0, re.MULTILINE)
+    result = FOOTNOTE_EQUATION_PATTERN.sub(EquationToAdmonition, footnotetext)
     lines = str.split(result, "\n")
     result = lines[0] + "\n"
     if (len(lines) > 1):
@@ -890,6 +925,7 @@ def FigureCodeReplace(matchobject):
     # Retain caption and label.
     # NB: The figure source file should be in the folder images/(subfolder if present) (as this is the target in the MD file) and have the same name as the actual figure.
     sourcefilename = basepath + str.split(matchobject.group(1), ".")[0] + ".py"
+    TrackDependency(sourcefilename)
     if (os.path.isfile(sourcefilename)):
         sourcefilelabel = str.split(str.split(matchobject.group(1), ".")[0], "/")[-1]
         result = "```{code-cell} ipython3\n:tags: [hide-input, remove-output]\n\n%config InlineBackend.figure_formats = ['svg']\n"
@@ -910,449 +946,370 @@ def FigureCodeReplace(matchobject):
         result = matchobject.group(0)
     return result
 
-def ConvertFileContentToMarkdown(latexsource, sourceslist, isBaseFile):
-    # Generate markdown from LaTeX through successive substitutions.
-    # Input: read file (essentially a long string).
-    # Second input: read content of file with sources (also a long string, only if given).
-    # Third input: true if base file, false if problem (will be run again with basefile later, to get all refs and footnotes right).
-    # Output: same string converted to MyST Markdown, can be written to a file.
+# Substitution rules used by ConvertFileContentToMarkdown, compiled once at import.
+# Each table is applied in order by ApplyRules; the order matters, as later rules act on the output of earlier ones.
+# Only rules that cannot interfere with each other are fused into a single pattern (see AccentsReplace, ASTRONOMICAL_SYMBOLS).
 
-    # Leave out as it gives unintended side-effects. 
-    ## Step 0: Strip preamble and \end{document} (and anything after \end{document}).
-    #regexpression = r"\\documentclass((.*?)\\begin{document}\s|\\end{document}(.*?))"
-    #result = re.sub(regexpression, "", latexsource, 0, re.MULTILINE | re.DOTALL)
-
-    result = latexsource
-
-    # Prep step: LaTeX conditionals.
-    # We only select A4paper parts from \ifAfourpaper ... \else .. \fi;
-    # don't include solutions, and take the part that is not 'problemset'.
-    # Flags for including parts (containsX): assume not.
-    # For Aurele's book: take the \ifchoicecolor option.
-    # First, find all instances of \ifxxx.
-    regexpression = r"\\if(Afourpaper|includesolutions|problemset|choicecolor|online|contains\w+)?"
-    matches = re.finditer(regexpression, result, re.MULTILINE)
-    matchlist = []
-    for matchid, match in enumerate(matches, start=1):
-        ## For each match, look for the matching closing "\fi". Could be on same line, but also further down. # Moved to below as it should be done per if.
-        #arguments = FindMatchingEndif(result, match.end())
-        #matchlist.append((matchid, match.start(), match.group(1), arguments[0], arguments[1]))
-        matchlist.append((matchid, match.start(), match.end(), match.group(1)))
-    # Note there is a bug: if there are nested conditionals, one of the arguments contains another if, but if that's already removed, we remove too much.    
-    if (len(matchlist) > 0):
-        #for (matchid, startpos, qualifier, argument1, argument2) in reversed(matchlist):
-        for (matchid, startpos, qualifierend, qualifier) in reversed(matchlist):
-            # Found a qualifier.
-            # NEW: find the matching \fi and arguments.
-            arguments = FindMatchingEndif(result, qualifierend)
-            # First, get the length of the block:
-            # 3 for '\if', length of the qualifier, length of the first argument (till \else or \fi),
-            # 3 for '\fi', and if second argument not "", 5 for '\else' and second argument's length.
-            #endpos = startpos + 6 + len(qualifier) + len(argument1)
-            endpos = startpos + 6 + len(qualifier) + len(arguments[0])
-            if (arguments[1] != ""): endpos += 5 + len(arguments[1])
-            #if (argument2 != ""): endpos += 5 + len(argument2)
-            # Now act depending on the code.
-            if (qualifier == 'Afourpaper') or (qualifier == 'choicecolor') or (qualifier == 'online'):
-                # Take the first part.
-                result = result[:startpos] + arguments[0] + result[endpos:]
-            elif (qualifier == 'includesolutions') or (qualifier == 'problemset'):
-                # Take the last part.
-                result = result[:startpos] + arguments[1] + result[endpos:]
-            elif (qualifier == 'containsLagrangianmechanics') or (qualifier == 'containsCM'):
-                # Take the first part (for physics1A book).
-                result = result[:startpos] + arguments[0] + result[endpos:]
-            else:
-                # Take the last part (might need adaptation!)
-                result = result[:startpos] + arguments[1] + result[endpos:]
-
-    # Replace occurences of source citations (strictly of the form [\ref{}]) with a footnote, containing the info found in the sourceslist.
-    if (sourceslist != ""):
-        result = SourceRefReplace(result, sourceslist)
-
-    """
-    # Step 0: Replace LaTeX comments with MarkDown / HTML ones.
-    # The leading "[^\\]" is to prevent \\% for actual % symbols to be caught.
-    regexpression = r"[^\\]%([^\n]+)"
-    result = re.sub(regexpression, CommentReplace, result)
-
-    # Remove empty lines starting with a %.
-    result = re.sub(r"^%$", "", result, 0, re.MULTILINE)
-    """
+# LaTeX conditionals: all instances of \ifxxx.
+CONDITIONAL_PATTERN = re.compile(r"\\if(Afourpaper|includesolutions|problemset|choicecolor|online|contains\w+)?", re.MULTILINE)
 
+# Comments, spacing and headings.
+PREP_RULES = [
     # Alternative: strip all comments, as in cleanlatex.
     # Remove lines with just a %.
-    result = re.sub(r"%\n", "\n", result, 0, re.MULTILINE)
-    
+    Rule(r"%\n", "\n", re.MULTILINE),
     # Comments that start at the start of a line.
     # Remove unless they start with a keyword (Problemtitle, Source, Figurewidth).
-    regexpression = r"^%\s?(Problemtitle|Source|Figurewidth)?(.*)\n"
-    result = re.sub(regexpression, LineCommentRemove, result, 0, re.MULTILINE | re.IGNORECASE)
-
+    Rule(r"^%\s?(Problemtitle|Source|Figurewidth)?(.*)\n", LineCommentRemove, re.MULTILINE | re.IGNORECASE),
     # Remove comments that start somewhere in a line.
     # Note we need to exclude linestarts and \% (for percent sign in eq.).
     # Just remove.
-    regexpression = r"([^\n\\])(%.*)\s"
-    result = re.sub(regexpression, CommentRemove, result, 0, re.MULTILINE)
-
+    Rule(r"([^\n\\])(%.*)\s", CommentRemove, re.MULTILINE),
     # Replace any \eqref{} with (\ref{}).
-    result = re.sub(r"\\eqref{([^\}]+)}", EqRefReplace, result, 0, re.MULTILINE)
-
+    Rule(r"\\eqref{([^\}]+)}", EqRefReplace, re.MULTILINE),
     # Remove any \hspace{} or \vspace{}.
     # UPDATE: just \vspace, \hspace is in info box. But do check for optional " \\"
-    #result = re.sub(r"\\(h|v)space\{[^}]+}", "", result, 0, re.MULTILINE)
-    result = re.sub(r"\\vspace{[^}]+}( *\\\\)?", "", result, 0, re.MULTILINE)
-
+    Rule(r"\\vspace{[^}]+}( *\\\\)?", "", re.MULTILINE),
     # Remove \small and \normalsize (probably need more).
-    regexpression = r"\\(small|normalsize)( )?"
-    result = re.sub(regexpression, "", result, 0, re.MULTILINE)
-
+    Rule(r"\\(small|normalsize)( )?", "", re.MULTILINE),
     # Remove section counters.
-    regexpression = r"\\setcounter{sectioncounter}{\\value{section}}"
-    result = re.sub(regexpression, "", result, 0, re.MULTILINE)
-
-    regexpression = r"\\setcounter{section}{\\value{sectioncounter}}"
-    result = re.sub(regexpression, "", result, 0, re.MULTILINE)
-
-    # Replace \[ ... \] with \begin{equation*} ... \end{equation*} as they give too much trouble.
-
+    Rule(r"\\setcounter{sectioncounter}{\\value{section}}", "", re.MULTILINE),
+    Rule(r"\\setcounter{section}{\\value{sectioncounter}}", "", re.MULTILINE),
     # Replace \ev{ with \braket{ (as used in physics2 package)
-    regexpression = r"\\ev{"
-    result = re.sub(regexpression, r"\\braket{", result, 0, re.MULTILINE)
-
+    Rule(r"\\ev{", r"\\braket{", re.MULTILINE),
     # Step 1: Chapters.
-    regexpression = r"\\chapter\*?(\[[^\]]+\])?{([^}]+)}\s?(\\label{([^}]+)})?"
-    result = re.sub(regexpression, ChapterTitleReplace, result, 0, re.MULTILINE)
-
+    Rule(r"\\chapter\*?(\[[^\]]+\])?{([^}]+)}\s?(\\label{([^}]+)})?", ChapterTitleReplace, re.MULTILINE),
     # Intermediate: for any \begin{appendices} - \end{appendices},
     # add "Appendix " to all section titles,
     # then remove \begin{appendices} - \end{appendices}.
-    regexpression = r"\\begin{appendices}\s(.*?)\\end{appendices}\s"
-    result = re.sub(regexpression, AppendicesReplace, result, 0, re.MULTILINE | re.DOTALL)
- 
+    Rule(r"\\begin{appendices}\s(.*?)\\end{appendices}\s", AppendicesReplace, re.MULTILINE | re.DOTALL),
     # Also for subappendices.
-    regexpression = r"\\begin{subappendices}\s(.*?)\\end{subappendices}\s"
-    result = re.sub(regexpression, AppendicesReplace, result, 0, re.MULTILINE | re.DOTALL)
-
+    Rule(r"\\begin{subappendices}\s(.*?)\\end{subappendices}\s", AppendicesReplace, re.MULTILINE | re.DOTALL),
     # Step 2: Section headings.
-    #regexpression = r"\\(sub|subsub)?section\*?(\[[^\]]+\])?{([^}]+)}\s?(\\label{([^}]+)})?"
-    regexpression = r"\\(sub|subsub)?section\*?(\[([^\]]+)\])?{([^}]+)}\s?(\\label{([^}]+)})?"
-    result = re.sub(regexpression, SectionTitleReplace, result, 0, re.MULTILINE)
-
-    
-
+    Rule(r"\\(sub|subsub)?section\*?(\[([^\]]+)\])?{([^}]+)}\s?(\\label{([^}]+)})?", SectionTitleReplace, re.MULTILINE),
     # Dutch (or French) accents. Replace with html.
     # Note that we need to do this early as accents have other roles.
-    result = AccentsReplace(result)
+    AccentsReplace,
+]
 
+# Quotes, tables, layout commands and macros.
+TEXT_RULES = [
     # Step X-1: Replace opening quotes with straight ones.
     # Note that we need to do this *before* the equations / figures as those have their own 'opening quotes' syntax.
     # Modification: only one or two, three or more are admonitions (might already be put in in exercises).
-    # result = re.sub("`", "'", result, 0, re.MULTILINE)
-    result = re.sub("`+", QuotesReplace, result, 0, re.MULTILINE)
-
-    result = re.sub(r"\\textquotesingle ?", "'", result, 0, re.MULTILINE)
-
+    Rule("`+", QuotesReplace, re.MULTILINE),
+    Rule(r"\\textquotesingle ?", "'", re.MULTILINE),
     # One thing that now has gone wrong, is {prf:ref}. Revert.
-    regexpression = r"{prf:ref}'([^']+)'"
-    result = re.sub(regexpression, FixPrfRef, result, 0, re.MULTILINE)
-
+    Rule(r"{prf:ref}'([^']+)'", FixPrfRef, re.MULTILINE),
     # AFTER textquotes, put anything that is in \texttt{..} in a `...` block.
-    regexpression = r"\\texttt({([^{}]*+(?:(?1)[^{}]*)*+)})"
-    result = regex.sub(regexpression, textttReplace, result, 0, re.MULTILINE)
-
+    Rule(r"\\texttt({([^{}]*+(?:(?1)[^{}]*)*+)})", textttReplace, regex.MULTILINE, engine=regex),
     # Replace \begin{center} ... \end{center} with \centering.
     # Needs to come before tables and figures.
     # Update: simply remove \begin{center} ... \end{center} as it doesn't fit with jupyter book style.
-    regexpression = r"\\begin{center}\s(.*?)\s\\end{center}\s?"
-    #result = re.sub(regexpression, CenterToCentering, result, 0, re.MULTILINE | re.DOTALL)
-    result = re.sub(regexpression, CenterRemove, result, 0, re.MULTILINE | re.DOTALL)
-
+    Rule(r"\\begin{center}\s(.*?)\s\\end{center}\s?", CenterRemove, re.MULTILINE | re.DOTALL),
     # Step 5b: Tables. Also include options to have whitespace before things folded in \begin-\end, and the option to account for a \resizebox command (used to compress a table to one A4 width). Caption becomes title; short caption (in []) taken if provided, in that case the long caption is printed under the table.
-    #regexpression = r"\\begin{table(\*)?}(\[\w+\])?\s(\s*\\centering\s)?\s*\\begin{tabular}{([^}]*)}\s(.*?)\\end{tabular}\s*(\\caption{(.*?)})?\s*(\\label{([^}]+)})?\s?\\end{table(\*)?}"
-    #regexpression = r"\\begin{table(\*)?}(\[\w+\])?\s(\s*\\centering\s|\\resizebox{\\textwidth}{!}{%?\s)?\s*\\begin{tabular}{([^}]*)}\s(.*?)\\end{tabular}}?\s*(\\caption{(.*?)})?\s*(\\label{([^}]+)})?\s?\\end{table(\*)?}"
-    regexpression = r"\\begin{table(\*)?}(\[\w+\])?\s(\s*\\centering\s|\\resizebox{\\textwidth}{!}{%?\s)?\s*\\begin{tabular}{([^}]*)}\s(.*?)\\end{tabular}}?\s*(\\caption(\[([^\]]+)?\])?{(.*?)})?\s*(\\label{([^}]+)})?\s?\\end{table(\*)?}"
-    result = re.sub(regexpression, TableReplace, result, 0, re.MULTILINE | re.DOTALL)
-
+    Rule(r"\\begin{table(\*)?}(\[\w+\])?\s(\s*\\centering\s|\\resizebox{\\textwidth}{!}{%?\s)?\s*\\begin{tabular}{([^}]*)}\s(.*?)\\end{tabular}}?\s*(\\caption(\[([^\]]+)?\])?{(.*?)})?\s*(\\label{([^}]+)})?\s?\\end{table(\*)?}", TableReplace, re.MULTILINE | re.DOTALL),
     # With tables: Remove any \parbox[x]{dist}{text}, just retaining the text.
-    regexpression = r"\\parbox(\[\w+\])?\{[^}]+}{([^}]+)}"
-    result = re.sub(regexpression, ParboxRemove, result, 0, re.MULTILINE)
-
+    Rule(r"\\parbox(\[\w+\])?\{[^}]+}{([^}]+)}", ParboxRemove, re.MULTILINE),
     # Step X-2: Replace non-breaking tildes with &nbsp;
     # Also needs to come early, as markdown ~x~ means subscript - but after table, as we should have no new &.
-    result = re.sub("~", "&nbsp;", result, 0, re.MULTILINE)
-
+    Rule("~", "&nbsp;", re.MULTILINE),
     # Replace \clearpage, \newpage, etc. with double line break.
-    regexpression = r"(\\clearpage|\\cleardoublepage|\\newpage)"
-    result = re.sub(regexpression, "\n\n", result, 0, re.MULTILINE)
-
+    Rule(r"(\\clearpage|\\cleardoublepage|\\newpage)", "\n\n", re.MULTILINE),
     # Newlines
     # Replace \newline with end-of-line. Note that we cannot do the same with "\\" as that will also kill the "\\" in equations (e.g. matrix, align).
-    #regexpression = r"(\\newline|\\\\)"
-    regexpression = r"\\newline"
-    result = re.sub(regexpression, "\n", result, 0, re.MULTILINE)
-
+    Rule(r"\\newline", "\n", re.MULTILINE),
     # Remove \noindent.
-    regexpression = r"(\\noindent\s?)"
-    result = re.sub(regexpression, "", result, 0, re.MULTILINE)
-
+    Rule(r"(\\noindent\s?)", "", re.MULTILINE),
     # Remove any \- indicating potential breaks in words.
-    result = re.sub(r"\\-", "", result, 0, re.MULTILINE)
-
+    Rule(r"\\-", "", re.MULTILINE),
     # Step: TI layout for straight d's and diffs, bvec, unitvec.
     # Option 1 (preferred): changes to physics package in Latex.
     # Option 2 (without physics package)
-
     # Straight d's. Note that we exclude \ddo to not accidentally convert \ddot.
     # Update: now check for o in StraightdReplace.
-    regexpression = r"\\dd(\w| )?"
-    #regexpression = r"\\dd([a-n]|[p-z]| |\\|\^)"
-    result = re.sub(regexpression, StraightdReplace, result, 0, re.MULTILINE)
-
+    Rule(r"\\dd(\w| )?", StraightdReplace, re.MULTILINE),
     # bvec
-    result = re.sub(r"\\bvec", r"\\bm", result, 0, re.MULTILINE)
-
+    Rule(r"\\bvec", r"\\bm", re.MULTILINE),
     # unitvec
-    regexpression = r"\\unitvec{([^}]+)}"
-    result = re.sub(regexpression, UnitvecReplace, result, 0, re.MULTILINE)
-
+    Rule(r"\\unitvec{([^}]+)}", UnitvecReplace, re.MULTILINE),
     # twovec
-    #result = TwovecReplace(result)
-    #regexpression = r"\\twovec{([^}]*)}{([^}]*)}"
-    #result = re.sub(regexpression, TwovecReplace, result, 0, re.MULTILINE)
-    result = TwoArgumentMacroReplace(result, r"\\twovec", r"\begin{pmatrix} ", r" \\ ", r" \end{pmatrix}")
-
+    functools.partial(TwoArgumentMacroReplace, latexmacro=r"\\twovec", startstring=r"\begin{pmatrix} ", midstring=r" \\ ", endstring=r" \end{pmatrix}"),
     # threevec
-    #regexpression = r"\\threevec{([^}]*)}{([^}]*)}{([^}]*)}"
-    #result = re.sub(regexpression, ThreevecReplace, result, 0, re.MULTILINE)
-    result = ThreeArgumentMacroReplace(result, r"\\threevec", r"\begin{pmatrix} ", r" \\ ", r" \\ ", r" \end{pmatrix}")
-
+    functools.partial(ThreeArgumentMacroReplace, regexpression=r"\\threevec", startstring=r"\begin{pmatrix} ", midstring1=r" \\ ", midstring2=r" \\ ", endstring=r" \end{pmatrix}"),
     # spinor
-    result = TwoArgumentMacroReplace(result, r"\\spinor", r"\begin{pmatrix} ", r" \\ ", r" \end{pmatrix}")
-
+    functools.partial(TwoArgumentMacroReplace, latexmacro=r"\\spinor", startstring=r"\begin{pmatrix} ", midstring=r" \\ ", endstring=r" \end{pmatrix}"),
     # Tr (note that \Tr is in physics and as such would not need replacement.)
-    result = re.sub(r"\\Tr", r"\\mathrm{Tr}", result, 0, re.MULTILINE)
-
+    Rule(r"\\Tr", r"\\mathrm{Tr}", re.MULTILINE),
     # diff
-    #regexpression = r"\\diff{([^}]+)}{([^}]+)}"
-    #result = re.sub(regexpression, DiffReplace, result, 0, re.MULTILINE)
-    result = TwoArgumentMacroReplace(result, r"\\diff", r"\frac{\partial ", r"}{\partial ", r"}")
-
+    functools.partial(TwoArgumentMacroReplace, latexmacro=r"\\diff", startstring=r"\frac{\partial ", midstring=r"}{\partial ", endstring=r"}"),
     # dv, one or two arguments.
-    regexpression = r"\\dv(\[(\w)\])?({([^{}]*+(?:(?3)[^{}]*)*+)})({([^{}]*+(?:(?5)[^{}]*)*+)})?"
-    result = regex.sub(regexpression, dvReplace, result, 0, re.MULTILINE)
+    Rule(r"\\dv(\[(\w)\])?({([^{}]*+(?:(?3)[^{}]*)*+)})({([^{}]*+(?:(?5)[^{}]*)*+)})?", dvReplace, regex.MULTILINE, engine=regex),
+    # pdv, 1-3 arguments
+    Rule(r"\\pdv(\[(\w)\])?({([^{}]*+(?:(?3)[^{}]*)*+)})({([^{}]*+(?:(?5)[^{}]*)*+)})?({([^{}]*+(?:(?7)[^{}]*)*+)})?", pdvReplace, regex.MULTILINE, engine=regex),
+    # Commutator
+    functools.partial(TwoArgumentMacroReplace, latexmacro=r"\\commutator", startstring=r"\left[", midstring=r", ", endstring=r"\right]"),
+    # bookref (TI defined command for problems to be able to refer to book eq. and fig. numbers in solution manual).
+    Rule(r"\\bookref", r"\\ref", re.MULTILINE),
+    # Order symbol
+    Rule(r"\\Order", r"\\mathcal{O}", re.MULTILINE),
+    # Script L Lagrangian
+    Rule(r"\\Lg", r"\\mathcal{L}", re.MULTILINE),
+    # inprod (revised using new TwoArgumentMacroReplace function)
+    functools.partial(TwoArgumentMacroReplace, latexmacro=r"\\inprod", startstring=r"\langle ", midstring=r" \,, ", endstring=r" \rangle"),
+]
 
-    # dv (old)
-    # result = TwoArgumentMacroReplace(result, r"\\dv", r"\frac{\mathrm{d} ", r"}{\mathrm{d} ", r"}")
+# Step 3: Equations.
+# Extension to also allow 'label' at end.
+# NB: always go for an admonition in a problem.
+EQUATION_PATTERN = re.compile(r"\\begin{equation(\*)?}\s?(\\label{([^}]+)})?\s?(.*?)(\\label{([^}]+)})?\s?\\end{equation(\*)?}", re.MULTILINE | re.DOTALL)
 
-    # pdv (old)
-    #result = pdvReplace(result)
+MATH_RULES = [
+    # Unnumbered equations with '\[ .. \]' syntax: turn into a math admonition, as they are breaking things in jb conversion unless we add white lines (but then they break indentation).
+    Rule(r"\\\[(.*)\\\]", UnnumberedEquationReplace, re.MULTILINE),
+    # Inline equations. If in $equation$, fine. If in \(equation\), put in dollars.
+    Rule(r"\\\((.*?)\\\)", InlineEquationReplace, re.MULTILINE | re.DOTALL),
+]
 
-    # pdv, 1-3 arguments
-    regexpression = r"\\pdv(\[(\w)\])?({([^{}]*+(?:(?3)[^{}]*)*+)})({([^{}]*+(?:(?5)[^{}]*)*+)})?({([^{}]*+(?:(?7)[^{}]*)*+)})?"
-    result = regex.sub(regexpression, pdvReplace, result, 0, re.MULTILINE)
+# Step 4A: Align environments with subequations numbering.
+SUBEQUATIONS_PATTERN = re.compile(r"\\begin{subequations}(.*?)\\end{subequations}", re.MULTILINE | re.DOTALL)
+SUBEQUATION_LABEL_PATTERN = re.compile(r"\\label{([^}]+)}")
 
-    # pdv. For now, do the [2] separate, leave higher order.
-#    result = ThreeArgumentMacroReplace(result, r"\\pdv\[2\]", r"\frac{\partial^2 ", r"}{\partial ", r" \partial ", r"}")
-#    result = TwoArgumentMacroReplace(result, r"\\pdv\[2\]", r"\frac{\partial^2 ", r"}{\partial ", r"^2}")
-#    result = TwoArgumentMacroReplace(result, r"\\pdv", r"\frac{\partial ", r"}{\partial ", r"}")
+# Align environments, figures and theorems.
+ENVIRONMENT_RULES = [
+    # 4.B: eqnarray for those too stubborn to let go of them.
+    # Simply turn into align,
+    # killing the second & on each line.
+    Rule(r"\\begin{eqnarray(\*)?}({\d})?\s(\\label{([^}]+)})?\s?(.*?)\s+(\\label{([^}]+)})?\s?\\end{eqnarray(\*)?}", EqnArrayToAlign, re.MULTILINE | re.DOTALL),
+    # Step 4: Align environments.
+    # 4.1: regular align, possibly with subequations, with additional option for label at end,
+    # and with a group for checking for a leading ```{math} (due to earlier runthrough in problem or example).
+    Rule(r"(```{math}\n|:label: \w+\n)?(\\begin{subequations}\s)?(\\label{([^}]+)}\s)?\s*?\\begin{align(at)?\*?}({\d})?\s(\\label{([^}]+)})?\s?(.*?)\s+(\\label{([^}]+)})?\s?\\end{align(at)?(\*)?}(\s)?(\\end{subequations})?", AlignReplace, re.MULTILINE | re.DOTALL),
+    # Step 5: Figures.
+    # TI Figure prior (shold be removed, left in to ease physics1A book production): strip "/figures/PNG" and "/figures/PDF"
+    Rule(r"/figures/PNG", "", re.MULTILINE),
+    Rule(r"/figures/PDF", "", re.MULTILINE),
+    Rule(r"/problemfigures/PDF", "", re.MULTILINE),
+    Rule(r"/problemfigures/PNG", "", re.MULTILINE),
+    Rule(r"mechanics/figures/", "mechanics/", re.MULTILINE),
+    Rule(r"mechanics/problems/", "mechanics/", re.MULTILINE),
+    # And for QMbook
+    Rule(r"/figures/", "/", re.MULTILINE),
+    Rule(r"SE/tunnelingexamples.pdf", "SE/tunnelingexamples.png", re.MULTILINE),
+    Rule(r"SE/Hydrogen_fine_structure.png", "SE/Hydrogen_fine_structure.svg", re.MULTILINE),
+    # Caption with dotall flag, can contain arbitrary number of line breaks.
+    # (In regexpression101.com, put flag 'single line' for dotall, or \gms)
+    Rule(r"\\begin{figure(\*)?}(\[!?\w+!?\])?\s(%Figurewidth: (\d+)\s)?(\s*\\centering\s)?\s*\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\s*\\caption(\[[^\]]+\])?{(.*?)})?\s?(\s*\\label{([^}]+)})?\s?\\end{figure(\*)?}", FigureReplace, re.MULTILINE | re.DOTALL),
+    # Step 6: Theorems, Propositions, Lemmas, proofs, axioms.
+    Rule(r"\\begin{(theorem|proposition|lemma|corollary|axiom|definition|proof)(\*)?}(\[([^\]]+)\])?\s(\\label{([^}]+)}\s)?(.*?)\\end{(theorem|proposition|lemma|corollary|axiom|definition|proof)(\*)?}", TheoremReplace, re.MULTILINE | re.DOTALL),
+]
+
+# Internal references and citations only for basefile (will include problems),
+# as otherwise refs in problems might break.
+REFERENCE_RULES = [
+    # Step 7A: Internal references to problems.
+    # Specific structure: problem~\ref{ch:X}.\ref{pb:Y}
+    # (allow for case and 'exercise' instead of 'probblem').
+    # Replace with only a link to the exercise (will have 'exercise' by Sphinx setting).
+    Rule(r"(problem|exercise)(~| |&nbsp;)\\ref{[^}]+}\.\\ref{(pb:[^}]+)}", ProblemRefReplace, re.MULTILINE | re.IGNORECASE),
+    # Step 7: Internal references. #TO ADD TABLES
+    Rule(r"((fig)(?:\.|ure)?|(table)|(ch)(\.|apter)?|(sub)?(sec)(\.|tion)?|(app)(\.|endix|ices)?|(eq)(\.|uation)?|theorem|(prop)(?:\.|osition)?|lemma|corollary|axiom|(def)(?:\.|inition)?)?(s)?(~|&nbsp;|-|\s)([(])?\\ref{([^}]+)}([)])?", RefReplace, re.MULTILINE | re.IGNORECASE),
+    # Step 8: Citations.
+    Rule(r"(~|&nbsp;| )\\citep?{([^}]+)}", CitationReplace, re.MULTILINE),
+]
+
+# Astronomical symbols (not widely used, but nice to have)
+ASTRONOMICAL_SYMBOLS = {
+    r"\mercury": "&#x263F;",    # ☿
+    r"\venus": "&#x2640;",      # ♀
+    r"\earth": "&#x2641;",      # ⊕
+    r"\mars": "&#x2642;",       # ♂
+    r"\jupiter": "&#x2643;",    # ♃
+    r"\saturn": "&#x2644;",     # ♄
+    r"\uranus": "&#x26E2;",     # ⛢
+    r"\neptune": "&#x2646;",    # ♆
+    r"\pluto": "&#x2647;",      # ♇
+    r"\sun": "&#x2609;",        # ☉
+    r"\leftmoon": "&#x263E;",   # ☾
+}
+
+# Lists, hyperlinks and symbols.
+LIST_RULES = [
+    # Step 9: Enumerate environments - bugged, is greeedy.
+    Rule(r"\\begin{enumerate}(\[([^\]]+)\])?\s(.*?)\\end{enumerate}", EnumerateReplace, re.MULTILINE | re.DOTALL),
+    # Step 9b: Itemize environments.
+    Rule(r"\\begin{itemize}(\[[^\]]+\])?\s(.*?)\\end{itemize}", ItemizeReplace, re.MULTILINE | re.DOTALL),
+    # Hyperlinks
+    Rule(r"\\(book)?href{(.*?)}{(.*?)}", HyperlinkReplace, re.MULTILINE | re.DOTALL),
+    # The symbols are plain macros replaced by html entities, so they are done in a single scan.
+    Rule("|".join(re.escape(symbol) for symbol in ASTRONOMICAL_SYMBOLS), lambda matchobject: ASTRONOMICAL_SYMBOLS[matchobject.group(0)]),
+]
 
-    # Commutator
-    result = TwoArgumentMacroReplace(result, r"\\commutator", r"\left[", r", ", r"\right]")
+# Step Y: Footnotes.
+FOOTNOTE_PATTERN = re.compile(r"\\footnote{", re.MULTILINE)
 
-    # bookref (TI defined command for problems to be able to refer to book eq. and fig. numbers in solution manual).
-    regexpression = r"\\bookref"
-    result = re.sub(r"\\bookref", r"\\ref", result, 0, re.MULTILINE)
+# Boxes, stray figures and index entries.
+BOX_RULES = [
+    # Framed boxes: turn into notes.
+    Rule(r"\\begin{framed}\s?(.*?)\\end{framed}\s?", FramedReplace, re.MULTILINE | re.DOTALL),
+    # Color box from optics book, also turn into notes.
+    Rule(r"\\begin{tcolorbox}\s?\[(.*?)\]\s?(.*?)\\end{tcolorbox}\s?", TcolorboxReplace, re.MULTILINE | re.DOTALL),
+    # Step Q: People info boxes. Already partly processed as we've gone through the above steps.
+    Rule(r"\\begin{figure\*}\[?.?\]?\n\\fbox{\n\s?\\begin{minipage}\S*\s?\n(\\index{([^}]*)})?(\\textbf{([^}]*)}\s?(\(\d*-\d*\))?.*?)\n\\end{minipage}\n\\hspace{[^}]*}\n\s?\\begin{minipage}\S*\s?\n(.*?)\\includegraphics\[[^\]]*\]{([^}]*)}\n\\caption{(.*?)}\n\\end{minipage}\n}\n\\end{figure\*}", InfoboxReplace, re.MULTILINE | re.DOTALL),
+    # Step 5b: Figures that are not in a `figure` environment: just with an \includegraphics. Note that this should come after the people info boxes.
+    Rule(r"(\\centering)?\s?\\includegraphics(\[[^\]]+\])?{([^}]+)}\s?", IncludeGraphicsReplace, re.MULTILINE),
+]
+# Index entries. Note that we take everything from the last \n, as we need to place the index admonition there. We run this multiple times, as there may be multiple entries per block (not very elegant, but works for now).
+BOX_RULES += [Rule(r"\n(.*?)\\index{([^}]+)}", IndexEntryReplace, re.MULTILINE)] * 5
+# Combine any multiple index boxes.
+BOX_RULES += [Rule(r"```{index} (.+)\n```\n\n```{index} (.+)\n```", CombineIndexEntries, re.MULTILINE)] * 4
+
+# Code that can account for nested arguments.
+LATEX_COMMAND_PATTERN = re.compile(r"\\(\w+){", re.MULTILINE)
+
+# Old-style font switches and book-specific fixes.
+FONT_RULES = [
+    # {\bf XYZ} --> **XYZ**
+    Rule(r"\{\\bf([^\}]+)\}", bfInTextReplace, re.MULTILINE),
+    # {\it XYZ} or {\em XYZ} --> *XYZ*
+    Rule(r"\{\\(it|em)([^\}]+)\}", itInTextReplace, re.MULTILINE),
+    # TI physics 1A specific (needs manual intervention otherwise)
+    # Ampère in table (& gets replaced by |)
+    Rule(r"Amp\|egrave;re", "Amp&egrave;re"),
+    # Ceres symbol in eqs. & const.
+    Rule(r"Ceres \|  \|", "Ceres | &#x26B3; |", re.MULTILINE),
+    # defCV in entropy.md refers to a subequation.
+    Rule(r"{eq}`defCV`", "{eq}`defspecificheat`A"),
+    # Part {eq}`part:mechanics` should get part I as the parts have no labels.
+    Rule(r"{eq}`part:mechanics`", "I"),
+]
 
-    # Order symbol
-    result = re.sub(r"\\Order", r"\\mathcal{O}", result, 0, re.MULTILINE)
+# Admonitions: all opening and closing ```.
+ADMONITION_PATTERN = re.compile(r"```({[^}]*})?(.*)?\n", re.MULTILINE)
 
-    # Script L Lagrangian
-    result = re.sub(r"\\Lg", r"\\mathcal{L}", result, 0, re.MULTILINE)
+# Cleanup: remove superfluous whitespace and empty lines.
+EMPTY_LINE_PATTERN = re.compile(r"^\s*\n", re.MULTILINE)
+LEADING_NEWLINE_PATTERN = re.compile(r"^\n", re.MULTILINE)
 
-    # inprod (revised using new TwoArgumentMacroReplace function)
-    result = TwoArgumentMacroReplace(result, r"\\inprod", r"\langle ", r" \,, ", r" \rangle")
+# YAML frontmatter, needed if figures are replaced with code.
+YAML_BLOCK = "---\njupytext:\n    formats: md:myst\n"
+YAML_BLOCK += "    text_representation:\n        extension: .md\n        format_name: myst\n"
+YAML_BLOCK += "kernelspec:\n    display_name: Python 3 (ipykernel)\n    language: python\n"
+YAML_BLOCK += "    name: python3\n"
+YAML_BLOCK += "---\n"
+
+# Put before the footnotes of a part of a document, see ConvertLatexSourceIncrementally.
+FOOTNOTES_MARKER = "<!-- footnotes -->"
+
+# Figures, to see if any have a source file. Note that we include options for indentation (to maintain!).
+FIGURE_CODE_PATTERN = re.compile(r"```{figure}\s(.+?)\s((\s+)?\:name\:\s(.+?)\s)?((\s+)?\:width\:\s(.+?)\s)?(\s+)?(.*?\s)?(\s+)?```", re.MULTILINE | re.DOTALL)
+
+def ConvertFileContentToMarkdown(latexsource, sourceslist, isBaseFile, subequationlabels=None, separatefootnotes=False):
+    # Generate markdown from LaTeX through successive substitutions.
+    # Input: read file (essentially a long string).
+    # Second input: read content of file with sources (also a long string, only if given).
+    # Third input: true if base file, false if problem (will be run again with basefile later, to get all refs and footnotes right).
+    # Optional: labels of subequations elsewhere in the document (see CollectCrossReferences),
+    # and whether to put FOOTNOTES_MARKER before the footnotes (for incremental conversion).
+    # Output: same string converted to MyST Markdown, can be written to a file.
+    # The substitutions themselves are in the rule tables above.
+
+    # Leave out as it gives unintended side-effects.
+    ## Step 0: Strip preamble and \end{document} (and anything after \end{document}).
+    #regexpression = r"\\documentclass((.*?)\\begin{document}\s|\\end{document}(.*?))"
+    #result = re.sub(regexpression, "", latexsource, 0, re.MULTILINE | re.DOTALL)
+
+    result = latexsource
+
+    # Prep step: LaTeX conditionals.
+    # We only select A4paper parts from \ifAfourpaper ... \else .. \fi;
+    # don't include solutions, and take the part that is not 'problemset'.
+    # Flags for including parts (containsX): assume not.
+    # For Aurele's book: take the \ifchoicecolor option.
+    # First, find all instances of \ifxxx.
+    matches = CONDITIONAL_PATTERN.finditer(result)
+    matchlist = []
+    for matchid, match in enumerate(matches, start=1):
+        matchlist.append((matchid, match.start(), match.end(), match.group(1)))
+    # Note there is a bug: if there are nested conditionals, one of the arguments contains another if, but if that's already removed, we remove too much.
+    if (len(matchlist) > 0):
+        for (matchid, startpos, qualifierend, qualifier) in reversed(matchlist):
+            # Found a qualifier.
+            # NEW: find the matching \fi and arguments.
+            arguments = FindMatchingEndif(result, qualifierend)
+            # First, get the length of the block:
+            # 3 for '\if', length of the qualifier, length of the first argument (till \else or \fi),
+            # 3 for '\fi', and if second argument not "", 5 for '\else' and second argument's length.
+            endpos = startpos + 6 + len(qualifier) + len(arguments[0])
+            if (arguments[1] != ""): endpos += 5 + len(arguments[1])
+            # Now act depending on the code.
+            if (qualifier == 'Afourpaper') or (qualifier == 'choicecolor') or (qualifier == 'online'):
+                # Take the first part.
+                result = result[:startpos] + arguments[0] + result[endpos:]
+            elif (qualifier == 'includesolutions') or (qualifier == 'problemset'):
+                # Take the last part.
+                result = result[:startpos] + arguments[1] + result[endpos:]
+            elif (qualifier == 'containsLagrangianmechanics') or (qualifier == 'containsCM'):
+                # Take the first part (for physics1A book).
+                result = result[:startpos] + arguments[0] + result[endpos:]
+            else:
+                # Take the last part (might need adaptation!)
+                result = result[:startpos] + arguments[1] + result[endpos:]
+
+    # Replace occurences of source citations (strictly of the form [\ref{}]) with a footnote, containing the info found in the sourceslist.
+    if (sourceslist != ""):
+        result = SourceRefReplace(result, sourceslist)
+
+    # Comments, spacing, headings, quotes, tables and macros.
+    result = ApplyRules(PREP_RULES, result)
+    result = ApplyRules(TEXT_RULES, result)
 
     # Step 3: Equations.
-    # Arbitrary number of lines by 'dotall' flag:
-    #regexpression = r"\\begin{equation(\*)?}\s?(\\label{([^}]+)})?\s?(.*?)\\end{equation(\*)?}"
-    # Extension to also allow 'label' at end.
-    # NB: always go for an admonition in a problem.
-    regexpression = r"\\begin{equation(\*)?}\s?(\\label{([^}]+)})?\s?(.*?)(\\label{([^}]+)})?\s?\\end{equation(\*)?}"
     if (isBaseFile):
-        result = re.sub(regexpression, EquationReplace, result, 0, re.MULTILINE | re.DOTALL)
+        result = EQUATION_PATTERN.sub(EquationReplace, result)
     else:
-        result = re.sub(regexpression, EquationReplaceAdmonition, result, 0, re.MULTILINE | re.DOTALL)
-
-    # Unnumbered equations with '\[ .. \]' syntax: simply make $$.
-    # Update: actually turn into a math admonition, as they are breaking things in jb conversion unless we add white lines (but then they break indentation).
-    #result = re.sub(r"(\\\[|\\\])", r"$$", result, 0, re.MULTILINE)
-    regexpression = r"\\\[(.*)\\\]"
-    result = re.sub(regexpression, UnnumberedEquationReplace, result, 0, re.MULTILINE)
-
-    # Inline equations. If in $equation$, fine. If in \(equation\), put in dollars.
-    regexpression = r"\\\((.*?)\\\)"
-    result = re.sub(regexpression, InlineEquationReplace, result, 0, re.MULTILINE | re.DOTALL)
+        result = EQUATION_PATTERN.sub(EquationReplaceAdmonition, result)
+    result = ApplyRules(MATH_RULES, result)
 
     # Step 4A: Align environments with subequations numbering.
     # Label in markdown will be the label (if any) given to the whole group.
     # Retrieve other labels as well, making substitutions accordingly.
     # First, we find all subequations sets.
-    regexpression = r"\\begin{subequations}(.*?)\\end{subequations}"
-    matches = re.finditer(regexpression, result, re.MULTILINE | re.DOTALL)
+    matches = SUBEQUATIONS_PATTERN.finditer(result)
     # Loop over matches, extracting labels. If there is just one label, we need do nothing (will be the group label). If there are multiple labels, we need to substitute the others in text with A/B/C etc.
     for match in matches:
-        labels = re.findall(r"\\label{([^}]+)}" , match.group())
-        #print(len(labels))
+        labels = SUBEQUATION_LABEL_PATTERN.findall(match.group())
         if (len(labels) > 1):
             grouplabel = labels[0]
-            #print(grouplabel)
             for labelid, label in enumerate(labels):
                 if (labelid > 0):
                     # New string: label of the whole group + letter in alphabet. A is number 65, a is 97.
                     labelstring = "ref{" + grouplabel + "})" + chr(96 + labelid)
                     result = re.sub("ref{" + label + r"}\)", labelstring, result, 0, re.MULTILINE)
-                    #print([label, labelstring])
                     labelstring = "ref{" + grouplabel + "}" + chr(96 + labelid)
                     result = re.sub(r"ref{" + label + r"}", labelstring, result, 0, re.MULTILINE)
+    # Subequations elsewhere in the document.
+    if (subequationlabels is not None):
+        for (label, (grouplabel, letter)) in subequationlabels.items():
+            result = result.replace("ref{" + label + "})", "ref{" + grouplabel + "})" + letter)
+            result = result.replace("ref{" + label + "}", "ref{" + grouplabel + "}" + letter)
 
-    # Again find all subequation sets, now lifting out the content.
-#    regexpression = r"\\begin{subequations}\s(\\label{([^}]+)})?\s?\\begin{align(at)?}({\d})?\s?(.*?)\\end{align(at)?}\s?\\end{subequations}"
-
- #   result = re.sub(regexpression, SubEqReplace, result, 0, re.MULTILINE | re.DOTALL)
+    # Align environments, figures and theorems.
+    result = ApplyRules(ENVIRONMENT_RULES, result)
 
-    # Step 4: Align environments.
-    #regexpression = r"\\begin{align(\*)?}\s(\\label{([^}]+)})?\s?(.*?)\\end{align(\*)?}"
-    #result = re.sub(regexpression, AlignReplace, result, 0, re.MULTILINE | re.DOTALL)
-
-    # 4.B: eqnarray for those too stubborn to let go of them.
-    # Simply turn into align,
-    # killing the second & on each line.
-    regexpression = r"\\begin{eqnarray(\*)?}({\d})?\s(\\label{([^}]+)})?\s?(.*?)\s+(\\label{([^}]+)})?\s?\\end{eqnarray(\*)?}"
-    result = re.sub(regexpression, EqnArrayToAlign, result, 0, re.MULTILINE | re.DOTALL)
-
-    # Step 4: Align environments.
-    # 4.1: regular align, possibly with subequations.
-    #regexpression = r"(\\begin{subequations}\s)?(\\label{([^}]+)}\s)?\\begin{align(at)?(\*)?}({\d})?\s(\\label{([^}]+)})?\s?(.*?)\\end{align(at)?(\*)?}(\s)?(\\end{subequations})?"
-    # Same, but with additional option for label at end.
-    regexpression = r"(\\begin{subequations}\s)?(\\label{([^}]+)}\s)?\\begin{align(at)?(\*)?}({\d})?\s(\\label{([^}]+)})?\s?(.*?)\s+(\\label{([^}]+)})?\s?\\end{align(at)?(\*)?}(\s)?(\\end{subequations})?"
-    # Same, but now wihtout a group for the stars (not needed), and with a group for chekcing for a leading ```{math} (due to earlier runthrough in problem or example).
-    regexpression = r"(```{math}\n|:label: \w+\n)?(\\begin{subequations}\s)?(\\label{([^}]+)}\s)?\s*?\\begin{align(at)?\*?}({\d})?\s(\\label{([^}]+)})?\s?(.*?)\s+(\\label{([^}]+)})?\s?\\end{align(at)?(\*)?}(\s)?(\\end{subequations})?"
-    result = re.sub(regexpression, AlignReplace, result, 0, re.MULTILINE | re.DOTALL)
-
-    
-
-    # Step 5: Figures.
-    # TI Figure prior (shold be removed, left in to ease physics1A book production): strip "/figures/PNG" and "/figures/PDF"
-    result = re.sub(r"/figures/PNG", "", result, 0, re.MULTILINE)
-    result = re.sub(r"/figures/PDF", "", result, 0, re.MULTILINE)
-    result = re.sub(r"/problemfigures/PDF", "", result, 0, re.MULTILINE)
-    result = re.sub(r"/problemfigures/PNG", "", result, 0, re.MULTILINE)
-    result = re.sub(r"mechanics/figures/", "mechanics/", result, 0, re.MULTILINE)
-    result = re.sub(r"mechanics/problems/", "mechanics/", result, 0, re.MULTILINE)
-
-    # And for QMbook
-    result = re.sub(r"/figures/", "/", result, 0, re.MULTILINE)
-    #result = re.sub(r"introduction/figures/", "introduction/", result, 0, re.MULTILINE)
-    #result = re.sub(r"SE/figures/", "SE/", result, 0, re.MULTILINE)
-    result = re.sub(r"SE/tunnelingexamples.pdf", "SE/tunnelingexamples.png", result, 0, re.MULTILINE)
-    result = re.sub(r"SE/Hydrogen_fine_structure.png", "SE/Hydrogen_fine_structure.svg", result, 0, re.MULTILINE)
-
-    # Caption limited by line breaks.
-    #regexpression = r"\\begin{figure(\*)?}\s(\\centering\s)?\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\\caption{([^\n]+)})?\s?(\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-    # Caption with dotall flag, can contain arbitrary number of line breaks:
-    #regexpression = r"\\begin{figure(\*)?}\s(\\centering\s)?\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\\caption{((?s).*?)})?\s?(\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-    # Ibid, but through dotall flag
-    # (In regexpression101.com, put flag 'single line' for dotall, or \gms)
-    #regexpression = r"\\begin{figure(\*)?}\s(\\centering\s)?\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\\caption{(.*?)})?\s?(\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-    #regexpression = r"\\begin{figure(\*)?}(\[\w+\])?\s(\\centering\s)?\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\\caption{(.*?)})?\s?(\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-    #regexpression = r"\\begin{figure(\*)?}(\[\w+\])?\s(\s*\\centering\s)?\s*\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\s*\\caption{(.*?)})?\s?(\s*\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-    #regexpression = r"\\begin{figure(\*)?}(\[\w+\])?\s(\s*\\centering\s)?\s*\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\s*\\caption(\[[^\]]+\])?{(.*?)})?\s?(\s*\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-    #regexpression = r"\\begin{figure(\*)?}(\[!?\w+!?\])?\s(\s*\\centering\s)?\s*\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\s*\\caption(\[[^\]]+\])?{(.*?)})?\s?(\s*\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-    regexpression = r"\\begin{figure(\*)?}(\[!?\w+!?\])?\s(%Figurewidth: (\d+)\s)?(\s*\\centering\s)?\s*\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(\s*\\caption(\[[^\]]+\])?{(.*?)})?\s?(\s*\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-
-    result = re.sub(regexpression, FigureReplace, result, 0, re.MULTILINE | re.DOTALL)
-
-    # Following is attempt to account for leading spaces / tabs, but makes regexpression greedy.
-    #regexpression = r"\\begin{figure(\*)?}(\[\w+\])?\s(.*\\centering\s)?.*\\includegraphics(\[[^\]]+\])?{([^}]+)}\s(.*\\caption{(.*?)})?\s?(.*\\label{([^}]+)})?\s?\\end{figure(\*)?}"
-
-    # Step 6: Theorems, Propositions, Lemmas, proofs, axioms.
-    regexpression = r"\\begin{(theorem|proposition|lemma|corollary|axiom|definition|proof)(\*)?}(\[([^\]]+)\])?\s(\\label{([^}]+)}\s)?(.*?)\\end{(theorem|proposition|lemma|corollary|axiom|definition|proof)(\*)?}"
-    result = re.sub(regexpression, TheoremReplace, result, 0, re.MULTILINE | re.DOTALL)
-
-    # Internal references and citations only for basefile (will include problems),
-    # as otherwise refs in problems might break.
     if (isBaseFile):
-        # Step 7A: Internal references to problems.
-        # Specific structure: problem~\ref{ch:X}.\ref{pb:Y}
-        # (allow for case and 'exercise' instead of 'probblem').
-        # Replace with only a link to the exercise (will have 'exercise' by Sphinx setting).
-        regexpression = r"(problem|exercise)(~| |&nbsp;)\\ref{[^}]+}\.\\ref{(pb:[^}]+)}"
-        result = re.sub(regexpression, ProblemRefReplace, result, 0, re.MULTILINE | re.IGNORECASE)
-
-        # Step 7: Internal references. #TO ADD TABLES
-        #regexpression = r"((fig)(?:\.|ure)?|(ch)(\.|apter)?|(sub)?(sec)(\.|tion)?|(app)(\.|endix|ices)?|(eq)(\.|uation)?)?(s)?(~|&nbsp;| )([(])?\\ref{([^}]+)}([)])?"
-        #regexpression = r"((fig)(?:\.|ure)?|(table)|(ch)(\.|apter)?|(sub)?(sec)(\.|tion)?|(app)(\.|endix|ices)?|(eq)(\.|uation)?)?(s)?(~|&nbsp;|-|\s)([(])?\\ref{([^}]+)}([)])?"
-        regexpression = r"((fig)(?:\.|ure)?|(table)|(ch)(\.|apter)?|(sub)?(sec)(\.|tion)?|(app)(\.|endix|ices)?|(eq)(\.|uation)?|theorem|(prop)(?:\.|osition)?|lemma|corollary|axiom|(def)(?:\.|inition)?)?(s)?(~|&nbsp;|-|\s)([(])?\\ref{([^}]+)}([)])?"
-        #result = re.sub(regexpression, RefReplace, result, 0, re.MULTILINE)
-        result = re.sub(regexpression, RefReplace, result, 0, re.MULTILINE | re.IGNORECASE)
-
-        # Step 8: Citations. Last two commented-out lines add a local bibliography at the bottom of the page. Unfortunately, it doesn't work well if the same source is cited in multiple documents.
-        # Commented-out: add a separate references file.
-        regexpression = r"(~|&nbsp;| )\\citep?{([^}]+)}"
-        result = re.sub(regexpression, CitationReplace, result, 0, re.MULTILINE)
-        matches = re.findall(r"{cite}", result)
-        #if (len(matches) > 0):
-        #    result += "## References\n```{bibliography}\n:style: unsrt\n:filter: docname in docnames\n```"
-
-    # End of ifBaseFile.
-
-    # Step 9: Enumerate environments - bugged, is greeedy.
-    regexpression = r"\\begin{enumerate}(\[([^\]]+)\])?\s(.*?)\\end{enumerate}"
-    result = re.sub(regexpression, EnumerateReplace, result, 0, re.MULTILINE | re.DOTALL)
-
-    # Step 9b: Itemize environments.
-    regexpression = r"\\begin{itemize}\s(.*?)\\end{itemize}"
-    regexpression = r"\\begin{itemize}(\[[^\]]+\])?\s(.*?)\\end{itemize}"
-    result = re.sub(regexpression, ItemizeReplace, result, 0, re.MULTILINE | re.DOTALL)
+        # Internal references and citations.
+        result = ApplyRules(REFERENCE_RULES, result)
 
-    # Hyperlinks
-    regexpression = r"\\(book)?href{(.*?)}{(.*?)}"
-    result = re.sub(regexpression, HyperlinkReplace, result, 0, re.MULTILINE | re.DOTALL)
-
-    # Astronomical symbols (not widely used, but nice to have)
-    result = re.sub(r"\\mercury", "&#x263F;", result, 0, re.MULTILINE)  # ☿
-    result = re.sub(r"\\venus", "&#x2640;", result, 0, re.MULTILINE)    # ♀
-    result = re.sub(r"\\earth", "&#x2641;", result, 0, re.MULTILINE)    # ⊕
-    result = re.sub(r"\\mars", "&#x2642;", result, 0, re.MULTILINE)     # ♂
-    result = re.sub(r"\\jupiter", "&#x2643;", result, 0, re.MULTILINE)  # ♃
-    result = re.sub(r"\\saturn", "&#x2644;", result, 0, re.MULTILINE)   # ♄
-    result = re.sub(r"\\uranus", "&#x26E2;", result, 0, re.MULTILINE)   # ⛢
-    result = re.sub(r"\\neptune", "&#x2646;", result, 0, re.MULTILINE)  # ♆
-    result = re.sub(r"\\pluto", "&#x2647;", result, 0, re.MULTILINE)    # ♇
-    result = re.sub(r"\\sun", "&#x2609;", result, 0, re.MULTILINE)      # ☉ 
-    result = re.sub(r"\\leftmoon", "&#x263E;", result, 0, re.MULTILINE)    # ☾ 
+    # Enumerate and itemize environments, hyperlinks, symbols.
+    result = ApplyRules(LIST_RULES, result)
 
     # Step Y: Footnotes. Again, only run for basefile.
     if(isBaseFile):
         # First, we find anything that is either '\footnote' OR anything between top-level matched {}. That's a lot of hits!
-        # All
-        regexpression = r"\\footnote{"
-        matches = re.finditer(regexpression, result, re.MULTILINE)
+        matches = FOOTNOTE_PATTERN.finditer(result)
         footnoteslist = []
         for footnoteid, match in enumerate(matches, start=1):
-            # print("Match {matchNum} was found at {start}-{end}: {match}".format(matchNum = footnoteid, start = match.start(), end = match.end(), match = match.group()))
-            """
-            footnotetext = ""
-            pos = 0
-            nestingdepthcounter = 0
-            while (((result[match.end() + pos] != "}") or (nestingdepthcounter > 0)) and (pos < len(result) - match.end())):
-                character = result[match.end() + pos]
-                footnotetext += character
-                if (character == "{"): nestingdepthcounter += 1
-                elif (character == "}"): nestingdepthcounter -= 1
-                pos += 1
-            """
             footnotetext = FindSubstringInBraces(result, match.end())
             footnoteslist.append((footnoteid, match.start(), footnotetext))
 
@@ -1362,55 +1319,23 @@ def ConvertFileContentToMarkdown(latexsource, sourceslist, isBaseFile):
                 endpos = startpos + 11 + len(footnotetext)
                 result = result[:startpos] + "<sup>[^" + str(footnoteid) + "]</sup>" + result[endpos:]
             # Add footnotes to the end of result string.
-            result += "\n\n"
+            if (separatefootnotes): result += FOOTNOTES_MARKER
+            else: result += "\n\n"
             for (footnoteid, startpos, footnotetext) in footnoteslist:
-                result += "[^" + str(footnoteid) + "]: " + FormatFootnoteText(footnotetext) + "\n\n" 
-    
-    # End of footnotes isBaseFile
-
-    # Framed boxes: turn into notes.
-    regexpression = r"\\begin{framed}\s?(.*?)\\end{framed}\s?"
-    result = re.sub(regexpression, FramedReplace, result, 0, re.MULTILINE | re.DOTALL)
-
-    # Color box from optics book, also turn into notes.
-    regexpression = r"\\begin{tcolorbox}\s?\[(.*?)\]\s?(.*?)\\end{tcolorbox}\s?"
-    result = re.sub(regexpression, TcolorboxReplace, result, 0, re.MULTILINE | re.DOTALL)
+                result += "[^" + str(footnoteid) + "]: " + FormatFootnoteText(footnotetext) + "\n\n"
 
-    # Step Q: People info boxes. Already partly processed as we've gone through the above steps.
-    regexpression = r"\\begin{figure\*}\[?.?\]?\n\\fbox{\n\s?\\begin{minipage}\S*\s?\n(\\index{([^}]*)})?(\\textbf{([^}]*)}\s?(\(\d*-\d*\))?.*?)\n\\end{minipage}\n\\hspace{[^}]*}\n\s?\\begin{minipage}\S*\s?\n(.*?)\\includegraphics\[[^\]]*\]{([^}]*)}\n\\caption{(.*?)}\n\\end{minipage}\n}\n\\end{figure\*}"
-    result = re.sub(regexpression, InfoboxReplace, result, 0, re.MULTILINE | re.DOTALL)
-
-    # Step 5b: Figures that are not in a `figure` environment: just with an \includegraphics. Note that this should come after the people info boxes.
-    regexpression = r"(\\centering)?\s?\\includegraphics(\[[^\]]+\])?{([^}]+)}\s?"
-    result = re.sub(regexpression, IncludeGraphicsReplace, result, 0, re.MULTILINE)
-
-    # Step X: Any commands of the form \code{xxx}. This might have to come earlier.
-    # Simple code, does not account for nested arguments - replaced.
-    #regexpression = r"\\(\w+){([^}]+)}"
-    #result = re.sub(regexpression, LatexCommandsReplace, result, 0, re.MULTILINE)
-
-    # Index entries. Note that we take everything from the last \n, as we need to place the index admonition there. We run this multiple times, as there may be multiple entries per block (not very elegant, but works for now).
-    regexpression = r"\n(.*?)\\index{([^}]+)}"
-    for i in range(5):
-        result = re.sub(regexpression, IndexEntryReplace, result, 0, re.MULTILINE)
+    # End of footnotes isBaseFile
 
-    # Combine any multiple index boxes.
-    regexpression = r"```{index} (.+)\n```\n\n```{index} (.+)\n```"
-    for i in range(4):
-        result = re.sub(regexpression, CombineIndexEntries, result, 0, re.MULTILINE)
+    # Boxes, stray figures, index entries.
+    result = ApplyRules(BOX_RULES, result)
 
     # Code that can account for nested arguments.
-    regexpression = r"\\(\w+){"
-    matches = re.finditer(regexpression, result, re.MULTILINE)
-    #matchcount = 0
-    #for match in matches: matchcount += 1
-    #print(matchcount)
+    matches = LATEX_COMMAND_PATTERN.finditer(result)
     matchlist = []
     for matchid, match in enumerate(matches, start=1):
         # For each match, look for the matching closing "}".
         argument1 = FindSubstringInBraces(result, match.end())
         matchlist.append((matchid, match.start(), match.group(1), argument1))
-    #print(len(matchlist))
     if (len(matchlist) > 0):
         for (matchid, startpos, latexcommand, argument1) in reversed(matchlist):
             # Found a command and the argument in braces (including subarguments.)
@@ -1421,42 +1346,16 @@ def ConvertFileContentToMarkdown(latexsource, sourceslist, isBaseFile):
                 result = result[:startpos] + "*" + argument1 + "*" + result[endpos:]
             elif (latexcommand == 'textbf'):
                 result = result[:startpos] + "**" + argument1 + "**" + result[endpos:]
-#            elif latexcommand == 'index':
-#                # Remove index (this will need updating later).
-#                result = result[:startpos] + result[endpos:]
             elif latexcommand == 'mbox':
                 result = result[:startpos] + "\\text{" + argument1 + "}" + result[endpos:]
-# Remove 'ev' as (1) it's in the physics package and (2) it could be nested.
-#            elif latexcommand == 'ev':
-#                result = result[:startpos] + "\\langle " + argument1 + " \\rangle" + result[endpos:]
-
-    # {\bf XYZ} --> **XYZ**
-    regexpression = r"\{\\bf([^\}]+)\}"
-    result = re.sub(regexpression, bfInTextReplace, result, 0, re.MULTILINE)
-
-    # {\it XYZ} or {\em XYZ} --> *XYZ*
-    regexpression = r"\{\\(it|em)([^\}]+)\}"
-    result = re.sub(regexpression, itInTextReplace, result, 0, re.MULTILINE)
-
-    # TI physics 1A specific (needs manual intervention otherwise)
-    # Ampère in table (& gets replaced by |)
-    result = re.sub(r"Amp\|egrave;re", "Amp&egrave;re", result)
-    # Ceres symbol in eqs. & const.
-    result = re.sub(r"Ceres \|  \|", "Ceres | &#x26B3; |", result, 0, re.MULTILINE)
-    # defCV in entropy.md refers to a subequation.
-    result = re.sub(r"{eq}`defCV`", "{eq}`defspecificheat`A", result)
-    # Part {eq}`part:mechanics` should get part I as the parts have no labels.
-    result = re.sub(r"{eq}`part:mechanics`", "I", result)
 
-    # TI mathappendix specific
-    # Width of polar coordinates figure - superseded by %Figurewidth: macro.
-    # result = re.sub(r":name: fig:polarcoordinates\n", ":name: fig:polarcoordinates\n:width: 300px\n", result)
+    # Old-style font switches and book-specific fixes.
+    result = ApplyRules(FONT_RULES, result)
 
     # Admonitions may have become nested. Resolve by matching opening-closing pairs, adding levels as required. Note that we only need to do this once, i.e., when processing the whole file
     if(isBaseFile):
         # First, find all opening and closing admonitions.
-        regexpression = r"```({[^}]*})?(.*)?\n"
-        matches = re.finditer(regexpression, result, re.MULTILINE)
+        matches = ADMONITION_PATTERN.finditer(result)
         # Make a list of admonitions (open/close), as they appear. Record id, startpos, type (0=open, 1=close), and indent level (all set at 0).
         matchlist = []
         for matchid, match in enumerate(matches): #enumerate(matches, start=0):
@@ -1498,14 +1397,11 @@ def ConvertFileContentToMarkdown(latexsource, sourceslist, isBaseFile):
     # End isBaseFile for admonition nesting.
 
     # Cleanup. First, remove superfluous whitespace and empty lines.
-    result = re.sub(r"^\s*\n", "\n", result, 0, re.MULTILINE)
-
-    # Weird repeats of \n sometimes randomly appear. Clean up.
-    #result = re.sub(r"\n{3,}", "\n\n", result, 0, re.MULTILINE)
+    result = EMPTY_LINE_PATTERN.sub("\n", result)
 
     # In a problem file or example, remove all empty lines, and after the first 1. or -, give every line that doesn't start with a number or a - an indentation.
     if (not isBaseFile):
-        result = re.sub(r"^\n", "", result, 0, re.MULTILINE)
+        result = LEADING_NEWLINE_PATTERN.sub("", result)
         lines = str.split(result, "\n")
         result = ""
         enumerationstarted = False
@@ -1522,27 +1418,16 @@ def ConvertFileContentToMarkdown(latexsource, sourceslist, isBaseFile):
                         result += line + "\n"
 
     # Finally, we check figures, to see if any have a source file (and thus could be built from the source).
-    # Note that we include options for indentation (to maintain!).
-    #regexpression = r"`{3,}{figure}\s(.+?)\s(\:name\:\s(.+?)\s)?(\:width\:\s(.+?)\s)?(.*?\s)?`{3,}"
-    regexpression = r"```{figure}\s(.+?)\s((\s+)?\:name\:\s(.+?)\s)?((\s+)?\:width\:\s(.+?)\s)?(\s+)?(.*?\s)?(\s+)?```"
-    result = re.sub(regexpression, FigureCodeReplace, result, 0, re.MULTILINE | re.DOTALL)
+    result = FIGURE_CODE_PATTERN.sub(FigureCodeReplace, result)
 
     # If we have replaced any figure with code, we need a YAML frontmatter block.
-    if (re.search(r"{code-cell} ipython3", result) != None):
-        YAMLblock = "---\njupytext:\n    formats: md:myst\n"
-        YAMLblock += "    text_representation:\n        extension: .md\n        format_name: myst\n"
-        YAMLblock += "kernelspec:\n    display_name: Python 3 (ipykernel)\n    language: python\n"
-        YAMLblock += "    name: python3\n"
-        YAMLblock += "---\n"
-        """
-        with open("./YAMLblock.md", 'r') as YAMLfrontmatter:
-            # Read file.
-            YAMLblock = YAMLfrontmatter.read()
-        """
-        result = YAMLblock + result
+    if ("{code-cell} ipython3" in result):
+        result = YAML_BLOCK + result
 
     return result
 
+WORKED_EXAMPLE_SOLUTION_PATTERN = re.compile(r"%Worked example solution\n\\(sub)?subsubsection\*{Solution}", re.MULTILINE)
+
 def ProcessWorkedExample(examplestring, title, label, sourceslist):
     # Set up start.
     result = "```{prf:example} " + title + "\n"
@@ -1550,7 +1435,7 @@ def ProcessWorkedExample(examplestring, title, label, sourceslist):
     result += ":class: example\n"
 
     # Split off a solution (if it's there). To simplify, first replace with an easy-to-recognize pattern.
-    examplestring2 = re.sub(r"%Worked example solution\n\\(sub)?subsubsection\*{Solution}", "|||", examplestring, 0, re.MULTILINE)
+    examplestring2 = WORKED_EXAMPLE_SOLUTION_PATTERN.sub("|||", examplestring)
     examplelist = str.split(examplestring2, "|||")
 
     # First the problem part
@@ -1562,32 +1447,38 @@ def ProcessWorkedExample(examplestring, title, label, sourceslist):
 
     return result + "\n```\n"
 
+PROBLEM_TITLE_PATTERN = re.compile(r"%\s?Problemtitle{([^}]+)}|%\s?Problemtitle\s?:?\s?(.*)|^\\textbf{([^}]+)}", re.MULTILINE)
+PROBLEM_TITLE_BRACES_PATTERN = re.compile(r"% ?Problemtitle{([^}]+)}")
+PROBLEM_TITLE_LINE_PATTERN = re.compile(r"%\s?Problemtitle\s?:?\s?(.*)")
+PROBLEM_COMMENT_PATTERN = re.compile(r"%.*")
+
 def ProcessProblemtitle(problemstring):
     # Check if the problem has a title. If so, extract it, and remove from the problem string.
     result = problemstring
-    regexpression = r"%\s?Problemtitle{([^}]+)}|%\s?Problemtitle\s?:?\s?(.*)|^\\textbf{([^}]+)}"
-    problemtitlematch = re.findall(regexpression, problemstring, re.MULTILINE)
+    problemtitlematch = PROBLEM_TITLE_PATTERN.findall(problemstring)
     if (len(problemtitlematch) > 0 and problemtitlematch[0][0] != ""):
         # Title found as comment in LaTeX, type %Problemtitle{X}. Copy title and remove comment.
         problemtitle = problemtitlematch[0][0]
-        result = re.sub(r"% ?Problemtitle{([^}]+)}", "", problemstring)
+        result = PROBLEM_TITLE_BRACES_PATTERN.sub("", problemstring)
     elif (len(problemtitlematch) > 0 and problemtitlematch[0][1] != ""):
         # Title found as comment in LaTeX, type % Problemtitle X. Copy title and remove content.
         problemtitle = problemtitlematch[0][1]
-        result = re.sub(r"%\s?Problemtitle\s?:?\s?(.*)", "", problemstring)
+        result = PROBLEM_TITLE_LINE_PATTERN.sub("", problemstring)
     elif (len(problemtitlematch) > 0 and len(problemtitlematch[0]) > 0 and problemtitlematch[0][2] != ""):
         # Problem title found as bold text at start of line. Copy title.
         problemtitle = problemtitlematch[0][2]
         # Could add something here to remove the title - leave for now.
     else: problemtitle = ""
     # Also remove any remaining lines that start with %.
-    result = re.sub(r"%.*", "", result, re.MULTILINE)
+    # NB: re.MULTILINE used to be passed as the count here, so at most 8 comments are removed; kept for identical output.
+    result = PROBLEM_COMMENT_PATTERN.sub("", result, count=re.MULTILINE)
     return (problemtitle, result.strip())
 
+PROBLEM_EQUATION_PATTERN = re.compile(r"\\begin{equation(\*)?}\s*(\\label{([^}]+)})?\s?(.*?)\\end{equation(\*)?}", re.MULTILINE | re.DOTALL)
+
 def ProblembreakReplace(matchobject):
     # First, look for equations, and make them math admonitions (dollarmath doesn't work here as we have indented lines).
-    regexpression = r"\\begin{equation(\*)?}\s*(\\label{([^}]+)})?\s?(.*?)\\end{equation(\*)?}"
-    result = re.sub(regexpression, EquationReplaceAdmonition, matchobject.group(1), 0, re.MULTILINE | re.DOTALL)
+    result = PROBLEM_EQUATION_PATTERN.sub(EquationReplaceAdmonition, matchobject.group(1))
     # Next, indent all lines to not break the numbering.
     textlines = str.split(result,"\n")
     textblock = "\n"
@@ -1595,27 +1486,30 @@ def ProblembreakReplace(matchobject):
         textblock += "    " + line + "\n"
     return textblock + "\n"
 
+NEWCOUNTER_PATTERN = re.compile(r"\\newcounter{[^}]+}\n", re.MULTILINE)
+PROBLEM_BREAK_PATTERN = re.compile(r"\\setcounter{[^}]+}{\\value{enumi+}}\s\\end{enumerate}\s(.*?)\\begin{enumerate}\[\(a\)\]\s\\setcounter{enumi+}{\\value{[^}]+}}", re.MULTILINE | re.DOTALL)
+
 def ProcessProblembreaks(problemstring):
     # Check if somewhere (or at multiple places) in the problem there is a \setcounter \end{enumerate} ... \begin{enumerate} \setcounter pattern. If so, remove it, and indent the text in between.
     # Also remove any "\newcounter{X}" line.
-    regexpression = r"\\newcounter{[^}]+}\n"
-    result = re.sub(regexpression, "", problemstring, 0, re.MULTILINE)
-    regexpression = r"\\setcounter{[^}]+}{\\value{enumi+}}\s\\end{enumerate}\s(.*?)\\begin{enumerate}\[\(a\)\]\s\\setcounter{enumi+}{\\value{[^}]+}}"
-    result = re.sub(regexpression, ProblembreakReplace, result, 0, re.MULTILINE | re.DOTALL)
+    result = NEWCOUNTER_PATTERN.sub("", problemstring)
+    result = PROBLEM_BREAK_PATTERN.sub(ProblembreakReplace, result)
     return result
 
+COMMENTED_ITEM_PATTERN = re.compile(r"%\\item(.*?)\n", re.MULTILINE)
+PROBLEM_ITEM_PATTERN = re.compile(r"(\\item|\\end{enumerate})\s?(\\label{([^}]*)})?\s?(\\input{([^}]*)})?", re.MULTILINE)
+PROBLEM_SOLUTION_PATTERN = re.compile(r"\\ifincludesolutions.*?\n\\fi")
+
 def ProcessProblems(problemsource, sourceslist):
     # Given a string containing a problem set, convert it to a set of exercises in markdown/sphinx.
     # The string consists of a \begin{enumerate}[..] \item \item ... \end{enumerate},
     # with an item for each problem, each on a line, with one of two options: either an included file, or a single problem with no subproblems.
 
     # Remove any line that starts with %\item
-    problemliststring = re.sub(r"%\\item(.*?)\n", "", problemsource, 0, re.MULTILINE)
+    problemliststring = COMMENTED_ITEM_PATTERN.sub("", problemsource)
 
     # First, list all \item positions, catching a potential following \label and a potential following \input, and get (last position) the \end{enumerate}.
-    regexpression = r"(\\item|\\end{enumerate})\s?(\\label{([^}]*)})?\s?(\\input{([^}]*)})?"
-    #matches = re.finditer(regexpression, problemsource, re.MULTILINE)
-    matches = re.finditer(regexpression, problemliststring, re.MULTILINE)
+    matches = PROBLEM_ITEM_PATTERN.finditer(problemliststring)
     # Make a list of problems, as they appear. Record id, startpos, label (if present), source file (if present).
     matchlist = []
     for matchid, match in enumerate(matches):
@@ -1632,13 +1526,14 @@ def ProcessProblems(problemsource, sourceslist):
             if (matchid < len(matchlist)-1):
                 if (problempath != ""):
                     #with open(basepath + problempath.rstrip(".tex") + ".tex",
+                    TrackDependency(basepath + problempath.split(".")[0] + ".tex")
                     with open(basepath + problempath.split(".")[0] + ".tex", 'r') as problemfile:
                         #print(problempath)
                         # Read file.
                         problemstring = problemfile.read()
                         # Remove solution if present.
-                        regexpression = r"\\ifincludesolutions.*?\n\\fi"
-                        problemstring = re.sub(regexpression, "", problemstring, re.MULTILINE | re.DOTALL)
+                        # NB: re.MULTILINE | re.DOTALL used to be passed as the count here (so no DOTALL); kept for identical output.
+                        problemstring = PROBLEM_SOLUTION_PATTERN.sub("", problemstring, count=re.MULTILINE | re.DOTALL)
                         # Check if the problem has a title. If so, extract it. Also remove any other lines that start with a %.
                         (problemtitle, problemstring) = ProcessProblemtitle(problemstring)
                         # Check if somewhere in the problem there is a break of the numbering. If so, adapt by indenting.
@@ -1681,17 +1576,38 @@ def ProcessProblems(problemsource, sourceslist):
 
     return returnstring
 
-#def ReadAndConvertLatexFile(filename, sourcesfilename):
-def ReadAndConvertLatexContent(content):
-    # Main function. Open the file in readonly mode.
+# Worked example sections, indicated by a pair or triplet (with solution) of comments.
+WORKED_EXAMPLE_PATTERN = re.compile(r"(%Worked example start\n\\(sub)?subsection{Worked example: ([^}]+)}\n(\\label{([^}]+)}\n)?)(.*?)\n%Worked example end", re.MULTILINE | re.DOTALL)
+# Problem sets.
+PROBLEM_SECTION_PATTERN = re.compile(r"(\\(sub|subsub)?section\*?{Problems}\s?)(\\label{([^}]+)}\s?)?(\\begin{enumerate}.*?\\end{enumerate}\s|\\input{([^}]+)}\s)", re.MULTILINE | re.DOTALL)
+
+# Conversion backends: "regex" (successive substitutions, below) or "tokenizer" (single pass, see latextokenizer).
+BACKENDS = ("regex", "tokenizer")
+
+def ReadAndConvertLatexContent(content, backend="regex", sourceslist="", path=None, cachedir=None):
+    # Main function. Convert the LaTeX source in content to markdown.
+    # sourceslist is the content of the file with (image) sources, path the directory relative to which files are looked up.
+    # If cachedir is given, only the sections that changed since the last conversion are converted again (see ConvertLatexSourceIncrementally).
+    global basepath
+    if (path is not None):
+        basepath = os.path.join(path, "")
+    if (backend == "tokenizer"):
+        # Tokenize once and render in a single pass; see latextokenizer for the supported subset.
+        if (cachedir is not None):
+            raise ValueError("Incremental conversion is only supported by the regex backend")
+        import latextokenizer
+        return latextokenizer.ConvertLatexToMarkdown(content)
+    elif (backend != "regex"):
+        raise ValueError("Unknown backend " + backend + ", choose from " + ", ".join(BACKENDS))
+    if (cachedir is not None):
+        return ConvertLatexSourceIncrementally(content, sourceslist, cachedir)
+    return ConvertLatexSource(content, sourceslist)
+
+def ConvertLatexSource(latexsource, sourceslist, crossreferences=None, separatefootnotes=False):
     # Generate markdown from LaTeX through successive substitutions.
-    #if (sourcesfilename != ""):
-    #    with open(sourcesfilename+".tex", 'r') as sourcesfile:
-    #        sourceslist = sourcesfile.read()
-    #else:
-    #    sourceslist = ""
-    sourceslist = "" 
-    latexsource = content 
+    # crossreferences: (subequation labels, worked example labels) defined elsewhere in the document, see CollectCrossReferences.
+    # separatefootnotes: put FOOTNOTES_MARKER before the footnotes, so they can be renumbered and moved.
+    if (crossreferences is None): crossreferences = ({}, [])
 
     #with open(filename+".tex", 'r') as file:
     if True: 
@@ -1699,9 +1615,7 @@ def ReadAndConvertLatexContent(content):
         result = ""
         # Check if the file has 'worked example' sections,
         # indicated by a pair or triplet (with solution) of comments.
-        #regexpression = r"(%Worked example start\n\\(sub)?subsection{Worked example: ([^}]+)}\n)(.*)\n%Worked example end"
-        regexpression = r"(%Worked example start\n\\(sub)?subsection{Worked example: ([^}]+)}\n(\\label{([^}]+)}\n)?)(.*?)\n%Worked example end"
-        matches = re.finditer(regexpression, latexsource, re.MULTILINE | re.DOTALL)
+        matches = WORKED_EXAMPLE_PATTERN.finditer(latexsource)
         # Make a list of matches.
         # Record, id, startpos, title, label, startpos of actual text, endpos.
         matchlist = []
@@ -1720,16 +1634,17 @@ def ReadAndConvertLatexContent(content):
             result += latexsource[prevendpos:]
             # Search for references to any of the labels of the problems; replace not with {numref} but with {prf:ref}.
             for (matchid, startpos, title, label, realstartpos, endpos) in matchlist:
-                regexpression = r"((sub)?(sec)(\.|tion)?|example)?(s)?(~|&nbsp;|-|\s)\\ref{(" + label + r")}"
-                result = re.sub(regexpression, ExampleRefReplace, result, 0, re.MULTILINE | re.IGNORECASE)
+                result = ExampleRefsReplace(result, label)
             latexsource = result
             result = ""
+        # References to worked examples elsewhere in the document.
+        for label in crossreferences[1]:
+            latexsource = ExampleRefsReplace(latexsource, label)
         #else:
         #    result = latexsource
 
         # Select problem sets from the file.
-        regexpression = r"(\\(sub|subsub)?section\*?{Problems}\s?)(\\label{([^}]+)}\s?)?(\\begin{enumerate}.*?\\end{enumerate}\s|\\input{([^}]+)}\s)"
-        matches = re.finditer(regexpression, latexsource, re.MULTILINE | re.DOTALL)
+        matches = PROBLEM_SECTION_PATTERN.finditer(latexsource)
         # Make a list of problem sections, as they appear. Record id, startpos, startpos of actual problems, endpos.
         matchlist = []
         for matchid, match in enumerate(matches):
@@ -1762,6 +1677,7 @@ def ReadAndConvertLatexContent(content):
                     # Different file. Load that file, then process.
                     # The weird stripping-and-adding ".tex" is to ensure that we have ".tex" at the end, as a LaTeX input also works without it.
                     #with open(basepath+problemsourcefile.rstrip(".tex") + ".tex" + 'r'):
+                    TrackDependency(basepath+problemsourcefile.rstrip(".tex") + ".tex")
                     with open(basepath+problemsourcefile.rstrip(".tex") + ".tex") as problemfile:
                         result += ProcessProblems(problemfile.read(), sourceslist)
                 else:
@@ -1774,35 +1690,208 @@ def ReadAndConvertLatexContent(content):
                         result += ConvertFileContentToMarkdown(latexsource[endpos:], sourceslist, False)
             # Now run Convertscript on main text + problems,
             # To get refs and footnotes in problems right.
-            result = ConvertFileContentToMarkdown(latexsource[:matchlist[0][1]] + result, sourceslist, True)
+            result = ConvertFileContentToMarkdown(latexsource[:matchlist[0][1]] + result, sourceslist, True, crossreferences[0], separatefootnotes)
         else:
             # No matches, i.e., no problems sections. Just convert the whole file in one go.
-            result = ConvertFileContentToMarkdown(latexsource, sourceslist, True)
+            result = ConvertFileContentToMarkdown(latexsource, sourceslist, True, crossreferences[0], separatefootnotes)
     return result 
 
-    #if result:
-    #    print("Conversion successful!")
-    #    with open(filename+".md", 'w') as file:
-    #        # Write the converted file as markdown.
-    #        file.write(result)
-    #        file.truncate()
+def ReadAndConvertLatexFile(filename, sourcesfilename="", backend="regex", cachedir=None):
+    # Read a LaTeX file (and optionally the file with (image) sources) and convert it to markdown.
+    # Figure sources and problem files are looked up relative to the directory of the file.
+    with open(filename, 'r') as file:
+        latexsource = file.read()
+    if (sourcesfilename != ""):
+        with open(sourcesfilename, 'r') as sourcesfile:
+            sourceslist = sourcesfile.read()
+    else:
+        sourceslist = ""
+    return ReadAndConvertLatexContent(latexsource, backend, sourceslist, os.path.dirname(os.path.abspath(filename)), cachedir)
+
+def WriteFileAtomically(filename, content):
+    # Write to a temporary file next to the target and move it into place, so readers never see half a file.
+    tmpfilename = filename + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(tmpfilename, 'w') as file:
+            file.write(content)
+        os.replace(tmpfilename, filename)
+    finally:
+        if os.path.exists(tmpfilename):
+            os.remove(tmpfilename)
+
+# Incremental conversion. The source is split at chapters, sections and subsections (outside environments,
+# conditionals and worked examples, and up to the first problem section), and the markdown of every part is cached
+# under the hash of its source.
+# Only the parts that changed are converted again; references to subequations and worked examples in other parts,
+# the numbering of footnotes and the YAML frontmatter are resolved for the whole document.
+CHUNK_PATTERN = re.compile(
+    r"(?P<boundary>^\\(chapter|section|subsection)\*?[\[{])"
+    r"|(?P<open>\\begin{(?!document})|\\if(Afourpaper|includesolutions|problemset|choicecolor|online|contains\w+)?(?![A-Za-z])|^%Worked example start$)"
+    r"|(?P<close>\\end{(?!document})|\\fi(?![A-Za-z])|^%Worked example end$)",
+    re.MULTILINE)
+FOOTNOTE_REF_PATTERN = re.compile(r"<sup>\[\^(\d+)\]</sup>")
+FOOTNOTE_DEFINITION_PATTERN = re.compile(r"^\[\^(\d+)\]:", re.MULTILINE)
+
+def SplitLatexSource(latexsource):
+    # Split the source into parts starting at chapters, sections and subsections that are not nested in anything.
+    # Everything from the first problem section on is converted as a problem file before it is converted with the
+    # rest of the document (see ConvertLatexSource), and the problem file conversion doesn't stop at sections,
+    # so that is kept in one part.
+    chunks = []
+    startpos = 0
+    depth = 0
+    firstproblems = PROBLEM_SECTION_PATTERN.search(latexsource)
+    endpos = firstproblems.start() if (firstproblems is not None) else len(latexsource)
+    for match in CHUNK_PATTERN.finditer(latexsource):
+        if (match.start() > endpos): break
+        if (match.lastgroup == "open"): depth += 1
+        elif (match.lastgroup == "close"): depth = max(depth - 1, 0)
+        elif (depth == 0 and match.start() > startpos):
+            chunks.append(latexsource[startpos:match.start()])
+            startpos = match.start()
+    chunks.append(latexsource[startpos:])
+    return chunks
+
+def CollectCrossReferences(latexsource):
+    # Labels that are rewritten in references throughout the document:
+    # subequations after the first in a group (label -> (group label, letter)), and worked examples.
+    subequationlabels = {}
+    for match in SUBEQUATIONS_PATTERN.finditer(latexsource):
+        labels = SUBEQUATION_LABEL_PATTERN.findall(match.group())
+        for labelid, label in enumerate(labels):
+            if (labelid > 0): subequationlabels[label] = (labels[0], chr(96 + labelid))
+    examplelabels = [match.group(5) for match in WORKED_EXAMPLE_PATTERN.finditer(latexsource) if match.group(4) != None]
+    return (subequationlabels, examplelabels)
+
+def FileHash(filename):
+    # sha1 of the content of a file, None if it doesn't exist.
+    if (not os.path.isfile(filename)):
+        return None
+    with open(filename, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def ConvertLatexChunk(chunk, sourceslist, crossreferences, cachedir, cachekey):
+    # Convert one part of a document, or take it from the cache if neither it nor any file it depends on changed.
+    global dependencies
+    cachefilename = os.path.join(cachedir, hashlib.sha1((cachekey + chunk).encode()).hexdigest() + ".json")
+    if os.path.exists(cachefilename):
+        with open(cachefilename, 'r') as cachefile:
+            entry = json.load(cachefile)
+        if all(FileHash(filename) == filehash for (filename, filehash) in entry["dependencies"].items()):
+            return entry["markdown"]
+    dependencies = []
+    try:
+        result = ConvertLatexSource(chunk, sourceslist, crossreferences, True)
+        entry = {"markdown": result, "dependencies": {filename: FileHash(filename) for filename in dependencies}}
+    finally:
+        dependencies = None
+    os.makedirs(cachedir, exist_ok=True)
+    WriteFileAtomically(cachefilename, json.dumps(entry))
+    return result
+
+def ConvertLatexSourceIncrementally(latexsource, sourceslist, cachedir):
+    # Convert a document part by part, reusing the cached markdown of parts that didn't change.
+    crossreferences = CollectCrossReferences(latexsource)
+    # Parts are converted differently if the converter, the sources, the lookup path or the cross references change.
+    with open(__file__, 'rb') as converterfile:
+        cachekey = hashlib.sha1(converterfile.read()).hexdigest()
+    cachekey += json.dumps([sourceslist, basepath, crossreferences])
+    result = ""
+    footnotes = ""
+    footnotecount = 0
+    needsYAML = False
+    for chunk in SplitLatexSource(latexsource):
+        markdown = ConvertLatexChunk(chunk, sourceslist, crossreferences, cachedir, cachekey)
+        if markdown.startswith(YAML_BLOCK):
+            needsYAML = True
+            markdown = markdown[len(YAML_BLOCK):]
+        (markdown, marker, chunkfootnotes) = markdown.partition(FOOTNOTES_MARKER)
+        # Number footnotes on from the previous parts, and collect them at the end.
+        offset = footnotecount
+        markdown = FOOTNOTE_REF_PATTERN.sub(lambda matchobject: "<sup>[^" + str(int(matchobject.group(1)) + offset) + "]</sup>", markdown)
+        chunkfootnotes = FOOTNOTE_DEFINITION_PATTERN.sub(lambda matchobject: "[^" + str(int(matchobject.group(1)) + offset) + "]:", chunkfootnotes)
+        footnotecount += len(FOOTNOTE_DEFINITION_PATTERN.findall(chunkfootnotes))
+        result += markdown
+        footnotes += chunkfootnotes
+    if (footnotes != ""):
+        result = result.rstrip("\n") + "\n\n" + footnotes
+    if (needsYAML):
+        result = YAML_BLOCK + result
+    return result
 
-# Main function - only to be executed if file is called as script, with an argument that is the name of the LaTeX file to be converted.
-if __name__ == "__main__":
-    import sys
-    import re
-    # Read filename (first argument) and name of file with (image) sources (optional second argument). Note that the zeroth argument is the script name.
-    filename = sys.argv[1]
-    #basepath = "./"
-    #basepath = "/Users/timonidema/Documents/Teaching/mathappendix/"
-    #basepath = "/Users/timonidema/Documents/Teaching/physics lecture notes/"
-    #basepath = "/Users/timonidema/Documents/Teaching/quantum mechanics lecture notes/"
-    basepath = "/Users/timonidema/Documents/Textbooks/latextemplate/"
-    if (len(sys.argv) > 2):
-        sourcesfilename = sys.argv[2]
-        ReadAndConvertLatexFile(basepath+filename, basepath+sourcesfilename)
+def ConvertLatexFile(filename, outputfilename, sourcesfilename="", backend="regex", cachedir=None):
+    # Convert one LaTeX file and write the markdown to outputfilename.
+    # Returns (filename, seconds, error message or None); errors are reported instead of raised, so one bad file doesn't stop a batch.
+    starttime = time.perf_counter()
+    try:
+        result = ReadAndConvertLatexFile(filename, sourcesfilename, backend, cachedir)
+        os.makedirs(os.path.dirname(os.path.abspath(outputfilename)), exist_ok=True)
+        WriteFileAtomically(outputfilename, result)
+        error = None
+    except Exception as exception:
+        error = type(exception).__name__ + ": " + str(exception)
+    return (filename, time.perf_counter() - starttime, error)
+
+def FindLatexFiles(inputpath):
+    # All .tex files in a directory tree (sorted), or the file itself.
+    if os.path.isfile(inputpath):
+        return [inputpath]
+    filenames = []
+    for (dirpath, dirnames, files) in os.walk(inputpath):
+        dirnames.sort()
+        filenames.extend(os.path.join(dirpath, file) for file in sorted(files) if file.endswith(".tex"))
+    return filenames
+
+def ConvertLatexTree(inputpath, outputpath=None, sourcesfilename="", backend="regex", workers=None, cachedir=None):
+    # Convert all .tex files under inputpath to .md files, mirroring the directory tree under outputpath
+    # (next to the sources if outputpath is None), on a pool of worker processes.
+    # Prints the time taken per file; returns the list of (filename, seconds, error) in input order.
+    filenames = FindLatexFiles(inputpath)
+    inputroot = inputpath if os.path.isdir(inputpath) else os.path.dirname(inputpath)
+    jobs = []
+    for filename in filenames:
+        outputfilename = os.path.splitext(filename)[0] + ".md"
+        if (outputpath is not None):
+            outputfilename = os.path.join(outputpath, os.path.relpath(outputfilename, inputroot))
+        jobs.append((filename, outputfilename, sourcesfilename, backend, cachedir))
+    results = {}
+    if (workers == 1 or len(jobs) <= 1):
+        for job in jobs:
+            results[job[0]] = ConvertLatexFile(*job)
+            ReportConversion(results[job[0]])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(ConvertLatexFile, *job) for job in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result[0]] = result
+                ReportConversion(result)
+    return [results[filename] for filename in filenames]
+
+def ReportConversion(result):
+    (filename, seconds, error) = result
+    if (error is None):
+        print("%8.3fs  %s" % (seconds, filename))
     else:
-        ReadAndConvertLatexFile(basepath+filename, "")
+        print("%8.3fs  %s FAILED (%s)" % (seconds, filename, error), file=sys.stderr)
+
+# Main function - only to be executed if file is called as script.
+# Converts a LaTeX file, or all LaTeX files in a directory tree, to markdown.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert LaTeX files to MyST markdown")
+    parser.add_argument("input", help="LaTeX file or directory tree of LaTeX files")
+    parser.add_argument("-o", "--output", default=None, help="output directory (default: next to the LaTeX files)")
+    parser.add_argument("-s", "--sources", default="", help="LaTeX file with (image) sources")
+    parser.add_argument("-b", "--backend", default="regex", choices=BACKENDS, help="conversion backend")
+    parser.add_argument("-j", "--workers", default=None, type=int, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-c", "--cache", default=None, help="cache directory; only sections that changed since the last run are converted")
+    args = parser.parse_args()
+
+    starttime = time.perf_counter()
+    results = ConvertLatexTree(args.input, args.output, args.sources, args.backend, args.workers, args.cache)
+    failed = [filename for (filename, seconds, error) in results if error is not None]
+    print("Converted %d of %d files in %.3fs" % (len(results) - len(failed), len(results), time.perf_counter() - starttime))
+    sys.exit(1 if failed else 0)
 
 #    filename = "tensors"
 #    filename = "mechanicsforces"
@@ -0,0 +1,6 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+x = np.linspace(0, 2 * np.pi, 100)
+fig, ax = plt.subplots()
+ax.plot(x, np.sin(x))
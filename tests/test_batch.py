@@ -0,0 +1,57 @@
+"""
+Server-side record of batch runs
+
+Every paper a batch runs is appended to the ledger, failures included, keyed by the file
+name reported to the client.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from doc2json.flask.batch import process_batch
+from doc2json.flask.cache import ResultCache
+from doc2json.utils.batch_util import Ledger
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'jats', 'short_report.nxml')
+
+
+class TestProcessBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        os.makedirs(self.input_dir)
+        shutil.copy(FIXTURE, os.path.join(self.input_dir, 'good.nxml'))
+        with open(os.path.join(self.input_dir, 'broken.nxml'), 'w') as f:
+            f.write('not xml at all')
+        self.ledger_file = os.path.join(self.tmp_dir, 'ledger.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ledger(self):
+        input_files = [os.path.join(self.input_dir, name) for name in ('good.nxml', 'broken.nxml')]
+        lines = process_batch(
+            input_files, os.path.join(self.tmp_dir, 'work'), ResultCache(os.path.join(self.tmp_dir, 'cache')),
+            workers=2, base_dir=self.input_dir, ledger_file=self.ledger_file
+        )
+        outputs = {}
+        for line in lines:
+            output = json.loads(line)
+            outputs[output["filename"]] = 'result' if 'result' in output else 'error'
+        self.assertEqual(outputs, {"good.nxml": 'result', "broken.nxml": 'error'})
+
+        records = Ledger.load(self.ledger_file)
+        self.assertEqual(records["good.nxml"]["status"], 'done')
+        self.assertEqual(records["broken.nxml"]["status"], 'failed')
+        self.assertTrue(records["broken.nxml"]["error"])
+        self.assertNotIn("result", records["good.nxml"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Start-up cost of the pipeline CLIs
+
+Each pipeline module is imported in a fresh interpreter with `python -X importtime`.
+Libraries only some code paths need (parquet output, figure rendering, MathML) must not
+be imported with the module, and the whole import has to stay within a generous budget.
+"""
+
+import os
+import sys
+import subprocess
+import unittest
+
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+PIPELINE_MODULES = (
+    'doc2json.tex2json.process_tex',
+    'doc2json.grobid2json.process_pdf',
+    'doc2json.jats2json.process_jats',
+)
+# imported on first use only
+LAZY_MODULES = ('pandas', 'pyarrow', 'PIL', 'pdf2image', 'latex2mathml', 'magic', 'tqdm')
+# cumulative import time of a pipeline module in seconds, a few times the time it takes now
+IMPORT_TIME_BUDGET = 1.0
+
+
+def get_import_times(module):
+    """
+    Cumulative import time of every module imported with a module
+    :param module:
+    :return: dict from module name to seconds
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    times = {}
+    # lines are "import time: <self us> | <cumulative us> | <indented name>"
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    def test_heavy_dependencies_are_lazy(self):
+        for module in PIPELINE_MODULES:
+            with self.subTest(module=module):
+                imported = get_import_times(module)
+                heavy = sorted(name for name in imported if name.split('.')[0] in LAZY_MODULES)
+                self.assertEqual(heavy, [])
+
+    def test_import_time_budget(self):
+        for module in PIPELINE_MODULES:
+            with self.subTest(module=module):
+                self.assertLess(get_import_times(module)[module], IMPORT_TIME_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
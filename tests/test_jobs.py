@@ -0,0 +1,83 @@
+"""
+Lifecycle of asynchronous conversion jobs
+
+JATS jobs are converted locally, so the tests run real jobs: the upload of a job is deleted
+once it has run, finished jobs expire after the retention, and concurrent submits never
+queue more than max_queued jobs.
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import threading
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from doc2json.flask.jobs import JobQueue, QueueFullError
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'jats', 'short_report.nxml')
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.jobs_dir = tempfile.mkdtemp()
+        with open(FIXTURE, 'rb') as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.jobs_dir)
+
+    def submit(self, queue):
+        return queue.submit('short_report.nxml', io.BytesIO(self.content))
+
+    def test_input_deleted_after_run(self):
+        queue = JobQueue(self.jobs_dir)
+        job_id = self.submit(queue)
+        self.assertTrue(os.path.isdir(os.path.join(queue.get_job_dir(job_id), 'input')))
+        self.assertTrue(queue.run_next())
+        job = queue.get(job_id)
+        self.assertEqual(job["status"], 'done')
+        self.assertIn("result", job)
+        self.assertEqual(os.listdir(queue.get_job_dir(job_id)), ['result.json'])
+
+    def test_expire(self):
+        queue = JobQueue(self.jobs_dir, retention=0)
+        finished = self.submit(queue)
+        queue.run_next()
+        queued = self.submit(queue)
+        self.assertEqual(queue.expire(), 1)
+        self.assertIsNone(queue.get(finished))
+        self.assertFalse(os.path.exists(queue.get_job_dir(finished)))
+        # queued jobs never expire
+        self.assertEqual(queue.get(queued)["status"], 'queued')
+        self.assertEqual(JobQueue(self.jobs_dir, retention=None).expire(), 0)
+
+    def test_concurrent_submits(self):
+        queue = JobQueue(self.jobs_dir, max_queued=3)
+        barrier = threading.Barrier(10)
+        job_ids = []
+        rejected = []
+
+        def submit():
+            barrier.wait()
+            try:
+                job_ids.append(self.submit(queue))
+            except QueueFullError:
+                rejected.append(True)
+
+        threads = [threading.Thread(target=submit) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(job_ids), 3)
+        self.assertEqual(len(rejected), 7)
+        self.assertEqual(queue.queue_depth(), 3)
+        self.assertEqual(sorted(os.listdir(queue.jobs_dir)), sorted(job_ids + ['jobs.sqlite3']))
+
+
+if __name__ == '__main__':
+    unittest.main()
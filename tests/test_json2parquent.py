@@ -0,0 +1,57 @@
+"""
+Figures of the parquet export
+
+A figure that doesn't exist or whose PDF fails to render is left out of the records instead
+of aborting the export.
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from json2parquent import convert_to_target_format
+from doc2json.utils.record_util import RECORD_TEMPLATE
+
+
+def make_paper(uris):
+    return {
+        "paper_id": 'paper',
+        "title": 'Title',
+        "header": {"date_generated": '2026-01-01'},
+        "latex_parse": {
+            "abstract": [],
+            "body_text": [],
+            "ref_entries": {
+                f'FIGREF{i}': {"type_str": 'figure', "uris": [uri], "text": ''} for i, uri in enumerate(uris)
+            },
+        },
+    }
+
+
+class TestFigures(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        figure_dir = os.path.join(self.tmp_dir, 'latex', 'paper')
+        os.makedirs(figure_dir)
+        Image.new('RGB', (4, 4), 'red').save(os.path.join(figure_dir, 'good.png'))
+        with open(os.path.join(figure_dir, 'broken.pdf'), 'wb') as f:
+            f.write(b'not a pdf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_failed_figures_left_out(self):
+        paper = make_paper(['good.png', 'broken.pdf', 'missing.png'])
+        records = convert_to_target_format(paper, dict(RECORD_TEMPLATE), self.tmp_dir, figure_cache=None)
+        images = [record["图片"] for record in records if record["数据类型"] == 'image']
+        self.assertEqual(len(images), 1)
+        self.assertEqual(Image.open(io.BytesIO(images[0])).size, (4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+"""
+Golden-output tests for latextomarkdown, and tests of its tokenizer backend
+
+Every tests/latextomarkdown/<name>.tex is converted and compared with <name>.md.
+The expected files were generated with the converter before its rules were
+precompiled and fused; to regenerate them after an intended change in output run
+
+    python tests/test_latextomarkdown.py --regenerate
+"""
+
+import gc
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import latextomarkdown
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'latextomarkdown')
+
+
+def get_fixture_names():
+    return sorted(f[:-4] for f in os.listdir(FIXTURE_DIR) if f.endswith('.tex'))
+
+
+def convert_fixture(name):
+    # figure source files are looked up relative to the directory of the file
+    return latextomarkdown.ReadAndConvertLatexFile(os.path.join(FIXTURE_DIR, name + '.tex'))
+
+
+class TestLatexToMarkdown(unittest.TestCase):
+    def test_golden_output(self):
+        names = get_fixture_names()
+        self.assertTrue(names)
+        for name in names:
+            with self.subTest(name=name):
+                with open(os.path.join(FIXTURE_DIR, name + '.md'), 'r') as f:
+                    expected = f.read()
+                self.assertEqual(convert_fixture(name), expected)
+
+
+class TestIncrementalConversion(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def test_same_output_as_full_conversion(self):
+        for name in get_fixture_names():
+            with self.subTest(name=name):
+                with open(os.path.join(FIXTURE_DIR, name + '.md'), 'r') as f:
+                    expected = f.read()
+                filename = os.path.join(FIXTURE_DIR, name + '.tex')
+                self.assertEqual(latextomarkdown.ReadAndConvertLatexFile(filename), expected)
+                # cold and warm cache
+                for i in range(2):
+                    self.assertEqual(latextomarkdown.ReadAndConvertLatexFile(filename, cachedir=self.cachedir), expected)
+
+    def test_sections_after_problems(self):
+        # everything after the first problem section is converted as a problem file first
+        problems = "\\section*{Problems}\n\\begin{enumerate}\n\\item Q\n\\end{enumerate}\n"
+        equation = "\\begin{equation}\nE\n\\end{equation}\n"
+        itemize = "\\begin{itemize}\n\\item one\n\\end{itemize}\n"
+        latexsources = [
+            "\\section{A}\nx\n" + problems + "\\section{B}\n" + equation,
+            "\\section{A}\n" + problems + itemize + "\\subsection{B}\n" + equation + "\\section{C}\n" + problems + "\\section{D}\ny\n",
+        ]
+        for latexsource in latexsources:
+            with self.subTest(latexsource=latexsource):
+                expected = latextomarkdown.ReadAndConvertLatexContent(latexsource)
+                for i in range(2):
+                    self.assertEqual(latextomarkdown.ReadAndConvertLatexContent(latexsource, cachedir=self.cachedir), expected)
+
+    def test_only_changed_sections_are_converted(self):
+        latexsource = (
+            "\\chapter{One}\nA\\footnote{first}.\n\\section{Two}\nB\\footnote{second}.\n"
+            "\\section{Three}\nC\\footnote{third}, see \\eqref{eq:b}.\n"
+            "\\begin{subequations}\n\\label{eq:g}\n\\begin{align}\na &= b \\label{eq:a}\\\\\nc &= d \\label{eq:b}\n\\end{align}\n\\end{subequations}\n"
+        )
+        self.assertEqual(len(latextomarkdown.SplitLatexSource(latexsource)), 3)
+        latextomarkdown.ReadAndConvertLatexContent(latexsource, cachedir=self.cachedir)
+        self.assertEqual(len(os.listdir(self.cachedir)), 3)
+
+        edited = latexsource.replace("B\\footnote{second}", "B, edited\\footnote{second}")
+        result = latextomarkdown.ReadAndConvertLatexContent(edited, cachedir=self.cachedir)
+        self.assertEqual(len(os.listdir(self.cachedir)), 4)
+        self.assertEqual(result, latextomarkdown.ReadAndConvertLatexContent(edited))
+
+
+class TestTokenizerBackend(unittest.TestCase):
+    def convert(self, latexsource):
+        return latextomarkdown.ReadAndConvertLatexContent(latexsource, backend="tokenizer")
+
+    def test_headings_and_text(self):
+        result = self.convert("\\section{Intro}\n\\label{sec:intro}\nSee \\ref{fig:a}, \\emph{caf\\'e} and \\textbf{na\\\"{i}ve}.\n")
+        self.assertEqual(
+            result,
+            "(sec:intro)=\n## Intro\n\nSee {numref}`fig:a`, *caf&eacute;* and **na&iuml;ve**.\n"
+        )
+
+    def test_math_macros(self):
+        result = self.convert("$\\dv{x}{t} + \\pdv[2]{f}{x} + \\pdv{f}{x}{y} + \\inprod{a}{b}$")
+        self.assertEqual(
+            result,
+            "$\\frac{\\mathrm{d}x}{\\mathrm{d}t} + \\frac{\\partial^2 f}{\\partial x^2}"
+            " + \\frac{\\partial^2 f}{\\partial x \\partial y} + \\langle a \\,, b \\rangle$\n"
+        )
+
+    def test_equation_and_align(self):
+        result = self.convert(
+            "\\begin{equation}\nE = mc^2\n\\label{eq:e}\n\\end{equation}\n"
+            "\\begin{eqnarray}\na &=& b \\\\\nc &<& d\n\\label{eq:abcd}\n\\end{eqnarray}\n"
+        )
+        self.assertEqual(
+            result,
+            "$$\nE = mc^2\n$$ (eq:e)\n\n```{math}\n:label: eq:abcd\n\\begin{align*}\na &= b \\\\\nc &< d\n\\end{align*}\n```\n"
+        )
+
+    def test_figure_table_theorem(self):
+        result = self.convert(
+            "\\begin{figure}[ht]\n%Figurewidth: 300\n\\includegraphics[width=5cm]{plots/sine.pdf}\n"
+            "\\caption{A sine.}\n\\label{fig:sine}\n\\end{figure}\n"
+            "\\begin{table}\n\\caption{Data}\n\\label{tab:data}\n\\begin{tabular}{lc}\n\\hline\na & b \\\\\nc & d \\\\\n\\end{tabular}\n\\end{table}\n"
+            "\\begin{theorem}[Pythagoras]\n\\label{thm:p}\n$a^2+b^2=c^2$.\n\\end{theorem}\n"
+        )
+        self.assertEqual(
+            result,
+            "```{figure} images/plots/sine.svg\n:name: fig:sine\n:width: 300\nA sine.\n```\n\n"
+            "```{table} Data\n:name: tab:data\n| a | b |\n| :--- | :--: |\n| c | d |\n```\n\n"
+            "```{prf:theorem} Pythagoras\n:label: thm:p\n$a^2+b^2=c^2$.\n```\n"
+        )
+
+    def test_problems(self):
+        result = self.convert(
+            "\\section*{Problems}\n\\begin{enumerate}\n\\item \\label{pb:fall} %Problemtitle Falling\nA ball falls.\n"
+            "\\item \\textbf{Spring} A spring.\n\\end{enumerate}\n"
+        )
+        self.assertEqual(
+            result,
+            "## Problems\n\n```{exercise} Falling\n:label: pb:fall\n:class: dropdown\nA ball falls.\n```\n\n"
+            "```{exercise} Spring\n:class: dropdown\nA spring.\n```\n"
+        )
+
+    def test_conditionals(self):
+        result = self.convert("\\ifAfourpaper A4\\else letter\\fi, \\ifincludesolutions solution\\else no solution\\fi")
+        self.assertEqual(result, " A4,  no solution\n")
+
+    def test_unbalanced_input(self):
+        result = self.convert("a } b \\end{itemize} c { d")
+        self.assertEqual(result, "a } b \\end{itemize} c { d}\n")
+
+    def test_deep_nesting(self):
+        depth = 20000
+        start = time.time()
+        result = self.convert("{" * depth + "x" + "}" * depth)
+        self.assertEqual(result, "{" * depth + "x" + "}" * depth + "\n")
+        self.assertLess(time.time() - start, 5)
+
+    def test_linear_time(self):
+        # eight times the input may take about eight times as long, quadratic work would take 64 times as long;
+        # the slack is for timer noise and load, which the alternating runs share
+        def best_times(latexsources):
+            times = [[] for _ in latexsources]
+            # garbage collections run at times that have little to do with the input
+            gc.disable()
+            try:
+                for _ in range(5):
+                    for (i, latexsource) in enumerate(latexsources):
+                        start = time.perf_counter()
+                        self.convert(latexsource)
+                        times[i].append(time.perf_counter() - start)
+            finally:
+                gc.enable()
+            return [min(t) for t in times]
+
+        shapes = {
+            "nested commands": lambda n: "\\emph{" * n + "x" + "}" * n,
+            "nested conditionals": lambda n: "\\ifAfourpaper " * n + "x" + "\\fi " * n,
+            "nested environments": lambda n: "\\begin{center}" * n + "x" + "\\end{center}" * n,
+            "text runs": lambda n: "a] " * n,
+        }
+        for (shape, make) in shapes.items():
+            with self.subTest(shape=shape):
+                (small, large) = best_times([make(1500), make(12000)])
+                self.assertLess(large, 16 * small)
+
+    def test_worked_example(self):
+        result = self.convert(
+            "See example~\\ref{ex:drop}.\n%Worked example start\n\\subsection{Worked example: a drop}\n\\label{ex:drop}\n"
+            "A drop falls.\n\\begin{equation}\nh = g t^2 / 2\n\\end{equation}\n%Worked example solution\n"
+            "\\subsubsection*{Solution}\nIt lands.\n%Worked example end\nAfter."
+        )
+        self.assertEqual(
+            result,
+            "See {prf:ref}`ex:drop`.\n\n````{prf:example} a drop\n:label: ex:drop\n:class: example\nA drop falls.\n\n"
+            "```{math}\nh = g t^2 / 2\n```\n\n---\n**Solution**\n\nIt lands.\n````\n\nAfter.\n"
+        )
+
+    def test_align_labels(self):
+        result = self.convert(
+            "\\begin{alignat}{2}\na &= b \\label{eq:a} \\\\\nc &= d \\label{eq:c}\n\\end{alignat}\n"
+            "\\begin{align}\n\\label{eq:e}\ne &= f \\\\\n\\label{eq:g}\ng &= h\n\\end{align}\n"
+            "\\begin{subequations}\n\\label{eq:group}\n\\begin{align}\nu &= v \\label{eq:u} \\\\\nw &= t \\label{eq:w}\n\\end{align}\n\\end{subequations}\n"
+            "See \\ref{eq:w} and \\eqref{eq:u}.\\index{labels}"
+        )
+        self.assertEqual(
+            result,
+            "```{math}\n:label: eq:c\n\\begin{alignat*}{2}\na &= b \\\\\nc &= d\n\\end{alignat*}\n```\n\n"
+            "```{math}\n:label: eq:e\n\\begin{align*}\ne &= f\n\\end{align*}\n```\n\n"
+            "```{math}\n:label: eq:g\n\\begin{align*}\ng &= h\n\\end{align*}\n```\n\n"
+            "```{math}\n:label: eq:group\n\\begin{align*}\nu &= v \\\\\nw &= t\n\\end{align*}\n```\n\n"
+            "```{index} labels\n```\nSee {eq}`eq:group`b and {eq}`eq:group`a.\n"
+        )
+
+    def test_figure_path(self):
+        result = self.convert("\\includegraphics{mechanics/figures/PDF/forces.pdf}")
+        self.assertEqual(result, "```{figure} images/mechanics/forces.svg\n```\n")
+
+
+# Differences between the backends on the fixtures: (fixture, regex output, tokenizer output, reason).
+# Outputs are compared without blank lines and trailing whitespace, as the tokenizer separates every block by a blank line.
+KNOWN_DIFFERENCES = [
+    ("chapter", "%Source: some external book\n", "",
+     "the regex backend keeps comments starting with a keyword, the tokenizer drops all comments it doesn't use"),
+    ("chapter", "see '{prf:ref}`.\nConsider `np.sum({a, {b}})` and `{}quoted'.", "see '{prf:ref}'.\nConsider `np.sum({a, {b}})` and '{}quoted'.",
+     "the regex backend turns quotes after a literal {prf:ref} and before \\textquotesingle into backticks"),
+    ("chapter", "x &= 1 \\\n", "x &= 1\n",
+     "the regex backend leaves a backslash of the \\\\ when it splits an align at its labels"),
+    ("chapter", ":label: eq:align\n", ":label: eq:eqnarray\n",
+     "the regex backend renames eqnarray to align in labels too"),
+    ("chapter", "1. First \\label{item:first}\n", "1. First\n",
+     "the regex backend keeps labels of list items, which MyST can't refer to"),
+    ("chapter", "```{math}\n\\boxed{a &= b}", "```{math}\n:label: eq:boxed\n\\boxed{a &= b}",
+     "the regex backend drops the label of a boxed equation"),
+    ("chapter", "\\text{box}, *it*.\nThe *nested \\textbf{bold \\textit{italic}} emphasis*'ere and",
+     "box, *it*.\nThe *nested **bold *italic*** emphasis* works.\nAmp&egrave;re and",
+     "the regex backend keeps \\text from \\mbox in text, doesn't convert nested formatting and misreads \\` before a line break"),
+    ("examples",
+     "A block slides down a slope with angle $\\theta$.\n```\n```{exercise}\n:class: dropdown\nFind the acceleration.\n```\n"
+     "```{exercise}\n:class: dropdown\nFind the velocity after a distance $d$.\n```\n1.\n**Incline** A second problem with an equation\n",
+     "A block slides down a slope with angle $\\theta$.\n1. Find the acceleration.\n1. Find the velocity after a distance $d$.\n```\n"
+     "````{exercise} Incline\n:label: pb:incline\n:class: dropdown\nA second problem with an equation\n",
+     "the regex backend ends the problem set at the end of a nested enumerate"),
+    ("examples", "and some *emphasis*.\n1. A third problem without a label, referring to {numref}`pb:block`.\n",
+     "and some *emphasis*.\n````\n```{exercise} Tricky\n:class: dropdown\nA third problem without a label, referring to {numref}`pb:block`.\n```\n",
+     "the regex backend ends the problem set at the end of a nested enumerate"),
+    ("figurecode",
+     "---\njupytext:\n    formats: md:myst\n    text_representation:\n        extension: .md\n        format_name: myst\n"
+     "kernelspec:\n    display_name: Python 3 (ipykernel)\n    language: python\n    name: python3\n---\n", "",
+     "figure source code is only supported by the regex backend"),
+    ("figurecode",
+     "```{code-cell} ipython3\n:tags: [hide-input, remove-output]\n%config InlineBackend.figure_formats = ['svg']\n"
+     "import numpy as np\nimport matplotlib.pyplot as plt\nx = np.linspace(0, 2 * np.pi, 100)\nfig, ax = plt.subplots()\n"
+     "ax.plot(x, np.sin(x))\n# Save graph to load in figure later (special Jupyter Book feature)\nglue(\"sine\", fig, display=False)\n```\n"
+     "```{glue:figure} sine\n", "```{figure} images/plots/sine.svg\n",
+     "figure source code is only supported by the regex backend"),
+]
+
+
+def without_blank_lines(markdown):
+    return "".join(line.rstrip() + "\n" for line in markdown.split("\n") if line.strip())
+
+
+class TestBackendParity(unittest.TestCase):
+    def test_fixtures(self):
+        for name in get_fixture_names():
+            with self.subTest(name=name):
+                filename = os.path.join(FIXTURE_DIR, name + '.tex')
+                expected = without_blank_lines(latextomarkdown.ReadAndConvertLatexFile(filename))
+                for (fixture, regexoutput, tokenizeroutput, reason) in KNOWN_DIFFERENCES:
+                    if (fixture == name):
+                        # a difference that is gone should be removed from the list
+                        self.assertIn(regexoutput, expected, reason)
+                        expected = expected.replace(regexoutput, tokenizeroutput, 1)
+                result = latextomarkdown.ReadAndConvertLatexFile(filename, backend="tokenizer")
+                self.assertEqual(without_blank_lines(result), expected)
+
+
+if __name__ == '__main__':
+    if '--regenerate' in sys.argv:
+        for name in get_fixture_names():
+            with open(os.path.join(FIXTURE_DIR, name + '.md'), 'w') as f:
+                f.write(convert_fixture(name))
+    else:
+        unittest.main()
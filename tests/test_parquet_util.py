@@ -0,0 +1,148 @@
+"""
+Parquet exports
+
+Images are deduplicated into a side table keyed by content hash, and can get a thumbnail
+column. Papers are written into one Hive-partitioned dataset by many processes at once. The
+tests check that the manifest lists exactly the data files on disk afterwards, and that a
+re-export into other partitions leaves no empty partition directories behind.
+"""
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import pyarrow.parquet as pq
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from doc2json.utils.parquet_util import save_to_dataset, load_manifest, build_manifest, split_images, \
+    add_thumbnails, save_to_parquet, get_image_table_path, IMAGE_KEY, IMAGE_HASH_KEY, THUMBNAIL_KEY
+
+
+NUM_PAPERS = 24
+
+
+def make_records(paper_id, year):
+    return [
+        {"paper_id": paper_id, "year": year, "数据类型": kind, "文本": f'{paper_id} {kind} {i}'}
+        for i, kind in enumerate(('段落', '段落', '公式'))
+    ]
+
+
+def export_paper(args):
+    root_dir, paper_id, year = args
+    return save_to_dataset(make_records(paper_id, year), root_dir, paper_id)
+
+
+def make_image(color, size=(64, 32)):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, format='PNG')
+    return out.getvalue()
+
+
+def make_image_records():
+    red = make_image('red')
+    blue = make_image('blue')
+    # the same figure referenced twice shares one bytes object, another figure file has
+    # equal bytes in a different object
+    return [
+        {"数据类型": 'text', "文本": 'a', IMAGE_KEY: None},
+        {"数据类型": 'figure', "文本": 'b', IMAGE_KEY: red},
+        {"数据类型": 'figure', "文本": 'c', IMAGE_KEY: red},
+        {"数据类型": 'figure', "文本": 'd', IMAGE_KEY: bytes(bytearray(red))},
+        {"数据类型": 'figure', "文本": 'e', IMAGE_KEY: blue},
+    ]
+
+
+def get_data_files(root_dir):
+    return sorted(
+        os.path.relpath(os.path.join(dirpath, f), root_dir)
+        for dirpath, _, filenames in os.walk(root_dir) for f in filenames if f.endswith('.parquet')
+    )
+
+
+class TestImages(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_split_images(self):
+        records = make_image_records()
+        block_records, image_records = split_images(records)
+        self.assertEqual(len(image_records), 2)
+        self.assertEqual({record[IMAGE_KEY] for record in image_records}, {records[1][IMAGE_KEY], records[4][IMAGE_KEY]})
+        hashes = [record[IMAGE_HASH_KEY] for record in block_records]
+        self.assertIsNone(hashes[0])
+        self.assertEqual(hashes[1], hashes[2])
+        self.assertEqual(hashes[1], hashes[3])
+        self.assertNotEqual(hashes[1], hashes[4])
+        # block rows keep only the hash
+        self.assertTrue(all(record[IMAGE_KEY] is None for record in block_records))
+        self.assertEqual([record["文本"] for record in block_records], ['a', 'b', 'c', 'd', 'e'])
+        # the input records are left alone
+        self.assertIsNotNone(records[1][IMAGE_KEY])
+        self.assertNotIn(THUMBNAIL_KEY, image_records[0])
+
+    def test_add_thumbnails(self):
+        records = add_thumbnails(make_image_records(), 16)
+        self.assertIsNone(records[0][THUMBNAIL_KEY])
+        for record in records[1:]:
+            thumbnail = Image.open(io.BytesIO(record[THUMBNAIL_KEY]))
+            self.assertLessEqual(max(thumbnail.size), 16)
+        # rows sharing an image share its thumbnail
+        self.assertIs(records[1][THUMBNAIL_KEY], records[2][THUMBNAIL_KEY])
+        self.assertIn(IMAGE_KEY, records[1])
+
+    def test_join_side_table(self):
+        records = make_image_records()
+        output_path = os.path.join(self.tmp_dir, 'paper.parquet')
+        save_to_parquet(records, output_path, dedup_images=True, thumbnail_size=16)
+        blocks = pq.read_table(output_path)
+        images = pq.read_table(get_image_table_path(output_path))
+        self.assertEqual(images.num_rows, 2)
+        self.assertEqual(images.column_names, [IMAGE_HASH_KEY, IMAGE_KEY, THUMBNAIL_KEY])
+        self.assertEqual(blocks.column(IMAGE_KEY).null_count, len(records))
+
+        joined = blocks.drop_columns([IMAGE_KEY]).join(images, IMAGE_HASH_KEY).sort_by('文本').to_pylist()
+        self.assertEqual(
+            [(row["文本"], row[IMAGE_KEY]) for row in joined],
+            [(record["文本"], record[IMAGE_KEY]) for record in records]
+        )
+        for row in joined[1:]:
+            self.assertLessEqual(max(Image.open(io.BytesIO(row[THUMBNAIL_KEY])).size), 16)
+
+
+class TestSaveToDataset(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_concurrent_exports(self):
+        tasks = [(self.root_dir, f'paper{i}', 2000 + i % 3) for i in range(NUM_PAPERS)]
+        with multiprocessing.get_context('spawn').Pool(4) as pool:
+            pool.map(export_paper, tasks, chunksize=1)
+        manifest = load_manifest(self.root_dir)
+        self.assertEqual(sorted(manifest["files"]), get_data_files(self.root_dir))
+        self.assertEqual(manifest["num_rows"], NUM_PAPERS * 3)
+        self.assertEqual(build_manifest(self.root_dir), manifest)
+
+    def test_reexport_removes_empty_partitions(self):
+        export_paper((self.root_dir, 'paper0', 2000))
+        export_paper((self.root_dir, 'paper1', 2000))
+        export_paper((self.root_dir, 'paper0', 2001))
+        self.assertEqual(sorted(os.listdir(self.root_dir)), ['_manifest.json', '_manifest.lock', 'year=2000', 'year=2001'])
+        # paper0 moved on to 2001, paper1 still has its files in 2000
+        export_paper((self.root_dir, 'paper1', 2001))
+        self.assertEqual(sorted(os.listdir(self.root_dir)), ['_manifest.json', '_manifest.lock', 'year=2001'])
+        self.assertEqual(sorted(load_manifest(self.root_dir)["files"]), get_data_files(self.root_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
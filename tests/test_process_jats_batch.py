@@ -0,0 +1,91 @@
+"""
+Resuming batch JATS conversions
+
+A killed run leaves its last shard as <shard>.jsonl.partial, with ledger records that point
+to it. The tests kill runs by renaming their last shard back to .partial, and check that
+the runs after them convert every article into exactly one shard.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from doc2json.jats2json.process_jats_batch import process_jats_batch, remove_partial_shards, LEDGER_NAME, \
+    PARTIAL_SUFFIX
+from doc2json.utils.batch_util import Ledger
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'jats', 'short_report.nxml')
+ARTICLES = ('a', 'b', 'c', 'd', 'e')
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        self.inputs = []
+        for name in ARTICLES:
+            path = os.path.join(self.tmp_dir, name + '.nxml')
+            shutil.copy(FIXTURE, path)
+            self.inputs.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_batch(self, inputs):
+        return process_jats_batch(inputs, self.output_dir, workers=1, shard_size=2, progress=False)
+
+    def kill_last_shard(self):
+        # as if the run was killed before closing its last shard
+        shard = max(name for name in os.listdir(self.output_dir) if name.startswith('shard-'))
+        path = os.path.join(self.output_dir, shard)
+        os.rename(path, path + PARTIAL_SUFFIX)
+
+    def get_shard_contents(self):
+        contents = {}
+        for name in sorted(os.listdir(self.output_dir)):
+            if name.startswith('shard-') and not name.endswith(PARTIAL_SUFFIX):
+                with open(os.path.join(self.output_dir, name), 'r') as f:
+                    contents[name] = [json.loads(line)["paper_id"] for line in f]
+        return contents
+
+    def assert_converted_once(self):
+        contents = self.get_shard_contents()
+        paper_ids = [paper_id for shard in contents.values() for paper_id in shard]
+        self.assertEqual(sorted(paper_ids), list(ARTICLES))
+        for key, record in Ledger.load(os.path.join(self.output_dir, LEDGER_NAME)).items():
+            self.assertEqual(record["status"], 'done')
+            self.assertIn(os.path.basename(key)[:-len('.nxml')], contents[record["shard"]])
+        self.assertEqual(self.run_batch(self.inputs), {"done": 0, "failed": 0, "skipped": len(ARTICLES)})
+
+    def test_resume_after_kill(self):
+        self.run_batch(self.inputs[:3])
+        self.kill_last_shard()
+        counts = self.run_batch(self.inputs)
+        self.assertEqual(counts, {"done": 3, "failed": 0, "skipped": 2})
+        self.assert_converted_once()
+
+    def test_shard_of_killed_run_is_not_reused(self):
+        self.run_batch(self.inputs[:3])
+        self.kill_last_shard()
+        # a run with other articles, the shard of the killed run's article mustn't be reused
+        self.run_batch(self.inputs[3:])
+        self.run_batch(self.inputs)
+        self.assert_converted_once()
+
+    def test_resume_after_two_kills(self):
+        self.run_batch(self.inputs[:3])
+        self.kill_last_shard()
+        # the second run is killed before it writes a shard, its partial shards are gone
+        remove_partial_shards(self.output_dir)
+        self.run_batch(self.inputs[3:])
+        self.run_batch(self.inputs)
+        self.assert_converted_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Per-request isolation of uploads
+
+A failed GROBID call logs to failed.log in the temp dir of the upload, not in the shared
+working directory of the service.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from doc2json.flask.uploads import process_upload
+from doc2json.grobid2json.grobid.grobid_client import DEFAULT_GROBID_CONFIG
+
+
+class FailingGrobidHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(500)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestProcessUpload(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.server = HTTPServer(('localhost', 0), FailingGrobidHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_failed_pdf_logs_in_work_dir(self):
+        grobid_config = dict(DEFAULT_GROBID_CONFIG, grobid_port=str(self.server.server_port))
+        input_file = os.path.join(self.tmp_dir, 'paper.pdf')
+        with open(input_file, 'wb') as f:
+            f.write(b'%PDF-1.4 not really a paper')
+        work_dir = os.path.join(self.tmp_dir, 'work')
+
+        # GROBID returns no TEI, so the conversion that follows fails too
+        with self.assertRaises(Exception):
+            process_upload('pdf', 'paper.pdf', input_file, work_dir, grobid_config=grobid_config)
+        self.assertTrue(os.path.isfile(os.path.join(work_dir, 'temp', 'failed.log')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'temp')))
+
+
+if __name__ == '__main__':
+    unittest.main()